@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Ingestion Benchmark for Solar Monitor
+Measures the collection -> parse -> SQLite path of both collectors
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Runs src/data_collector.py and simple_data_collector.py against the bundled
+PVS6 simulator (src/pvs_simulator.py) and throwaway databases pre-filled to
+different sizes. Every (pipeline, size) case runs in its own process so
+peak RSS and module state are per case. Results go to a JSON file:
+
+    python benchmark_ingest.py --cycles 100 --inverters 24 \\
+        --sizes 0,100000,1000000 --output benchmark_results.json
+
+Per case it reports end-to-end cycle latency (p50/p99 of collect_data()),
+stage latencies (PVSClient.get_system_summary, device-row extraction,
+the single-transaction insert), rows/sec, commit latency and peak RSS.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(ROOT, 'src')
+
+PIPELINES = {
+    'data_collector': 'data_collector',          # src/data_collector.py
+    'simple_data_collector': 'simple_data_collector',  # ./simple_data_collector.py
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile (no numpy on the Pi)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(values):
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50),
+        'p99_ms': percentile(values, 99),
+        'max_ms': max(values) if values else None,
+        'mean_ms': sum(values) / len(values) if values else None,
+    }
+
+
+def prefill(db_path, device_rows, inverters):
+    """Fill the database with ``device_rows`` inverter rows of 1-minute history"""
+    if not device_rows:
+        return
+    minutes = max(1, device_rows // inverters)
+    start = datetime.now() - timedelta(minutes=minutes)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    batch_system, batch_devices = [], []
+
+    def flush():
+        # system_status/solar_data are views over site_samples: one row per sample
+        conn.executemany("""
+            INSERT INTO site_samples (timestamp, production_kw, consumption_kw, net_export_kw, ts_epoch)
+            VALUES (?, ?, ?, ?, ?)
+        """, batch_system)
+        # device_data is the decoding view over device_samples; its trigger encodes
+        conn.executemany("""
+            INSERT INTO device_data
+            (timestamp, device_id, device_type, status, power_kw, voltage, current_a, frequency, temperature)
+            VALUES (?, ?, 'inverter', 'working', ?, 240.0, 1.0, 60.0, 35.0)
+        """, batch_devices)
+        conn.commit()
+        batch_system.clear()
+        batch_devices.clear()
+
+    for minute in range(minutes):
+        moment = start + timedelta(minutes=minute)
+        ts = moment.isoformat()
+        batch_system.append((ts, 3.0, 1.5, 1.5, int(moment.timestamp())))
+        for i in range(inverters):
+            batch_devices.append((ts, f"E00122{1000000 + i:09d}", 0.25))
+        if len(batch_devices) >= 50000:
+            flush()
+    flush()
+    conn.close()
+
+
+# ----------------------------------------------------------------------
+# Worker: one (pipeline, size) case in a fresh process
+# ----------------------------------------------------------------------
+def run_case(args):
+    sys.path.insert(0, SRC)
+    sys.path.insert(1, ROOT)
+    module = __import__(PIPELINES[args.pipeline])
+    from pvs_client import get_shared_client
+
+    workdir = tempfile.mkdtemp(prefix='solar_bench_')
+    module.DB_PATH = os.path.join(workdir, 'solar_data.db')
+    module._writer = None
+    module._buffer = None
+    module.ensure_tables()
+
+    started = time.perf_counter()
+    prefill(module.DB_PATH, args.size, args.inverters)
+    prefill_seconds = time.perf_counter() - started
+
+    writer = module.get_writer()
+    buffer = module.get_buffer()
+    client = get_shared_client()
+    sink = io.StringIO()
+
+    # Warm-up: connections, page cache, first-import costs
+    with contextlib.redirect_stdout(sink):
+        module.collect_data()
+
+    cycle_ms, commit_ms = [], []
+    rows_before = writer.stats['rows']
+    write_seconds_before = writer.stats['write_seconds']
+    loop_started = time.perf_counter()
+    for _ in range(args.cycles):
+        sink.seek(0)
+        sink.truncate()
+        transactions = writer.stats['transactions']
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            module.collect_data()
+        cycle_ms.append((time.perf_counter() - started) * 1000)
+        if writer.stats['transactions'] > transactions:
+            commit_ms.append(writer.stats['last_commit_ms'])
+    loop_seconds = time.perf_counter() - loop_started
+    rows = writer.stats['rows'] - rows_before
+    write_seconds = writer.stats['write_seconds'] - write_seconds_before
+
+    # Stage breakdown on the same database
+    stages = {'fetch': [], 'summary': [], 'device_rows': [], 'insert': []}
+    from storage import make_cycle
+    for _ in range(args.cycles):
+        with contextlib.redirect_stdout(sink):
+            started = time.perf_counter()
+            snapshot = client.get_snapshot()
+            stages['fetch'].append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            summary = client.get_system_summary(snapshot)
+            stages['summary'].append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            devices = module.build_device_rows(snapshot)
+            stages['device_rows'].append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            writer.write_cycles([make_cycle(snapshot.timestamp, {
+                'production_kw': summary['total_production_kw'],
+                'consumption_kw': summary['total_consumption_kw'],
+                'net_export_kw': summary['net_export_kw'],
+            }, devices)])
+            stages['insert'].append((time.perf_counter() - started) * 1000)
+        sink.seek(0)
+        sink.truncate()
+
+    with contextlib.redirect_stdout(sink):
+        buffer.close()
+    writer.close()
+    db_bytes = sum(os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir))
+
+    result = {
+        'pipeline': args.pipeline,
+        'db_size_device_rows': args.size,
+        'inverters': args.inverters,
+        'cycles': args.cycles,
+        'prefill_seconds': prefill_seconds,
+        'db_bytes': db_bytes,
+        'cycle_latency': latency_summary(cycle_ms),
+        'commit_latency': latency_summary(commit_ms),
+        'stages': {name: latency_summary(values) for name, values in stages.items()},
+        'rows_written': rows,
+        'rows_per_sec': rows / loop_seconds if loop_seconds else None,
+        'rows_per_sec_in_transaction': rows / write_seconds if write_seconds else None,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                       // (1024 if sys.platform == 'darwin' else 1),
+    }
+    with open(args.result_file, 'w') as f:
+        json.dump(result, f)
+
+    for name in os.listdir(workdir):
+        os.remove(os.path.join(workdir, name))
+    os.rmdir(workdir)
+
+
+# ----------------------------------------------------------------------
+# Driver
+# ----------------------------------------------------------------------
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Solar Monitor ingestion benchmark')
+    parser.add_argument('--pipelines', default=','.join(PIPELINES),
+                        help='Comma separated: ' + ', '.join(PIPELINES))
+    parser.add_argument('--sizes', default='0,100000,1000000',
+                        help='Pre-filled device_data rows per case, comma separated')
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--inverters', type=int, default=24)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Simulated gateway latency')
+    parser.add_argument('--output', default='benchmark_results.json')
+    # Internal: worker mode
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--pipeline', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_case(args)
+        return
+
+    sys.path.insert(0, SRC)
+    from pvs_simulator import PVSSimulator, SimClock, SyntheticFleet
+
+    # Midday on the simulated clock so every inverter reports production
+    noon = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    simulator = PVSSimulator(SyntheticFleet(args.inverters, SimClock(1.0, noon.timestamp())),
+                             port=0, latency_ms=args.latency_ms).start()
+    env = dict(os.environ,
+               PVS6_IP_ADDRESS='127.0.0.1',
+               PVS6_PORT=str(simulator.port),
+               WEATHER_ENABLED='false',
+               WRITE_BUFFER_MAX_SAMPLES='1',
+               WRITE_JOURNAL_PATH='')
+
+    pipelines = [p.strip() for p in args.pipelines.split(',') if p.strip()]
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    results = []
+    print(f"🏁 Benchmarking {pipelines} x sizes {sizes}: {args.cycles} cycles, "
+          f"{args.inverters} inverters, simulator on port {simulator.port}")
+    try:
+        for size in sizes:
+            for pipeline in pipelines:
+                with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+                    result_file = tmp.name
+                cmd = [sys.executable, os.path.abspath(__file__), '--worker',
+                       '--pipeline', pipeline, '--size', str(size),
+                       '--cycles', str(args.cycles), '--inverters', str(args.inverters),
+                       '--result-file', result_file]
+                proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+                if proc.returncode != 0:
+                    print(f"❌ {pipeline} @ {size} rows failed:\n{proc.stderr[-2000:]}")
+                    os.remove(result_file)
+                    continue
+                with open(result_file) as f:
+                    result = json.load(f)
+                os.remove(result_file)
+                results.append(result)
+                print(f"✅ {pipeline:<22} {size:>9} rows: "
+                      f"cycle p50 {result['cycle_latency']['p50_ms']:.1f}ms "
+                      f"p99 {result['cycle_latency']['p99_ms']:.1f}ms, "
+                      f"commit p50 {result['commit_latency']['p50_ms']:.2f}ms, "
+                      f"{result['rows_per_sec']:.0f} rows/s, "
+                      f"RSS {result['peak_rss_kb'] / 1024:.1f}MB")
+    finally:
+        simulator.stop()
+
+    report = {
+        'generated_at': datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'parameters': {
+            'cycles': args.cycles,
+            'inverters': args.inverters,
+            'sizes': sizes,
+            'latency_ms': args.latency_ms,
+        },
+        'simulator': dict(simulator.stats),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ Uses the original PVSClient that was successfully getting real data
 
 import sys
 import os
+import signal
 import time
 import sqlite3
 from datetime import datetime
@@ -33,18 +34,60 @@ load_env_file()
 # Add the current directory to Python path to import modules
 sys.path.append('/opt/solar_monitor')
 
+# The collector modules (storage, migrations, config, ...) live in src/. Put it
+# first: this directory's own config.py is the old small Config, and picking it
+# up instead of src/config.py fails with "'Config' object has no attribute ..."
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
 try:
-    from pvs_client import PVSClient
+    from pvs_client import PVSClient, get_shared_client
     print("✅ Successfully imported PVSClient")
     USE_REAL_PVS = True
 except ImportError as e:
     print(f"❌ Could not import PVSClient: {e}")
     USE_REAL_PVS = False
 
+from storage import CycleWriter, WriteBehindBuffer, make_cycle
+from scheduler import AdaptiveScheduler
+from migrations import migrate as migrate_schema
+from compression import DeadbandCompressor
+from partitions import PartitionSet
+from raw_archive import ArchiveWriter
+from site_samples import create_site_samples
+from devices import create_device_samples
+from maintenance import ensure_auto_vacuum
+from config import config
+
+DB_PATH = '/opt/solar_monitor/solar_data.db'
+
+# Long-lived writer: every cycle is one transaction on one connection
+_writer = None
+
+def get_writer():
+    """Process-wide CycleWriter"""
+    global _writer
+    if _writer is None:
+        # Deadband compression (COMPRESSION_ENABLED) and monthly partition
+        # files (STORAGE_MODE=partitioned) are opt-in
+        _writer = CycleWriter(DB_PATH, compressor=DeadbandCompressor.from_config(),
+                              partitions=PartitionSet.from_config(DB_PATH),
+                              archive=ArchiveWriter.from_config())
+    return _writer
+
+# Write-behind buffer in front of the writer: group commits, rides out
+# "database is locked", spills to a journal if SQLite stays unavailable
+_buffer = None
+
+def get_buffer():
+    """Process-wide WriteBehindBuffer (flusher thread started on first use)"""
+    global _buffer
+    if _buffer is None:
+        _buffer = WriteBehindBuffer.from_config(get_writer()).start()
+    return _buffer
+
 def get_db_connection():
     """Simple database connection"""
-    db_path = '/opt/solar_monitor/solar_data.db'
-    conn = sqlite3.connect(db_path, timeout=10.0, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, timeout=10.0, check_same_thread=False)
     conn.execute('PRAGMA journal_mode=WAL')
     conn.execute('PRAGMA busy_timeout=5000')
     return conn
@@ -54,46 +97,16 @@ def ensure_tables():
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Create system_status table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS system_status (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            production_kw REAL DEFAULT 0,
-            consumption_kw REAL DEFAULT 0,
-            net_export_kw REAL DEFAULT 0,
-            grid_frequency REAL DEFAULT 60.0,
-            voltage REAL DEFAULT 240.0
-        )
-    """)
+    # A new database gets auto_vacuum=INCREMENTAL before its first table
+    ensure_auto_vacuum(conn)
     
-    # Create solar_data table with device_id column
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS solar_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            production_kw REAL DEFAULT 0,
-            consumption_kw REAL DEFAULT 0,
-            net_export_kw REAL DEFAULT 0,
-            device_id TEXT DEFAULT NULL
-        )
-    """)
+    # One site-level table; system_status/solar_data are views over it
+    # (created by the migrations below)
+    create_site_samples(conn)
     
-    # Create device_data table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS device_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            device_id TEXT,
-            device_type TEXT DEFAULT 'inverter',
-            status TEXT DEFAULT 'working',
-            power_kw REAL DEFAULT 0,
-            voltage REAL DEFAULT 240.0,
-            current_a REAL DEFAULT 0,
-            frequency REAL DEFAULT 60.0,
-            temperature REAL DEFAULT 25.0
-        )
-    """)
+    # Dictionary-encoded device samples; device_data is a view over them
+    # (created by the migrations below, like the registry tables)
+    create_device_samples(conn)
     
     # Create weather_data table
     cursor.execute("""
@@ -121,31 +134,29 @@ def ensure_tables():
     """)
     
     # Create indexes for better performance
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON solar_data(timestamp)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_device_timestamp ON device_data(device_id, timestamp)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_weather_timestamp ON weather_data(timestamp)")
     
     conn.commit()
     conn.close()
+    
+    # Indexed integer ts_epoch columns (backfilled in chunks on first run)
+    migrate_schema(DB_PATH)
 
 def collect_data_from_pvs():
-    """Collect real data using the original PVSClient"""
+    """Collect real data from ONE DeviceList snapshot"""
     try:
-        pvs_client = PVSClient()
+        pvs_client = get_shared_client()
         
-        # Test connection first
-        if not pvs_client.test_connection():
+        # A single fetch doubles as the connection test
+        snapshot = pvs_client.get_snapshot()
+        if not snapshot.pvs_online:
             print("❌ PVS connection test failed")
             return None
             
-        print("✅ PVS connection test successful")
+        print(f"✅ Got {snapshot.device_count} REAL devices from PVS")
         
-        # Get system summary with real data
-        summary = pvs_client.get_system_summary()
-        
-        # Get individual device data
-        devices = pvs_client.get_device_list()
-        print(f"✅ Got {len(devices)} REAL devices from PVS")
+        # System summary is derived from the same snapshot
+        summary = pvs_client.get_system_summary(snapshot)
         
         if summary and summary.get('system_online', False):
             production_kw = summary.get('total_production_kw', 0)
@@ -159,7 +170,7 @@ def collect_data_from_pvs():
                 'consumption_kw': consumption_kw,
                 'net_export_kw': net_export_kw,
                 'source': 'pvs6_real_original',
-                'devices': devices  # Include device data
+                'snapshot': snapshot  # Device rows are derived from this
             }
         else:
             print("❌ PVS system not online or no data available")
@@ -169,64 +180,53 @@ def collect_data_from_pvs():
         print(f"❌ Error collecting PVS data: {e}")
         return None
 
-def store_device_data(devices, timestamp):
-    """Store individual device data in device_data table"""
-    if not devices:
-        return
-        
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def build_device_rows(snapshot):
+    """Per-inverter device_data rows, with sleeping inverters normalised"""
+    rows = []
+    if snapshot is None:
+        return rows
     
-    try:
-        # Process each device
-        for device in devices:
-            device_type = device.get('DEVICE_TYPE', '').lower()
-            device_id = device.get('SERIAL', '')
-            
-            # Only store inverter data (skip meters and gateway)
-            if ('inverter' in device_type or 
-                'inv' in device_id.lower() or 
-                device_type == 'inverter'):
-                
-                # Extract device data
-                power_kw = float(device.get('p_3phsum_kw', 0.0))
-                voltage = float(device.get('vln_3phavg_v', 240.0))
-                current_a = float(device.get('i_3phsum_a', 0.0))
-                frequency = float(device.get('freq_hz', 60.0))
-                temperature = float(device.get('temperature', 25.0))
-                status = device.get('STATE', 'unknown').lower()
-                
-                # Map PVS6 status to our status and adjust values for sleeping inverters
-                if status == 'working' and power_kw > 0:
-                    status = 'working'
-                    # Keep actual values for working inverters
-                elif status == 'error' or power_kw == 0:
-                    status = 'sleeping'  # Nighttime/no production
-                    # Realistic values for sleeping inverters
-                    voltage = 0.0      # No voltage when sleeping
-                    current_a = 0.0    # No current when sleeping
-                    frequency = 0.0    # No frequency when sleeping
-                    temperature = None # Unknown temperature when sleeping
-                else:
-                    status = 'unknown'
-                
-                # Insert device data
-                cursor.execute("""
-                    INSERT INTO device_data 
-                    (timestamp, device_id, device_type, status, power_kw, voltage, current_a, frequency, temperature)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (timestamp, device_id, 'inverter', status, power_kw, voltage, current_a, frequency, temperature))
-                
-                print(f"📊 Stored inverter {device_id}: {power_kw:.3f}kW, {status}")
+    # Process each inverter (meters and gateway are skipped by the snapshot)
+    for row in snapshot.inverter_rows(by_serial=True):
+        power_kw = row['power_kw']
+        voltage = row['voltage']
+        current_a = row['current_a']
+        frequency = row['frequency']
+        temperature = row['temperature']
+        status = row['state']
         
-        conn.commit()
-        print(f"✅ Stored {len([d for d in devices if 'inverter' in d.get('DEVICE_TYPE', '').lower()])} inverter records")
+        # Map PVS6 status to our status and adjust values for sleeping inverters
+        if status == 'working' and power_kw > 0:
+            status = 'working'
+            # Keep actual values for working inverters
+        elif status == 'error' or power_kw == 0:
+            status = 'sleeping'  # Nighttime/no production
+            # Realistic values for sleeping inverters
+            voltage = 0.0      # No voltage when sleeping
+            current_a = 0.0    # No current when sleeping
+            frequency = 0.0    # No frequency when sleeping
+            temperature = None # Unknown temperature when sleeping
+        else:
+            status = 'unknown'
         
-    except Exception as e:
-        print(f"❌ Error storing device data: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        rows.append({
+            'device_id': row['device_id'],
+            'device_type': 'inverter',
+            'status': status,
+            'power_kw': power_kw,
+            'voltage': voltage,
+            'current_a': current_a,
+            'frequency': frequency,
+            'temperature': temperature,
+            'attributes': row.get('attributes'),
+        })
+    return rows
+
+def raw_devices(snapshot):
+    """DeviceList entries for the raw archive (none for a stale/offline snapshot)"""
+    if snapshot is None or not snapshot.pvs_online or snapshot.stale:
+        return []
+    return snapshot.raw_devices()
 
 def generate_fallback_data():
     """Generate realistic fallback data when PVS is not available"""
@@ -249,8 +249,8 @@ def generate_fallback_data():
         'source': 'fallback_simulated'
     }
 
-def collect_weather_data():
-    """Collect and store weather data"""
+def fetch_weather_data():
+    """Fetch current weather; returns weather_info or None"""
     try:
         # Get weather configuration from environment
         weather_enabled = os.getenv('WEATHER_ENABLED', 'true').lower() == 'true'
@@ -260,156 +260,114 @@ def collect_weather_data():
         
         if not weather_enabled or not weather_api_key:
             print("⚠️  Weather collection disabled or API key not configured")
-            return
+            return None
         
         # Call OpenWeatherMap API
         url = f"https://api.openweathermap.org/data/2.5/weather?lat={weather_lat}&lon={weather_lon}&appid={weather_api_key}&units=metric"
         
         response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            weather_data = response.json()
-            
-            # Extract weather information
-            weather_info = {
-                'temperature': weather_data['main']['temp'],
-                'feels_like': weather_data['main']['feels_like'],
-                'humidity': weather_data['main']['humidity'],
-                'pressure': weather_data['main']['pressure'],
-                'visibility': weather_data.get('visibility', 0) / 1000,  # Convert to km
-                'uv_index': weather_data.get('uvi', 0),
-                'clouds': weather_data['clouds']['all'],
-                'wind_speed': weather_data['wind']['speed'],
-                'wind_direction': weather_data['wind'].get('deg', 0),
-                'weather_main': weather_data['weather'][0]['main'],
-                'weather_description': weather_data['weather'][0]['description'],
-                'weather_icon': weather_data['weather'][0]['icon'],
-                'sunrise': weather_data['sys']['sunrise'],
-                'sunset': weather_data['sys']['sunset'],
-                'city': weather_data['name'],
-                'country': weather_data['sys']['country']
-            }
-            
-            # Store in database
-            conn = get_db_connection()
-            if conn:
-                cursor = conn.cursor()
-                timestamp = datetime.now().isoformat()
-                
-                cursor.execute('''
-                    INSERT INTO weather_data (
-                        timestamp, temperature, feels_like, humidity, pressure, visibility, uv_index,
-                        clouds, wind_speed, wind_direction, weather_main, weather_description,
-                        weather_icon, sunrise, sunset, city, country, api_response
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    timestamp,
-                    weather_info['temperature'],
-                    weather_info['feels_like'],
-                    weather_info['humidity'],
-                    weather_info['pressure'],
-                    weather_info['visibility'],
-                    weather_info['uv_index'],
-                    weather_info['clouds'],
-                    weather_info['wind_speed'],
-                    weather_info['wind_direction'],
-                    weather_info['weather_main'],
-                    weather_info['weather_description'],
-                    weather_info['weather_icon'],
-                    weather_info['sunrise'],
-                    weather_info['sunset'],
-                    weather_info['city'],
-                    weather_info['country'],
-                    json.dumps(weather_info)
-                ))
-                
-                conn.commit()
-                conn.close()
-                
-                print(f"✅ Weather data stored: {weather_info['city']} - {weather_info['temperature']:.1f}°C, {weather_info['weather_description']}")
-            else:
-                print("❌ Failed to connect to database for weather data")
-                
-        else:
+        if response.status_code != 200:
             print(f"❌ Weather API error: {response.status_code}")
+            return None
+        
+        weather_data = response.json()
+        
+        # Extract weather information
+        return {
+            'temperature': weather_data['main']['temp'],
+            'feels_like': weather_data['main']['feels_like'],
+            'humidity': weather_data['main']['humidity'],
+            'pressure': weather_data['main']['pressure'],
+            'visibility': weather_data.get('visibility', 0) / 1000,  # Convert to km
+            'uv_index': weather_data.get('uvi', 0),
+            'clouds': weather_data['clouds']['all'],
+            'wind_speed': weather_data['wind']['speed'],
+            'wind_direction': weather_data['wind'].get('deg', 0),
+            'weather_main': weather_data['weather'][0]['main'],
+            'weather_description': weather_data['weather'][0]['description'],
+            'weather_icon': weather_data['weather'][0]['icon'],
+            'sunrise': weather_data['sys']['sunrise'],
+            'sunset': weather_data['sys']['sunset'],
+            'city': weather_data['name'],
+            'country': weather_data['sys']['country']
+        }
             
     except requests.exceptions.RequestException as e:
         print(f"❌ Weather API request failed: {e}")
     except Exception as e:
         print(f"❌ Error collecting weather data: {e}")
+    return None
 
-def collect_data():
-    """Main data collection function"""
+def collect_data(timestamp=None):
+    """Main data collection function; ``timestamp`` is the scheduled grid time"""
     try:
         print(f"[{datetime.now()}] 🔌 Attempting to collect data from PVS6...")
+        snapshot = None
         
         # Try to get real PVS data first (if PVSClient is available)
-        if USE_REAL_PVS:
-            pvs_data = collect_data_from_pvs()
+        pvs_data = collect_data_from_pvs() if USE_REAL_PVS else None
+        system = None
+        
+        if pvs_data:
+            # Use real PVS data
+            production_kw = pvs_data['production_kw']
+            consumption_kw = pvs_data['consumption_kw']
+            net_export_kw = pvs_data['net_export_kw']
+            data_source = pvs_data['source']
+            snapshot = pvs_data['snapshot']
             
-            if pvs_data:
-                # Use real PVS data
-                production_kw = pvs_data['production_kw']
-                consumption_kw = pvs_data['consumption_kw']
-                net_export_kw = pvs_data['net_export_kw']
-                data_source = pvs_data['source']
-                devices = pvs_data.get('devices', [])
-                
-                print(f"✅ REAL PVS6 Data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
-                
-                # Store individual device data if available
-                if devices:
-                    timestamp = datetime.now().isoformat()
-                    store_device_data(devices, timestamp)
-            else:
-                # Fall back to simulated data
-                fallback = generate_fallback_data()
-                production_kw = fallback['production_kw']
-                consumption_kw = fallback['consumption_kw']
-                net_export_kw = fallback['net_export_kw']
-                data_source = fallback['source']
-                devices = []
-                
-                print(f"⚠️  PVS6 not available - using fallback data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
-        else:
-            # PVSClient not available, use simulated data
+            print(f"✅ REAL PVS6 Data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
+        elif config.simulated_fallback:
+            # Simulated data only when explicitly asked for (demo/dev)
             fallback = generate_fallback_data()
             production_kw = fallback['production_kw']
             consumption_kw = fallback['consumption_kw']
             net_export_kw = fallback['net_export_kw']
             data_source = fallback['source']
-            devices = []
             
-            print(f"⚠️  PVSClient not available - using fallback data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
+            print(f"⚠️  PVS6 not available - using fallback data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
+        else:
+            # Leave a gap rather than writing made-up numbers into real tables
+            data_source = 'pvs6_offline'
+            print("⚠️  PVS6 not available - no solar sample stored this cycle")
         
-        # Store in database
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if data_source != 'pvs6_offline':
+            system = {
+                'production_kw': production_kw,
+                'consumption_kw': consumption_kw,
+                'net_export_kw': net_export_kw,
+            }
         
-        timestamp = datetime.now().isoformat()
+        # Collect weather data at the same frequency as solar data
+        weather_info = fetch_weather_data()
         
-        # Insert into system_status
-        cursor.execute("""
-            INSERT INTO system_status (timestamp, production_kw, consumption_kw, net_export_kw)
-            VALUES (?, ?, ?, ?)
-        """, (timestamp, production_kw, consumption_kw, net_export_kw))
+        # System totals, inverter rows and weather in ONE transaction
+        if timestamp is None:
+            timestamp = snapshot.timestamp if snapshot is not None else datetime.now().isoformat()
+        devices = build_device_rows(snapshot)
+        cycle = make_cycle(timestamp, system, devices, weather_info, raw=raw_devices(snapshot))
         
-        # Insert into solar_data for compatibility
-        cursor.execute("""
-            INSERT INTO solar_data (timestamp, production_kw, consumption_kw, net_export_kw)
-            VALUES (?, ?, ?, ?)
-        """, (timestamp, production_kw, consumption_kw, net_export_kw))
+        buffer = get_buffer()
+        rows = buffer.add(cycle)
         
-        conn.commit()
-        conn.close()
+        if system is not None:
+            print(f"✅ Data stored ({data_source}): {production_kw:.2f}kW, {consumption_kw:.2f}kW, {net_export_kw:.2f}kW")
+        if rows:
+            print(f"✅ Stored {len(devices)} inverter records, {rows} rows total")
+        else:
+            print(f"📥 Buffered cycle, {buffer.get_stats()['pending']} pending")
         
-        print(f"✅ Data stored ({data_source}): {production_kw:.2f}kW, {consumption_kw:.2f}kW, {net_export_kw:.2f}kW")
-        
-        # Collect weather data at the same frequency as solar data
-        collect_weather_data()
+        stats = get_writer().get_stats()
+        if stats['transactions']:
+            print(f"💾 Writer: {stats['rows_per_sec'] or 0:.0f} rows/s, commit {stats['last_commit_ms']:.1f}ms (avg {stats['avg_commit_ms']:.1f}ms)")
         
     except Exception as e:
         print(f"❌ Collection error: {e}")
 
+def _exit_on_sigterm(signum, frame):
+    print("\n🛑 SIGTERM received - flushing buffered data")
+    sys.exit(0)
+
 def main():
     """Main data collector loop"""
     print("🌞 Original Working Solar Data Collector Starting...")
@@ -426,20 +384,34 @@ def main():
         print(f"❌ Database setup error: {e}")
         return
     
-    # Collect initial data
-    collect_data()
+    # Cycles spilled by a previous run go in before anything new
+    get_buffer().replay_journal()
+    
+    # systemctl stop -> SystemExit, so the buffer is flushed below
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    
+    # Samples land on a wall-clock grid whose spacing follows the sun
+    scheduler = AdaptiveScheduler.from_config(DB_PATH)
+    print(f"⏰ Schedule: {scheduler.describe()}")
     
-    # Run collection loop
-    while True:
-        try:
-            time.sleep(60)   # Wait 1 minute
-            collect_data()
-        except KeyboardInterrupt:
-            print("\n🛑 Collector stopped by user")
-            break
-        except Exception as e:
-            print(f"❌ Error: {e}")
-            time.sleep(60)  # Wait 1 minute before retry
+    try:
+        # Collect initial data
+        collect_data()
+        
+        # Run collection loop
+        for scheduled, phase in scheduler.ticks():
+            try:
+                collect_data(scheduled.isoformat())
+            except KeyboardInterrupt:
+                print("\n🛑 Collector stopped by user")
+                break
+            except Exception as e:
+                print(f"❌ Error: {e}")
+    except KeyboardInterrupt:
+        print("\n🛑 Collector stopped by user")
+    finally:
+        get_buffer().close()
+        print(f"💾 Write-behind buffer closed: {get_buffer().get_stats()}")
 
 if __name__ == '__main__':
     main()
@@ -42,27 +42,237 @@ import json
 import os
 import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import sys
 
 # Add src directory to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+# Collector modules (db_pool, rollups, ...) when installed flat in /opt/solar_monitor;
+# once here, not in every helper, or sys.path grows by one entry per request
+if '/opt/solar_monitor' not in sys.path:
+    sys.path.append('/opt/solar_monitor')
 from version import get_version_string, get_full_version_info
 
 app = Flask(__name__)
 DATABASE_PATH = '/opt/solar_monitor/solar_data.db'
 
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Process-wide ConnectionPool for DATABASE_PATH (None if db_pool isn't importable)"""
+    global _pool
+    if _pool is None or _pool.db_path != DATABASE_PATH:
+        try:
+            from db_pool import ConnectionPool
+        except ImportError:
+            return None
+        with _pool_lock:
+            if _pool is None or _pool.db_path != DATABASE_PATH:
+                _pool = ConnectionPool.from_config(DATABASE_PATH, row_factory=sqlite3.Row)
+    return _pool
+
 def get_db_connection():
+    """Pooled read-only connection; close() returns it to the pool"""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        pool = get_pool()
+        if pool is None:
+            conn = sqlite3.connect(DATABASE_PATH, timeout=10.0)
+            conn.row_factory = sqlite3.Row
+            return conn
+        return pool.reader()
     except:
         return None
 
+def get_write_connection():
+    """The web process's single write connection (admin endpoints); close() releases it"""
+    try:
+        pool = get_pool()
+        if pool is None:
+            conn = sqlite3.connect(DATABASE_PATH, timeout=10.0)
+            conn.row_factory = sqlite3.Row
+            return conn
+        return pool.writer()
+    except:
+        return None
+
+@app.teardown_request
+def release_db_connections(exc):
+    """Return pooled connections a handler did not close (e.g. after an exception)"""
+    if _pool is not None:
+        _pool.release_thread()
+
+def attach_partitions(conn, since=None, until=None):
+    """In partitioned mode, attach only the monthly files overlapping [since, until]"""
+    try:
+        from partitions import PartitionSet
+    except ImportError:
+        return conn
+    partitions = PartitionSet.from_config(DATABASE_PATH)
+    if partitions is not None:
+        partitions.open_range(conn, since, until)
+    return conn
+
+def get_range_connection(since=None, until=None):
+    """Read connection for time-series queries over [since, until] (epochs, None = open)"""
+    conn = get_db_connection()
+    if conn is None:
+        return None
+    try:
+        return attach_partitions(conn, since, until)
+    except Exception:
+        conn.close()
+        raise
+
+def get_replica_manager():
+    """ReplicaManager of DATABASE_PATH, or None when the analytics replica is off"""
+    replica = get_replica()
+    return replica.get_manager(DATABASE_PATH) if replica is not None else None
+
+def get_analytics_connection(since=None, until=None):
+    """
+    Read connection for ad-hoc queries (SQL explorer, table browser, exports):
+    the analytics replica when it's on and built, else the live database
+    """
+    manager = get_replica_manager()
+    if manager is not None:
+        conn = manager.connect(since, until)
+        if conn is not None:
+            conn.row_factory = sqlite3.Row
+            return conn
+    return get_range_connection(since, until)
+
+def analytics_source():
+    """Where get_analytics_connection reads and how far behind the live database that is"""
+    manager = get_replica_manager()
+    if manager is None:
+        return {'source': 'live', 'enabled': False}
+    return dict(manager.describe(), enabled=True)
+
+def time_filter_since(time_filter):
+    """Epoch start of a table browser time filter ('all' -> None)"""
+    windows = {'1h': {'hours': 1}, '24h': {'hours': 24}, '7d': {'days': 7}, '30d': {'days': 30}}
+    return since_epoch(**windows[time_filter]) if time_filter in windows else None
+
+# Window that always contains the newest samples ("latest reading" queries)
+LATEST_WINDOW = {'days': 1}
+
+def get_shared_pvs_client():
+    """Process-wide PVSClient, or None when pvs_client isn't importable"""
+    try:
+        from pvs_client import get_shared_client
+        return get_shared_client()
+    except ImportError:
+        return None
+
+def get_compression():
+    """compression module when COMPRESSION_ENABLED, else None"""
+    try:
+        from config import config
+        if not config.compression_enabled:
+            return None
+        import compression
+        return compression
+    except ImportError:
+        return None
+
+def migrate_database():
+    """Add/backfill the indexed ts_epoch columns the range filters use"""
+    try:
+        from migrations import migrate
+        migrate(DATABASE_PATH)
+    except (ImportError, sqlite3.Error) as e:
+        print(f"Error migrating database: {e}")
+
+def local_epoch(timestamp):
+    """Epoch seconds of a local 'YYYY-MM-DD HH:MM:SS' / ISO timestamp"""
+    return int(datetime.fromisoformat(timestamp).timestamp())
+
+def since_epoch(**delta):
+    """Epoch seconds of now minus a timedelta, e.g. since_epoch(hours=24)"""
+    return int(time.time() - timedelta(**delta).total_seconds())
+
+def epoch_timestamp(epoch):
+    """Local ISO timestamp of epoch seconds (None stays None)"""
+    return datetime.fromtimestamp(epoch).isoformat() if epoch is not None else None
+
+def get_rollups():
+    """rollups module (tier planner), or None when it isn't importable"""
+    try:
+        import rollups
+        return rollups
+    except ImportError:
+        return None
+
+def get_retention():
+    """retention module (policy-driven cleanup), or None when it isn't importable"""
+    try:
+        import retention
+        return retention
+    except ImportError:
+        return None
+
+def get_raw_archive():
+    """raw_archive module (DeviceList snapshot archive), or None when it isn't importable"""
+    try:
+        import raw_archive
+        return raw_archive
+    except ImportError:
+        return None
+
+def get_json_fields():
+    """json_fields module (promoted JSON columns), or None when it isn't importable"""
+    try:
+        import json_fields
+        return json_fields
+    except ImportError:
+        return None
+
+# Comparisons the table browser accepts on promoted JSON columns
+FIELD_FILTER_OPS = {'=': '=', '!=': '!=', '>': '>', '>=': '>=', '<': '<', '<=': '<=',
+                    'is_null': 'IS NULL', 'not_null': 'IS NOT NULL'}
+
+def get_maintenance():
+    """maintenance module (checkpoint/optimize/vacuum jobs), or None when it isn't importable"""
+    try:
+        import maintenance
+        return maintenance
+    except ImportError:
+        return None
+
+def get_stats_catalog():
+    """stats_catalog module (trigger-maintained row counts), or None when it isn't importable"""
+    try:
+        import stats_catalog
+        return stats_catalog
+    except ImportError:
+        return None
+
+def get_backup():
+    """backup module (backup API sets), or None when it isn't importable"""
+    try:
+        import backup
+        return backup
+    except ImportError:
+        return None
+
+def get_replica():
+    """replica module (analytics replica), or None when it isn't importable"""
+    try:
+        import replica
+        return replica
+    except ImportError:
+        return None
+
+# Bucket width per historical_data granularity (month/year approximate)
+GRANULARITY_SECONDS = {
+    '30sec': 30, 'minute': 60, '5min': 300, '15min': 900, 'hour': 3600,
+    'day': 86400, 'week': 604800, 'month': 2592000, 'year': 31536000,
+}
+
 def init_weather_table():
     """Initialize weather data table if it doesn't exist"""
-    conn = get_db_connection()
+    conn = get_write_connection()
     if conn:
         try:
             cursor = conn.cursor()
@@ -105,17 +315,23 @@ def init_weather_table():
 
 def store_weather_data(weather_data):
     """Store weather data in the database"""
-    conn = get_db_connection()
-    if conn and weather_data.get('success'):
+    if not weather_data.get('success'):
+        return
+    conn = get_write_connection()
+    if conn:
         try:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO weather_data (
+                    timestamp, ts_epoch,
                     temperature, feels_like, humidity, pressure, visibility, uv_index,
                     clouds, wind_speed, wind_direction, weather_main, weather_description,
                     weather_icon, sunrise, sunset, city, country, api_response
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
+                # Local time like the collectors (not the UTC column default)
+                datetime.now().isoformat(),
+                int(time.time()),
                 weather_data.get('temperature'),
                 weather_data.get('feels_like'),
                 weather_data.get('humidity'),
@@ -1895,6 +2111,12 @@ def get_page_content(page):
         '''
     elif page == 'data':
         return '''
+        <!-- Analytics replica status (where the browser, SQL explorer and exports read) -->
+        <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 20px; padding: 10px 15px; background: #f8f9fa; border-radius: 8px; border-left: 4px solid #6c757d;">
+            <span id="replica-status-text">🗄️ Queries read the live database</span>
+            <button class="btn" id="replica-refresh-btn" onclick="refreshReplica()" style="display: none;">🔄 Refresh Replica</button>
+        </div>
+        
         <!-- Table Browser -->
         <div class="info-card" style="margin-bottom: 30px;">
             <h3>🔍 Table Browser</h3>
@@ -2411,7 +2633,7 @@ LIMIT 50;</textarea>
             <p><em>Note: These tools are located on the System page for security.</em></p>
             <ul style="margin: 15px 0; padding-left: 20px;">
                 <li><strong>Database Cleanup:</strong> Remove old or invalid records</li>
-                <li><strong>Optimize Database:</strong> Run VACUUM to improve performance</li>
+                <li><strong>Optimize Database:</strong> Checkpoint the WAL, refresh statistics and return free pages in the background</li>
                 <li><strong>Create Backup:</strong> Full database backup with timestamp</li>
                 <li><strong>Export All Data:</strong> Complete data export in multiple formats</li>
             </ul>
@@ -4125,6 +4347,7 @@ def get_page_script(page):
                 '• Energy consumption records\\n' +
                 '• Inverter performance history\\n' +
                 '• System status logs\\n\\n' +
+                '📊 Hourly and daily summaries are kept (see RETENTION_POLICY)\\n\\n' +
                 '❌ This action CANNOT be undone!\\n' +
                 '❌ Deleted data CANNOT be recovered!\\n' +
                 '❌ This will affect historical charts and reports!\\n\\n' +
@@ -4142,11 +4365,39 @@ def get_page_script(page):
                 });
                 
                 const data = await response.json();
-                if (data.success) {
-                    showMaintenanceMessage(`Successfully deleted ${data.deleted_records} old records`, 'success');
-                    refreshDbStats();
-                } else {
+                if (!data.success) {
                     showMaintenanceMessage('Cleanup failed: ' + data.error, 'error');
+                    return;
+                }
+                if (!data.started) {
+                    showMaintenanceMessage('A cleanup is already running - showing its progress', 'info');
+                }
+                pollRetention();
+            } catch (error) {
+                showMaintenanceMessage('Cleanup error: ' + error.message, 'error');
+            }
+        }
+        
+        async function pollRetention() {
+            try {
+                const response = await fetch('/api/db/retention');
+                const data = await response.json();
+                const status = data.status;
+                if (!data.success || !status) {
+                    showMaintenanceMessage('Cleanup status unavailable: ' + (data.error || 'no run'), 'error');
+                    return;
+                }
+                const tables = Object.values(status.tables || {});
+                const deleted = tables.reduce((sum, t) => sum + (t.deleted || 0), 0);
+                if (status.state === 'running') {
+                    const current = status.table ? ` (${status.table})` : '';
+                    showMaintenanceMessage(`Cleaning up${current}... ${deleted} records removed so far`, 'info');
+                    setTimeout(pollRetention, 2000);
+                } else if (status.state === 'failed') {
+                    showMaintenanceMessage('Cleanup failed: ' + status.error, 'error');
+                } else {
+                    showMaintenanceMessage(`Successfully deleted ${deleted} old records in ${status.elapsed_s}s`, 'success');
+                    refreshDbStats();
                 }
             } catch (error) {
                 showMaintenanceMessage('Cleanup error: ' + error.message, 'error');
@@ -4159,11 +4410,40 @@ def get_page_script(page):
                 const response = await fetch('/api/db/optimize', { method: 'POST' });
                 const data = await response.json();
                 
-                if (data.success) {
-                    showMaintenanceMessage(`Database optimized successfully. Space saved: ${data.space_saved || 'Unknown'}`, 'success');
-                    refreshDbStats();
-                } else {
+                if (!data.success) {
                     showMaintenanceMessage('Optimization failed: ' + data.error, 'error');
+                    return;
+                }
+                if (!data.started) {
+                    showMaintenanceMessage('Optimization is already running - showing its progress', 'info');
+                }
+                pollMaintenance();
+            } catch (error) {
+                showMaintenanceMessage('Optimization error: ' + error.message, 'error');
+            }
+        }
+        
+        async function pollMaintenance() {
+            try {
+                const response = await fetch('/api/db/maintenance');
+                const data = await response.json();
+                const status = data.status;
+                if (!data.success || !status) {
+                    showMaintenanceMessage('Optimization status unavailable: ' + (data.error || 'no run'), 'error');
+                    return;
+                }
+                if (status.state === 'running') {
+                    const current = status.job ? ` (${status.job})` : '';
+                    showMaintenanceMessage(`Optimizing database${current}...`, 'info');
+                    setTimeout(pollMaintenance, 2000);
+                } else if (status.state === 'failed') {
+                    showMaintenanceMessage('Optimization failed: ' + status.error, 'error');
+                } else {
+                    const vacuum = (status.jobs || {}).vacuum || {};
+                    const saved = vacuum.skipped ? `not vacuumed (${vacuum.skipped})`
+                        : `Space saved: ${((vacuum.freed_bytes || 0) / (1024 * 1024)).toFixed(2)} MB`;
+                    showMaintenanceMessage(`Database optimized in ${status.elapsed_s}s. ${saved}`, 'success');
+                    refreshDbStats();
                 }
             } catch (error) {
                 showMaintenanceMessage('Optimization error: ' + error.message, 'error');
@@ -4175,12 +4455,15 @@ def get_page_script(page):
             try {
                 const response = await fetch('/api/db/backup', { method: 'POST' });
                 
-                if (response.ok) {
+                const type = response.headers.get('Content-Type') || '';
+                if (response.ok && !type.includes('application/json')) {
                     const blob = await response.blob();
                     const url = window.URL.createObjectURL(blob);
                     const a = document.createElement('a');
+                    const disposition = response.headers.get('Content-Disposition') || '';
+                    const match = disposition.match(/filename=([^;]+)/);
                     a.href = url;
-                    a.download = `solar_monitor_backup_${new Date().toISOString().split('T')[0]}.db`;
+                    a.download = match ? match[1] : `solar_monitor_backup_${new Date().toISOString().split('T')[0]}.db.gz`;
                     document.body.appendChild(a);
                     a.click();
                     window.URL.revokeObjectURL(url);
@@ -6223,8 +6506,63 @@ LIMIT 100;`
             } catch (error) {
                 console.error('Error loading DB stats:', error);
             }
+            refreshReplicaStatus();
         }
         
+        // Analytics replica: where the browser, SQL explorer and exports read
+        function describeDataSource(source) {
+            if (!source || source.source !== 'replica') {
+                return source && source.enabled ? 'live database (replica not built yet)' : 'live database';
+            }
+            const minutes = Math.round((source.lag_seconds || 0) / 60);
+            const asOf = new Date(source.as_of).toLocaleTimeString();
+            return `replica as of ${asOf} (${minutes < 1 ? 'under a minute' : minutes + ' min'} behind)`;
+        }
+        
+        function showDataSource(source) {
+            const text = document.getElementById('replica-status-text');
+            const button = document.getElementById('replica-refresh-btn');
+            if (!text || !source) return;
+            text.textContent = `🗄️ Queries read the ${describeDataSource(source)}` +
+                (source.refreshing ? ' - refreshing...' : '');
+            button.style.display = source.enabled ? 'inline-block' : 'none';
+        }
+        
+        async function refreshReplicaStatus() {
+            try {
+                const response = await fetch('/api/db/replica');
+                const data = await response.json();
+                if (data.success) {
+                    showDataSource(data.data_source);
+                }
+                return data;
+            } catch (error) {
+                console.error('Error loading replica status:', error);
+            }
+        }
+        
+        async function refreshReplica() {
+            try {
+                const response = await fetch('/api/db/replica', { method: 'POST' });
+                const data = await response.json();
+                if (!data.success) {
+                    alert('Replica refresh failed: ' + data.error);
+                    return;
+                }
+                // Poll until the background refresh has finished
+                const poll = setInterval(async () => {
+                    const status = await refreshReplicaStatus();
+                    if (!status || !status.status || status.status.state !== 'running') {
+                        clearInterval(poll);
+                    }
+                }, 2000);
+            } catch (error) {
+                alert('Replica refresh failed: ' + error.message);
+            }
+        }
+        
+        document.addEventListener('DOMContentLoaded', refreshReplicaStatus);
+        
         // Table Browser Functions
         async function loadTableData() {
             const tableSelector = document.getElementById('table-selector').value;
@@ -6338,7 +6676,8 @@ LIMIT 100;`
             }
             
             // Update title
-            resultsTitle.textContent = `Table Results (${data.results.length} rows)`;
+            resultsTitle.textContent = `Table Results (${data.results.length} rows, ${describeDataSource(data.data_source)})`;
+            showDataSource(data.data_source);
             
             // Try to use AG-Grid first
             loadAGGrid(() => {
@@ -6914,7 +7253,8 @@ LIMIT 100;`
             
             resultsDiv.innerHTML = '';
             resultsSection.style.display = 'block';
-            resultsTitle.textContent = `Query Results (${data.results.length} rows)`;
+            resultsTitle.textContent = `Query Results (${data.results.length} rows, ${describeDataSource(data.data_source)})`;
+            showDataSource(data.data_source);
             
             loadAGGrid(() => {
                 createAGGrid(data, resultsDiv, resultsSection);
@@ -8095,6 +8435,7 @@ def get_weather():
 @app.route('/api/pvs6/proxy')
 def pvs6_proxy():
     """Proxy endpoint to communicate with PVS6 gateway and avoid CORS issues"""
+    import requests
     try:
         command = request.args.get('command', 'DeviceList')
         
@@ -8109,56 +8450,47 @@ def pvs6_proxy():
                 'error': f'Invalid command. Valid commands: {", ".join(valid_commands)}'
             }), 400
         
-        # Try to import the PVS client
-        try:
-            import sys
-            sys.path.append('/opt/solar_monitor')
-            from pvs_client import PVSClient
-            
-            # Initialize PVS client
-            pvs_client = PVSClient()
-            
+        # Shared client: reuses the pooled keep-alive connection to the gateway
+        pvs_client = get_shared_pvs_client()
+        if pvs_client is not None:
             # Execute the command based on the request
+            # During an outage the breaker answers instantly; DeviceList and
+            # SystemStatus then fall back to the last good snapshot
             if command == 'DeviceList':
-                result = pvs_client.get_device_list()
-                return jsonify(result)
+                snapshot = pvs_client.get_snapshot(allow_stale=True)
+                if not snapshot.pvs_online:
+                    return jsonify({
+                        'error': 'PVS6 gateway connection failed',
+                        'health': pvs_client.get_health()
+                    }), 503
+                response = jsonify(snapshot.raw_devices())
+                if snapshot.stale:
+                    response.headers['X-PVS6-Stale'] = 'true'
+                    response.headers['X-PVS6-Age-Seconds'] = str(snapshot.age_seconds)
+                return response
             elif command == 'SystemStatus':
-                result = pvs_client.get_system_summary()
+                result = pvs_client.get_system_summary(allow_stale=True)
                 return jsonify(result)
             else:
-                # For other commands, try direct HTTP request to PVS6
-                import requests
-                pvs6_url = f'http://172.27.152.1/cgi-bin/dl_cgi?Command={command}'
-                
-                response = requests.get(pvs6_url, timeout=10)
-                
-                # Try to parse as JSON first
-                try:
-                    json_data = response.json()
-                    return jsonify(json_data)
-                except:
-                    # Return raw text if not JSON
-                    return response.text, response.status_code, {'Content-Type': 'text/plain'}
-                    
-        except ImportError:
+                response = pvs_client.send_command(command)
+        else:
             # If PVS client not available, try direct HTTP request
-            import requests
             pvs6_url = f'http://172.27.152.1/cgi-bin/dl_cgi?Command={command}'
-            
             response = requests.get(pvs6_url, timeout=10)
-            
-            # Try to parse as JSON first
-            try:
-                json_data = response.json()
-                return jsonify(json_data)
-            except:
-                # Return raw text if not JSON
-                return response.text, response.status_code, {'Content-Type': 'text/plain'}
+        
+        # Try to parse as JSON first
+        try:
+            json_data = response.json()
+            return jsonify(json_data)
+        except:
+            # Return raw text if not JSON
+            return response.text, response.status_code, {'Content-Type': 'text/plain'}
                 
     except requests.exceptions.RequestException as e:
         return jsonify({
             'error': 'PVS6 gateway connection failed',
             'details': str(e),
+            'retry_in_s': getattr(e, 'retry_in', None),
             'suggestions': [
                 'Check if PVS6 gateway is powered on',
                 'Verify WiFi connection to SunPower12345',
@@ -8172,6 +8504,14 @@ def pvs6_proxy():
             'details': str(e)
         }), 500
 
+@app.route('/api/pvs6/transport-stats')
+def pvs6_transport_stats():
+    """Connection reuse and latency counters of the shared PVS6 session"""
+    pvs_client = get_shared_pvs_client()
+    if pvs_client is None:
+        return jsonify({'success': False, 'error': 'PVS client not available'})
+    return jsonify({'success': True, 'stats': pvs_client.get_transport_stats()})
+
 # Analytics API Endpoints
 @app.route('/api/historical_data')
 def historical_data():
@@ -8318,39 +8658,58 @@ def historical_data():
             else:
                 time_format = '%m/%d %H:%M'
 
-        # Get aggregated historical data
-        # Build the datetime filter based on period type
+        # Range filter on the indexed integer ts_epoch column (index range scan)
         if start_time is not None:
             # Use the start_time we calculated earlier for "this" periods
-            cursor.execute(f'''
-                SELECT 
-                    {group_by} as time_group,
-                    AVG(production_kw) as production_kw,
-                    AVG(consumption_kw) as consumption_kw,
-                    AVG(production_kw - consumption_kw) as net_export_kw,
-                    strftime(?, MIN(timestamp)) as time_label,
-                    MIN(timestamp) as timestamp
-                FROM solar_data 
-                WHERE datetime(timestamp) >= ?
-                GROUP BY {group_by}
-                ORDER BY MIN(timestamp) ASC
-            ''', (time_format, start_time))
+            window_epoch = local_epoch(start_time)
         else:
             # Use hours_back for relative periods
-            hours_filter = f"datetime('now', 'localtime', '-{hours_back} hours')"
-            cursor.execute(f'''
-                SELECT 
-                    {group_by} as time_group,
-                    AVG(production_kw) as production_kw,
-                    AVG(consumption_kw) as consumption_kw,
-                    AVG(production_kw - consumption_kw) as net_export_kw,
-                    strftime(?, MIN(timestamp)) as time_label,
-                    MIN(timestamp) as timestamp
-                FROM solar_data 
-                WHERE datetime(timestamp) >= {hours_filter}
-                GROUP BY {group_by}
-                ORDER BY MIN(timestamp) ASC
-            ''', (time_format,))
+            window_epoch = since_epoch(hours=hours_back)
+        
+        # Read the coarsest rollup tier that still resolves the requested
+        # buckets; raw rows only below 1 minute (or before the backfill ran)
+        rollups = get_rollups()
+        plan = rollups.plan(conn, GRANULARITY_SECONDS.get(granularity, 3600)) if rollups else None
+        if plan and plan['tier']:
+            source = plan['source']
+            # Whole first bucket, like the partial first group of raw rows
+            window_epoch = rollups.bucket_start(conn, plan['tier'], window_epoch)
+        else:
+            # With deadband compression the stored points are irregular, so
+            # aggregate over the series reconstructed onto a regular grid
+            source_table = 'solar_data'
+            compression = get_compression()
+            # Compressed series interpolate from the stored point before the window
+            lookback = compression.config.compression_max_gap_seconds if compression else 0
+            attach_partitions(conn, window_epoch - lookback)
+            if compression is not None:
+                if start_time is not None:
+                    window_start = start_time
+                else:
+                    cursor.execute(f"SELECT datetime('now', 'localtime', '-{hours_back} hours') as start_time")
+                    window_start = cursor.fetchone()['start_time']
+                span = time.time() - compression.to_epoch(window_start)
+                step = compression.grid_step(GRANULARITY_SECONDS.get(granularity, 3600), span)
+                source_table = compression.expand_solar_data(conn, window_start, step=step)
+            source = (rollups.source_sql(None, source_table) if rollups else
+                      f"(SELECT timestamp, ts_epoch, 60 AS seconds, production_kw * 60 AS production_energy, "
+                      f"consumption_kw * 60 AS consumption_energy FROM {source_table})")
+        
+        # Get aggregated historical data (time-weighted: energy over the seconds
+        # it covers, the same averages as performance_summary and the mobile API)
+        cursor.execute(f'''
+            SELECT 
+                {group_by} as time_group,
+                SUM(production_energy) / SUM(seconds) as production_kw,
+                SUM(consumption_energy) / SUM(seconds) as consumption_kw,
+                (SUM(production_energy) - SUM(consumption_energy)) / SUM(seconds) as net_export_kw,
+                strftime(?, MIN(timestamp)) as time_label,
+                MIN(timestamp) as timestamp
+            FROM {source} 
+            WHERE ts_epoch >= ?
+            GROUP BY {group_by}
+            ORDER BY MIN(timestamp) ASC
+        ''', (time_format, window_epoch))
         
         rows = cursor.fetchall()
         
@@ -8479,17 +8838,15 @@ def devices_inverters():
         
         if conn:
             cursor = conn.cursor()
+            # device_latest holds the most recent record of each device (O(devices))
             cursor.execute('''
                 SELECT device_id, status, power_kw, voltage, current_a, 
-                       frequency, temperature, timestamp,
-                       ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY timestamp DESC) as rn
-                FROM device_data 
+                       frequency, temperature, timestamp
+                FROM device_latest 
                 WHERE device_type = 'inverter'
+                ORDER BY device_id
             ''')
-            
-            # Get only the most recent record for each inverter
-            all_records = cursor.fetchall()
-            recent_records = [r for r in all_records if r['rn'] == 1]
+            recent_records = cursor.fetchall()
             
             conn.close()
             
@@ -8552,7 +8909,7 @@ def devices_inverters():
 @app.route('/api/device_details')
 def device_details():
     try:
-        conn = get_db_connection()
+        conn = get_range_connection(since_epoch(**LATEST_WINDOW))
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -8634,7 +8991,7 @@ def device_details():
 @app.route('/api/inverter-details')
 def inverter_details():
     try:
-        conn = get_db_connection()
+        conn = get_range_connection(since_epoch(**LATEST_WINDOW))
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -8751,7 +9108,7 @@ def reset_pvs6_wifi():
 @app.route('/api/export-device-data')
 def export_device_data():
     try:
-        conn = get_db_connection()
+        conn = get_analytics_connection()
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -8787,7 +9144,7 @@ def export_device_data():
 @app.route('/api/device-diagnostics')
 def device_diagnostics():
     try:
-        conn = get_db_connection()
+        conn = get_range_connection()
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -8797,10 +9154,12 @@ def device_diagnostics():
         cursor.execute('SELECT COUNT(DISTINCT device_id) as device_count FROM solar_data WHERE device_id IS NOT NULL')
         device_count = cursor.fetchone()['device_count']
         
-        cursor.execute('SELECT COUNT(*) as recent_records FROM solar_data WHERE timestamp > datetime("now", "-1 hour")')
+        cursor.execute('SELECT COUNT(*) as recent_records FROM solar_data WHERE ts_epoch > ?',
+                       (since_epoch(hours=1),))
         recent_records = cursor.fetchone()['recent_records']
         
-        cursor.execute('SELECT AVG(production_kw) as avg_production FROM solar_data WHERE timestamp > datetime("now", "-1 hour")')
+        cursor.execute('SELECT AVG(production_kw) as avg_production FROM solar_data WHERE ts_epoch > ?',
+                       (since_epoch(hours=1),))
         avg_production = cursor.fetchone()['avg_production'] or 0
         
         conn.close()
@@ -8853,27 +9212,33 @@ def current_status():
         if not conn:
             return jsonify({'success': False, 'error': 'DB connection failed'})
         
-        cursor = conn.cursor()
-        cursor.execute('SELECT production_kw, consumption_kw, net_export_kw FROM solar_data ORDER BY timestamp DESC LIMIT 1')
-        row = cursor.fetchone()
-        conn.close()
+        try:
+            cursor = conn.cursor()
+            # Newest sample from the 1-minute rollup (kept current on every insert)
+            rollups = get_rollups()
+            site = rollups.latest(conn) if rollups else None
+            if site is None:
+                attach_partitions(conn, since_epoch(**LATEST_WINDOW))
+                cursor.execute('SELECT production_kw, consumption_kw, net_export_kw FROM solar_data ORDER BY ts_epoch DESC LIMIT 1')
+                row = cursor.fetchone()
+                site = dict(row) if row else None
+            
+            # One row per device, no matter how much history is stored
+            cursor.execute('''
+                SELECT COUNT(*) as total, COALESCE(SUM(status = 'working'), 0) as working
+                FROM device_latest WHERE device_type = 'inverter'
+            ''')
+            devices = cursor.fetchone()
+        finally:
+            conn.close()
         
-        if row:
-            return jsonify({
-                'success': True,
-                'production_kw': row['production_kw'],
-                'consumption_kw': row['consumption_kw'], 
-                'net_export_kw': row['net_export_kw'],
-                'devices': {'total': 21, 'working': 18}
-            })
-        else:
-            return jsonify({
-                'success': True,
-                'production_kw': 0.0,
-                'consumption_kw': 0.0,
-                'net_export_kw': 0.0,
-                'devices': {'total': 21, 'working': 18}
-            })
+        return jsonify({
+            'success': True,
+            'production_kw': site['production_kw'] if site else 0.0,
+            'consumption_kw': site['consumption_kw'] if site else 0.0,
+            'net_export_kw': site['net_export_kw'] if site else 0.0,
+            'devices': {'total': devices['total'], 'working': devices['working']}
+        })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -8893,7 +9258,7 @@ def execute_query():
         if not clean_query.upper().startswith('SELECT'):
             return jsonify({'success': False, 'error': 'Only SELECT queries are allowed'})
         
-        conn = get_db_connection()
+        conn = get_analytics_connection()
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -8910,7 +9275,8 @@ def execute_query():
         return jsonify({
             'success': True,
             'results': results,
-            'count': len(results)
+            'count': len(results),
+            'data_source': analytics_source()
         })
         
     except Exception as e:
@@ -8940,7 +9306,7 @@ def execute_sql_chart():
             if keyword in query_upper:
                 return jsonify({'success': False, 'error': f'Keyword "{keyword}" is not allowed'})
         
-        conn = get_db_connection()
+        conn = get_analytics_connection()
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -8976,7 +9342,8 @@ def execute_sql_chart():
             'results': results,
             'count': len(results),
             'numeric_columns': numeric_columns,
-            'message': f'Query executed successfully. Found {len(numeric_columns)} numeric columns.'
+            'message': f'Query executed successfully. Found {len(numeric_columns)} numeric columns.',
+            'data_source': analytics_source()
         })
         
     except Exception as e:
@@ -8989,7 +9356,7 @@ def export_data():
         format_type = request.args.get('format', 'csv')
         limit = request.args.get('limit', '1000')
         
-        conn = get_db_connection()
+        conn = get_analytics_connection()
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -9462,37 +9829,31 @@ def disk_usage():
 @app.route('/api/db/status')
 def db_status():
     try:
-        conn = get_db_connection()
+        stats_catalog = get_stats_catalog()
+        if stats_catalog is None:
+            return jsonify({'success': False, 'error': 'Statistics catalog not available'})
+        
+        since = since_epoch(hours=24)
+        conn = get_range_connection(since)
         if not conn:
             return jsonify({'success': False})
         
-        cursor = conn.cursor()
-        
-        # Get comprehensive database statistics
-        cursor.execute("""
-            SELECT COUNT(*) as total_records,
-                   COUNT(DISTINCT device_id) as unique_devices,
-                   MAX(timestamp) as latest_timestamp,
-                   MIN(timestamp) as earliest_timestamp
-            FROM solar_data 
-            WHERE timestamp >= datetime('now', '-24 hours')
-        """)
-        stats_24h = cursor.fetchone()
-        
-        # Get total records (all time)
-        cursor.execute('SELECT COUNT(*) as total_count FROM solar_data')
-        total_count = cursor.fetchone()['total_count']
-        
-        conn.close()
+        # Statistics catalog (trigger-maintained) instead of full-table counts
+        try:
+            total = stats_catalog.table_stats(conn, 'site_samples')
+            stats_24h = stats_catalog.window(conn, 'site_samples', since)
+            devices_24h = stats_catalog.active_devices(conn, 'device_samples', since)
+        finally:
+            conn.close()
         
         return jsonify({
             'success': True, 
-            'total_records': total_count,
+            'total_records': total['rows'],
             'stats': {
-                'total_records_24h': stats_24h['total_records'],
-                'unique_devices_24h': stats_24h['unique_devices'],
-                'latest_timestamp': stats_24h['latest_timestamp'],
-                'earliest_timestamp': stats_24h['earliest_timestamp']
+                'total_records_24h': stats_24h['rows'],
+                'unique_devices_24h': devices_24h,
+                'latest_timestamp': epoch_timestamp(stats_24h['last_epoch']),
+                'earliest_timestamp': epoch_timestamp(stats_24h['first_epoch'])
             }
         })
     except Exception as e:
@@ -9531,9 +9892,13 @@ def db_health_check():
         
         cursor = conn.cursor()
         
-        # Check database integrity
-        cursor.execute('PRAGMA integrity_check')
-        integrity = cursor.fetchone()[0]
+        # Latest scheduled/on-demand check (maintenance.py) - no scan per request
+        maintenance = get_maintenance()
+        check = maintenance.integrity(conn) if maintenance else None
+        if check is None and maintenance:
+            # Never checked: start a quick_check; the next load shows it
+            maintenance.run_in_background(DATABASE_PATH, jobs=['quick_check'])
+        integrity = check['result'] if check else 'not checked yet'
         
         # Check fragmentation (page count vs file size)
         cursor.execute('PRAGMA page_count')
@@ -9545,15 +9910,7 @@ def db_health_check():
         
         # Get last vacuum time from system metadata table
         try:
-            # Try to get actual VACUUM time from metadata table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS system_metadata (
-                    key TEXT PRIMARY KEY,
-                    value TEXT,
-                    updated_at TEXT
-                )
-            ''')
-            
+            # Last vacuum job (maintenance.py); a missing table just means "never"
             cursor.execute('SELECT value FROM system_metadata WHERE key = "last_vacuum"')
             vacuum_row = cursor.fetchone()
             last_optimized = vacuum_row['value'] if vacuum_row else None
@@ -9572,8 +9929,11 @@ def db_health_check():
         
         return jsonify({
             'success': True,
-            'status': 'Healthy' if integrity == 'ok' else 'Issues Detected',
+            'status': ('Healthy' if integrity == 'ok' else
+                       'Not Checked Yet' if check is None else 'Issues Detected'),
             'integrity': integrity,
+            'integrity_mode': check['mode'] if check else None,
+            'integrity_checked_at': check['last_run'] if check else None,
             'fragmentation': fragmentation,
             'page_count': page_count,
             'freelist_count': freelist_count,
@@ -9593,15 +9953,18 @@ def browse_table():
         device_filter = data.get('device_filter', 'all')
         limit = data.get('limit', 100)
         sort_by = data.get('sort_by', 'timestamp DESC')
+        # [{'field': 'lifetime_kwh', 'op': '>', 'value': 1000}, ...] on promoted JSON columns
+        field_filters = data.get('field_filters') or []
         
-        conn = get_db_connection()
+        conn = get_analytics_connection(time_filter_since(time_filter))
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
         cursor = conn.cursor()
         
         # Validate table name for security
-        valid_tables = ['solar_data', 'device_data', 'system_status', 'weather_data']
+        valid_tables = ['solar_data', 'device_data', 'system_status', 'weather_data', 'site_samples',
+                        'device_samples']
         if table_name not in valid_tables:
             return jsonify({'success': False, 'error': 'Invalid table name'})
         
@@ -9611,13 +9974,13 @@ def browse_table():
         # Time filter (all tables have timestamp)
         if time_filter != 'all':
             if time_filter == '1h':
-                where_conditions.append("timestamp >= datetime('now', '-1 hour')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(hours=1)}")
             elif time_filter == '24h':
-                where_conditions.append("timestamp >= datetime('now', '-24 hours')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(hours=24)}")
             elif time_filter == '7d':
-                where_conditions.append("timestamp >= datetime('now', '-7 days')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(days=7)}")
             elif time_filter == '30d':
-                where_conditions.append("timestamp >= datetime('now', '-30 days')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(days=30)}")
         
         # Device filter (depends on table)
         if device_filter != 'all':
@@ -9635,7 +9998,7 @@ def browse_table():
             elif table_name == 'solar_data':
                 # For solar_data, filter based on data patterns since device_id is mostly null
                 if device_filter == 'recent':
-                    where_conditions.append("timestamp >= datetime('now', '-1 day')")
+                    where_conditions.append(f"ts_epoch >= {since_epoch(days=1)}")
                 elif device_filter == 'production':
                     where_conditions.append("production_kw > 4.0")
                 elif device_filter == 'consumption':
@@ -9659,16 +10022,32 @@ def browse_table():
                 elif device_filter == 'low_temp':
                     where_conditions.append("temperature < 10")
         
+        # Promoted JSON fields (generated, possibly indexed columns)
+        params = []
+        if field_filters:
+            json_fields = get_json_fields()
+            promoted = {f['name'] for f in json_fields.promoted_fields(table_name)} if json_fields else set()
+            for condition in field_filters:
+                field, op = condition.get('field'), FIELD_FILTER_OPS.get(condition.get('op', '='))
+                if field not in promoted or op is None:
+                    conn.close()
+                    return jsonify({'success': False, 'error': f'Invalid field filter: {condition}'})
+                if op.startswith('IS'):
+                    where_conditions.append(f"{field} {op}")
+                else:
+                    where_conditions.append(f"{field} {op} ?")
+                    params.append(condition.get('value'))
+        
         where_clause = ' AND '.join(where_conditions) if where_conditions else '1=1'
         
         # Get total count
-        cursor.execute(f'SELECT COUNT(*) FROM {table_name} WHERE {where_clause}')
+        cursor.execute(f'SELECT COUNT(*) FROM {table_name} WHERE {where_clause}', params)
         total_available = cursor.fetchone()[0]
         
         # Get filtered results - select all columns
         query = f"SELECT * FROM {table_name} WHERE {where_clause} ORDER BY {sort_by} LIMIT {limit}"
         
-        cursor.execute(query)
+        cursor.execute(query, params)
         results = [dict(row) for row in cursor.fetchall()]
         
         conn.close()
@@ -9683,8 +10062,10 @@ def browse_table():
                 'time_filter': time_filter,
                 'device_filter': device_filter,
                 'limit': limit,
-                'sort_by': sort_by
-            }
+                'sort_by': sort_by,
+                'field_filters': field_filters
+            },
+            'data_source': analytics_source()
         })
         
     except Exception as e:
@@ -9692,113 +10073,301 @@ def browse_table():
 
 @app.route('/api/db/cleanup', methods=['POST'])
 def cleanup_old_data():
+    """Start a retention run in the background (raw tables kept ``days``)"""
     try:
-        data = request.get_json()
-        days = data.get('days', 90)
+        data = request.get_json() or {}
+        days = int(data.get('days', 90))
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'success': False, 'error': 'Database connection failed'})
-        
-        cursor = conn.cursor()
+        retention = get_retention()
+        if retention is None:
+            return jsonify({'success': False, 'error': 'Retention engine not available'})
         
-        # Count records to be deleted
-        cursor.execute(f"SELECT COUNT(*) FROM solar_data WHERE timestamp < datetime('now', '-{days} days')")
-        count_to_delete = cursor.fetchone()[0]
-        
-        # Delete old records
-        cursor.execute(f"DELETE FROM solar_data WHERE timestamp < datetime('now', '-{days} days')")
-        deleted_records = cursor.rowcount
-        
-        conn.commit()
-        conn.close()
+        # The chosen period applies to the raw tables; tiers follow RETENTION_POLICY
+        engine, started = retention.run_in_background(
+            DATABASE_PATH, site_samples=days, device_samples=days)
         
         return jsonify({
             'success': True,
-            'deleted_records': deleted_records,
-            'days': days
+            'started': started,
+            'days': days,
+            'status': engine.report
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/db/retention', methods=['GET'])
+def retention_status():
+    """Progress/report of the latest retention run, or a dry-run preview"""
+    try:
+        retention = get_retention()
+        if retention is None:
+            return jsonify({'success': False, 'error': 'Retention engine not available'})
+        
+        result = {'success': True, 'status': retention.status()}
+        if request.args.get('preview') == 'true':
+            result['preview'] = retention.RetentionEngine.from_config(DATABASE_PATH).preview()
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/raw-archive', methods=['GET'])
+def raw_archive_status():
+    """Archive size/compression and the newest archived snapshots"""
+    try:
+        raw_archive = get_raw_archive()
+        if raw_archive is None:
+            return jsonify({'success': False, 'error': 'Raw archive not available'})
+        
+        limit = min(int(request.args.get('limit', 50)), 1000)
+        conn = get_db_connection()
+        try:
+            return jsonify({
+                'success': True,
+                'stats': raw_archive.archive_stats(conn),
+                'snapshots': raw_archive.snapshot_index(conn, limit=limit),
+            })
+        finally:
+            conn.close()
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/raw-snapshot', methods=['GET'])
+def raw_snapshot():
+    """Rebuild the raw DeviceList archived at or before ?timestamp= (or ?id=)"""
+    try:
+        raw_archive = get_raw_archive()
+        if raw_archive is None:
+            return jsonify({'success': False, 'error': 'Raw archive not available'})
+        
+        snapshot_id = request.args.get('id')
+        timestamp = request.args.get('timestamp')
+        conn = get_db_connection()
+        try:
+            snapshot = raw_archive.rebuild(
+                conn,
+                at_epoch=local_epoch(timestamp) if timestamp else None,
+                snapshot_id=int(snapshot_id) if snapshot_id else None)
+        finally:
+            conn.close()
+        if snapshot is None:
+            return jsonify({'success': False, 'error': 'No archived snapshot at or before that time'})
+        return jsonify({'success': True, 'snapshot': snapshot})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/promoted-fields', methods=['GET'])
+def promoted_fields():
+    """JSON fields promoted to (indexed) columns, usable in the browser and SQL explorer"""
+    try:
+        json_fields = get_json_fields()
+        if json_fields is None:
+            return jsonify({'success': False, 'error': 'Promoted JSON fields not available'})
+        
+        conn = get_db_connection()
+        try:
+            return jsonify({'success': True, 'fields': json_fields.describe(conn)})
+        finally:
+            conn.close()
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/pool', methods=['GET'])
+def db_pool_stats():
+    """Connection pool hit/wait counters of this web process"""
+    pool = get_pool()
+    if pool is None:
+        return jsonify({'success': False, 'error': 'Connection pool not available'})
+    return jsonify({'success': True, 'pool': pool.stats()})
+
 @app.route('/api/db/optimize', methods=['POST'])
 def optimize_database():
+    """Start the maintenance jobs in the background (no VACUUM under the request)"""
     try:
-        import os
+        data = request.get_json(silent=True) or {}
         
-        # Get size before optimization
-        size_before = os.path.getsize(DATABASE_PATH)
+        maintenance = get_maintenance()
+        if maintenance is None:
+            return jsonify({'success': False, 'error': 'Maintenance module not available'})
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'success': False, 'error': 'Database connection failed'})
+        # checkpoint + optimize + incremental_vacuum; {"convert": true} also
+        # runs the one-time auto_vacuum conversion now instead of in quiet hours
+        jobs = data.get('jobs') or maintenance.OPTIMIZE_JOBS
+        runner, started = maintenance.run_in_background(
+            DATABASE_PATH, jobs=jobs, convert=bool(data.get('convert')))
         
-        cursor = conn.cursor()
+        return jsonify({
+            'success': True,
+            'started': started,
+            'status': runner.report
+        })
         
-        # Run VACUUM to optimize database
-        cursor.execute('VACUUM')
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/integrity-check', methods=['POST'])
+def start_integrity_check():
+    """Run PRAGMA quick_check ({"mode": "quick"}) or integrity_check ("full") in the background"""
+    try:
+        data = request.get_json(silent=True) or {}
+        mode = data.get('mode', 'quick')
         
-        # Update statistics
-        cursor.execute('ANALYZE')
+        maintenance = get_maintenance()
+        if maintenance is None:
+            return jsonify({'success': False, 'error': 'Maintenance module not available'})
+        if mode not in maintenance.CHECK_JOBS:
+            return jsonify({'success': False, 'error': f'Unknown check mode {mode}'})
         
-        # Record the optimization time in metadata table
-        optimization_time = datetime.now().isoformat()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS system_metadata (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                updated_at TEXT
-            )
-        ''')
-        cursor.execute('''
-            INSERT OR REPLACE INTO system_metadata (key, value, updated_at)
-            VALUES (?, ?, ?)
-        ''', ('last_vacuum', optimization_time, optimization_time))
+        # Poll GET /api/db/maintenance; the result also lands in /api/db/health-check
+        runner, started = maintenance.run_in_background(
+            DATABASE_PATH, jobs=[maintenance.CHECK_JOBS[mode]])
         
-        conn.commit()
-        conn.close()
+        return jsonify({
+            'success': True,
+            'started': started,
+            'status': runner.report
+        })
         
-        # Get size after optimization
-        size_after = os.path.getsize(DATABASE_PATH)
-        space_saved = size_before - size_after
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/maintenance', methods=['GET'])
+def maintenance_status():
+    """Latest on-demand run plus every job's recorded last run"""
+    try:
+        maintenance = get_maintenance()
+        if maintenance is None:
+            return jsonify({'success': False, 'error': 'Maintenance module not available'})
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'success': False, 'error': 'Database connection failed'})
+        try:
+            auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            jobs = maintenance.job_stats(conn)
+        finally:
+            conn.close()
         
         return jsonify({
             'success': True,
-            'size_before': f"{size_before / (1024*1024):.2f} MB",
-            'size_after': f"{size_after / (1024*1024):.2f} MB",
-            'space_saved': f"{space_saved / (1024*1024):.2f} MB" if space_saved > 0 else "0 MB"
+            'status': maintenance.status(),
+            'jobs': jobs,
+            'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(auto_vacuum, auto_vacuum),
+            'freelist_count': freelist_count
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/db/backup', methods=['POST'])
+@app.route('/api/db/backup/download', methods=['GET'])
 def create_database_backup():
+    """Stream a backup set gzip-compressed: a fresh one, or ?name= an existing set"""
+    try:
+        backup = get_backup()
+        if backup is None:
+            return jsonify({'success': False, 'error': 'Backup module not available'})
+        
+        manager = backup.BackupManager.from_config(DATABASE_PATH)
+        name = request.args.get('name')
+        if name is None:
+            # Consistent copy via the backup API (verified) - never the live file
+            report = manager.run()
+            if report['state'] != 'done':
+                return jsonify({'success': False, 'error': report.get('error', 'Backup failed')})
+            name = report['name']
+        elif name not in manager.sets():
+            return jsonify({'success': False, 'error': f'No backup set {name}'})
+        
+        return app.response_class(
+            manager.stream_set(name),
+            mimetype='application/gzip',
+            headers={'Content-Disposition': f'attachment; filename={manager.download_name(name)}'}
+        )
+            
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/backups', methods=['GET'])
+def list_database_backups():
+    """Backup sets in BACKUP_PATH and the latest run's report"""
     try:
-        import shutil
-        import tempfile
+        backup = get_backup()
+        if backup is None:
+            return jsonify({'success': False, 'error': 'Backup module not available'})
         
-        # Create temporary backup file
-        backup_filename = f"solar_monitor_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+        manager = backup.BackupManager.from_config(DATABASE_PATH)
+        return jsonify({'success': True, 'sets': manager.list_sets(), 'status': backup.status()})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/backups', methods=['POST'])
+def start_database_backup():
+    """Take a backup set in the background (poll GET /api/db/backups)"""
+    try:
+        backup = get_backup()
+        if backup is None:
+            return jsonify({'success': False, 'error': 'Backup module not available'})
+        
+        manager, started = backup.run_in_background(DATABASE_PATH)
+        return jsonify({'success': True, 'started': started, 'status': manager.report})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/backups/<name>/verify', methods=['POST'])
+def verify_database_backup(name):
+    """Re-check a backup set against its manifest (sha256 + quick_check)"""
+    try:
+        backup = get_backup()
+        if backup is None:
+            return jsonify({'success': False, 'error': 'Backup module not available'})
+        
+        manager = backup.BackupManager.from_config(DATABASE_PATH)
+        if name not in manager.sets():
+            return jsonify({'success': False, 'error': f'No backup set {name}'})
+        return jsonify({'success': True, 'result': manager.verify_set(name)})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/replica', methods=['GET'])
+def analytics_replica_status():
+    """Where ad-hoc queries run, the analytics replica's lag and the latest refresh"""
+    try:
+        manager = get_replica_manager()
+        return jsonify({'success': True, 'data_source': analytics_source(),
+                        'status': manager.report if manager is not None else None})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/db/replica', methods=['POST'])
+def refresh_analytics_replica():
+    """Refresh the analytics replica in the background (poll GET /api/db/replica)"""
+    try:
+        replica = get_replica()
+        if replica is None:
+            return jsonify({'success': False, 'error': 'Replica module not available'})
+        
+        manager, started = replica.run_in_background(DATABASE_PATH)
+        if manager is None:
+            return jsonify({'success': False, 'error': 'Analytics replica is disabled (ANALYTICS_REPLICA_ENABLED)'})
+        return jsonify({'success': True, 'started': started, 'status': manager.report})
         
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            shutil.copy2(DATABASE_PATH, temp_file.name)
-            
-            # Return file for download
-            return app.response_class(
-                open(temp_file.name, 'rb').read(),
-                mimetype='application/octet-stream',
-                headers={'Content-Disposition': f'attachment; filename={backup_filename}'}
-            )
-            
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/db/export-full')
 def export_full_database():
     try:
-        conn = get_db_connection()
+        conn = get_analytics_connection()
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -9857,7 +10426,7 @@ def export_query_results():
         if not clean_query.upper().startswith('SELECT'):
             return jsonify({'success': False, 'error': 'Only SELECT queries are allowed'})
         
-        conn = get_db_connection()
+        conn = get_analytics_connection()
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -9896,36 +10465,35 @@ def export_query_results():
 @app.route('/api/db/detailed-status')
 def db_detailed_status():
     try:
-        conn = get_db_connection()
+        stats_catalog = get_stats_catalog()
+        if stats_catalog is None:
+            return jsonify({'success': False, 'error': 'Statistics catalog not available'})
+        
+        conn = get_range_connection(since_epoch(days=7))
         if not conn:
             return jsonify({'success': False})
         
-        cursor = conn.cursor()
-        
-        # Get comprehensive statistics
-        cursor.execute('SELECT COUNT(*) as count FROM solar_data')
-        total_records = cursor.fetchone()['count']
+        # Counts and range from the statistics catalog (no full-table scans)
+        site = stats_catalog.table_stats(conn, 'site_samples')
+        total_records = site['rows']
         
         # Records in different time periods
-        cursor.execute("SELECT COUNT(*) as count FROM solar_data WHERE timestamp >= datetime('now', '-24 hours')")
-        records_24h = cursor.fetchone()['count']
-        
-        cursor.execute("SELECT COUNT(*) as count FROM solar_data WHERE timestamp >= datetime('now', '-7 days')")
-        records_7d = cursor.fetchone()['count']
+        records_24h = stats_catalog.window(conn, 'site_samples', since_epoch(hours=24))['rows']
+        records_7d = stats_catalog.window(conn, 'site_samples', since_epoch(days=7))['rows']
         
-        # Active devices - count from device_data table (inverters) plus system-level data
-        cursor.execute('SELECT COUNT(DISTINCT device_id) as count FROM device_data WHERE device_id IS NOT NULL')
-        inverter_devices = cursor.fetchone()['count']
+        # Active devices - inverters with device_samples rows, from the same
+        # statistics catalog as /api/db/status (which counts only the last 24h
+        # and leaves out the gateway), plus system-level data
+        inverter_devices = stats_catalog.active_devices(conn, 'device_samples')
         
         # Add 1 for the main system (PVS6 gateway) if we have any solar_data
-        cursor.execute('SELECT COUNT(*) as count FROM solar_data LIMIT 1')
-        has_system_data = cursor.fetchone()['count'] > 0
+        has_system_data = total_records > 0
         
         unique_devices = inverter_devices + (1 if has_system_data else 0)
         
         # Date range
-        cursor.execute('SELECT MIN(timestamp) as first, MAX(timestamp) as last FROM solar_data')
-        range_row = cursor.fetchone()
+        range_row = {'first': epoch_timestamp(site['first_epoch']),
+                     'last': epoch_timestamp(site['last_epoch'])}
         
         # Calculate date range in days
         date_range_days = None
@@ -9970,7 +10538,8 @@ def db_detailed_status():
             'latest_timestamp': range_row['last'],
             'earliest_timestamp': range_row['first'],
             'date_range_days': date_range_days,
-            'database_size': database_size
+            'database_size': database_size,
+            'catalog_reconciled_at': site['reconciled_at']
         })
         
     except Exception as e:
@@ -9987,7 +10556,7 @@ def export_table_data():
         sort_by = data.get('sort_by', 'timestamp DESC')
         format_type = data.get('format', 'csv')
         
-        conn = get_db_connection()
+        conn = get_analytics_connection(time_filter_since(time_filter))
         if not conn:
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
@@ -9999,13 +10568,13 @@ def export_table_data():
         # Time filter
         if time_filter != 'all':
             if time_filter == '1h':
-                where_conditions.append("timestamp >= datetime('now', '-1 hour')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(hours=1)}")
             elif time_filter == '24h':
-                where_conditions.append("timestamp >= datetime('now', '-24 hours')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(hours=24)}")
             elif time_filter == '7d':
-                where_conditions.append("timestamp >= datetime('now', '-7 days')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(days=7)}")
             elif time_filter == '30d':
-                where_conditions.append("timestamp >= datetime('now', '-30 days')")
+                where_conditions.append(f"ts_epoch >= {since_epoch(days=30)}")
         
         # Device filter
         if device_filter != 'all':
@@ -10071,7 +10640,7 @@ def get_inverter_ids():
             return jsonify({'success': False, 'error': 'Database connection failed'})
         
         cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT device_id FROM device_data WHERE device_type = 'inverter' ORDER BY device_id")
+        cursor.execute("SELECT device_id FROM device_latest WHERE device_type = 'inverter' ORDER BY device_id")
         results = cursor.fetchall()
         conn.close()
         
@@ -10093,39 +10662,30 @@ def performance_summary():
     try:
         period = request.args.get('period', '7d')
         
-        # Map period to SQL datetime modifier
+        # Map period to a window length
         period_map = {
-            '1h': '-1 hour',
-            '4h': '-4 hours', 
-            '12h': '-12 hours',
-            '24h': '-1 day',
-            '7d': '-7 days',
-            '30d': '-30 days',
-            '90d': '-90 days',
-            '1y': '-1 year'
+            '1h': timedelta(hours=1),
+            '4h': timedelta(hours=4),
+            '12h': timedelta(hours=12),
+            '24h': timedelta(days=1),
+            '7d': timedelta(days=7),
+            '30d': timedelta(days=30),
+            '90d': timedelta(days=90),
+            '1y': timedelta(days=365)
         }
         
-        sql_period = period_map.get(period, '-7 days')
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        window = period_map.get(period, timedelta(days=7))
+        window_epoch = since_epoch(seconds=window.total_seconds())
         
-        # Get data for the specified period
-        cursor.execute("""
-            SELECT 
-                production_kw,
-                consumption_kw,
-                net_export_kw,
-                timestamp
-            FROM solar_data 
-            WHERE timestamp >= datetime('now', 'localtime', ?)
-            ORDER BY timestamp DESC
-        """, (sql_period,))
+        conn = get_range_connection(window_epoch)
         
-        rows = cursor.fetchall()
-        conn.close()
+        # Totals, peaks and day count straight from the rollup tiers (a few
+        # hundred rows even for 1y) instead of every raw row of the period
+        rollups = get_rollups()
+        totals = rollups.window_totals(conn, window_epoch)
         
-        if not rows:
+        if not totals['samples']:
+            conn.close()
             # Return empty/zero data if no real data available
             return jsonify({
                 'success': True,
@@ -10147,53 +10707,34 @@ def performance_summary():
             })
         
         # Calculate comprehensive statistics
-        # For energy totals, sum all the instantaneous power readings and convert to kWh
-        # Each reading represents ~1 minute of data, so divide by 60 to get kWh
-        total_production = sum(row[0] or 0 for row in rows) / 60.0  # Convert kW-minutes to kWh
-        total_consumption = sum(row[1] or 0 for row in rows) / 60.0  # Convert kW-minutes to kWh
+        # Energy totals are the tiers' integrals: each reading weighted by the
+        # time since the previous one (the collection grid is not fixed)
+        total_production = totals['production_kwh']
+        total_consumption = totals['consumption_kwh']
         net_export = total_production - total_consumption
         efficiency = (total_production / total_consumption * 100) if total_consumption > 0 else 0
         
-        # Find peaks with timestamps
-        peak_production = max((row[0] or 0, row[3]) for row in rows)
-        peak_consumption = max((row[1] or 0, row[3]) for row in rows)
-        best_export = max((row[2] or 0, row[3]) for row in rows)
+        # Find peaks with timestamps (drilled down to the minute)
+        def peak_with_time(metric):
+            found = rollups.peak(conn, metric, window_epoch)
+            if not found:
+                return (0, '--')
+            return (found[0] or 0, datetime.fromtimestamp(found[1]).isoformat())
+        
+        peak_production = peak_with_time('production')
+        peak_consumption = peak_with_time('consumption')
+        best_export = peak_with_time('net_export')
         
         # Calculate daily averages only for periods >= 1 day
         periods_with_daily_averages = ['24h', '7d', '30d', '90d', '1y']
         
         if period in periods_with_daily_averages:
-            # Calculate actual daily averages by grouping data by calendar day (midnight to midnight)
-            daily_totals = {}
-            
-            for row in rows:
-                # Extract date (YYYY-MM-DD) from timestamp
-                date_str = row[3][:10]  # Get date part of timestamp
-                
-                if date_str not in daily_totals:
-                    daily_totals[date_str] = {
-                        'production': 0.0,
-                        'consumption': 0.0,
-                        'net_export': 0.0,
-                        'count': 0
-                    }
-                
-                # Sum up the kW readings for this day (convert to kWh by dividing by 60)
-                daily_totals[date_str]['production'] += (row[0] or 0) / 60.0
-                daily_totals[date_str]['consumption'] += (row[1] or 0) / 60.0
-                daily_totals[date_str]['net_export'] += (row[2] or 0) / 60.0
-                daily_totals[date_str]['count'] += 1
-            
-            # Calculate averages across all complete days
-            if daily_totals:
-                total_daily_production = sum(day['production'] for day in daily_totals.values())
-                total_daily_consumption = sum(day['consumption'] for day in daily_totals.values())
-                total_daily_export = sum(day['net_export'] for day in daily_totals.values())
-                
-                num_days = len(daily_totals)
-                avg_daily_production = total_daily_production / num_days
-                avg_daily_consumption = total_daily_consumption / num_days
-                avg_daily_export = total_daily_export / num_days
+            # Average over the calendar days (midnight to midnight) that have data
+            num_days = rollups.days_with_data(conn, window_epoch)
+            if num_days:
+                avg_daily_production = total_production / num_days
+                avg_daily_consumption = total_consumption / num_days
+                avg_daily_export = totals['net_export_kwh'] / num_days
             else:
                 avg_daily_production = 0.0
                 avg_daily_consumption = 0.0
@@ -10203,6 +10744,7 @@ def performance_summary():
             avg_daily_production = None
             avg_daily_consumption = None
             avg_daily_export = None
+        conn.close()
         
         summary = {
             'total_production': total_production,
@@ -10428,10 +10970,10 @@ def weather_historical():
                 weather_icon,
                 city
             FROM weather_data 
-            WHERE datetime(timestamp) >= datetime('now', '-{} hours')
+            WHERE ts_epoch >= ?
             ORDER BY timestamp DESC
             LIMIT ?
-        '''.format(hours_back), (int(limit),))
+        ''', (since_epoch(hours=hours_back), int(limit)))
         
         rows = cursor.fetchall()
         
@@ -10497,8 +11039,8 @@ def weather_stats():
                 AVG(wind_speed) as avg_wind_speed,
                 AVG(clouds) as avg_clouds
             FROM weather_data 
-            WHERE datetime(timestamp) >= datetime('now', '-{} hours')
-        '''.format(hours_back))
+            WHERE ts_epoch >= ?
+        ''', (since_epoch(hours=hours_back),))
         
         row = cursor.fetchone()
         
@@ -10508,12 +11050,12 @@ def weather_stats():
                 weather_main,
                 COUNT(*) as count,
                 ROUND(COUNT(*) * 100.0 / (SELECT COUNT(*) FROM weather_data 
-                    WHERE datetime(timestamp) >= datetime('now', '-{} hours')), 2) as percentage
+                    WHERE ts_epoch >= :since), 2) as percentage
             FROM weather_data 
-            WHERE datetime(timestamp) >= datetime('now', '-{} hours')
+            WHERE ts_epoch >= :since
             GROUP BY weather_main
             ORDER BY count DESC
-        '''.format(hours_back, hours_back))
+        ''', {'since': since_epoch(hours=hours_back)})
         
         conditions = cursor.fetchall()
         
@@ -10559,4 +11101,5 @@ if __name__ == '__main__':
     print("🌞 Solar Monitor v1.0.0 - Production Release")
     # Initialize weather table on startup
     init_weather_table()
+    migrate_database()
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Async Collector
+asyncio collection engine for one or more SunPower PVS6 gateways.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Every source (each PVS6 gateway, OpenWeatherMap) runs as its own task with
+its own time budget, and results are handed to a single storage task through
+an asyncio.Queue. A slow weather API or a sleepy gateway therefore never
+delays the SQLite writes, and cycles follow the AdaptiveScheduler's
+wall-clock grid (waited out on the loop's monotonic clock) so the period
+does not drift and slows down overnight.
+
+Run with:  python data_collector.py --async   (or COLLECTOR_MODE=async)
+"""
+
+import asyncio
+import signal
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import config
+from pvs_client import PVSSnapshot, get_shared_client
+from scheduler import AdaptiveScheduler
+from storage import make_cycle
+
+
+class AsyncCollector:
+    """Concurrent collector: per-source tasks feeding a queued storage writer"""
+
+    def __init__(self, buffer, build_cycle: Callable, fetch_weather: Callable,
+                 db_path: Optional[str] = None, interval: Optional[float] = None,
+                 gateways: Optional[List[Tuple[str, int]]] = None,
+                 queue_size: int = 100):
+        # The caller's write-behind buffer and cycle helpers: data_collector
+        # usually runs as __main__, so importing it here would build a second
+        # buffer that main() never replays or closes
+        self.buffer = buffer
+        self.build_cycle = build_cycle
+        self.fetch_weather = fetch_weather
+        # An explicit interval means a fixed grid; otherwise follow the sun
+        self.scheduler = (AdaptiveScheduler.fixed(interval) if interval
+                          else AdaptiveScheduler.from_config(db_path or config.database_path))
+        self.interval = interval or config.collector_interval
+        self.gateways = gateways or config.pvs6_gateways
+        self.pvs_budget = config.pvs6_timeout_budget
+        self.weather_budget = config.weather_timeout_budget
+        self.queue_size = queue_size
+        self.queue = None  # created inside the running loop
+
+        # Blocking fetches run in worker threads; a thread that outlives its
+        # budget keeps running, so the next cycle skips that source instead of
+        # piling up threads against a gateway that is already struggling
+        self._pending_fetches: Dict[str, asyncio.Future] = {}
+        self._source_tasks = set()
+
+        self.stats = {
+            'cycles': 0,
+            'skipped_ticks': 0,
+            'max_lag_ms': 0.0,
+            'timeouts': {},
+            'busy_skips': {},
+            'queued': 0,
+            'dropped': 0,
+            'written': 0,
+            'write_errors': 0,
+        }
+
+    # ------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------
+    async def run(self, cycles: Optional[int] = None):
+        """Run until cancelled (or for ``cycles`` ticks)"""
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        writer = asyncio.create_task(self._writer())
+        loop = asyncio.get_running_loop()
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        # SIGTERM cancels the schedule; the finally below drains the queue
+        # into the write-behind buffer, which run_async_collector() then closes
+        loop.add_signal_handler(signal.SIGTERM, self._on_sigterm, asyncio.current_task())
+        tick = 0
+        previous, previous_phase = None, None
+
+        try:
+            while cycles is None or tick < cycles:
+                target, phase = self.scheduler.next_tick()
+                if phase == previous_phase:
+                    # next_tick() is always after "now": an overrun re-aligns
+                    # to the grid rather than bursting to catch up
+                    step = self.scheduler.intervals[phase]
+                    self.stats['skipped_ticks'] += max(0, round((target - previous) / step) - 1)
+                deadline = loop.time() + (target - time.time())
+                await asyncio.sleep(max(0.0, deadline - loop.time()))
+                lag_ms = (loop.time() - deadline) * 1000
+                self.stats['max_lag_ms'] = max(self.stats['max_lag_ms'], lag_ms)
+
+                self._start_cycle(datetime.fromtimestamp(target).isoformat())
+                previous, previous_phase = target, phase
+                tick += 1
+        finally:
+            if self._source_tasks:
+                await asyncio.gather(*self._source_tasks, return_exceptions=True)
+            await self.queue.join()
+            writer.cancel()
+            loop.remove_signal_handler(signal.SIGTERM)
+            # Back to the caller's handler (SystemExit) while the buffer closes
+            signal.signal(signal.SIGTERM, previous_handler)
+
+    @staticmethod
+    def _on_sigterm(task: asyncio.Task):
+        print("\n🛑 SIGTERM received - flushing buffered data")
+        task.cancel()
+
+    def _start_cycle(self, timestamp: str):
+        self.stats['cycles'] += 1
+        print(f"[{timestamp}] 🔌 Async cycle {self.stats['cycles']} "
+              f"({len(self.gateways)} gateway(s), weather)")
+        self._spawn(self._collect_pvs(timestamp))
+        self._spawn(self._collect_weather(timestamp))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._source_tasks.add(task)
+        task.add_done_callback(self._source_tasks.discard)
+
+    # ------------------------------------------------------------------
+    # Sources
+    # ------------------------------------------------------------------
+    async def _fetch(self, source: str, func, budget: float):
+        """Run blocking ``func`` in a thread, bounded by ``budget`` seconds"""
+        pending = self._pending_fetches.get(source)
+        if pending is not None and not pending.done():
+            self.stats['busy_skips'][source] = self.stats['busy_skips'].get(source, 0) + 1
+            print(f"⚠️  {source} still busy from a previous cycle - skipping")
+            return None
+
+        future = asyncio.ensure_future(asyncio.to_thread(func))
+        self._pending_fetches[source] = future
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), budget)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'][source] = self.stats['timeouts'].get(source, 0) + 1
+            print(f"⏱️  {source} exceeded its {budget:.0f}s budget")
+            return None
+        except Exception as e:
+            print(f"❌ {source} failed: {e}")
+            return None
+
+    async def _collect_pvs(self, timestamp: str):
+        started = time.perf_counter()
+        fetches = [
+            self._fetch(f"pvs6@{ip}:{port}", get_shared_client(ip, port).get_snapshot, self.pvs_budget)
+            for ip, port in self.gateways
+        ]
+        snapshots = await asyncio.gather(*fetches)
+        snapshot = PVSSnapshot.merge(list(snapshots), timestamp=timestamp)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"⏱️  PVS6 stage: {snapshot.timings['gateways_online']}/{len(self.gateways)} "
+              f"gateway(s) in {elapsed_ms:.0f}ms")
+        self._enqueue(('pvs', timestamp, snapshot))
+
+    async def _collect_weather(self, timestamp: str):
+        started = time.perf_counter()
+        weather_info = await self._fetch('weather', self.fetch_weather, self.weather_budget)
+        if weather_info:
+            print(f"⏱️  Weather stage: {(time.perf_counter() - started) * 1000:.0f}ms")
+            self._enqueue(('weather', timestamp, weather_info))
+
+    def _enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+            self.stats['queued'] += 1
+        except asyncio.QueueFull:
+            # Storage is far behind; keep the newest data
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.queue.put_nowait(item)
+            self.stats['dropped'] += 1
+
+    # ------------------------------------------------------------------
+    # Storage
+    # ------------------------------------------------------------------
+    async def _writer(self):
+        """Single consumer so SQLite sees one writer; runs off the event loop"""
+        while True:
+            items = [await self.queue.get()]
+            # Whatever else is already queued goes into the same transaction
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                await asyncio.to_thread(self._store, items)
+                self.stats['written'] += len(items)
+            except Exception as e:
+                self.stats['write_errors'] += 1
+                print(f"❌ Storage error: {e}")
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _store(self, items):
+        cycles = []
+        for kind, timestamp, payload in items:
+            if kind == 'weather':
+                cycles.append(make_cycle(timestamp, weather=payload))
+            else:
+                cycle, data_source = self.build_cycle(payload, timestamp)
+                system = cycle['system']
+                if system is None:
+                    continue
+                print(f"✅ Storing ({data_source}): {system['production_kw']:.2f}kW, "
+                      f"{system['consumption_kw']:.2f}kW, {len(cycle['devices'])} device rows")
+                cycles.append(cycle)
+        rows = self.buffer.add_many(cycles)
+        if rows:
+            stats = self.buffer.writer.get_stats()
+            print(f"💾 Stored {rows} rows in one transaction (commit {stats['last_commit_ms']:.1f}ms)")
+
+
+def run_async_collector(buffer, build_cycle: Callable, fetch_weather: Callable,
+                        db_path: Optional[str] = None):
+    """Entry point used by data_collector.main(); always closes ``buffer``"""
+    async_collector = AsyncCollector(buffer, build_cycle, fetch_weather, db_path)
+    print(f"⚡ Async collector: schedule={async_collector.scheduler.describe()}, "
+          f"gateways={async_collector.gateways}, budgets pvs={async_collector.pvs_budget}s "
+          f"weather={async_collector.weather_budget}s")
+    try:
+        asyncio.run(async_collector.run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print("\n🛑 Collector stopped")
+    finally:
+        # Flush, or spill to the journal that the next start replays
+        buffer.close()
+        print(f"💾 Write-behind buffer closed: {buffer.get_stats()}")
+    print(f"📈 Async collector stats: {async_collector.stats}")
+
+
+if __name__ == '__main__':
+    import data_collector as collector
+    collector.ensure_tables()
+    collector.get_buffer().replay_journal()
+    run_async_collector(collector.get_buffer(), collector.build_cycle,
+                        collector.fetch_weather_data, collector.DB_PATH)
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Backups
+Consistent online backups through the SQLite backup API.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Copying a live WAL-mode database file misses whatever is still in the -wal
+file, so the copy can be torn. Backups are taken with
+sqlite3.Connection.backup instead: BACKUP_STEP_PAGES pages per step with a
+short pause in between, so the collector gets the write lock between
+steps. A write by another connection makes SQLite restart the copy; after
+a restart the step grows (x8, finally the whole file in one step, which in
+WAL mode still doesn't block the writer) so a busy database can't keep
+the backup from ever finishing.
+
+A backup is a directory (a "set") under config.backup_path:
+
+    <BACKUP_PATH>/solar_20250925_030000/
+        solar_data.db                   the main database
+        partitions/solar_2025-09.db     monthly files (partitioned mode)
+        manifest.json                   size, sha256 and check result per file
+
+Sets are built in a ``.partial`` directory and renamed when complete.
+Backups are incremental in partitioned mode: a monthly file unchanged since
+the previous set (same size/mtime of the file and its -wal) is hard-linked
+from it instead of copied, so only the main database and the current month
+are read. Every copied file is verified (PRAGMA quick_check, or
+integrity_check with BACKUP_VERIFY=full) before the set is published; the
+newest BACKUP_KEEP sets are kept.
+
+stream_set() yields a set gzip-compressed in 1 MB chunks (a tar.gz when it
+has monthly files), so a download never holds the database in memory.
+BackupScheduler takes a set every BACKUP_INTERVAL_HOURS.
+
+Run standalone with:  python backup.py [--verify NAME] [/path/to/solar_data.db]
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tarfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from config import config
+from partitions import PartitionSet
+
+SET_PREFIX = 'solar_'
+MANIFEST = 'manifest.json'
+CHUNK_BYTES = 1024 * 1024
+# Step growth after each restart; past MAX_STEP_PAGES the rest goes in one step
+STEP_GROWTH = 8
+MAX_STEP_PAGES = 1 << 20
+
+
+class BackupRestarted(Exception):
+    """The source changed underneath a page-stepped copy"""
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path: str) -> List[int]:
+    """Size/mtime of a database file and its -wal (changes on every commit)"""
+    values = []
+    for name in (path, path + '-wal'):
+        try:
+            stat = os.stat(name)
+            values += [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            values += [0, 0]
+    return values
+
+
+def copy_database(source: str, dest: str, step_pages: int = 1024,
+                  pause_seconds: float = 0.02) -> Dict:
+    """
+    Page-stepped backup of ``source`` into ``dest``; returns
+    {'pages', 'steps', 'restarts', 'seconds'}.
+    """
+    started = time.monotonic()
+    stats = {'pages': 0, 'steps': 0, 'restarts': 0}
+    src = sqlite3.connect(source, timeout=30.0)
+    dst = sqlite3.connect(dest)
+    try:
+        pages = max(1, step_pages)
+        while True:
+            remaining = [None]
+
+            def progress(status, left, total):
+                stats['steps'] += 1
+                stats['pages'] = total
+                if remaining[0] is not None and left > remaining[0]:
+                    raise BackupRestarted()
+                remaining[0] = left
+                # Between steps the source is unlocked: let the collector in
+                time.sleep(pause_seconds)
+
+            try:
+                src.backup(dst, pages=pages, progress=progress)
+                break
+            except BackupRestarted:
+                stats['restarts'] += 1
+                pages = -1 if pages < 0 or pages * STEP_GROWTH > MAX_STEP_PAGES else pages * STEP_GROWTH
+        # A standalone file: no -wal/-shm next to it (checks open it read-only)
+        dst.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        src.close()
+        dst.close()
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def check_database(path: str, mode: str = 'quick') -> str:
+    """'ok', or the first problem PRAGMA quick_check/integrity_check reports"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        pragma = 'integrity_check' if mode == 'full' else 'quick_check'
+        rows = [row[0] for row in conn.execute(f"PRAGMA {pragma}")]
+        return 'ok' if rows == ['ok'] else '; '.join(rows[:5])
+    finally:
+        conn.close()
+
+
+class BackupManager:
+    """Backup sets of one database (and its monthly files) under ``directory``"""
+
+    def __init__(self, db_path: str, directory: str, keep: int = 7, step_pages: int = 1024,
+                 pause_seconds: float = 0.02, verify: str = 'quick', partitions=None):
+        self.db_path = db_path
+        self.directory = directory
+        self.keep = max(1, keep)
+        self.step_pages = step_pages
+        self.pause_seconds = pause_seconds
+        self.verify = verify
+        self.partitions = partitions
+        self._lock = threading.Lock()
+        self.report = {'state': 'idle'}
+
+    @classmethod
+    def from_config(cls, db_path: str) -> 'BackupManager':
+        return cls(db_path, config.backup_path, keep=config.backup_keep,
+                   step_pages=config.backup_step_pages,
+                   pause_seconds=config.backup_step_pause_ms / 1000.0,
+                   verify=config.backup_verify,
+                   partitions=PartitionSet.from_config(db_path))
+
+    # ------------------------------------------------------------------
+    # Sets
+    # ------------------------------------------------------------------
+    def sets(self) -> List[str]:
+        """Published sets, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith(SET_PREFIX) and not name.endswith('.partial')
+                      and os.path.isfile(os.path.join(self.directory, name, MANIFEST)))
+
+    def manifest(self, name: str) -> Dict:
+        with open(os.path.join(self.directory, name, MANIFEST)) as f:
+            return json.load(f)
+
+    def list_sets(self) -> List[Dict]:
+        """Manifests of the published sets, newest first"""
+        result = []
+        for name in reversed(self.sets()):
+            manifest = self.manifest(name)
+            result.append({
+                'name': name,
+                'created': manifest['created'],
+                'files': len(manifest['files']),
+                'bytes': sum(f['size'] for f in manifest['files'].values()),
+                'copied': sum(1 for f in manifest['files'].values() if f['copied']),
+                'verified': manifest['verified'],
+            })
+        return result
+
+    def _sources(self) -> Dict[str, str]:
+        """Relative name in a set -> live file"""
+        sources = {os.path.basename(self.db_path): self.db_path}
+        if self.partitions is not None:
+            for key in self.partitions.keys():
+                path = self.partitions.path(key)
+                sources[os.path.join('partitions', os.path.basename(path))] = path
+        return sources
+
+    # ------------------------------------------------------------------
+    # Run
+    # ------------------------------------------------------------------
+    def run(self) -> Dict:
+        """Take, verify and publish one set, then rotate; returns the report"""
+        with self._lock:
+            started = time.monotonic()
+            self.report = {'state': 'running', 'started_at': datetime.now().isoformat(), 'file': None}
+            try:
+                name = self._take()
+                self.report.update(state='done', name=name, rotated=self._rotate())
+            except Exception as e:
+                self.report.update(state='failed', error=str(e))
+                print(f"❌ Backup failed: {e}")
+            self.report['file'] = None
+            self.report['elapsed_s'] = round(time.monotonic() - started, 3)
+            if self.report['state'] == 'done':
+                print(f"💾 Backup {self.report['name']} done in {self.report['elapsed_s']}s "
+                      f"({self.report['copied']} copied, {self.report['linked']} linked)")
+            return self.report
+
+    def _take(self) -> str:
+        name = f"{SET_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        final = os.path.join(self.directory, name)
+        work = final + '.partial'
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(work)
+
+        previous = self.sets()[-1] if self.sets() else None
+        previous_files = self.manifest(previous)['files'] if previous else {}
+        files = {}
+        self.report.update(copied=0, linked=0)
+        try:
+            for relative, source in self._sources().items():
+                self.report['file'] = relative
+                dest = os.path.join(work, relative)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                fingerprint = file_fingerprint(source)
+                before = previous_files.get(relative)
+                # The main database always changes; closed months usually don't
+                if (relative != os.path.basename(self.db_path) and before is not None
+                        and before['fingerprint'] == fingerprint and self._link(previous, relative, dest)):
+                    files[relative] = dict(before, copied=False)
+                    self.report['linked'] += 1
+                    continue
+                stats = copy_database(source, dest, self.step_pages, self.pause_seconds)
+                check = check_database(dest, self.verify) if self.verify != 'off' else 'skipped'
+                files[relative] = {
+                    'size': os.path.getsize(dest),
+                    'sha256': _sha256(dest),
+                    'fingerprint': fingerprint,
+                    'copied': True,
+                    'check': check,
+                    'pages': stats['pages'],
+                    'restarts': stats['restarts'],
+                    'seconds': stats['seconds'],
+                }
+                self.report['copied'] += 1
+            failed = {k: f['check'] for k, f in files.items() if f['check'] not in ('ok', 'skipped')}
+            if failed:
+                raise RuntimeError(f"verification failed: {failed}")
+            with open(os.path.join(work, MANIFEST), 'w') as f:
+                json.dump({
+                    'created': datetime.now().isoformat(),
+                    'source': self.db_path,
+                    'verify': self.verify,
+                    'verified': self.verify != 'off',
+                    'previous': previous,
+                    'files': files,
+                }, f, indent=2)
+            os.rename(work, final)
+        except BaseException:
+            shutil.rmtree(work, ignore_errors=True)
+            raise
+        return name
+
+    def _link(self, previous: str, relative: str, dest: str) -> bool:
+        """Hard-link an unchanged file from the previous set (False: copy it instead)"""
+        try:
+            os.link(os.path.join(self.directory, previous, relative), dest)
+            return True
+        except OSError:
+            return False  # e.g. a FAT-formatted backup drive
+
+    def _rotate(self) -> List[str]:
+        """Remove all but the newest ``keep`` sets (hard links keep shared months alive)"""
+        removed = self.sets()[:-self.keep]
+        for name in removed:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        # Leftovers of runs that died half way (a running one is younger than a day)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.partial') and time.time() - os.path.getmtime(path) > 86400:
+                shutil.rmtree(path, ignore_errors=True)
+        return removed
+
+    def verify_set(self, name: str) -> Dict:
+        """Re-check a published set: sha256 against the manifest plus quick_check"""
+        manifest = self.manifest(name)
+        problems = {}
+        for relative, info in manifest['files'].items():
+            path = os.path.join(self.directory, name, relative)
+            if not os.path.exists(path):
+                problems[relative] = 'missing'
+            elif _sha256(path) != info['sha256']:
+                problems[relative] = 'checksum mismatch'
+            else:
+                check = check_database(path, 'quick')
+                if check != 'ok':
+                    problems[relative] = check
+        return {'name': name, 'ok': not problems, 'problems': problems,
+                'checked_at': datetime.now().isoformat()}
+
+    # ------------------------------------------------------------------
+    # Download
+    # ------------------------------------------------------------------
+    def stream_set(self, name: str, level: int = 6) -> Iterator[bytes]:
+        """gzip chunks of a set: the bare database, or a tar of all its files"""
+        root = os.path.join(self.directory, name)
+        files = sorted(self.manifest(name)['files'])
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+        tarred = len(files) > 1
+        for relative in files:
+            path = os.path.join(root, relative)
+            if tarred:
+                info = tarfile.TarInfo(f"{name}/{relative}")
+                info.size = os.path.getsize(path)
+                info.mtime = int(os.path.getmtime(path))
+                info.mode = 0o644
+                yield compressor.compress(info.tobuf(tarfile.GNU_FORMAT))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+                    data = compressor.compress(chunk)
+                    if data:
+                        yield data
+            if tarred and info.size % tarfile.BLOCKSIZE:
+                yield compressor.compress(b'\0' * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE))
+        if tarred:
+            yield compressor.compress(b'\0' * (2 * tarfile.BLOCKSIZE))
+        yield compressor.flush()
+
+    def download_name(self, name: str) -> str:
+        return f"{name}.tar.gz" if len(self.manifest(name)['files']) > 1 else f"{name}.db.gz"
+
+
+class BackupScheduler:
+    """Daemon thread taking a set every ``interval_seconds``"""
+
+    def __init__(self, manager: BackupManager, interval_seconds: float):
+        self.manager = manager
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, db_path: str) -> Optional['BackupScheduler']:
+        """Scheduler per BACKUP_INTERVAL_HOURS, or None when scheduled backups are off"""
+        if config.backup_interval_hours <= 0:
+            return None
+        return cls(BackupManager.from_config(db_path), config.backup_interval_hours * 3600)
+
+    def next_due(self) -> float:
+        """Epoch the next set is due (interval after the newest one)"""
+        sets = self.manager.sets()
+        if not sets:
+            return 0.0  # none yet: due now
+        newest = os.path.getmtime(os.path.join(self.manager.directory, sets[-1], MANIFEST))
+        return newest + self.interval_seconds
+
+    def start(self) -> 'BackupScheduler':
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='backup', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(max(1.0, min(self.next_due() - time.time(), 3600.0))):
+            if time.time() >= self.next_due():
+                self.manager.run()
+                if self.manager.report['state'] == 'failed':
+                    # Don't retry in a tight loop
+                    self._stop.wait(min(self.interval_seconds, 3600.0))
+
+
+# ----------------------------------------------------------------------
+# Background runs (dashboard)
+# ----------------------------------------------------------------------
+_current: Optional[BackupManager] = None
+_current_lock = threading.Lock()
+
+
+def run_in_background(db_path: str):
+    """Start a backup unless one is going; returns (manager, started)"""
+    global _current
+    with _current_lock:
+        if _current is not None and _current.report.get('state') == 'running':
+            return _current, False
+        manager = BackupManager.from_config(db_path)
+        manager.report = {'state': 'running'}
+        _current = manager
+    threading.Thread(target=manager.run, name='backup', daemon=True).start()
+    return manager, True
+
+
+def status() -> Optional[Dict]:
+    """Report of the latest run in this process (None if none yet)"""
+    return _current.report if _current is not None else None
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if '--verify' in sys.argv:
+        name = args.pop(0)
+        manager = BackupManager.from_config(args[0] if args else config.database_path)
+        print(json.dumps(manager.verify_set(name), indent=2))
+    else:
+        manager = BackupManager.from_config(args[0] if args else config.database_path)
+        manager.run()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Compression
+Swinging-door deadband compression at ingest, and series reconstruction.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Each series (one inverter in device_samples, the site in site_samples)
+keeps an "anchor" (the last archived row) and a "tail" (the newest sample,
+also a row). A new sample replaces the tail in place (UPDATE) as long as the
+straight line anchor -> new sample stays within the per-column tolerance of
+every sample seen since the anchor; otherwise the tail is frozen as the new
+anchor and the sample is INSERTed as the next tail.
+
+Consequences:
+  * the newest row is always the latest real sample, so "latest value"
+    queries (current status, /api/devices/inverters) need no changes;
+  * a run of identical samples (sleeping inverters all night) collapses to
+    one row per max_gap and linear interpolation between them is exact;
+  * a status change or a gap longer than max_gap always starts a new run,
+    and stored points inside a run are at most max_gap apart, so a longer
+    distance between stored rows means the collector really was down.
+
+Reconstruction interpolates the stored points back onto a regular grid
+(never across gaps longer than max_gap); see expand_solar_data(). Device
+rows are only read as latest values or as stored rows (table browser, SQL
+explorer), so the inverter series are not reconstructed.
+"""
+
+import math
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from config import config
+from db_pool import temp_writes
+
+DEVICE_FIELDS = ('power_kw', 'voltage', 'current_a', 'frequency', 'temperature')
+SITE_FIELDS = ('production_kw', 'consumption_kw', 'net_export_kw')
+
+
+def to_epoch(timestamp: str) -> float:
+    """Collector timestamps are local ISO strings ('T' or space separated)"""
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+class _Series:
+    """Compression state of one series"""
+
+    __slots__ = ('anchor_t', 'anchor', 'key', 'tail_t', 'tail', 'tail_id', 'lower', 'upper')
+
+    def __init__(self, t: float, values: Dict, key):
+        self.anchor_t, self.anchor, self.key = t, values, key
+        self.tail_t, self.tail, self.tail_id = None, None, None
+        self.lower, self.upper = {}, {}
+
+    def copy(self) -> '_Series':
+        other = _Series(self.anchor_t, self.anchor, self.key)
+        other.tail_t, other.tail, other.tail_id = self.tail_t, self.tail, self.tail_id
+        other.lower, other.upper = dict(self.lower), dict(self.upper)
+        return other
+
+    @property
+    def last_t(self) -> float:
+        return self.tail_t if self.tail is not None else self.anchor_t
+
+
+class DeadbandCompressor:
+    """Per-series swinging-door state shared by every write transaction"""
+
+    def __init__(self, tolerances: Dict[str, float], max_gap: float = 1800.0):
+        self.tolerances = tolerances
+        self.max_gap = max_gap
+        self._series: Dict[Tuple, _Series] = {}
+        self.stats = {'offered': 0, 'inserted': 0, 'updated': 0}
+
+    @classmethod
+    def from_config(cls) -> Optional['DeadbandCompressor']:
+        """Compressor from COMPRESSION_* settings, or None when disabled"""
+        if not config.compression_enabled:
+            return None
+        return cls(config.compression_tolerances, config.compression_max_gap_seconds)
+
+    def session(self) -> 'CompressionSession':
+        """State overlay for one transaction; applied only on commit"""
+        return CompressionSession(self)
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats, series=len(self._series))
+        stats['ratio'] = (stats['offered'] / stats['inserted']) if stats['inserted'] else None
+        return stats
+
+
+class CompressionSession:
+    """
+    Decides INSERT vs UPDATE-tail for each sample of a transaction.
+
+    feed() returns ('insert', None), ('update', row_id) or ('raw', None); the
+    caller executes it and reports the new row id with bind(). commit()
+    publishes the state once the transaction is durable, so a rolled-back
+    write never leaves the compressor pointing at rows that do not exist.
+    """
+
+    def __init__(self, compressor: DeadbandCompressor):
+        self.compressor = compressor
+        self._overlay: Dict[Tuple, Optional[_Series]] = {}
+        self._counts = {'offered': 0, 'inserted': 0, 'updated': 0}
+
+    def _get(self, series_key) -> Optional[_Series]:
+        if series_key not in self._overlay:
+            base = self.compressor._series.get(series_key)
+            self._overlay[series_key] = base.copy() if base is not None else None
+        return self._overlay[series_key]
+
+    def feed(self, series_key, timestamp: str, values: Dict, key=None) -> Tuple[str, Optional[int]]:
+        self._counts['offered'] += 1
+        t = to_epoch(timestamp)
+        state = self._get(series_key)
+
+        if state is not None and t <= state.last_t:
+            # Late/replayed sample: store verbatim, leave the run alone
+            self._counts['inserted'] += 1
+            return 'raw', None
+
+        if state is None or self._breaks_run(state, t, values, key):
+            self._overlay[series_key] = _Series(t, values, key)
+            self._counts['inserted'] += 1
+            return 'insert', None
+
+        if state.tail is None:
+            # Second point of a run: becomes the tail, nothing between yet
+            state.tail_t, state.tail = t, values
+            self._counts['inserted'] += 1
+            return 'insert', None
+
+        # The current tail becomes an intermediate point: narrow the door
+        lower, upper = dict(state.lower), dict(state.upper)
+        for field, tol in self._fields(state):
+            dt = state.tail_t - state.anchor_t
+            delta = state.tail[field] - state.anchor[field]
+            lower[field] = max(lower.get(field, -math.inf), (delta - tol) / dt)
+            upper[field] = min(upper.get(field, math.inf), (delta + tol) / dt)
+
+        dt = t - state.anchor_t
+        # Stored points are never more than max_gap apart inside a run, so
+        # reconstruction can tell a long flat run from a collector outage
+        inside = dt <= self.compressor.max_gap and all(
+            lower[field] <= (values[field] - state.anchor[field]) / dt <= upper[field]
+            for field, _ in self._fields(state)
+        )
+        if inside:
+            state.tail_t, state.tail = t, values
+            state.lower, state.upper = lower, upper
+            if state.tail_id is not None:
+                self._counts['updated'] += 1
+                return 'update', state.tail_id
+            self._counts['inserted'] += 1
+            return 'insert', None
+
+        # Door closed: freeze the tail as the new anchor, sample is the new tail
+        new_state = _Series(state.tail_t, state.tail, key)
+        new_state.tail_t, new_state.tail = t, values
+        self._overlay[series_key] = new_state
+        self._counts['inserted'] += 1
+        return 'insert', None
+
+    def bind(self, series_key, row_id: int):
+        """Record the row id of the sample just inserted by feed()"""
+        state = self._overlay.get(series_key)
+        if state is not None:
+            state.tail_id = row_id if state.tail is not None else None
+
+    def _fields(self, state: _Series):
+        for field, tol in self.compressor.tolerances.items():
+            if field in state.anchor and state.anchor[field] is not None:
+                yield field, tol
+
+    def _breaks_run(self, state: _Series, t: float, values: Dict, key) -> bool:
+        if key != state.key or t - state.last_t > self.compressor.max_gap:
+            return True
+        # NULL <-> value transitions (e.g. temperature of a sleeping inverter)
+        # can't be interpolated, so they always start a new run
+        for field in self.compressor.tolerances:
+            if field in state.anchor and (state.anchor[field] is None) != (values.get(field) is None):
+                return True
+        return False
+
+    def commit(self):
+        series = self.compressor._series
+        for series_key, state in self._overlay.items():
+            if state is None:
+                series.pop(series_key, None)
+            else:
+                series[series_key] = state
+        for name, count in self._counts.items():
+            self.compressor.stats[name] += count
+
+
+# ----------------------------------------------------------------------
+# Reconstruction
+# ----------------------------------------------------------------------
+def expand_series(points: Sequence[Tuple[float, Dict]], fields: Iterable[str],
+                  start: float, end: float, step: float,
+                  max_gap: float) -> List[Tuple[float, Dict]]:
+    """
+    Linear interpolation of stored (epoch, values) points onto a grid.
+
+    Grid points inside a gap longer than ``max_gap`` (collector down) and
+    after the newest point are left out, exactly as if they were never
+    sampled.
+    """
+    fields = tuple(fields)
+    result = []
+    if not points or step <= 0:
+        return result
+    i = 0
+    g = math.ceil(start / step) * step
+    while g <= end:
+        while i + 1 < len(points) and points[i + 1][0] < g:
+            i += 1
+        t0, v0 = points[i]
+        if g == t0:
+            result.append((g, {f: v0.get(f) for f in fields}))
+        elif i + 1 < len(points) and t0 < g <= points[i + 1][0]:
+            t1, v1 = points[i + 1]
+            if t1 - t0 <= max_gap:
+                ratio = (g - t0) / (t1 - t0)
+                row = {}
+                for f in fields:
+                    a, b = v0.get(f), v1.get(f)
+                    row[f] = a + (b - a) * ratio if a is not None and b is not None else (b if g == t1 else a)
+                result.append((g, row))
+        g += step
+    return result
+
+
+def grid_step(bucket_seconds: float, span_seconds: float, max_points: int = 100000) -> float:
+    """Grid spacing fine enough for the bucket, bounded in total points"""
+    step = max(30.0, bucket_seconds / 60.0)
+    return max(step, math.ceil(span_seconds / max_points))
+
+
+def expand_solar_data(conn, start: str, end: Optional[str] = None, step: float = 60.0,
+                      max_gap: Optional[float] = None) -> str:
+    """
+    Fill TEMP table solar_data_expanded with site samples reconstructed on a
+    ``step``-second grid between ``start`` and ``end`` (local time strings).
+
+    Returns the table name so callers can run their usual aggregate SQL
+    against it instead of solar_data.
+    """
+    if max_gap is None:
+        max_gap = config.compression_max_gap_seconds
+    start_epoch = to_epoch(start)
+    end_epoch = to_epoch(end) if end else datetime.now().timestamp()
+
+    cursor = conn.cursor()
+    # The row just before the window anchors interpolation at its left edge
+    cursor.execute("""
+        SELECT * FROM (
+            SELECT timestamp, production_kw, consumption_kw, net_export_kw FROM site_samples
+            WHERE ts_epoch < ? ORDER BY ts_epoch DESC LIMIT 1
+        )
+        UNION ALL
+        SELECT timestamp, production_kw, consumption_kw, net_export_kw FROM site_samples
+        WHERE ts_epoch >= ? AND ts_epoch <= ?
+        ORDER BY timestamp
+    """, (int(start_epoch), int(start_epoch), int(end_epoch)))
+
+    points = []
+    for row in cursor.fetchall():
+        try:
+            t = to_epoch(row[0])
+        except (TypeError, ValueError):
+            continue
+        points.append((t, {f: row[i + 1] for i, f in enumerate(SITE_FIELDS)}))
+    points.sort(key=lambda p: p[0])
+
+    # Pooled web connections are query_only; TEMP writes are still fine
+    with temp_writes(conn):
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS solar_data_expanded (
+                timestamp TEXT, production_kw REAL, consumption_kw REAL, net_export_kw REAL,
+                ts_epoch INTEGER
+            )
+        """)
+        cursor.execute("DELETE FROM temp.solar_data_expanded")
+        cursor.executemany(
+            "INSERT INTO temp.solar_data_expanded VALUES (?, ?, ?, ?, ?)",
+            [(datetime.fromtimestamp(t).isoformat(timespec='seconds'),
+              v['production_kw'], v['consumption_kw'], v['net_export_kw'], int(t))
+             for t, v in expand_series(points, SITE_FIELDS, start_epoch, end_epoch, step, max_gap)]
+        )
+    return 'temp.solar_data_expanded'
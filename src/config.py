@@ -12,6 +12,14 @@ Licensed under the MIT License - see LICENSE file for details
 import os
 from pathlib import Path
 
+# Table names that used to be written directly and are now views over a
+# base table; settings naming them apply to that table
+LEGACY_TABLES = {
+    'solar_data': 'site_samples',
+    'system_status': 'site_samples',
+    'device_data': 'device_samples',
+}
+
 class Config:
     def __init__(self):
         self.load_env_file()
@@ -43,6 +51,61 @@ class Config:
     def pvs6_ip(self):
         return os.getenv('PVS6_IP_ADDRESS', '172.27.152.1')
     
+    @property
+    def pvs6_port(self):
+        return int(os.getenv('PVS6_PORT', '80'))
+    
+    @property
+    def pvs6_connect_timeout(self):
+        return float(os.getenv('PVS6_CONNECT_TIMEOUT', '3.05'))
+    
+    @property
+    def pvs6_read_timeout(self):
+        return float(os.getenv('PVS6_READ_TIMEOUT', '10'))
+    
+    @property
+    def pvs6_pool_size(self):
+        return int(os.getenv('PVS6_POOL_SIZE', '4'))
+    
+    @property
+    def pvs6_breaker_threshold(self):
+        """Consecutive failures before the circuit opens"""
+        return int(os.getenv('PVS6_BREAKER_THRESHOLD', '3'))
+    
+    @property
+    def pvs6_backoff_base(self):
+        return float(os.getenv('PVS6_BACKOFF_BASE', '5'))
+    
+    @property
+    def pvs6_backoff_max(self):
+        return float(os.getenv('PVS6_BACKOFF_MAX', '300'))
+    
+    @property
+    def pvs6_max_stale_seconds(self):
+        """Oldest last-good snapshot the dashboards may be served"""
+        return float(os.getenv('PVS6_MAX_STALE_SECONDS', '900'))
+    
+    @property
+    def simulated_fallback(self):
+        """Store simulated totals when the PVS6 is down (demo/dev only)"""
+        return os.getenv('SIMULATED_FALLBACK', 'false').lower() == 'true'
+    
+    @property
+    def pvs6_gateways(self):
+        """[(ip, port), ...] from PVS6_GATEWAYS="172.27.152.1,10.0.0.7:8080" (defaults to PVS6_IP_ADDRESS)"""
+        gateways = []
+        for entry in os.getenv('PVS6_GATEWAYS', '').split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            host, _, port = entry.partition(':')
+            gateways.append((host, int(port) if port else self.pvs6_port))
+        return gateways or [(self.pvs6_ip, self.pvs6_port)]
+    
+    @property
+    def pvs6_timeout_budget(self):
+        return float(os.getenv('PVS6_TIMEOUT_BUDGET', '20'))
+    
     @property
     def database_path(self):
         return os.getenv('DATABASE_PATH', '/opt/solar_monitor/solar_data.db')
@@ -51,6 +114,228 @@ class Config:
     def collector_interval(self):
         return int(os.getenv('COLLECTOR_INTERVAL', '60'))
     
+    @property
+    def collector_mode(self):
+        return os.getenv('COLLECTOR_MODE', 'sync').lower()
+    
+    @property
+    def noon_interval(self):
+        """Sample period around solar noon (seconds)"""
+        return int(os.getenv('NOON_INTERVAL', '30'))
+    
+    @property
+    def night_interval(self):
+        """Sample period between sunset and sunrise (seconds)"""
+        return int(os.getenv('NIGHT_INTERVAL', '600'))
+    
+    @property
+    def noon_window_hours(self):
+        """Fast sampling runs this many hours either side of solar noon"""
+        return float(os.getenv('NOON_WINDOW_HOURS', '2'))
+    
+    @property
+    def twilight_minutes(self):
+        """Daytime rate starts this long before sunrise / ends after sunset"""
+        return float(os.getenv('TWILIGHT_MINUTES', '30'))
+    
+    @property
+    def write_buffer_max_samples(self):
+        """Group-commit after this many buffered cycles"""
+        return int(os.getenv('WRITE_BUFFER_MAX_SAMPLES', '1'))
+    
+    @property
+    def write_buffer_max_seconds(self):
+        """...or once the oldest buffered cycle is this old"""
+        return float(os.getenv('WRITE_BUFFER_MAX_SECONDS', '60'))
+    
+    @property
+    def write_buffer_capacity(self):
+        """Cycles held in memory before spilling to the journal"""
+        return int(os.getenv('WRITE_BUFFER_CAPACITY', '500'))
+    
+    @property
+    def write_journal_path(self):
+        """Spill journal; empty means <database>-ingest.jsonl next to the DB"""
+        return os.getenv('WRITE_JOURNAL_PATH', '')
+    
+    @property
+    def compression_enabled(self):
+        """Deadband (swinging-door) compression of device_samples/site_samples"""
+        return os.getenv('COMPRESSION_ENABLED', 'false').lower() == 'true'
+    
+    @property
+    def compression_tolerances(self):
+        """Allowed deviation per column before a point must be stored"""
+        power = float(os.getenv('COMPRESSION_POWER_KW', '0.005'))
+        return {
+            'power_kw': power,
+            'production_kw': power,
+            'consumption_kw': power,
+            'net_export_kw': power,
+            'voltage': float(os.getenv('COMPRESSION_VOLTAGE', '1.0')),
+            'current_a': float(os.getenv('COMPRESSION_CURRENT_A', '0.05')),
+            'frequency': float(os.getenv('COMPRESSION_FREQUENCY', '0.05')),
+            'temperature': float(os.getenv('COMPRESSION_TEMPERATURE', '1.0')),
+        }
+    
+    @property
+    def compression_max_gap_seconds(self):
+        """Samples further apart than this are never interpolated across"""
+        return float(os.getenv('COMPRESSION_MAX_GAP_SECONDS', '1800'))
+    
+    @property
+    def raw_archive_enabled(self):
+        """Keep every DeviceList snapshot in the raw archive (raw_archive.py)"""
+        return os.getenv('RAW_ARCHIVE_ENABLED', 'true').lower() == 'true'
+    
+    @property
+    def raw_archive_level(self):
+        """zlib level of archived blocks (1 fastest .. 9 smallest)"""
+        return int(os.getenv('RAW_ARCHIVE_LEVEL', '6'))
+    
+    @property
+    def promoted_json_fields(self):
+        """JSON paths exposed as generated, optionally indexed columns (json_fields.py)"""
+        spec = os.getenv('PROMOTED_JSON_FIELDS',
+                         'device_samples.lifetime_kwh=$.ltea_3phsum_kwh:index,'
+                         'device_samples.mppt_kw=$.p_mppt1_kw,'
+                         'device_samples.mppt_v=$.v_mppt1_v,'
+                         'device_samples.mppt_a=$.i_mppt1_a')
+        fields = []
+        # e.g. "device_samples.lifetime_kwh=$.ltea_3phsum_kwh:index,weather_data.gust=$.wind.gust"
+        for rule in spec.split(','):
+            if '=' in rule:
+                target, path = (part.strip() for part in rule.split('=', 1))
+                table, _, name = target.partition('.')
+                table = LEGACY_TABLES.get(table, table)
+                path, *options = (part.strip() for part in path.split(':'))
+                options = [o.lower() for o in options]
+                types = [o.upper() for o in options if o in ('real', 'integer', 'text')]
+                fields.append({
+                    'table': table,
+                    'name': name,
+                    'path': path,
+                    'type': types[0] if types else 'REAL',
+                    'indexed': 'index' in options,
+                })
+        return fields
+    
+    @property
+    def retention_policy(self):
+        """Days to keep per table (None = forever); RETENTION_POLICY overrides"""
+        policy = {
+            'site_samples': 90,
+            'device_samples': 90,
+            'weather_data': 730,
+            'solar_rollup_1m': 90,
+            'solar_rollup_15m': 730,
+            'solar_rollup_1h': 730,
+            'solar_rollup_1d': None,
+            'device_rollup_15m': 730,
+            'device_rollup_1d': None,
+            'raw_snapshots': None,
+        }
+        # e.g. "device_samples=30,solar_rollup_15m=1095,weather_data=forever"
+        for rule in os.getenv('RETENTION_POLICY', '').split(','):
+            if '=' in rule:
+                table, days = (part.strip() for part in rule.split('=', 1))
+                table = LEGACY_TABLES.get(table, table)
+                policy[table] = None if days.lower() in ('forever', 'none', '') else int(days)
+        return policy
+    
+    @property
+    def retention_batch_rows(self):
+        return int(os.getenv('RETENTION_BATCH_ROWS', '2000'))
+    
+    @property
+    def retention_batch_pause_ms(self):
+        """Pause between delete batches so the collector can get the write lock"""
+        return float(os.getenv('RETENTION_BATCH_PAUSE_MS', '50'))
+    
+    @property
+    def maintenance_enabled(self):
+        """Collector thread running the maintenance.py jobs"""
+        return os.getenv('MAINTENANCE_ENABLED', 'true').lower() == 'true'
+    
+    @property
+    def maintenance_quiet_hours(self):
+        """Local hours 'start-end' in which free pages are vacuumed"""
+        return os.getenv('MAINTENANCE_QUIET_HOURS', '1-5')
+    
+    @property
+    def maintenance_vacuum_pages(self):
+        """Pages returned per incremental_vacuum transaction"""
+        return int(os.getenv('MAINTENANCE_VACUUM_PAGES', '256'))
+    
+    @property
+    def maintenance_vacuum_pause_ms(self):
+        return float(os.getenv('MAINTENANCE_VACUUM_PAUSE_MS', '100'))
+    
+    @property
+    def maintenance_convert(self):
+        """Convert an existing database to auto_vacuum=INCREMENTAL (one VACUUM in quiet hours)"""
+        return os.getenv('MAINTENANCE_CONVERT', 'true').lower() == 'true'
+    
+    @property
+    def maintenance_checkpoint_minutes(self):
+        return float(os.getenv('MAINTENANCE_CHECKPOINT_MINUTES', '10'))
+    
+    @property
+    def maintenance_wal_max_mb(self):
+        """WAL size past which a TRUNCATE checkpoint is forced"""
+        return float(os.getenv('MAINTENANCE_WAL_MAX_MB', '32'))
+    
+    @property
+    def maintenance_optimize_hours(self):
+        return float(os.getenv('MAINTENANCE_OPTIMIZE_HOURS', '6'))
+    
+    @property
+    def maintenance_quick_check_hours(self):
+        """PRAGMA quick_check every N hours (0 = only on demand)"""
+        return float(os.getenv('MAINTENANCE_QUICK_CHECK_HOURS', '6'))
+    
+    @property
+    def maintenance_integrity_check_days(self):
+        """Full PRAGMA integrity_check every N days, in quiet hours (0 = only on demand)"""
+        return float(os.getenv('MAINTENANCE_INTEGRITY_CHECK_DAYS', '7'))
+    
+    @property
+    def maintenance_stats_reconcile_hours(self):
+        """Recount the statistics catalog every N hours, in quiet hours (0 = only on demand)"""
+        return float(os.getenv('MAINTENANCE_STATS_RECONCILE_HOURS', '24'))
+    
+    @property
+    def db_pool_max_readers(self):
+        """Read-only connections the web process keeps open at most"""
+        return int(os.getenv('DB_POOL_MAX_READERS', '8'))
+    
+    @property
+    def db_pool_wait_seconds(self):
+        """How long a request waits for a free connection before failing"""
+        return float(os.getenv('DB_POOL_WAIT_SECONDS', '10'))
+    
+    @property
+    def db_pool_cached_statements(self):
+        """Prepared statements cached per pooled connection"""
+        return int(os.getenv('DB_POOL_CACHED_STATEMENTS', '256'))
+    
+    @property
+    def storage_mode(self):
+        """'single' (one database file) or 'partitioned' (monthly files)"""
+        return os.getenv('STORAGE_MODE', 'single').lower()
+    
+    @property
+    def partition_dir(self):
+        """Monthly partition files; empty means <database dir>/partitions"""
+        return os.getenv('PARTITION_DIR', '')
+    
+    @property
+    def partitioned_tables(self):
+        """Time-series tables that go to the monthly files in partitioned mode"""
+        tables = os.getenv('PARTITIONED_TABLES', 'site_samples,device_samples')
+        tables = (LEGACY_TABLES.get(t.strip(), t.strip()) for t in tables.split(','))
+        return tuple(dict.fromkeys(t for t in tables if t))
+    
     @property
     def system_timezone(self):
         return os.getenv('SYSTEM_TIMEZONE', 'America/Denver')
@@ -59,6 +344,46 @@ class Config:
     def backup_path(self):
         return os.getenv('BACKUP_PATH', '/opt/solar_monitor/backups')
     
+    @property
+    def backup_interval_hours(self):
+        """Scheduled backup sets (backup.py) every N hours; 0 disables them"""
+        return float(os.getenv('BACKUP_INTERVAL_HOURS', '24'))
+    
+    @property
+    def backup_keep(self):
+        """Backup sets kept in BACKUP_PATH (oldest removed first)"""
+        return int(os.getenv('BACKUP_KEEP', '7'))
+    
+    @property
+    def backup_step_pages(self):
+        """Pages copied per backup step before the lock is released"""
+        return int(os.getenv('BACKUP_STEP_PAGES', '1024'))
+    
+    @property
+    def backup_step_pause_ms(self):
+        """Pause between backup steps so the collector can write"""
+        return float(os.getenv('BACKUP_STEP_PAUSE_MS', '20'))
+    
+    @property
+    def backup_verify(self):
+        """'quick' (quick_check), 'full' (integrity_check) or 'off'"""
+        return os.getenv('BACKUP_VERIFY', 'quick').lower()
+    
+    @property
+    def analytics_replica_enabled(self):
+        """Run SQL explorer/browse/export queries on a replica (replica.py), not the live database"""
+        return os.getenv('ANALYTICS_REPLICA_ENABLED', 'false').lower() == 'true'
+    
+    @property
+    def analytics_replica_path(self):
+        """Replica directory; empty means <database dir>/replica"""
+        return os.getenv('ANALYTICS_REPLICA_PATH', '')
+    
+    @property
+    def analytics_replica_refresh_minutes(self):
+        """Replica refreshed every N minutes by the collector; 0 only refreshes on demand"""
+        return float(os.getenv('ANALYTICS_REPLICA_REFRESH_MINUTES', '15'))
+    
     @property
     def weather_api_key(self):
         return os.getenv('WEATHER_API_KEY', '')
@@ -74,6 +399,10 @@ class Config:
     @property
     def weather_enabled(self):
         return os.getenv('WEATHER_ENABLED', 'true').lower() == 'true'
+    
+    @property
+    def weather_timeout_budget(self):
+        return float(os.getenv('WEATHER_TIMEOUT_BUDGET', '10'))
 
 # Global config instance
 config = Config()
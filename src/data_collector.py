@@ -13,27 +13,67 @@ Uses the original PVSClient that was successfully getting real data
 
 import sys
 import os
+import signal
 import time
 import sqlite3
 from datetime import datetime
 import requests
-import json
 
 # Add the current directory to Python path to import modules
 sys.path.append('/opt/solar_monitor')
 
 try:
-    from pvs_client import PVSClient
+    from pvs_client import get_shared_client
     print("✅ Successfully imported PVSClient")
     USE_REAL_PVS = True
 except ImportError as e:
     print(f"❌ Could not import PVSClient: {e}")
     USE_REAL_PVS = False
 
+from storage import CycleWriter, WriteBehindBuffer, make_cycle
+from scheduler import AdaptiveScheduler
+from migrations import migrate as migrate_schema
+from compression import DeadbandCompressor
+from partitions import PartitionSet
+from raw_archive import ArchiveWriter
+from site_samples import create_site_samples
+from devices import create_device_samples
+from maintenance import MaintenanceScheduler, ensure_auto_vacuum
+from config import config
+
+DB_PATH = '/opt/solar_monitor/solar_data.db'
+
+# Per-stage timings (milliseconds) of the most recent collection cycle
+LAST_CYCLE_TIMINGS = {}
+
+# Long-lived writer: every cycle is one transaction on one connection
+_writer = None
+
+def get_writer():
+    """Process-wide CycleWriter"""
+    global _writer
+    if _writer is None:
+        # Deadband compression (COMPRESSION_ENABLED) and monthly partition
+        # files (STORAGE_MODE=partitioned) are opt-in
+        _writer = CycleWriter(DB_PATH, compressor=DeadbandCompressor.from_config(),
+                              partitions=PartitionSet.from_config(DB_PATH),
+                              archive=ArchiveWriter.from_config())
+    return _writer
+
+# Write-behind buffer in front of the writer: group commits, rides out
+# "database is locked", spills to a journal if SQLite stays unavailable
+_buffer = None
+
+def get_buffer():
+    """Process-wide WriteBehindBuffer (flusher thread started on first use)"""
+    global _buffer
+    if _buffer is None:
+        _buffer = WriteBehindBuffer.from_config(get_writer()).start()
+    return _buffer
+
 def get_db_connection():
     """Simple database connection"""
-    db_path = '/opt/solar_monitor/solar_data.db'
-    conn = sqlite3.connect(db_path, timeout=10.0, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, timeout=10.0, check_same_thread=False)
     conn.execute('PRAGMA journal_mode=WAL')
     conn.execute('PRAGMA busy_timeout=5000')
     return conn
@@ -43,46 +83,16 @@ def ensure_tables():
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Create system_status table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS system_status (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            production_kw REAL DEFAULT 0,
-            consumption_kw REAL DEFAULT 0,
-            net_export_kw REAL DEFAULT 0,
-            grid_frequency REAL DEFAULT 60.0,
-            voltage REAL DEFAULT 240.0
-        )
-    """)
+    # A new database gets auto_vacuum=INCREMENTAL before its first table
+    ensure_auto_vacuum(conn)
     
-    # Create solar_data table with device_id column
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS solar_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            production_kw REAL DEFAULT 0,
-            consumption_kw REAL DEFAULT 0,
-            net_export_kw REAL DEFAULT 0,
-            device_id TEXT DEFAULT NULL
-        )
-    """)
+    # One site-level table; system_status/solar_data are views over it
+    # (created by the migrations below)
+    create_site_samples(conn)
     
-    # Create device_data table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS device_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            device_id TEXT,
-            device_type TEXT DEFAULT 'inverter',
-            status TEXT DEFAULT 'working',
-            power_kw REAL DEFAULT 0,
-            voltage REAL DEFAULT 240.0,
-            current_a REAL DEFAULT 0,
-            frequency REAL DEFAULT 60.0,
-            temperature REAL DEFAULT 25.0
-        )
-    """)
+    # Dictionary-encoded device samples; device_data is a view over them
+    # (created by the migrations below, like the registry tables)
+    create_device_samples(conn)
     
     # Create weather_data table
     cursor.execute("""
@@ -110,27 +120,33 @@ def ensure_tables():
     """)
     
     # Create indexes for better performance
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON solar_data(timestamp)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_device_timestamp ON device_data(device_id, timestamp)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_weather_timestamp ON weather_data(timestamp)")
     
     conn.commit()
     conn.close()
+    
+    # Indexed integer ts_epoch columns (backfilled in chunks on first run)
+    migrate_schema(DB_PATH)
 
-def collect_data_from_pvs():
-    """Collect real data using the original PVSClient"""
+def collect_snapshot():
+    """Fetch the single DeviceList snapshot used by this collection cycle"""
     try:
-        pvs_client = PVSClient()
-        
-        # Test connection first
-        if not pvs_client.test_connection():
+        return get_shared_client().get_snapshot()
+    except Exception as e:
+        print(f"❌ Error fetching PVS snapshot: {e}")
+        return None
+
+def collect_data_from_pvs(snapshot):
+    """Derive system totals from this cycle's snapshot (no extra gateway requests)"""
+    try:
+        if snapshot is None or not snapshot.pvs_online:
             print("❌ PVS connection test failed")
             return None
             
         print("✅ PVS connection test successful")
         
         # Get system summary with real data
-        summary = pvs_client.get_system_summary()
+        summary = get_shared_client().get_system_summary(snapshot)
         
         if summary and summary.get('system_online', False):
             production_kw = summary.get('total_production_kw', 0)
@@ -175,59 +191,24 @@ def generate_fallback_data():
     }
 
 
-def collect_and_store_device_data():
-    """Collect and store individual device data from PVS"""
-    if not USE_REAL_PVS:
-        print("⚠️  PVSClient not available - skipping individual device data collection")
-        return
-        
-    try:
-        pvs_client = PVSClient()
-        
-        # Get individual device data
-        devices = pvs_client.get_device_list()
-        if not devices:
-            print("❌ No device data available from PVS")
-            return
-            
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        timestamp = datetime.now().isoformat()
-        
-        device_count = 0
-        for device in devices:
-            device_id = device.get('DEVICE_ID')
-            device_type = device.get('TYPE', 'unknown').lower()
-            
-            # Only process inverters for now
-            if device_type == 'inverter' and device_id:
-                # Extract device metrics
-                power_kw = float(device.get('p_3phsum_kw', 0))
-                voltage = float(device.get('vln_3phavg', 240.0))
-                current_a = float(device.get('i_3phsum_a', 0))
-                frequency = float(device.get('freq_hz', 60.0))
-                temperature = float(device.get('t_htsnk_degc', 25.0))
-                status = 'working' if device.get('STATE') == 'working' else 'offline'
-                
-                # Insert time-series record for this device
-                cursor.execute("""
-                    INSERT INTO device_data (timestamp, device_id, device_type, status, power_kw, voltage, current_a, frequency, temperature)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (timestamp, device_id, device_type, status, power_kw, voltage, current_a, frequency, temperature))
-                
-                device_count += 1
-                print(f"✅ Stored data for {device_id}: {power_kw:.3f}kW, {voltage:.1f}V, {temperature:.1f}°C, {status}")
-        
-        conn.commit()
-        conn.close()
-        
-        print(f"✅ Stored individual data for {device_count} devices")
-        
-    except Exception as e:
-        print(f"❌ Error collecting individual device data: {e}")
+def build_device_rows(snapshot):
+    """Per-inverter device_data rows for this cycle's snapshot"""
+    if snapshot is None:
+        return []
+    rows = []
+    for row in snapshot.inverter_rows():
+        status = 'working' if row['state'] == 'working' else 'offline'
+        rows.append(dict(row, status=status))
+    return rows
 
-def collect_weather_data():
-    """Collect and store weather data"""
+def raw_devices(snapshot):
+    """DeviceList entries for the raw archive (none for a stale/offline snapshot)"""
+    if snapshot is None or not snapshot.pvs_online or snapshot.stale:
+        return []
+    return snapshot.raw_devices()
+
+def fetch_weather_data(timeout=10):
+    """Fetch current conditions from OpenWeatherMap; returns weather_info or None"""
     try:
         # Get weather configuration from environment
         weather_enabled = os.getenv('WEATHER_ENABLED', 'true').lower() == 'true'
@@ -237,151 +218,138 @@ def collect_weather_data():
         
         if not weather_enabled or not weather_api_key:
             print("⚠️  Weather collection disabled or API key not configured")
-            return
+            return None
         
         # Call OpenWeatherMap API
         url = f"https://api.openweathermap.org/data/2.5/weather?lat={weather_lat}&lon={weather_lon}&appid={weather_api_key}&units=metric"
         
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            weather_data = response.json()
-            
-            # Extract weather information
-            weather_info = {
-                'temperature': weather_data['main']['temp'],
-                'feels_like': weather_data['main']['feels_like'],
-                'humidity': weather_data['main']['humidity'],
-                'pressure': weather_data['main']['pressure'],
-                'visibility': weather_data.get('visibility', 0) / 1000,  # Convert to km
-                'uv_index': weather_data.get('uvi', 0),
-                'clouds': weather_data['clouds']['all'],
-                'wind_speed': weather_data['wind']['speed'],
-                'wind_direction': weather_data['wind'].get('deg', 0),
-                'weather_main': weather_data['weather'][0]['main'],
-                'weather_description': weather_data['weather'][0]['description'],
-                'weather_icon': weather_data['weather'][0]['icon'],
-                'sunrise': weather_data['sys']['sunrise'],
-                'sunset': weather_data['sys']['sunset'],
-                'city': weather_data['name'],
-                'country': weather_data['sys']['country']
-            }
-            
-            # Store in database
-            conn = get_db_connection()
-            if conn:
-                cursor = conn.cursor()
-                timestamp = datetime.now().isoformat()
-                
-                cursor.execute('''
-                    INSERT INTO weather_data (
-                        timestamp, temperature, feels_like, humidity, pressure, visibility, uv_index,
-                        clouds, wind_speed, wind_direction, weather_main, weather_description,
-                        weather_icon, sunrise, sunset, city, country, api_response
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    timestamp,
-                    weather_info['temperature'],
-                    weather_info['feels_like'],
-                    weather_info['humidity'],
-                    weather_info['pressure'],
-                    weather_info['visibility'],
-                    weather_info['uv_index'],
-                    weather_info['clouds'],
-                    weather_info['wind_speed'],
-                    weather_info['wind_direction'],
-                    weather_info['weather_main'],
-                    weather_info['weather_description'],
-                    weather_info['weather_icon'],
-                    weather_info['sunrise'],
-                    weather_info['sunset'],
-                    weather_info['city'],
-                    weather_info['country'],
-                    json.dumps(weather_info)
-                ))
-                
-                conn.commit()
-                conn.close()
-                
-                print(f"✅ Weather data stored: {weather_info['city']} - {weather_info['temperature']:.1f}°C, {weather_info['weather_description']}")
-            else:
-                print("❌ Failed to connect to database for weather data")
-                
-        else:
+        response = requests.get(url, timeout=timeout)
+        if response.status_code != 200:
             print(f"❌ Weather API error: {response.status_code}")
+            return None
+        
+        weather_data = response.json()
+        
+        # Extract weather information
+        return {
+            'temperature': weather_data['main']['temp'],
+            'feels_like': weather_data['main']['feels_like'],
+            'humidity': weather_data['main']['humidity'],
+            'pressure': weather_data['main']['pressure'],
+            'visibility': weather_data.get('visibility', 0) / 1000,  # Convert to km
+            'uv_index': weather_data.get('uvi', 0),
+            'clouds': weather_data['clouds']['all'],
+            'wind_speed': weather_data['wind']['speed'],
+            'wind_direction': weather_data['wind'].get('deg', 0),
+            'weather_main': weather_data['weather'][0]['main'],
+            'weather_description': weather_data['weather'][0]['description'],
+            'weather_icon': weather_data['weather'][0]['icon'],
+            'sunrise': weather_data['sys']['sunrise'],
+            'sunset': weather_data['sys']['sunset'],
+            'city': weather_data['name'],
+            'country': weather_data['sys']['country']
+        }
             
     except requests.exceptions.RequestException as e:
         print(f"❌ Weather API request failed: {e}")
     except Exception as e:
         print(f"❌ Error collecting weather data: {e}")
+    return None
+
+def build_cycle(snapshot, timestamp=None, weather=None):
+    """
+    Turn this cycle's snapshot into a storage cycle record.
+    Returns (cycle, data_source). Without PVS data the cycle carries no
+    system/device rows (a gap, not made-up numbers) unless
+    SIMULATED_FALLBACK=true.
+    """
+    pvs_data = collect_data_from_pvs(snapshot) if USE_REAL_PVS else None
+    
+    if timestamp is None:
+        timestamp = snapshot.timestamp if snapshot is not None else datetime.now().isoformat()
+    
+    if not pvs_data:
+        if not config.simulated_fallback:
+            print("⚠️  PVS6 not available - no solar sample stored this cycle")
+            return make_cycle(timestamp, weather=weather), 'pvs6_offline'
+        pvs_data = generate_fallback_data()
+        print(f"⚠️  PVS6 not available - using fallback data: {pvs_data['production_kw']:.2f}kW production, {pvs_data['consumption_kw']:.2f}kW consumption")
+    
+    system = {
+        'production_kw': pvs_data['production_kw'],
+        'consumption_kw': pvs_data['consumption_kw'],
+        'net_export_kw': pvs_data['net_export_kw'],
+    }
+    devices = build_device_rows(snapshot) if USE_REAL_PVS else []
+    raw = raw_devices(snapshot) if USE_REAL_PVS else []
+    return make_cycle(timestamp, system, devices, weather, raw), pvs_data['source']
+
+def _elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
 
-def collect_data():
-    """Main data collection function"""
+def report_cycle_timings(timings):
+    """Print this cycle's per-stage timings on one line"""
+    LAST_CYCLE_TIMINGS.clear()
+    LAST_CYCLE_TIMINGS.update(timings)
+    stages = ', '.join(f"{name}={ms:.0f}ms" for name, ms in timings.items())
+    print(f"⏱️  Cycle timings: {stages}")
+
+def collect_data(timestamp=None):
+    """Main data collection function; ``timestamp`` is the scheduled grid time"""
     try:
         print(f"[{datetime.now()}] 🔌 Attempting to collect data from PVS6...")
+        cycle_started = time.perf_counter()
+        timings = {}
+        snapshot = None
         
         # Try to get real PVS data first (if PVSClient is available)
         if USE_REAL_PVS:
-            pvs_data = collect_data_from_pvs()
-            
-            if pvs_data:
-                # Use real PVS data
-                production_kw = pvs_data['production_kw']
-                consumption_kw = pvs_data['consumption_kw']
-                net_export_kw = pvs_data['net_export_kw']
-                data_source = pvs_data['source']
-                
-                print(f"✅ REAL PVS6 Data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
-            else:
-                # Fall back to simulated data
-                fallback = generate_fallback_data()
-                production_kw = fallback['production_kw']
-                consumption_kw = fallback['consumption_kw']
-                net_export_kw = fallback['net_export_kw']
-                data_source = fallback['source']
-                
-                print(f"⚠️  PVS6 not available - using fallback data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
+            # One DeviceList fetch per cycle - everything below derives from it
+            started = time.perf_counter()
+            snapshot = collect_snapshot()
+            timings['pvs_fetch'] = _elapsed_ms(started)
         else:
-            # PVSClient not available, use simulated data
-            fallback = generate_fallback_data()
-            production_kw = fallback['production_kw']
-            consumption_kw = fallback['consumption_kw']
-            net_export_kw = fallback['net_export_kw']
-            data_source = fallback['source']
-            
-            print(f"⚠️  PVSClient not available - using fallback data: {production_kw:.2f}kW production, {consumption_kw:.2f}kW consumption")
-        
-        # Store in database
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        timestamp = datetime.now().isoformat()
+            print("⚠️  PVSClient not available - using fallback data")
         
-        # Insert into system_status
-        cursor.execute("""
-            INSERT INTO system_status (timestamp, production_kw, consumption_kw, net_export_kw)
-            VALUES (?, ?, ?, ?)
-        """, (timestamp, production_kw, consumption_kw, net_export_kw))
+        started = time.perf_counter()
+        cycle, data_source = build_cycle(snapshot, timestamp)
+        timings['parse'] = _elapsed_ms(started)
         
-        # Insert into solar_data for compatibility
-        cursor.execute("""
-            INSERT INTO solar_data (timestamp, production_kw, consumption_kw, net_export_kw)
-            VALUES (?, ?, ?, ?)
-        """, (timestamp, production_kw, consumption_kw, net_export_kw))
+        # Collect weather data at the same frequency as solar data
+        started = time.perf_counter()
+        cycle['weather'] = fetch_weather_data()
+        timings['weather'] = _elapsed_ms(started)
         
-        conn.commit()
-        conn.close()
+        # System totals, inverter rows and weather in ONE transaction (group
+        # committed with other buffered cycles when WRITE_BUFFER_MAX_SAMPLES > 1)
+        started = time.perf_counter()
+        buffer = get_buffer()
+        rows = buffer.add(cycle)
+        timings['store'] = _elapsed_ms(started)
         
-        print(f"✅ Data stored ({data_source}): {production_kw:.2f}kW, {consumption_kw:.2f}kW, {net_export_kw:.2f}kW")
+        system = cycle['system']
+        if system is None:
+            print(f"💤 No solar sample this cycle ({data_source}), {rows} rows stored")
+        elif rows:
+            print(f"✅ Data stored ({data_source}): {system['production_kw']:.2f}kW, {system['consumption_kw']:.2f}kW, {system['net_export_kw']:.2f}kW")
+            print(f"✅ Stored {len(cycle['devices'])} device rows, {rows} rows total")
+        else:
+            print(f"📥 Data buffered ({data_source}): {system['production_kw']:.2f}kW, {buffer.get_stats()['pending']} cycle(s) pending")
         
-        # Also collect and store individual device data
-        collect_and_store_device_data()
+        timings['total'] = _elapsed_ms(cycle_started)
+        report_cycle_timings(timings)
         
-        # Collect weather data at the same frequency as solar data
-        collect_weather_data()
+        stats = get_writer().get_stats()
+        if stats['transactions']:
+            print(f"💾 Writer: {stats['rows_per_sec'] or 0:.0f} rows/s, commit {stats['last_commit_ms']:.1f}ms (avg {stats['avg_commit_ms']:.1f}ms)")
         
     except Exception as e:
         print(f"❌ Collection error: {e}")
 
+def _exit_on_sigterm(signum, frame):
+    print("\n🛑 SIGTERM received - flushing buffered data")
+    sys.exit(0)
+
 def main():
     """Main data collector loop"""
     print("🌞 Original Working Solar Data Collector Starting...")
@@ -398,20 +366,59 @@ def main():
         print(f"❌ Database setup error: {e}")
         return
     
-    # Collect initial data
-    collect_data()
+    # Cycles spilled by a previous run go in before anything new
+    get_buffer().replay_journal()
     
-    # Run collection loop
-    while True:
-        try:
-            time.sleep(60)   # Wait 1 minute
-            collect_data()
-        except KeyboardInterrupt:
-            print("\n🛑 Collector stopped by user")
-            break
-        except Exception as e:
-            print(f"❌ Error: {e}")
-            time.sleep(60)  # Wait 1 minute before retry
+    # Online backups (BACKUP_INTERVAL_HOURS) on their own thread
+    from backup import BackupScheduler
+    backups = BackupScheduler.from_config(DB_PATH)
+    if backups is not None:
+        backups.start()
+    
+    # Analytics replica for the SQL explorer (ANALYTICS_REPLICA_ENABLED)
+    from replica import ReplicaScheduler
+    replica = ReplicaScheduler.from_config(DB_PATH)
+    if replica is not None:
+        replica.start()
+    
+    # Checkpoints, PRAGMA optimize, quiet-hours incremental_vacuum
+    maintenance = MaintenanceScheduler.from_config(DB_PATH)
+    if maintenance is not None:
+        maintenance.start()
+    
+    # systemctl stop -> SystemExit, so the buffer is flushed on either path
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    
+    # Concurrent per-source engine (python data_collector.py --async)
+    if '--async' in sys.argv or config.collector_mode == 'async':
+        from async_collector import run_async_collector
+        # Hand over this module's buffer: under "python data_collector.py"
+        # this module is __main__, and only its buffer is replayed and closed
+        run_async_collector(get_buffer(), build_cycle, fetch_weather_data, DB_PATH)
+        return
+    
+    # Samples land on a wall-clock grid whose spacing follows the sun
+    scheduler = AdaptiveScheduler.from_config(DB_PATH)
+    print(f"⏰ Schedule: {scheduler.describe()}")
+    
+    try:
+        # Collect initial data
+        collect_data()
+        
+        # Run collection loop
+        for scheduled, phase in scheduler.ticks():
+            try:
+                collect_data(scheduled.isoformat())
+            except KeyboardInterrupt:
+                print("\n🛑 Collector stopped by user")
+                break
+            except Exception as e:
+                print(f"❌ Error: {e}")
+    except KeyboardInterrupt:
+        print("\n🛑 Collector stopped by user")
+    finally:
+        get_buffer().close()
+        print(f"💾 Write-behind buffer closed: {get_buffer().get_stats()}")
 
 if __name__ == '__main__':
     main()
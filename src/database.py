@@ -2,14 +2,20 @@
 Database management for solar monitoring data
 """
 import sqlite3
-import json
+import time
 from datetime import datetime
 from typing import List, Dict, Optional
 import config
+import rollups
+from migrations import migrate, timestamp_epoch
+from raw_archive import ArchiveWriter
+from retention import RetentionEngine
+from site_samples import create_site_samples
 
 class SolarDatabase:
     def __init__(self, db_path: str = config.DATABASE_PATH):
         self.db_path = db_path
+        self.archive = ArchiveWriter.from_config()
         self.init_database()
     
     def get_connection(self):
@@ -28,43 +34,11 @@ class SolarDatabase:
     def init_database(self):
         """Initialize the database with required tables"""
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Create solar_data table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS solar_data (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    device_id TEXT,
-                    device_type TEXT,
-                    power_kw REAL,
-                    energy_kwh REAL,
-                    voltage REAL,
-                    current REAL,
-                    frequency REAL,
-                    raw_data TEXT
-                )
-            ''')
-            
-            # Create system_status table for overall system health
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS system_status (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    total_production_kw REAL,
-                    total_consumption_kw REAL,
-                    net_export_kw REAL,
-                    system_online BOOLEAN,
-                    pvs_online BOOLEAN
-                )
-            ''')
-            
-            # Create indexes for better query performance
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON solar_data(timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_device_id ON solar_data(device_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_status_timestamp ON system_status(timestamp)')
-            
+            # solar_data and system_status are views over site_samples; the
+            # migrations create them (with insert triggers for the methods below)
+            create_site_samples(conn)
             conn.commit()
+        migrate(self.db_path, verbose=False)
     
     def insert_solar_data(self, device_data: Dict):
         """Insert solar device data into the database"""
@@ -73,8 +47,8 @@ class SolarDatabase:
             
             cursor.execute('''
                 INSERT INTO solar_data 
-                (device_id, device_type, power_kw, energy_kwh, voltage, current, frequency, raw_data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                (device_id, device_type, power_kw, energy_kwh, voltage, current, frequency)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (
                 device_data.get('device_id'),
                 device_data.get('device_type'),
@@ -83,9 +57,18 @@ class SolarDatabase:
                 device_data.get('voltage'),
                 device_data.get('current'),
                 device_data.get('frequency'),
-                json.dumps(device_data.get('raw_data', {}))
             ))
             
+            # The raw device block goes to the deduplicating archive, not a column
+            raw_data = device_data.get('raw_data')
+            if raw_data and self.archive is not None:
+                timestamp = datetime.now().isoformat()
+                try:
+                    self.archive.archive(conn, timestamp, timestamp_epoch(timestamp), [raw_data])
+                except sqlite3.Error:
+                    self.archive.reset()
+                    raise
+            
             conn.commit()
     
     def insert_system_status(self, status_data: Dict):
@@ -138,49 +121,26 @@ class SolarDatabase:
             return [dict(row) for row in rows]
     
     def get_daily_summary(self, days: int = 7) -> List[Dict]:
-        """Get daily energy production summary"""
+        """Get daily energy production summary (from the 1-day rollup tier)"""
         with self.get_connection() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
-            cursor.execute('''
+            # Samples are irregular (denser around noon): time-weighted energy and mean
+            cursor.execute(f'''
                 SELECT 
-                    DATE(timestamp) as date,
-                    SUM(energy_kwh) as daily_energy_kwh,
-                    AVG(power_kw) as avg_power_kw,
-                    MAX(power_kw) as peak_power_kw
-                FROM solar_data 
-                WHERE timestamp >= datetime('now', '-{} days')
-                AND device_type = 'production_meter'
-                GROUP BY DATE(timestamp)
-                ORDER BY date DESC
-            '''.format(days))
+                    date(bucket, 'unixepoch', 'localtime') as date,
+                    {rollups.energy_sql('production')} / 3600.0 as daily_energy_kwh,
+                    {rollups.energy_sql('production')} / {rollups.seconds_sql()} as avg_power_kw,
+                    production_max as peak_power_kw
+                FROM {rollups.rollup_table('1d')} 
+                WHERE bucket >= ?
+                ORDER BY bucket DESC
+            ''', (rollups.bucket_start(conn, '1d', time.time() - days * 86400),))
             
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
     
     def cleanup_old_data(self):
-        """Remove old data to prevent database from growing too large"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Keep only the most recent data points
-            cursor.execute('''
-                DELETE FROM solar_data 
-                WHERE id NOT IN (
-                    SELECT id FROM solar_data 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                )
-            ''', (config.MAX_DATA_POINTS,))
-            
-            cursor.execute('''
-                DELETE FROM system_status 
-                WHERE id NOT IN (
-                    SELECT id FROM system_status 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                )
-            ''', (config.MAX_DATA_POINTS // 10,))  # Keep fewer status records
-            
-            conn.commit()
+        """Apply the retention policy (downsample, then batched deletes)"""
+        return RetentionEngine.from_config(self.db_path).run()
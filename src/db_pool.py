@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Connection Pool
+Reusable SQLite connections for the web process.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Readers are opened once, read-only (``mode=ro`` URI + ``PRAGMA query_only``),
+with a busy timeout, a larger page cache, in-memory temp storage and a
+bigger prepared-statement cache, and then handed out to one request thread
+at a time. close() on a pooled connection returns it to the pool (rolled
+back and reset) instead of closing it; release_thread() - called by the
+Flask teardown hook - returns whatever a request forgot to close, so an
+exception can no longer leak a connection.
+
+All writes of the web process (admin endpoints) share ONE write connection,
+serialised by a lock, so the dashboard never competes with itself for the
+SQLite write lock.
+
+stats() reports checkouts, hits (an idle connection was reused), misses
+(a new one had to be opened) and waits for both sides.
+"""
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """No pooled connection became free within the wait limit"""
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to its pool"""
+
+    pool = None
+    writer = False
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool._release(self)
+
+    def discard(self):
+        """Really close (used when the pool shuts down)"""
+        super().close()
+
+
+@contextmanager
+def temp_writes(conn):
+    """Allow TEMP views/tables on a query_only reader (main stays mode=ro)"""
+    query_only = conn.execute('PRAGMA query_only').fetchone()[0]
+    if query_only:
+        conn.execute('PRAGMA query_only=OFF')
+    try:
+        yield conn
+    finally:
+        if query_only:
+            conn.execute('PRAGMA query_only=ON')
+
+
+class ConnectionPool:
+    """Bounded pool of read-only connections plus one shared writer"""
+
+    def __init__(self, db_path: str, max_readers: int = 8, wait_seconds: float = 10.0,
+                 cached_statements: int = 256, busy_timeout_ms: int = 5000,
+                 cache_kib: int = 8192, row_factory=None):
+        self.db_path = db_path
+        self.max_readers = max_readers
+        self.wait_seconds = wait_seconds
+        self.cached_statements = cached_statements
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_kib = cache_kib
+        self.row_factory = row_factory
+
+        self._cond = threading.Condition()
+        self._idle: List[PooledConnection] = []
+        self._open = 0
+        self._checked_out: Dict[int, List[PooledConnection]] = {}
+        self._writer: Optional[PooledConnection] = None
+        self._write_lock = threading.Lock()
+        self._write_owner: Optional[int] = None
+        self._counters = {
+            'reader_checkouts': 0,
+            'reader_hits': 0,
+            'reader_misses': 0,
+            'reader_waits': 0,
+            'reader_wait_ms': 0.0,
+            'max_reader_wait_ms': 0.0,
+            'reader_timeouts': 0,
+            'writer_checkouts': 0,
+            'writer_waits': 0,
+            'writer_wait_ms': 0.0,
+            'released_by_teardown': 0,
+        }
+
+    @classmethod
+    def from_config(cls, db_path: str, row_factory=None) -> 'ConnectionPool':
+        from config import config
+        return cls(db_path, max_readers=config.db_pool_max_readers,
+                   wait_seconds=config.db_pool_wait_seconds,
+                   cached_statements=config.db_pool_cached_statements,
+                   row_factory=row_factory)
+
+    # ------------------------------------------------------------------
+    # Connections
+    # ------------------------------------------------------------------
+    def _connect(self, writer: bool) -> PooledConnection:
+        if writer:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000,
+                                   check_same_thread=False, factory=PooledConnection,
+                                   cached_statements=self.cached_statements)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        else:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True,
+                                   timeout=self.busy_timeout_ms / 1000,
+                                   check_same_thread=False, factory=PooledConnection,
+                                   cached_statements=self.cached_statements)
+            conn.execute('PRAGMA query_only=ON')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_kib)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.row_factory = self.row_factory
+        conn.writer = writer
+        conn.pool = self
+        return conn
+
+    def reader(self) -> PooledConnection:
+        """Check out a read-only connection; close() returns it"""
+        started = time.monotonic()
+        waited = False
+        with self._cond:
+            while not self._idle and self._open >= self.max_readers:
+                remaining = self.wait_seconds - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._counters['reader_timeouts'] += 1
+                    raise PoolTimeout(f"No database connection free after {self.wait_seconds:.0f}s "
+                                      f"({self.max_readers} in use)")
+                waited = True
+                self._cond.wait(remaining)
+            if self._idle:
+                conn = self._idle.pop()
+                self._counters['reader_hits'] += 1
+            else:
+                self._open += 1
+                conn = None
+            self._counters['reader_checkouts'] += 1
+            if waited:
+                wait_ms = (time.monotonic() - started) * 1000
+                self._counters['reader_waits'] += 1
+                self._counters['reader_wait_ms'] += wait_ms
+                self._counters['max_reader_wait_ms'] = max(self._counters['max_reader_wait_ms'],
+                                                           wait_ms)
+        if conn is None:
+            try:
+                conn = self._connect(writer=False)
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+            self._counters['reader_misses'] += 1
+        self._track(conn)
+        return conn
+
+    def writer(self) -> PooledConnection:
+        """Check out THE write connection (one holder at a time); close() returns it"""
+        if self._write_owner == threading.get_ident():
+            raise RuntimeError('Write connection already checked out by this thread')
+        started = time.monotonic()
+        if not self._write_lock.acquire(blocking=False):
+            self._counters['writer_waits'] += 1
+            if not self._write_lock.acquire(timeout=self.wait_seconds):
+                raise PoolTimeout(f"Write connection busy for {self.wait_seconds:.0f}s")
+            self._counters['writer_wait_ms'] += (time.monotonic() - started) * 1000
+        try:
+            if self._writer is None:
+                self._writer = self._connect(writer=True)
+        except Exception:
+            self._write_lock.release()
+            raise
+        self._write_owner = threading.get_ident()
+        self._counters['writer_checkouts'] += 1
+        self._track(self._writer)
+        return self._writer
+
+    def _track(self, conn):
+        with self._cond:
+            self._checked_out.setdefault(threading.get_ident(), []).append(conn)
+
+    def _release(self, conn: PooledConnection):
+        with self._cond:
+            for owner, held in list(self._checked_out.items()):
+                if conn in held:
+                    held.remove(conn)
+                    if not held:
+                        del self._checked_out[owner]
+                    break
+            else:
+                return  # already returned (double close)
+        try:
+            self._reset(conn)
+            usable = True
+        except sqlite3.Error:
+            # Unusable (e.g. database file replaced): drop it, the pool reopens
+            conn.discard()
+            usable = False
+        if conn.writer:
+            if not usable:
+                self._writer = None
+            self._write_owner = None
+            self._write_lock.release()
+        else:
+            with self._cond:
+                if usable:
+                    self._idle.append(conn)
+                else:
+                    self._open -= 1
+                self._cond.notify()
+
+    @staticmethod
+    def _reset(conn: PooledConnection):
+        """Back to a clean session: no open transaction, views or attachments"""
+        if conn.in_transaction:
+            conn.rollback()
+        views = [row[0] for row in conn.execute(
+            "SELECT name FROM temp.sqlite_master WHERE type = 'view'")]
+        attached = [row[1] for row in conn.execute('PRAGMA database_list')
+                    if row[1] not in ('main', 'temp')]
+        if views or attached:
+            with temp_writes(conn):
+                for view in views:
+                    conn.execute(f'DROP VIEW temp."{view}"')
+            for schema in attached:
+                conn.execute(f'DETACH DATABASE "{schema}"')
+
+    def release_thread(self):
+        """Return every connection the calling thread still holds"""
+        with self._cond:
+            held = list(self._checked_out.get(threading.get_ident(), []))
+        for conn in held:
+            self._counters['released_by_teardown'] += 1
+            self._release(conn)
+
+    def close_all(self):
+        """Close idle readers and the writer (checked-out readers close on return)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            conn.discard()
+        if self._writer is not None and self._write_lock.acquire(timeout=self.wait_seconds):
+            try:
+                self._writer.discard()
+                self._writer = None
+            finally:
+                self._write_lock.release()
+
+    def stats(self) -> Dict:
+        """Pool counters plus current occupancy"""
+        with self._cond:
+            stats = dict(self._counters)
+            stats['readers_open'] = self._open
+            stats['readers_idle'] = len(self._idle)
+            stats['readers_in_use'] = self._open - len(self._idle)
+        stats['max_readers'] = self.max_readers
+        stats['writer_in_use'] = self._write_lock.locked()
+        checkouts = stats['reader_checkouts']
+        stats['reader_hit_rate'] = round(stats['reader_hits'] / checkouts, 3) if checkouts else None
+        stats['avg_reader_wait_ms'] = (round(stats['reader_wait_ms'] / stats['reader_waits'], 2)
+                                       if stats['reader_waits'] else 0.0)
+        return stats
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Device Registry
+Dictionary-encoded device identity, status and static attributes.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+device_data used to repeat device_id, device_type and status as text in
+every row. The registry stores each device once:
+
+    devices                   device_key (small integer) -> device_id, device_type
+                              and the static DeviceList attributes (MODEL, SWVER,
+                              hw_version, PANEL, TYPE, DESCR)
+    device_attribute_history  every value an attribute has had, with valid_from
+    device_status_codes       the status enum (DEVICE_STATUS), extended on demand
+
+The samples themselves live in device_samples, which carries only
+device_key and status_code. device_data is now a view over it that decodes
+them back into the old device_id / device_type / status columns, so legacy
+readers (PARTITION BY device_id, WHERE device_type = 'inverter', the SQL
+explorer) see the table they were written against; device_readings is the
+same view under the name the status pages use. INSTEAD OF triggers turn
+inserts, updates and deletes on device_data into writes on device_samples,
+registering unseen devices and status strings on the way.
+
+"Which devices exist" is now a lookup on ``devices`` instead of a
+DISTINCT over the whole history.
+
+The views also carry device_samples' promoted JSON columns (json_fields.py)
+and are re-created whenever those change.
+"""
+
+from typing import Dict, Optional, Sequence
+
+from json_fields import generated_columns
+from migrations import epoch_sql
+
+DEVICE_TABLE = 'device_samples'
+
+# Decoding views over device_samples (device_data in the old column order)
+DEVICE_VIEWS = ('device_data', 'device_readings')
+
+# Fixed codes for the states the collectors write; other strings get the
+# next free code in device_status_codes the first time they are seen
+DEVICE_STATUS = {
+    'working': 1,
+    'offline': 2,
+    'sleeping': 3,
+    'error': 4,
+}
+
+# Static attributes kept in devices (and their history)
+DEVICE_ATTRIBUTES = ('model', 'sw_version', 'hw_version', 'panel', 'module_type', 'description')
+
+READINGS_COLUMNS = ('power_kw', 'voltage', 'current_a', 'frequency', 'temperature')
+
+# device_data defaults of the old table, applied by the INSERT trigger
+_TIMESTAMP = "COALESCE(NEW.timestamp, CURRENT_TIMESTAMP)"
+_EPOCH = f"COALESCE(NEW.ts_epoch, {epoch_sql(_TIMESTAMP)})"
+_STATUS = "COALESCE(NEW.status, 'working')"
+
+DEVICE_DATA_TRIGGERS = {
+    'insert': f"""
+        INSERT OR IGNORE INTO devices (device_id, device_type, first_seen, updated_at)
+        SELECT NEW.device_id, COALESCE(NEW.device_type, 'inverter'), {_EPOCH}, {_EPOCH}
+        WHERE NEW.device_id IS NOT NULL;
+        INSERT OR IGNORE INTO device_status_codes (status) VALUES ({_STATUS});
+        INSERT INTO device_samples
+        (id, timestamp, device_key, status_code, power_kw, voltage, current_a, frequency,
+         temperature, raw_fields, ts_epoch)
+        VALUES (NEW.id, {_TIMESTAMP},
+                COALESCE(NEW.device_key,
+                         (SELECT device_key FROM devices WHERE device_id = NEW.device_id)),
+                COALESCE(NEW.status_code,
+                         (SELECT code FROM device_status_codes WHERE status = {_STATUS})),
+                COALESCE(NEW.power_kw, 0), NEW.voltage, NEW.current_a, NEW.frequency,
+                NEW.temperature, NEW.raw_fields, {_EPOCH});
+    """,
+    # device_type and the attributes belong to the device (devices), not the row
+    'update': f"""
+        INSERT OR IGNORE INTO devices (device_id, device_type, first_seen, updated_at)
+        SELECT NEW.device_id, NEW.device_type, {_EPOCH}, {_EPOCH}
+        WHERE NEW.device_id IS NOT OLD.device_id AND NEW.device_id IS NOT NULL;
+        INSERT OR IGNORE INTO device_status_codes (status)
+        SELECT NEW.status WHERE NEW.status IS NOT OLD.status AND NEW.status IS NOT NULL;
+        UPDATE device_samples
+        SET timestamp = NEW.timestamp,
+            device_key = CASE WHEN NEW.device_id IS OLD.device_id THEN NEW.device_key
+                         ELSE (SELECT device_key FROM devices WHERE device_id = NEW.device_id) END,
+            status_code = CASE WHEN NEW.status IS OLD.status THEN NEW.status_code
+                          ELSE (SELECT code FROM device_status_codes WHERE status = NEW.status) END,
+            power_kw = NEW.power_kw, voltage = NEW.voltage, current_a = NEW.current_a,
+            frequency = NEW.frequency, temperature = NEW.temperature,
+            raw_fields = NEW.raw_fields,
+            ts_epoch = CASE WHEN NEW.timestamp IS NOT OLD.timestamp AND NEW.ts_epoch IS OLD.ts_epoch
+                       THEN {epoch_sql('NEW.timestamp')} ELSE NEW.ts_epoch END
+        WHERE id = OLD.id;
+    """,
+    'delete': """
+        DELETE FROM device_samples WHERE id = OLD.id;
+    """,
+}
+
+
+def readings_sql(source: str = DEVICE_TABLE, registry: str = 'main',
+                 extra: Sequence[str] = ()) -> str:
+    """SELECT decoding ``source`` rows through the registry tables"""
+    columns = ''.join(f", d.{c}" for c in READINGS_COLUMNS)
+    extra = ''.join(f", d.{c}" for c in extra)
+    return f"""
+        SELECT d.id, d.timestamp, r.device_id, r.device_type, s.status{columns},
+               d.ts_epoch, d.device_key, d.status_code, d.raw_fields{extra}
+        FROM {source} d
+        LEFT JOIN {registry}.devices r ON r.device_key = d.device_key
+        LEFT JOIN {registry}.device_status_codes s ON s.code = d.status_code
+    """
+
+
+def create_registry(conn):
+    """Registry tables and the fixed status codes (idempotent)"""
+    attribute_columns = ''.join(f"\n            {a} TEXT," for a in DEVICE_ATTRIBUTES)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS devices (
+            device_key INTEGER PRIMARY KEY,
+            device_id TEXT NOT NULL UNIQUE,
+            device_type TEXT,{attribute_columns}
+            first_seen INTEGER,
+            updated_at INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS device_attribute_history (
+            device_key INTEGER NOT NULL,
+            attribute TEXT NOT NULL,
+            value TEXT,
+            valid_from INTEGER NOT NULL,
+            PRIMARY KEY (device_key, attribute, valid_from)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS device_status_codes (
+            code INTEGER PRIMARY KEY,
+            status TEXT NOT NULL UNIQUE
+        )
+    """)
+    conn.executemany("INSERT OR IGNORE INTO device_status_codes (code, status) VALUES (?, ?)",
+                     [(code, status) for status, code in DEVICE_STATUS.items()])
+
+
+def create_device_samples(conn):
+    """The encoded per-device table (idempotent)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS device_samples (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            device_key INTEGER,
+            status_code INTEGER,
+            power_kw REAL DEFAULT 0,
+            voltage REAL,
+            current_a REAL,
+            frequency REAL,
+            temperature REAL,
+            raw_fields TEXT,
+            ts_epoch INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_device_samples_epoch ON device_samples(ts_epoch)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_device_samples_key_epoch "
+                 "ON device_samples(device_key, ts_epoch)")
+
+
+def create_device_views(conn, replace: bool = False, promoted: bool = True):
+    """
+    device_data / device_readings views plus device_data's INSTEAD OF
+    triggers; ``promoted=False`` leaves out the promoted JSON columns, so
+    they can be dropped while the views stay in place.
+    """
+    if replace:
+        # Dropping a view drops its triggers too; both are re-created below
+        for view in DEVICE_VIEWS:
+            conn.execute(f"DROP VIEW IF EXISTS main.{view}")
+    select = readings_sql(extra=generated_columns(conn, DEVICE_TABLE) if promoted else ())
+    for view in DEVICE_VIEWS:
+        conn.execute(f"CREATE VIEW IF NOT EXISTS {view} AS {select}")
+    for event, body in DEVICE_DATA_TRIGGERS.items():
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_device_data_{event}
+            INSTEAD OF {event.upper()} ON device_data
+            BEGIN
+                {body}
+            END
+        """)
+
+
+def create_temp_device_views(conn):
+    """The views over temp.device_samples (the partition UNION view)"""
+    select = readings_sql('temp.' + DEVICE_TABLE, registry='main',
+                          extra=generated_columns(conn, DEVICE_TABLE))
+    for view in DEVICE_VIEWS:
+        conn.execute(f"DROP VIEW IF EXISTS temp.{view}")
+        conn.execute(f"CREATE TEMP VIEW {view} AS {select}")
+
+
+def device_count(conn, device_type: Optional[str] = None) -> int:
+    """Registered devices (optionally of one type)"""
+    if device_type is None:
+        return conn.execute("SELECT COUNT(*) FROM devices").fetchone()[0]
+    return conn.execute("SELECT COUNT(*) FROM devices WHERE device_type = ?",
+                        (device_type,)).fetchone()[0]
+
+
+class DeviceRegistry:
+    """Writer-side cache of device keys and status codes"""
+
+    def __init__(self):
+        self._devices: Dict[str, Dict] = {}
+        self._status: Dict[str, int] = {}
+        self._loaded = False
+
+    def reset(self):
+        """Forget the cache (after a rollback undid registrations)"""
+        self._devices.clear()
+        self._status.clear()
+        self._loaded = False
+
+    def load(self, conn):
+        columns = ('device_key', 'device_id', 'device_type') + DEVICE_ATTRIBUTES
+        self._devices = {}
+        for row in conn.execute(f"SELECT {', '.join(columns)} FROM devices"):
+            self._devices[row[1]] = dict(zip(columns, row))
+        self._status = {status: code for code, status in
+                        conn.execute("SELECT code, status FROM device_status_codes")}
+        self._loaded = True
+
+    def device_key(self, conn, device_id: str, device_type: Optional[str] = None,
+                   attributes: Optional[Dict] = None, epoch: Optional[int] = None) -> int:
+        """
+        Key of ``device_id``, registering it and recording attribute changes;
+        runs inside the caller's write transaction.
+        """
+        if not self._loaded:
+            self.load(conn)
+        entry = self._devices.get(device_id)
+        if entry is None:
+            conn.execute("INSERT OR IGNORE INTO devices (device_id, device_type, first_seen, "
+                         "updated_at) VALUES (?, ?, ?, ?)", (device_id, device_type, epoch, epoch))
+            columns = ('device_key', 'device_id', 'device_type') + DEVICE_ATTRIBUTES
+            row = conn.execute(f"SELECT {', '.join(columns)} FROM devices WHERE device_id = ?",
+                               (device_id,)).fetchone()
+            entry = self._devices[device_id] = dict(zip(columns, row))
+
+        changes = {}
+        if device_type and device_type != entry['device_type']:
+            changes['device_type'] = device_type
+        for attribute, value in (attributes or {}).items():
+            if attribute in DEVICE_ATTRIBUTES and value not in (None, ''):
+                if str(value) != entry[attribute]:
+                    changes[attribute] = str(value)
+        if changes:
+            assignments = ', '.join(f"{a} = ?" for a in changes)
+            conn.execute(f"UPDATE devices SET {assignments}, updated_at = ? WHERE device_key = ?",
+                         tuple(changes.values()) + (epoch, entry['device_key']))
+            conn.executemany("""
+                INSERT OR REPLACE INTO device_attribute_history
+                (device_key, attribute, value, valid_from) VALUES (?, ?, ?, ?)
+            """, [(entry['device_key'], a, v, epoch or 0) for a, v in changes.items()])
+            entry.update(changes)
+        return entry['device_key']
+
+    def status_code(self, conn, status: Optional[str]) -> Optional[int]:
+        """Enum code of ``status``, adding unseen strings to device_status_codes"""
+        if status is None:
+            return None
+        if not self._loaded:
+            self.load(conn)
+        code = self._status.get(status)
+        if code is None:
+            conn.execute("INSERT OR IGNORE INTO device_status_codes (status) VALUES (?)", (status,))
+            code = self._status[status] = conn.execute(
+                "SELECT code FROM device_status_codes WHERE status = ?", (status,)).fetchone()[0]
+        return code
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Promoted JSON Fields
+Generated, optionally indexed columns over JSON paths.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+PROMOTED_JSON_FIELDS (config.promoted_json_fields) lists JSON paths that
+should be queryable like ordinary columns. Each one becomes a VIRTUAL
+generated column
+
+    lifetime_kwh REAL GENERATED ALWAYS AS (json_extract(raw_fields, '$.ltea_3phsum_kwh')) VIRTUAL
+
+plus, with ``:index``, an index on it, so ``WHERE lifetime_kwh > ?`` or
+``MAX(lifetime_kwh)`` in the SQL explorer is an index lookup instead of a
+json_extract over every row. Virtual columns cost no space; the index build
+is the only backfill they need.
+
+The JSON each table's columns read (JSON_SOURCES):
+
+    device_samples.raw_fields   the DeviceList keys the promoted paths refer
+                                to, written by storage.CycleWriter; the full
+                                snapshot stays in the raw archive, from which
+                                older rows are backfilled (backfill_raw_fields)
+    weather_data.api_response   the stored weather response
+
+device_samples' columns also show up in the device_data/device_readings
+views over it (devices.py).
+
+Columns are added, re-created (path/type changed) and dropped to match the
+configuration by migrations.migrate_json_fields, and in every monthly
+partition file as it is attached (partitions.py).
+"""
+
+import json
+import re
+import time
+from datetime import datetime
+from typing import Dict, List, Mapping, Optional, Sequence
+
+from config import LEGACY_TABLES, config
+
+JSON_SOURCES = {
+    'device_samples': 'raw_fields',
+    'weather_data': 'api_response',
+}
+
+IDENTIFIER = re.compile(r'^[A-Za-z_]\w*$')
+# First member of a JSON path: $.key, $."key" or $[0]
+TOP_LEVEL_KEY = re.compile(r'^\$\.(?:"([^"]+)"|([^.\[]+))')
+
+# Snapshots per backfill transaction
+BACKFILL_SNAPSHOTS = 200
+
+
+def promoted_fields(table: Optional[str] = None) -> List[Dict]:
+    """Configured fields (of ``table``; device_data means device_samples) that can be promoted"""
+    table = LEGACY_TABLES.get(table, table)
+    fields = []
+    for field in config.promoted_json_fields:
+        if field['table'] not in JSON_SOURCES or (table and field['table'] != table):
+            continue
+        if not IDENTIFIER.match(field['name']) or not field['path'].startswith('$'):
+            print(f"⚠️  Ignoring promoted JSON field {field['table']}.{field['name']}={field['path']}")
+            continue
+        fields.append(field)
+    return fields
+
+
+def raw_keys(fields: Optional[Sequence[Dict]] = None) -> tuple:
+    """DeviceList keys device_samples.raw_fields must carry for its promoted paths"""
+    keys = []
+    for field in promoted_fields('device_samples') if fields is None else fields:
+        match = TOP_LEVEL_KEY.match(field['path'])
+        if match:
+            keys.append(match.group(1) or match.group(2))
+    return tuple(sorted(set(keys)))
+
+
+def raw_fields(device: Optional[Mapping], keys: Sequence[str]) -> Optional[str]:
+    """device_samples.raw_fields value for one DeviceList entry (None: nothing to keep)"""
+    if not device or not keys:
+        return None
+    kept = {k: device[k] for k in keys if k in device}
+    return json.dumps(kept, separators=(',', ':')) if kept else None
+
+
+def column_sql(field: Dict) -> str:
+    path = field['path'].replace("'", "''")
+    return (f"{field['name']} {field['type']} GENERATED ALWAYS AS "
+            f"(json_extract({JSON_SOURCES[field['table']]}, '{path}')) VIRTUAL")
+
+
+def index_name(table: str, column: str) -> str:
+    return f"idx_{table}_{column}"
+
+
+def generated_columns(conn, table: str, schema: str = 'main') -> List[str]:
+    """Generated columns of ``schema``.table (PRAGMA table_info omits them)"""
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_xinfo({table})") if row[6] in (2, 3)]
+
+
+def apply_fields(conn, table: str, schema: str = 'main',
+                 fields: Optional[Sequence[Dict]] = None) -> Dict:
+    """
+    Make ``schema``.table's generated columns match the configuration;
+    returns {'added': [...], 'dropped': [...]}. Runs in the caller's transaction.
+    """
+    fields = promoted_fields(table) if fields is None else fields
+    changes = {'added': [], 'dropped': []}
+    info = list(conn.execute(f"PRAGMA {schema}.table_xinfo({table})"))
+    if not info:
+        return changes
+    plain = {row[1] for row in info if row[6] not in (2, 3)}
+    source = JSON_SOURCES[table]
+    if source not in plain:
+        conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {source} TEXT")
+        plain.add(source)
+    table_sql = conn.execute(f"SELECT sql FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                             (table,)).fetchone()[0]
+
+    wanted = {f['name']: f for f in fields if f['name'] not in plain}
+    for column in generated_columns(conn, table, schema):
+        if column in wanted and column_sql(wanted[column]) in table_sql:
+            continue
+        # Removed from the configuration, or its path/type changed
+        conn.execute(f"DROP INDEX IF EXISTS {schema}.{index_name(table, column)}")
+        conn.execute(f"ALTER TABLE {schema}.{table} DROP COLUMN {column}")
+        changes['dropped'].append(column)
+    present = set(generated_columns(conn, table, schema))
+    for name, field in wanted.items():
+        if name not in present:
+            conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column_sql(field)}")
+            changes['added'].append(name)
+        if field['indexed']:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.{index_name(table, name)} "
+                         f"ON {table}({name})")
+        else:
+            conn.execute(f"DROP INDEX IF EXISTS {schema}.{index_name(table, name)}")
+    return changes
+
+
+def describe(conn) -> Dict[str, List[Dict]]:
+    """Configured fields per table, with whether the column/index exist"""
+    result = {}
+    for table in JSON_SOURCES:
+        present = set(generated_columns(conn, table))
+        indexes = {row[1] for row in conn.execute(f"PRAGMA index_list({table})")}
+        result[table] = [dict(field, source=JSON_SOURCES[table], present=field['name'] in present,
+                              index_present=index_name(table, field['name']) in indexes)
+                         for field in promoted_fields(table)]
+    return result
+
+
+def backfill_raw_fields(conn, chunk_snapshots: int = BACKFILL_SNAPSHOTS, verbose: bool = True) -> int:
+    """
+    Fill device_samples.raw_fields of already stored rows from the raw archive,
+    BACKFILL_SNAPSHOTS snapshots per transaction with progress in
+    raw_fields_backfill, which is dropped once done. Completion is recorded
+    in schema_migrations per key set, so a changed configuration starts
+    over. Returns the rows updated.
+    """
+    import raw_archive
+
+    keys = raw_keys()
+    if not keys:
+        return 0
+    signature = ','.join(keys)
+    name = f"raw_fields:{signature}"
+    if conn.execute("SELECT 1 FROM schema_migrations WHERE name = ?", (name,)).fetchone():
+        return 0
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS raw_fields_backfill (
+            keys TEXT PRIMARY KEY,
+            last_snapshot INTEGER NOT NULL
+        )
+    """)
+    row = conn.execute("SELECT last_snapshot FROM raw_fields_backfill WHERE keys = ?",
+                       (signature,)).fetchone()
+    if row is None:
+        conn.execute("DELETE FROM raw_fields_backfill")
+        conn.execute("INSERT INTO raw_fields_backfill (keys, last_snapshot) VALUES (?, 0)", (signature,))
+    last = row[0] if row is not None else 0
+
+    device_keys = dict(conn.execute("SELECT device_id, device_key FROM devices"))
+    started = time.monotonic()
+    updated = 0
+    while True:
+        ids = [r[0] for r in conn.execute("SELECT id FROM raw_snapshots WHERE id > ? ORDER BY id LIMIT ?",
+                                          (last, chunk_snapshots))]
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for snapshot_id in ids:
+                snapshot = raw_archive.rebuild(conn, snapshot_id=snapshot_id)
+                rows = []
+                for device in snapshot['devices']:
+                    # Registered under its DEVICE_ID or its SERIAL (see pvs_client.inverter_rows)
+                    device_key = next((device_keys[i] for i in (device.get('DEVICE_ID'), device.get('SERIAL'))
+                                       if i in device_keys), None)
+                    if device_key is not None:
+                        rows.append((raw_fields(device, keys), device_key, snapshot['ts_epoch']))
+                updated += conn.executemany(
+                    "UPDATE device_samples SET raw_fields = ? WHERE device_key = ? AND ts_epoch = ?",
+                    rows).rowcount
+            last = ids[-1] if ids else last
+            if len(ids) < chunk_snapshots:
+                # Only the current key set counts as filled
+                conn.execute("DELETE FROM schema_migrations WHERE name LIKE 'raw_fields:%'")
+                conn.execute("INSERT INTO schema_migrations (name, applied_at) VALUES (?, ?)",
+                             (name, datetime.now().isoformat()))
+                conn.execute("DROP TABLE raw_fields_backfill")
+            else:
+                conn.execute("UPDATE raw_fields_backfill SET last_snapshot = ? WHERE keys = ?",
+                             (last, signature))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        if len(ids) < chunk_snapshots:
+            break
+    if verbose and updated:
+        print(f"✅ device_samples.raw_fields: {updated} rows backfilled from the raw archive "
+              f"in {time.monotonic() - started:.1f}s")
+    return updated
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Database Maintenance
+Small, scheduled upkeep jobs instead of a VACUUM inside an HTTP request.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+A full VACUUM rewrites the whole file under an exclusive lock, so every
+collector write fails until it is done. The jobs below each hold the write
+lock only briefly:
+
+    checkpoint  PRAGMA wal_checkpoint(PASSIVE) every MAINTENANCE_CHECKPOINT_MINUTES;
+                once the -wal file is past MAINTENANCE_WAL_MAX_MB (a long
+                reader kept the automatic checkpoints from resetting it) a
+                TRUNCATE checkpoint, which waits busy_timeout for readers
+    optimize    PRAGMA optimize every MAINTENANCE_OPTIMIZE_HOURS (ANALYZE of
+                the tables whose statistics are stale, bounded by
+                analysis_limit)
+    vacuum      in quiet hours (MAINTENANCE_QUIET_HOURS, local time) free
+                pages are returned to the file system with
+                PRAGMA incremental_vacuum, MAINTENANCE_VACUUM_PAGES per
+                transaction with a pause in between
+    quick_check PRAGMA quick_check every MAINTENANCE_QUICK_CHECK_HOURS
+    integrity_check
+                the full PRAGMA integrity_check (indexes against their
+                tables too) every MAINTENANCE_INTEGRITY_CHECK_DAYS, in
+                quiet hours; both checks read every monthly file as well
+    reconcile_stats
+                recount the statistics catalog (stats_catalog.py) and fix
+                any drift, every MAINTENANCE_STATS_RECONCILE_HOURS in quiet hours
+
+incremental_vacuum needs auto_vacuum=INCREMENTAL. New databases get it
+before their first table (ensure_auto_vacuum); an existing database is
+converted once, by a single VACUUM in quiet hours - the collector's
+write-behind buffer holds the cycles that arrive meanwhile.
+
+Every job's last run (duration, freed pages, ...) is kept in system_metadata
+under 'maintenance.<job>', which is also how the scheduler knows what is due
+after a restart - and what /api/db/health-check reports (integrity()),
+instead of scanning the database on every page load. MaintenanceScheduler
+runs the jobs on a collector thread; run_in_background() serves the
+dashboard's "Optimize" button and on-demand checks.
+
+Run standalone with:  python maintenance.py [--convert] [JOB ...] [/path/to/solar_data.db]
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional, Sequence
+
+import stats_catalog
+from backup import check_database
+from config import config
+from partitions import PartitionSet
+
+JOBS = ('checkpoint', 'optimize', 'vacuum', 'quick_check', 'integrity_check', 'reconcile_stats')
+# The dashboard's "Optimize"
+OPTIMIZE_JOBS = ('checkpoint', 'optimize', 'vacuum')
+CHECK_JOBS = {'quick': 'quick_check', 'full': 'integrity_check'}
+# Scheduled only inside MAINTENANCE_QUIET_HOURS
+QUIET_JOBS = ('vacuum', 'integrity_check', 'reconcile_stats')
+AUTO_VACUUM_INCREMENTAL = 2
+# Rows examined per index by ANALYZE (keeps PRAGMA optimize fast on big tables)
+ANALYSIS_LIMIT = 400
+# PRAGMA optimize mask that also checks tables this connection hasn't used (3.46+)
+OPTIMIZE_ALL_TABLES = 0x10002
+
+
+def create_metadata(conn):
+    """Key/value table for maintenance state (idempotent)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS system_metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TEXT
+        )
+    """)
+
+
+def set_metadata(conn, key: str, value: str):
+    now = datetime.now().isoformat()
+    conn.execute("INSERT OR REPLACE INTO system_metadata (key, value, updated_at) VALUES (?, ?, ?)",
+                 (key, value, now))
+
+
+def job_stats(conn) -> Dict[str, Dict]:
+    """Last recorded run per job (missing table/keys: never ran)"""
+    try:
+        rows = conn.execute("SELECT key, value FROM system_metadata WHERE key LIKE 'maintenance.%'").fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {key.split('.', 1)[1]: json.loads(value) for key, value in rows}
+
+
+def integrity(conn) -> Optional[Dict]:
+    """Newest recorded quick_check/integrity_check result (None: never checked)"""
+    stats = job_stats(conn)
+    results = [dict(stats[job], mode=mode) for mode, job in CHECK_JOBS.items() if job in stats]
+    return max(results, key=lambda r: r['last_run']) if results else None
+
+
+def ensure_auto_vacuum(conn) -> bool:
+    """auto_vacuum=INCREMENTAL on a database with no tables yet; True if it is set"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+        return True
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # Header already written (journal_mode=WAL came first): an empty
+            # file VACUUMs instantly
+            conn.execute("VACUUM")
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+    return False
+
+
+def parse_hours(spec: str):
+    """'1-5' -> (1, 5): local hours [start, end), may wrap midnight ('22-4')"""
+    start, _, end = spec.partition('-')
+    return int(start) % 24, int(end or start) % 24
+
+
+def in_hours(hours, when: Optional[datetime] = None) -> bool:
+    start, end = hours
+    hour = (when or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class MaintenanceRunner:
+    """The jobs against one database; each run_job() uses a fresh connection"""
+
+    def __init__(self, db_path: str, quiet_hours=(1, 5), vacuum_pages: int = 256,
+                 pause_seconds: float = 0.1, wal_max_bytes: int = 32 * 1024 * 1024,
+                 intervals: Optional[Dict[str, float]] = None, convert: bool = True,
+                 partitions=None):
+        self.db_path = db_path
+        self.quiet_hours = quiet_hours
+        self.vacuum_pages = max(1, vacuum_pages)
+        self.pause_seconds = pause_seconds
+        self.wal_max_bytes = wal_max_bytes
+        self.intervals = intervals or {'checkpoint': 600, 'optimize': 6 * 3600, 'vacuum': 3600,
+                                       'quick_check': 6 * 3600, 'integrity_check': 7 * 86400,
+                                       'reconcile_stats': 86400}
+        self.convert = convert
+        self.partitions = partitions
+        # On-demand runs convert only when asked to (--convert, {"convert": true})
+        self.force_convert = False
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.report = {'state': 'idle', 'job': None, 'jobs': {}}
+
+    @classmethod
+    def from_config(cls, db_path: str) -> 'MaintenanceRunner':
+        return cls(db_path,
+                   quiet_hours=parse_hours(config.maintenance_quiet_hours),
+                   vacuum_pages=config.maintenance_vacuum_pages,
+                   pause_seconds=config.maintenance_vacuum_pause_ms / 1000.0,
+                   wal_max_bytes=int(config.maintenance_wal_max_mb * 1024 * 1024),
+                   intervals={
+                       'checkpoint': config.maintenance_checkpoint_minutes * 60,
+                       'optimize': config.maintenance_optimize_hours * 3600,
+                       'vacuum': 3600,
+                       'quick_check': config.maintenance_quick_check_hours * 3600,
+                       'integrity_check': config.maintenance_integrity_check_days * 86400,
+                       'reconcile_stats': config.maintenance_stats_reconcile_hours * 3600,
+                   },
+                   convert=config.maintenance_convert,
+                   partitions=PartitionSet.from_config(db_path))
+
+    def stop(self):
+        """Finish the current step and stop"""
+        self._stop.set()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        create_metadata(conn)
+        return conn
+
+    def quiet(self) -> bool:
+        return in_hours(self.quiet_hours)
+
+    def due(self) -> list:
+        """Jobs whose interval has passed (QUIET_JOBS only in quiet hours; <= 0: never)"""
+        conn = self._connect()
+        try:
+            stats = job_stats(conn)
+        finally:
+            conn.close()
+        now = time.time()
+        due = []
+        for job in JOBS:
+            if job in QUIET_JOBS and not self.quiet() or self.intervals[job] <= 0:
+                continue
+            if now - stats.get(job, {}).get('epoch', 0) >= self.intervals[job]:
+                due.append(job)
+        return due
+
+    # ------------------------------------------------------------------
+    # Run
+    # ------------------------------------------------------------------
+    def run(self, jobs: Sequence[str] = OPTIMIZE_JOBS, scheduled: bool = False) -> Dict:
+        """Run ``jobs`` in order; returns the report"""
+        with self._lock:
+            started = time.monotonic()
+            self.report = {'state': 'running', 'started_at': datetime.now().isoformat(),
+                           'job': None, 'jobs': {}}
+            try:
+                for job in jobs:
+                    if self._stop.is_set():
+                        break
+                    self.report['job'] = job
+                    self.report['jobs'][job] = self.run_job(job, scheduled)
+                self.report['state'] = 'stopped' if self._stop.is_set() else 'done'
+            except Exception as e:
+                self.report['state'] = 'failed'
+                self.report['error'] = str(e)
+                print(f"❌ Maintenance failed ({self.report['job']}): {e}")
+            self.report['job'] = None
+            self.report['elapsed_s'] = round(time.monotonic() - started, 3)
+            return self.report
+
+    def run_job(self, job: str, scheduled: bool = False) -> Dict:
+        """One job; its stats are recorded in system_metadata"""
+        if job not in JOBS:
+            raise ValueError(f"Unknown maintenance job {job}")
+        conn = self._connect()
+        try:
+            started = time.monotonic()
+            if job in CHECK_JOBS.values():
+                stats = self._check(conn, job)
+            else:
+                stats = getattr(self, f"_{job}")(conn, scheduled)
+            stats['duration_s'] = round(time.monotonic() - started, 3)
+            previous = job_stats(conn).get(job, {})
+            stats.update(last_run=datetime.now().isoformat(), epoch=int(time.time()),
+                         runs=previous.get('runs', 0) + 1)
+            if 'freed_pages' in stats or 'total_freed_pages' in previous:
+                stats['total_freed_pages'] = previous.get('total_freed_pages', 0) + stats.get('freed_pages', 0)
+            set_metadata(conn, f"maintenance.{job}", json.dumps(stats))
+            if job == 'vacuum' and not stats.get('skipped'):
+                # Shown as "Last Optimized" by /api/db/health-check
+                set_metadata(conn, 'last_vacuum', stats['last_run'])
+            if (not scheduled or stats.get('freed_pages') or stats.get('busy')
+                    or stats.get('ok') is False or stats.get('corrected')):
+                print(f"🔧 Maintenance {job}: {_summary(stats)}")
+            return stats
+        finally:
+            conn.close()
+
+    def _checkpoint(self, conn, scheduled: bool) -> Dict:
+        wal_path = self.db_path + '-wal'
+        wal_before = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        mode = 'TRUNCATE' if wal_before > self.wal_max_bytes or not scheduled else 'PASSIVE'
+        busy, log_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        wal_after = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        if busy and mode == 'TRUNCATE':
+            print(f"⚠️  WAL is {wal_before / 1048576:.1f} MB and a reader kept it from being reset")
+        return {'mode': mode, 'busy': bool(busy), 'log_frames': log_frames,
+                'checkpointed_frames': checkpointed, 'wal_bytes_before': wal_before,
+                'wal_bytes_after': wal_after}
+
+    def _optimize(self, conn, scheduled: bool) -> Dict:
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        if sqlite3.sqlite_version_info >= (3, 46, 0):
+            conn.execute(f"PRAGMA optimize={OPTIMIZE_ALL_TABLES}")
+            return {'mode': 'optimize'}
+        # Older SQLite only considers tables this connection has queried,
+        # which for a fresh connection is none: analyze (bounded) instead
+        has_stats = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()[0]
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        return {'mode': 'analyze' if has_stats else 'analyze (first)'}
+
+    def _vacuum(self, conn, scheduled: bool) -> Dict:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            if not (self.force_convert or scheduled and self.convert and self.quiet()):
+                return {'skipped': 'auto_vacuum not INCREMENTAL yet (converted in quiet hours)',
+                        'free_pages': free_before}
+            # One-time conversion: a full VACUUM rewrites the file with the new mode
+            print("🔧 Converting the database to auto_vacuum=INCREMENTAL (one-time VACUUM)...")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+            return {'mode': 'convert', 'freed_pages': pages_before - pages_after,
+                    'freed_bytes': (pages_before - pages_after) * page_size, 'steps': 1,
+                    'free_pages': conn.execute("PRAGMA freelist_count").fetchone()[0]}
+
+        steps = 0
+        free = free_before
+        while free > 0 and not self._stop.is_set():
+            if scheduled and not self.quiet():
+                break
+            # Each step is its own short write transaction. The pragma frees
+            # one page per sqlite3_step and Cursor.execute steps only once, so
+            # it goes through executescript (sqlite3_exec runs it to the end)
+            conn.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+            steps += 1
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free > 0:
+                time.sleep(self.pause_seconds)
+        pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+        return {'mode': 'incremental', 'freed_pages': pages_before - pages_after,
+                'freed_bytes': (pages_before - pages_after) * page_size,
+                'steps': steps, 'free_pages': free}
+
+    def _reconcile_stats(self, conn, scheduled: bool) -> Dict:
+        corrected = stats_catalog.reconcile(conn, self.partitions)
+        if any(corrected.values()):
+            print(f"📊 Statistics catalog drift corrected: {corrected}")
+        return {'corrected': sum(corrected.values()), 'tables': corrected}
+
+    def _check(self, conn, job: str) -> Dict:
+        """PRAGMA quick_check/integrity_check of the database and each monthly file"""
+        files = {os.path.basename(self.db_path): self.db_path}
+        if self.partitions is not None:
+            files.update((os.path.basename(self.partitions.path(key)), self.partitions.path(key))
+                         for key in self.partitions.keys())
+        problems = {}
+        for name, path in files.items():
+            if self._stop.is_set():
+                break
+            result = check_database(path, 'full' if job == 'integrity_check' else 'quick')
+            if result != 'ok':
+                problems[name] = result
+        if problems:
+            print(f"❌ {job} found problems: {problems}")
+        return {'ok': not problems, 'result': 'ok' if not problems else '; '.join(problems.values()),
+                'problems': problems, 'files': len(files)}
+
+
+def _summary(stats: Dict) -> str:
+    if stats.get('skipped'):
+        return f"skipped ({stats['skipped']})"
+    parts = [f"{stats['duration_s']}s"]
+    if 'corrected' in stats:
+        parts.append(f"{stats['corrected']} catalog entries corrected")
+    if 'ok' in stats:
+        parts.append(f"{stats['files']} files, {stats['result']}")
+    if 'freed_pages' in stats:
+        parts.append(f"{stats['freed_pages']} pages freed in {stats['steps']} steps")
+    if 'wal_bytes_before' in stats:
+        parts.append(f"{stats['mode']}, WAL {stats['wal_bytes_before']} -> {stats['wal_bytes_after']} bytes"
+                     + (' (busy)' if stats['busy'] else ''))
+    return ', '.join(parts)
+
+
+class MaintenanceScheduler:
+    """Daemon thread running whatever is due every ``tick_seconds``"""
+
+    def __init__(self, runner: MaintenanceRunner, tick_seconds: float = 60.0):
+        self.runner = runner
+        self.tick_seconds = tick_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, db_path: str) -> Optional['MaintenanceScheduler']:
+        """Scheduler per MAINTENANCE_*, or None when MAINTENANCE_ENABLED=false"""
+        if not config.maintenance_enabled:
+            return None
+        return cls(MaintenanceRunner.from_config(db_path))
+
+    def start(self) -> 'MaintenanceScheduler':
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='maintenance', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.runner.stop()
+
+    def _loop(self):
+        while not self._stop.wait(self.tick_seconds):
+            try:
+                due = self.runner.due()
+                if due:
+                    self.runner.run(due, scheduled=True)
+            except Exception as e:
+                print(f"⚠️  Maintenance scheduler: {e}")
+
+
+# ----------------------------------------------------------------------
+# Background runs (dashboard)
+# ----------------------------------------------------------------------
+_current: Optional[MaintenanceRunner] = None
+_current_lock = threading.Lock()
+
+
+def run_in_background(db_path: str, jobs: Sequence[str] = OPTIMIZE_JOBS, convert: bool = False):
+    """Start a run unless one is going; returns (runner, started)"""
+    global _current
+    with _current_lock:
+        if _current is not None and _current.report.get('state') == 'running':
+            return _current, False
+        runner = MaintenanceRunner.from_config(db_path)
+        runner.force_convert = convert
+        runner.report = {'state': 'running', 'job': None, 'jobs': {}}
+        _current = runner
+    threading.Thread(target=runner.run, args=(tuple(jobs),), name='maintenance', daemon=True).start()
+    return runner, True
+
+
+def status() -> Optional[Dict]:
+    """Report of the latest run in this process (None if none yet)"""
+    return _current.report if _current is not None else None
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    jobs = [a for a in args if a in JOBS] or list(OPTIMIZE_JOBS)
+    paths = [a for a in args if not a.startswith('--') and a not in JOBS]
+    runner = MaintenanceRunner.from_config(paths[0] if paths else config.database_path)
+    if '--convert' in args:
+        runner.force_convert = True
+    runner.run(jobs)
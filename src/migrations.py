@@ -0,0 +1,791 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Schema Migrations
+Idempotent, resumable upgrades of the shared SQLite schema.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+ts_epoch: every time-series table gets an INTEGER ``ts_epoch`` column (UTC
+epoch seconds) with its own index, so range filters can be written as plain
+``ts_epoch >= ?`` comparisons that SQLite answers with an index range scan.
+The ISO ``timestamp`` text column is kept as is for display and grouping.
+
+How ``timestamp`` is interpreted:
+
+    '2025-09-25T12:00:00.123456'   collector rows (datetime.isoformat()), local time
+    '2025-09-25 18:00:00'          CURRENT_TIMESTAMP column defaults, UTC
+
+New rows are filled in by the writers (storage.CycleWriter passes ts_epoch
+explicitly); triggers cover every other writer. Existing rows are
+backfilled in short rowid-range transactions so the collectors can keep
+writing while a year of history is converted.
+
+rollups: the 1m/15m/1h/1d tier tables of rollups.py, their triggers on
+the site table, and a resumable backfill of existing history. Tables and
+triggers are created in one transaction together with a high-water mark
+(the newest rowid); rows up to the mark are folded in by the backfill, one
+chunk per transaction with its progress, and everything after it by the
+triggers, so no sample is counted twice.
+
+rollup_energy: tiers created before the energy integrals get their
+columns and new triggers in one transaction that also settles the newest
+minute; older 1m buckets (and the coarser buckets they fully cover) are
+then filled in from the 1m tier in bucket chunks. Tiers created since
+have the integrals from the start and only record the migration.
+
+site_samples: the one canonical site table (site_samples.py). Databases
+that still have system_status / solar_data tables get their rows copied
+over in rowid chunks (system_status first, keeping its ids; solar_data
+site rows only where system_status had no sample at that second, device
+rows into device_data, which is converted below). One last transaction
+copies what arrived meanwhile, drops the tables, creates the views in
+their place and moves the rollup triggers; rollups were already fed by
+system_status, so copied rows must not fire them. Monthly partition files
+are converted one month per transaction.
+
+device_samples: the dictionary-encoded device table (devices.py), with
+device_data as the decoding view over it. A device_data table is copied
+over the same way as the site tables: rowid chunks that register the
+devices and status strings they name and keep the row ids (the id
+sequence starts above them), one last transaction that copies what
+arrived meanwhile, drops the table, creates the views and their INSTEAD OF
+triggers and moves the statistics catalog's counts. Monthly partition
+files are converted one month per transaction.
+
+device_latest: one row per device with its newest sample, upserted by
+storage.CycleWriter in the same transaction as the device_samples insert,
+so status pages read O(devices) rows instead of scanning the history.
+Filled once from device_data (newest row per device).
+
+raw_archive: raw_archive.py's block store and snapshot index; new tables
+only, nothing to backfill.
+
+json_fields: the promoted JSON columns of json_fields.py are added/dropped
+to match PROMOTED_JSON_FIELDS in one transaction (their indexes are built
+there too); device_samples.raw_fields of rows stored before then is filled
+from the raw archive, a chunk of snapshots per transaction.
+
+Run standalone with:  python migrations.py [/path/to/solar_data.db]
+"""
+
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+# solar_data/system_status only until migrate_site_samples turns them into views;
+# a device_data table's epochs are computed as its rows are copied
+EPOCH_TABLES = ('site_samples', 'solar_data', 'system_status', 'device_samples', 'weather_data')
+
+LEGACY_SITE_TABLES = ('system_status', 'solar_data')
+
+EPOCH_INDEXES = {
+    'site_samples': [('idx_site_samples_epoch', 'ts_epoch')],
+    'solar_data': [('idx_solar_data_epoch', 'ts_epoch')],
+    'system_status': [('idx_system_status_epoch', 'ts_epoch')],
+    'device_samples': [('idx_device_samples_epoch', 'ts_epoch'),
+                       ('idx_device_samples_key_epoch', 'device_key, ts_epoch')],
+    'weather_data': [('idx_weather_data_epoch', 'ts_epoch')],
+}
+
+BACKFILL_CHUNK_ROWS = 5000
+
+
+def epoch_sql(column: str = 'timestamp') -> str:
+    """SQL expression turning a stored timestamp into UTC epoch seconds"""
+    return (f"CAST(CASE WHEN instr({column}, 'T') THEN strftime('%s', {column}, 'utc') "
+            f"ELSE strftime('%s', {column}) END AS INTEGER)")
+
+
+def timestamp_epoch(timestamp) -> Optional[int]:
+    """Python twin of epoch_sql() for collector (local ISO) timestamps"""
+    try:
+        return int(datetime.fromisoformat(timestamp).timestamp())
+    except (TypeError, ValueError):
+        return None  # left NULL; the insert trigger tries again in SQL
+
+
+def _table_exists(conn, table: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (table,)).fetchone() is not None
+
+
+def _has_column(conn, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def _applied(conn, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM schema_migrations WHERE name = ?",
+                        (name,)).fetchone() is not None
+
+
+def add_epoch_column(conn, table: str):
+    """ts_epoch column plus the triggers that keep it filled (one transaction)"""
+    expr = epoch_sql('NEW.timestamp')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not _has_column(conn, table, 'ts_epoch'):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN ts_epoch INTEGER")
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_epoch_insert
+            AFTER INSERT ON {table} WHEN NEW.ts_epoch IS NULL
+            BEGIN
+                UPDATE {table} SET ts_epoch = {expr} WHERE rowid = NEW.rowid;
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_epoch_update
+            AFTER UPDATE OF timestamp ON {table} WHEN NEW.ts_epoch IS OLD.ts_epoch
+            BEGIN
+                UPDATE {table} SET ts_epoch = {expr} WHERE rowid = NEW.rowid;
+            END
+        """)
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+
+def backfill_epoch(conn, table: str, chunk_rows: int = BACKFILL_CHUNK_ROWS,
+                   verbose: bool = True) -> int:
+    """Fill ts_epoch for existing rows, one short transaction per rowid chunk"""
+    first = conn.execute(f"SELECT MIN(rowid) FROM {table} WHERE ts_epoch IS NULL").fetchone()[0]
+    if first is None:
+        return 0
+    # Rows added after this point are filled by the writers/triggers
+    last = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0]
+
+    updated = 0
+    started = time.monotonic()
+    for lo in range(first, last + 1, chunk_rows):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.execute(f"""
+                UPDATE {table} SET ts_epoch = {epoch_sql()}
+                WHERE rowid >= ? AND rowid < ? AND ts_epoch IS NULL
+            """, (lo, lo + chunk_rows))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        updated += cursor.rowcount
+        if verbose and (lo - first) // chunk_rows % 100 == 99:
+            done = (lo + chunk_rows - first) / max(1, last + 1 - first) * 100
+            print(f"🔄 {table}.ts_epoch backfill: {done:.0f}% ({updated} rows)")
+    if verbose:
+        print(f"✅ {table}.ts_epoch backfilled: {updated} rows in {time.monotonic() - started:.1f}s")
+    return updated
+
+
+def migrate_epoch(conn, table: str, chunk_rows: int = BACKFILL_CHUNK_ROWS,
+                  verbose: bool = True) -> int:
+    """ts_epoch column, triggers, backfill and indexes for one table"""
+    name = f"ts_epoch:{table}"
+    add_epoch_column(conn, table)
+    if _applied(conn, name):
+        return 0
+    updated = backfill_epoch(conn, table, chunk_rows, verbose)
+    # Indexes after the backfill: one sorted build instead of per-row updates
+    for index, columns in EPOCH_INDEXES.get(table, []):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table}({columns})")
+    conn.execute("INSERT OR IGNORE INTO schema_migrations (name, applied_at) VALUES (?, ?)",
+                 (name, datetime.now().isoformat()))
+    return updated
+
+
+def migrate_rollups(conn, table: str = 'site_samples', verbose: bool = True) -> int:
+    """Rollup tiers + triggers, then backfill existing ``table`` rows"""
+    import rollups
+
+    if _applied(conn, 'rollups') or not _has_column(conn, table, 'production_kw'):
+        return 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if _applied(conn, 'rollups'):
+            # Another process finished (and dropped rollup_backfill) meanwhile
+            conn.execute('COMMIT')
+            return 0
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_backfill (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                next_rowid INTEGER,
+                last_rowid INTEGER
+            )
+        """)
+        if not _table_exists(conn, rollups.rollup_table('1m')):
+            # New tiers: the backfill and the triggers fill in the energy integrals too
+            conn.execute("INSERT OR IGNORE INTO schema_migrations (name, applied_at) "
+                         "VALUES ('rollup_energy', ?)", (datetime.now().isoformat(),))
+        rollups.create_rollups(conn, table)
+        conn.execute(f"""
+            INSERT OR IGNORE INTO rollup_backfill (id, next_rowid, last_rowid)
+            SELECT 1, COALESCE(MIN(rowid), 1), COALESCE(MAX(rowid), 0) FROM {table}
+        """)
+        next_rowid, last_rowid = conn.execute(
+            "SELECT next_rowid, last_rowid FROM rollup_backfill WHERE id = 1").fetchone()
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+    started = time.monotonic()
+    total = max(1, last_rowid - next_rowid + 1)
+    chunks = 0
+    while next_rowid is not None:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-read inside the write lock: another process may be backfilling too
+            if _applied(conn, 'rollups'):
+                following = None
+            else:
+                next_rowid = conn.execute(
+                    "SELECT next_rowid FROM rollup_backfill WHERE id = 1").fetchone()[0]
+                following = rollups.backfill_rollups(conn, next_rowid, last_rowid, table=table)
+                if following is None:
+                    conn.execute("INSERT OR IGNORE INTO schema_migrations (name, applied_at) "
+                                 "VALUES ('rollups', ?)", (datetime.now().isoformat(),))
+                    conn.execute("DROP TABLE rollup_backfill")
+                else:
+                    conn.execute("UPDATE rollup_backfill SET next_rowid = ? WHERE id = 1",
+                                 (following,))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        next_rowid = following
+        chunks += 1
+        if verbose and next_rowid is not None and chunks % 10 == 0:
+            done = (last_rowid - next_rowid + 1) / total
+            print(f"🔄 Rollup backfill: {100 - done * 100:.0f}%")
+    if verbose:
+        print(f"✅ Rollups backfilled in {time.monotonic() - started:.1f}s")
+    return total
+
+
+def migrate_rollup_energy(conn, table: str = 'site_samples', chunk_rows: int = BACKFILL_CHUNK_ROWS,
+                          verbose: bool = True) -> int:
+    """Energy integral columns on tiers that predate them, backfilled from the 1m tier"""
+    import rollups
+
+    if _applied(conn, 'rollup_energy') or not _applied(conn, 'rollups'):
+        return 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_energy_backfill (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                next_bucket INTEGER,
+                last_bucket INTEGER
+            )
+        """)
+        if conn.execute("SELECT 1 FROM rollup_energy_backfill").fetchone() is None:
+            rollups.create_rollups(conn, table)
+            # The newest minute already holds samples of both kinds: settle
+            # it before the new triggers add to it; the backfill does the rest
+            first, last = conn.execute(f"SELECT COALESCE(MIN(bucket), 0), COALESCE(MAX(bucket), -60) "
+                                       f"FROM {rollups.rollup_table('1m')}").fetchone()
+            rollups.backfill_energy(conn, last, last)
+            conn.execute("INSERT INTO rollup_energy_backfill (id, next_bucket, last_bucket) "
+                         "VALUES (1, ?, ?)", (first, last - 60))
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+    started = time.monotonic()
+    chunks = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-read inside the write lock: another process may be backfilling too
+            row = conn.execute("SELECT next_bucket, last_bucket FROM rollup_energy_backfill "
+                               "WHERE id = 1").fetchone()
+            following = (rollups.backfill_energy(conn, row[0], row[1], chunk_rows)
+                         if row[0] is not None else None)
+            if following is None:
+                conn.execute("INSERT OR IGNORE INTO schema_migrations (name, applied_at) "
+                             "VALUES ('rollup_energy', ?)", (datetime.now().isoformat(),))
+                conn.execute("DROP TABLE rollup_energy_backfill")
+            else:
+                conn.execute("UPDATE rollup_energy_backfill SET next_bucket = ? WHERE id = 1",
+                             (following,))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        chunks += 1
+        if following is None:
+            break
+    if verbose:
+        print(f"✅ Rollup energy backfilled in {time.monotonic() - started:.1f}s")
+    return chunks
+
+
+def _pick(columns, names, default: str = '0') -> str:
+    """First non-NULL of the ``names`` present in ``columns``"""
+    present = [n for n in names if n in columns]
+    return f"COALESCE({', '.join(present)}, {default})" if present else default
+
+
+def _copy_site_rows(conn, source: str, schema: str = 'main', lo: int = 0,
+                    hi: Optional[int] = None) -> int:
+    """Copy ``schema``.``source`` rows with lo <= rowid < hi into site_samples/device_data"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({source})")}
+    where = "rowid >= ?" + (" AND rowid < ?" if hi is not None else "")
+    args = (lo,) if hi is None else (lo, hi)
+    site = (f"timestamp, {_pick(columns, ('production_kw', 'total_production_kw', 'power_kw'))}, "
+            f"{_pick(columns, ('consumption_kw', 'total_consumption_kw'))}, "
+            f"{_pick(columns, ('net_export_kw', 'net_power_kw'))}, ts_epoch")
+    insert = (f"INSERT INTO {schema}.site_samples "
+              f"(timestamp, production_kw, consumption_kw, net_export_kw, ts_epoch)")
+    if source == 'system_status':
+        # Canonical: every sample, ids kept
+        return conn.execute(f"""
+            {insert.replace('(timestamp', '(id, timestamp')}
+            SELECT id, {site} FROM {schema}.system_status WHERE {where}
+        """, args).rowcount
+
+    device_rows = 'device_id IS NOT NULL' if 'device_id' in columns else '0'
+    copied = conn.execute(f"""
+        {insert}
+        SELECT {site} FROM {schema}.solar_data x WHERE {where} AND NOT ({device_rows})
+        AND NOT EXISTS (SELECT 1 FROM {schema}.site_samples s WHERE s.ts_epoch = x.ts_epoch)
+    """, args).rowcount
+    # device_data: the table (epochs filled in when it is copied) or the view
+    target = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(device_data)")}
+    if 'device_id' in columns and target:
+        epoch = ', ts_epoch' if 'ts_epoch' in target else ''
+        copied += conn.execute(f"""
+            INSERT INTO {schema}.device_data
+            (timestamp, device_id, device_type, power_kw, voltage, current_a, frequency{epoch})
+            SELECT timestamp, device_id, {_pick(columns, ('device_type',), "'inverter'")},
+                   {_pick(columns, ('power_kw', 'production_kw'))},
+                   {_pick(columns, ('voltage',), 'NULL')}, {_pick(columns, ('current',), 'NULL')},
+                   {_pick(columns, ('frequency',), 'NULL')}{epoch}
+            FROM {schema}.solar_data WHERE {where} AND device_id IS NOT NULL
+        """, args).rowcount
+    return copied
+
+
+def migrate_site_samples(conn, db_path: str, chunk_rows: int = BACKFILL_CHUNK_ROWS,
+                         verbose: bool = True) -> int:
+    """Fold system_status/solar_data into site_samples and put views in their place"""
+    import rollups
+    import site_samples
+
+    if _applied(conn, 'site_samples'):
+        return 0
+    sources = [t for t in LEGACY_SITE_TABLES if _table_exists(conn, t)]
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS site_samples_backfill (
+            source TEXT PRIMARY KEY,
+            next_rowid INTEGER,
+            last_rowid INTEGER
+        )
+    """)
+    started = time.monotonic()
+    # One transaction per month, each rerunnable: before the main swap is recorded
+    copied = migrate_partition_site_samples(conn, db_path)
+    for source in sources:
+        conn.execute(f"""
+            INSERT OR IGNORE INTO site_samples_backfill (source, next_rowid, last_rowid)
+            SELECT ?, COALESCE(MIN(rowid), 1), COALESCE(MAX(rowid), 0) FROM {source}
+        """, (source,))
+        next_rowid, last_rowid = conn.execute(
+            "SELECT next_rowid, last_rowid FROM site_samples_backfill WHERE source = ?",
+            (source,)).fetchone()
+        while next_rowid <= last_rowid:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                copied += _copy_site_rows(conn, source, lo=next_rowid, hi=next_rowid + chunk_rows)
+                next_rowid += chunk_rows
+                conn.execute("UPDATE site_samples_backfill SET next_rowid = ? WHERE source = ?",
+                             (next_rowid, source))
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+
+    # Swap: rows written since, then views instead of tables
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for source in sources:
+            next_rowid = conn.execute("SELECT next_rowid FROM site_samples_backfill WHERE source = ?",
+                                      (source,)).fetchone()[0]
+            copied += _copy_site_rows(conn, source, lo=next_rowid)
+            conn.execute(f"DROP TABLE {source}")
+        site_samples.create_legacy_views(conn)
+        if _applied(conn, 'rollups'):
+            rollups.create_rollup_triggers(conn)
+        conn.execute("DROP TABLE site_samples_backfill")
+        conn.execute("INSERT OR IGNORE INTO schema_migrations (name, applied_at) VALUES (?, ?)",
+                     ('site_samples', datetime.now().isoformat()))
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    if verbose and copied:
+        print(f"✅ site_samples: {copied} rows folded in from {', '.join(sources) or 'partitions'} "
+              f"in {time.monotonic() - started:.1f}s")
+    return copied
+
+
+def migrate_partition_site_samples(conn, db_path: str) -> int:
+    """Same conversion for monthly files written before site_samples existed"""
+    from partitions import PartitionSet
+
+    partitions = PartitionSet.from_config(db_path)
+    if partitions is None or not partitions.partitioned('site_samples'):
+        return 0
+    copied = 0
+    for key in partitions.keys():
+        schema = partitions.attach(conn, key, create=True)
+        try:
+            sources = [t for t in LEGACY_SITE_TABLES if conn.execute(
+                f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                (t,)).fetchone()]
+            if not sources:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for source in sources:
+                    copied += _copy_site_rows(conn, source, schema)
+                    conn.execute(f"DROP TABLE {schema}.{source}")
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.execute(f'DETACH DATABASE {schema}')
+    return copied
+
+
+DEVICE_LATEST_COLUMNS = ('timestamp', 'device_id', 'device_type', 'status', 'power_kw', 'voltage',
+                         'current_a', 'frequency', 'temperature', 'ts_epoch')
+
+
+def create_device_latest(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS device_latest (
+            device_id TEXT PRIMARY KEY,
+            device_type TEXT,
+            status TEXT,
+            power_kw REAL,
+            voltage REAL,
+            current_a REAL,
+            frequency REAL,
+            temperature REAL,
+            timestamp TEXT,
+            ts_epoch INTEGER
+        )
+    """)
+
+
+def migrate_device_latest(conn) -> int:
+    """device_latest table plus its one-time fill from device_data"""
+    if _applied(conn, 'device_latest') or not _applied(conn, 'device_samples'):
+        return 0
+    columns = ', '.join(DEVICE_LATEST_COLUMNS)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        create_device_latest(conn)
+        # Bare columns next to MAX() come from the row holding the maximum
+        cursor = conn.execute(f"""
+            INSERT OR IGNORE INTO device_latest ({columns})
+            SELECT {columns.replace('ts_epoch', 'MAX(ts_epoch)')} FROM device_data
+            WHERE device_id IS NOT NULL GROUP BY device_id
+        """)
+        conn.execute("INSERT OR IGNORE INTO schema_migrations (name, applied_at) VALUES (?, ?)",
+                     ('device_latest', datetime.now().isoformat()))
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    return cursor.rowcount
+
+
+def create_device_registry(conn):
+    """Registry tables and device_samples (one transaction, idempotent)"""
+    import devices
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        devices.create_registry(conn)
+        devices.create_device_samples(conn)
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+
+def _copy_device_rows(conn, schema: str = 'main', lo: int = 0, hi: Optional[int] = None,
+                      keep_ids: bool = True) -> int:
+    """Copy ``schema``.device_data table rows with lo <= rowid < hi into device_samples"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(device_data)")}
+    where = "rowid >= ?" + (" AND rowid < ?" if hi is not None else "")
+    args = (lo,) if hi is None else (lo, hi)
+    epoch = f"COALESCE(ts_epoch, {epoch_sql()})" if 'ts_epoch' in columns else epoch_sql()
+    # The devices and status strings these rows name, first seen here
+    conn.execute(f"""
+        INSERT OR IGNORE INTO main.devices (device_id, device_type, first_seen, updated_at)
+        SELECT device_id, device_type, MIN({epoch}), MIN({epoch}) FROM {schema}.device_data
+        WHERE {where} AND device_id IS NOT NULL GROUP BY device_id
+    """, args)
+    conn.execute(f"""
+        INSERT OR IGNORE INTO main.device_status_codes (status)
+        SELECT DISTINCT status FROM {schema}.device_data WHERE {where} AND status IS NOT NULL
+    """, args)
+    key = "(SELECT device_key FROM main.devices r WHERE r.device_id = d.device_id)"
+    code = "(SELECT code FROM main.device_status_codes c WHERE c.status = d.status)"
+    if 'device_key' in columns:
+        # Rows already encoded in place by an earlier version
+        key, code = f"COALESCE(d.device_key, {key})", f"COALESCE(d.status_code, {code})"
+    return conn.execute(f"""
+        INSERT INTO {schema}.device_samples
+        (id, timestamp, device_key, status_code, power_kw, voltage, current_a, frequency,
+         temperature, raw_fields, ts_epoch)
+        SELECT {'d.id' if keep_ids else 'NULL'}, d.timestamp, {key}, {code}, d.power_kw,
+               d.voltage, d.current_a, d.frequency, d.temperature,
+               {'d.raw_fields' if 'raw_fields' in columns else 'NULL'}, {epoch}
+        FROM {schema}.device_data d WHERE {where}
+    """, args).rowcount
+
+
+def migrate_device_samples(conn, db_path: str, chunk_rows: int = BACKFILL_CHUNK_ROWS,
+                           verbose: bool = True) -> int:
+    """Copy a device_data table into device_samples and put the decoding views in its place"""
+    import devices
+    import stats_catalog
+
+    if _applied(conn, 'device_samples'):
+        return 0
+    started = time.monotonic()
+    # One transaction per month, each rerunnable: before the main swap is recorded
+    copied = migrate_partition_device_samples(conn, db_path)
+    if _table_exists(conn, 'device_data'):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS device_samples_backfill (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    next_rowid INTEGER,
+                    last_rowid INTEGER
+                )
+            """)
+            if conn.execute("SELECT 1 FROM device_samples_backfill").fetchone() is None:
+                first, last = conn.execute("SELECT COALESCE(MIN(rowid), 1), COALESCE(MAX(rowid), 0) "
+                                           "FROM device_data").fetchone()
+                conn.execute("INSERT INTO device_samples_backfill (id, next_rowid, last_rowid) "
+                             "VALUES (1, ?, ?)", (first, last))
+                # New rows are numbered after the copied ids
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = 'device_samples'")
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('device_samples', "
+                             "(SELECT MAX(COALESCE(MAX(id), 0), ?) FROM device_samples))", (last,))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Re-read inside the write lock: another process may be copying too
+                next_rowid, last_rowid = conn.execute(
+                    "SELECT next_rowid, last_rowid FROM device_samples_backfill WHERE id = 1"
+                    ).fetchone()
+                if next_rowid <= last_rowid:
+                    hi = min(next_rowid + chunk_rows, last_rowid + 1)
+                    copied += _copy_device_rows(conn, lo=next_rowid, hi=hi)
+                    conn.execute("UPDATE device_samples_backfill SET next_rowid = ? WHERE id = 1",
+                                 (hi,))
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            if next_rowid > last_rowid:
+                break
+            if verbose and (next_rowid // chunk_rows) % 100 == 99:
+                print(f"🔄 device_samples: {hi * 100 // max(1, last_rowid + 1)}% ({copied} rows)")
+
+    # Swap: rows written since, then the views instead of the table
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not _applied(conn, 'device_samples'):
+            if _table_exists(conn, 'device_data'):
+                next_rowid = conn.execute(
+                    "SELECT next_rowid FROM device_samples_backfill WHERE id = 1").fetchone()[0]
+                copied += _copy_device_rows(conn, lo=next_rowid, keep_ids=False)
+                conn.execute("DROP TABLE device_data")
+            conn.execute("DROP TABLE IF EXISTS device_samples_backfill")
+            # An older device_readings read the table; replace it too
+            devices.create_device_views(conn, replace=True)
+            if stats_catalog.exists(conn):
+                for catalog in ('stats_tables', 'stats_days', 'stats_devices'):
+                    conn.execute(f"UPDATE OR REPLACE {catalog} SET tbl = 'device_samples' "
+                                 f"WHERE tbl = 'device_data'")
+                stats_catalog.create_triggers(conn, 'device_samples')
+            conn.execute("INSERT OR IGNORE INTO schema_migrations (name, applied_at) VALUES (?, ?)",
+                         ('device_samples', datetime.now().isoformat()))
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    if verbose and copied:
+        print(f"✅ device_samples: {copied} rows copied from device_data "
+              f"in {time.monotonic() - started:.1f}s")
+    return copied
+
+
+def migrate_partition_device_samples(conn, db_path: str) -> int:
+    """Same conversion for monthly files written before device_samples existed"""
+    from partitions import PartitionSet
+
+    partitions = PartitionSet.from_config(db_path)
+    if partitions is None or not partitions.partitioned('device_samples'):
+        return 0
+    copied = 0
+    for key in partitions.keys():
+        schema = partitions.attach(conn, key, create=True)
+        try:
+            if not conn.execute(f"SELECT 1 FROM {schema}.sqlite_master "
+                                f"WHERE type = 'table' AND name = 'device_data'").fetchone():
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                copied += _copy_device_rows(conn, schema)
+                conn.execute(f"DROP TABLE {schema}.device_data")
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.execute(f'DETACH DATABASE {schema}')
+    return copied
+
+
+def migrate_json_fields(conn, verbose: bool = True) -> Dict:
+    """Promoted JSON columns matching PROMOTED_JSON_FIELDS, then the raw_fields backfill"""
+    import devices
+    import json_fields
+
+    changes = {}
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for table, source in json_fields.JSON_SOURCES.items():
+            if not _table_exists(conn, table):
+                continue
+            if not _has_column(conn, table, source):
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {source} TEXT")
+            if sqlite3.sqlite_version_info < (3, 35, 0):
+                continue  # no generated columns / DROP COLUMN
+            if table == devices.DEVICE_TABLE and _applied(conn, 'device_samples'):
+                # The views name the columns, which would block DROP COLUMN;
+                # dropping them instead would break solar_data's insert trigger
+                devices.create_device_views(conn, replace=True, promoted=False)
+            result = json_fields.apply_fields(conn, table)
+            if result['added'] or result['dropped']:
+                changes[table] = result
+        if _applied(conn, 'device_samples'):
+            devices.create_device_views(conn, replace=True)
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    if verbose:
+        for table, result in changes.items():
+            print(f"✅ {table}: promoted JSON columns added {result['added']}, dropped {result['dropped']}")
+
+    backfilled = 0
+    if (_has_column(conn, 'device_samples', 'raw_fields') and _table_exists(conn, 'raw_snapshots')
+            and _table_exists(conn, 'devices')):
+        backfilled = json_fields.backfill_raw_fields(conn, verbose=verbose)
+    return {'columns': changes, 'raw_fields': backfilled}
+
+
+def migrate_stats_catalog(conn, db_path: str, verbose: bool = True) -> int:
+    """Statistics catalog and its triggers; counted once when first created"""
+    import stats_catalog
+    from partitions import PartitionSet
+    if not stats_catalog.create_all(conn):
+        return 0
+    started = time.monotonic()
+    counted = stats_catalog.reconcile(conn, PartitionSet.from_config(db_path))
+    rows = sum(stats_catalog.table_stats(conn, table)['rows'] for table in counted)
+    if verbose and rows:
+        print(f"✅ Statistics catalog: {rows} rows counted in {time.monotonic() - started:.1f}s")
+    return rows
+
+
+def migrate(db_path: str, chunk_rows: int = BACKFILL_CHUNK_ROWS, verbose: bool = True) -> Dict:
+    """Bring a database up to the current schema; safe to run on every start"""
+    conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        import maintenance
+        maintenance.ensure_auto_vacuum(conn)
+        maintenance.create_metadata(conn)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TEXT
+            )
+        """)
+        backfilled = {}
+        import raw_archive
+        raw_archive.create_raw_archive(conn)
+        if any(_table_exists(conn, t) for t in LEGACY_SITE_TABLES):
+            import site_samples
+            site_samples.create_site_samples(conn)
+        if _table_exists(conn, 'device_data') or _table_exists(conn, 'device_samples'):
+            create_device_registry(conn)
+        for table in EPOCH_TABLES:
+            if _table_exists(conn, table):
+                backfilled[table] = migrate_epoch(conn, table, chunk_rows, verbose)
+        if _table_exists(conn, 'system_status'):
+            # Legacy tables: rollups from system_status first, then the swap
+            backfilled['rollups'] = migrate_rollups(conn, 'system_status', verbose)
+            backfilled['rollup_energy'] = migrate_rollup_energy(conn, 'system_status',
+                                                                chunk_rows, verbose)
+        if _table_exists(conn, 'site_samples'):
+            backfilled['site_samples'] = migrate_site_samples(conn, db_path, chunk_rows, verbose)
+            backfilled['rollups'] = (backfilled.get('rollups')
+                                     or migrate_rollups(conn, 'site_samples', verbose))
+            backfilled['rollup_energy'] = (backfilled.get('rollup_energy')
+                                           or migrate_rollup_energy(conn, 'site_samples',
+                                                                    chunk_rows, verbose))
+        if _table_exists(conn, 'device_samples'):
+            backfilled['device_samples'] = migrate_device_samples(conn, db_path, chunk_rows, verbose)
+            backfilled['device_latest'] = migrate_device_latest(conn)
+        if _table_exists(conn, 'device_samples') or _table_exists(conn, 'weather_data'):
+            backfilled['json_fields'] = migrate_json_fields(conn, verbose)
+        # Last: the catalog's triggers would only slow the backfills above
+        backfilled['stats_catalog'] = migrate_stats_catalog(conn, db_path, verbose)
+        return {'success': True, 'backfilled': backfilled}
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    from config import config
+    result = migrate(sys.argv[1] if len(sys.argv) > 1 else config.database_path)
+    print(f"📦 Migration complete: {result['backfilled']}")
@@ -29,7 +29,10 @@ import threading
 import queue
 
 # Import existing modules
-from pvs_client import PVSClient
+from pvs_client import get_shared_client
+from migrations import timestamp_epoch
+import rollups
+from partitions import PartitionSet
 from database import SolarDatabase
 from version import get_version_string, get_full_version_info
 
@@ -44,7 +47,7 @@ class MobileAPI:
     def __init__(self, database_path: str = "solar_data.db"):
         self.database_path = database_path
         self.logger = logging.getLogger(__name__)
-        self.pvs_client = PVSClient()
+        self.pvs_client = get_shared_client()
         self.db = SolarDatabase(database_path)
         
         # Mobile app configuration
@@ -134,11 +137,18 @@ class MobileAPI:
         except Exception as e:
             self.logger.error(f"Dashboard data refresh error: {e}")
     
+    def _open_partitions(self, conn, since=None, until=None):
+        """Attach the monthly files a raw-table query needs (partitioned mode)"""
+        partitions = PartitionSet.from_config(self.database_path)
+        if partitions is not None:
+            partitions.open_range(conn, since, until)
+    
     def _get_current_solar_data(self) -> Dict:
         """Get current solar production data."""
         try:
             # Get latest data from database
             conn = sqlite3.connect(self.database_path)
+            self._open_partitions(conn, time.time() - 86400)
             cursor = conn.cursor()
             
             cursor.execute("""
@@ -206,45 +216,45 @@ class MobileAPI:
         try:
             conn = sqlite3.connect(self.database_path)
             cursor = conn.cursor()
+            # Indexed integer range on ts_epoch rather than comparing ISO text
+            window = (timestamp_epoch(start_date), timestamp_epoch(end_date))
             
-            # Build query based on interval
-            if interval == 'hour':
-                cursor.execute("""
-                    SELECT 
-                        strftime('%Y-%m-%d %H:00:00', timestamp) as time_bucket,
-                        AVG(production_kw) as avg_production,
-                        AVG(consumption_kw) as avg_consumption,
-                        AVG(net_power_kw) as avg_net_power,
-                        SUM(production_kw * 0.25) as total_production_kwh
-                    FROM solar_data 
-                    WHERE timestamp BETWEEN ? AND ?
-                    GROUP BY time_bucket
-                    ORDER BY time_bucket
-                """, (start_date, end_date))
-            elif interval == 'day':
-                cursor.execute("""
+            # Read from the coarsest rollup tier that resolves the interval
+            buckets = {'hour': (3600, '%Y-%m-%d %H:00:00'), 'day': (86400, '%Y-%m-%d')}
+            bucket_seconds, label_format = buckets.get(interval, (60, None))
+            plan = rollups.plan(conn, bucket_seconds)
+            source = plan['source']
+            if plan['tier'] and window[0] is not None:
+                # Include the whole bucket the start falls into
+                window = (rollups.bucket_start(conn, plan['tier'], window[0]), window[1])
+            elif not plan['tier']:
+                self._open_partitions(conn, *window)
+            
+            # Build query based on interval (time-weighted: the sample grid is not fixed)
+            if interval in buckets:
+                cursor.execute(f"""
                     SELECT 
-                        strftime('%Y-%m-%d', timestamp) as time_bucket,
-                        AVG(production_kw) as avg_production,
-                        AVG(consumption_kw) as avg_consumption,
-                        AVG(net_power_kw) as avg_net_power,
-                        SUM(production_kw * 0.25) as total_production_kwh
-                    FROM solar_data 
-                    WHERE timestamp BETWEEN ? AND ?
+                        strftime(?, timestamp) as time_bucket,
+                        SUM(production_energy) / SUM(seconds) as avg_production,
+                        SUM(consumption_energy) / SUM(seconds) as avg_consumption,
+                        SUM(net_export_energy) / SUM(seconds) as avg_net_power,
+                        SUM(production_energy) / 3600.0 as total_production_kwh
+                    FROM {source} 
+                    WHERE ts_epoch BETWEEN ? AND ?
                     GROUP BY time_bucket
                     ORDER BY time_bucket
-                """, (start_date, end_date))
+                """, (label_format,) + window)
             else:  # minute
-                cursor.execute("""
+                cursor.execute(f"""
                     SELECT 
                         timestamp,
-                        production_kw,
-                        consumption_kw,
-                        net_power_kw
-                    FROM solar_data 
-                    WHERE timestamp BETWEEN ? AND ?
-                    ORDER BY timestamp
-                """, (start_date, end_date))
+                        production_sum / samples,
+                        consumption_sum / samples,
+                        net_export_sum / samples
+                    FROM {source} 
+                    WHERE ts_epoch BETWEEN ? AND ?
+                    ORDER BY ts_epoch
+                """, window)
             
             rows = cursor.fetchall()
             conn.close()
@@ -278,7 +288,8 @@ class MobileAPI:
         """Get list of all devices for mobile app."""
         try:
             # Get device list from PVS6
-            devices = self.pvs_client.get_device_list()
+            # Last good list (if recent) while the gateway is unreachable
+            devices = self.pvs_client.get_device_list(allow_stale=True) or []
             
             # Format for mobile app
             device_list = []
@@ -436,6 +447,7 @@ def get_device_list():
             'success': True,
             'devices': devices,
             'count': len(devices),
+            'pvs6': mobile_api.pvs_client.get_health(),
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Partitioned Storage
+Monthly SQLite files for the raw time-series tables.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+With STORAGE_MODE=partitioned the raw tables (PARTITIONED_TABLES, by default
+site_samples and device_samples) are written to one file per local calendar
+month:
+
+    <PARTITION_DIR>/solar_2025-09.db    site_samples, device_samples
+
+Everything else (rollup tiers, weather, metadata) stays in the main
+database, which therefore stays small: VACUUM and backups no longer scale
+with the raw history, and expiring a month is an unlink instead of a
+DELETE.
+
+Readers call open_range(): only the months overlapping the requested range
+are ATTACHed, and TEMP views named after the partitioned tables
+(main rows UNION ALL each attached month) shadow the main tables, so the
+existing SQL runs unchanged and the ts_epoch filter is pushed down to every
+file's own index. The views that decode those tables (system_status,
+solar_data, device_data, device_readings) are recreated as TEMP views on top, since the
+main database's views only ever read the main tables. SQLite attaches at most 10 files per connection, so a
+range spanning more months than that raises PartitionLimitError.
+
+Writers call attach_for_write() (outside a transaction) and insert into the
+returned schema; rollup tiers in the main database are kept current by TEMP
+triggers on the attached month (rollups.create_rollup_triggers). Months
+written before a column or promoted JSON field (json_fields.py) was added
+get it when they are attached for writing.
+"""
+
+import glob
+import os
+import re
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+import devices
+import json_fields
+import rollups
+import site_samples
+import stats_catalog
+from config import config
+from db_pool import temp_writes
+from migrations import EPOCH_INDEXES
+
+FILE_PREFIX = 'solar_'
+
+# Raw, high-volume tables written only through storage.CycleWriter
+PARTITIONABLE_TABLES = ('site_samples', 'device_samples')
+
+# SQLITE_MAX_ATTACHED of stock SQLite builds
+MAX_ATTACHED = 10
+
+
+class PartitionLimitError(ValueError):
+    """A range needs more monthly files than SQLite can attach at once"""
+
+
+def month_key(epoch: Optional[float] = None) -> str:
+    """'YYYY-MM' of the local month containing ``epoch`` (default: now)"""
+    return time.strftime('%Y-%m', time.localtime(time.time() if epoch is None else epoch))
+
+
+def month_bounds(key: str):
+    """(start, end) epoch seconds of a local month"""
+    year, month = (int(part) for part in key.split('-'))
+    start = time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1))
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return int(start), int(time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1)))
+
+
+def schema_name(key: str) -> str:
+    return 'p_' + key.replace('-', '_')
+
+
+class PartitionSet:
+    """The monthly files next to one main database"""
+
+    def __init__(self, db_path: str, directory: str = '', tables=None):
+        self.db_path = db_path
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(db_path)),
+                                                   'partitions')
+        self.tables = tuple(t for t in (tables or config.partitioned_tables)
+                            if t in PARTITIONABLE_TABLES)
+
+    @classmethod
+    def from_config(cls, db_path: str) -> Optional['PartitionSet']:
+        """PartitionSet when STORAGE_MODE=partitioned, else None"""
+        if config.storage_mode != 'partitioned':
+            return None
+        return cls(db_path, config.partition_dir, config.partitioned_tables)
+
+    def partitioned(self, table: str) -> bool:
+        return table in self.tables
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{FILE_PREFIX}{key}.db")
+
+    def keys(self) -> List[str]:
+        """Existing months, oldest first"""
+        pattern = re.compile(rf"^{FILE_PREFIX}(\d{{4}}-\d{{2}})\.db$")
+        names = (os.path.basename(p) for p in glob.glob(os.path.join(self.directory, '*.db')))
+        return sorted(m.group(1) for m in map(pattern.match, names) if m)
+
+    def keys_for_range(self, since: Optional[float] = None, until: Optional[float] = None) -> List[str]:
+        """Existing months overlapping [since, until]"""
+        keys = self.keys()
+        if since is not None:
+            keys = [k for k in keys if k >= month_key(since)]
+        if until is not None:
+            keys = [k for k in keys if k <= month_key(until)]
+        return keys
+
+    # ------------------------------------------------------------------
+    # Attaching
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _attached(conn) -> Dict[str, str]:
+        """schema name -> file of everything attached to ``conn``"""
+        return {row[1]: row[2] for row in conn.execute('PRAGMA database_list')}
+
+    def attach(self, conn, key: str, create: bool = False) -> str:
+        """ATTACH one month (idempotent); must run outside a transaction"""
+        schema = schema_name(key)
+        if schema in self._attached(conn):
+            return schema
+        path = self.path(key)
+        if not create and not os.path.exists(path):
+            raise FileNotFoundError(path)
+        os.makedirs(self.directory, exist_ok=True)
+        conn.execute('ATTACH DATABASE ? AS ' + schema, (path,))
+        if create:
+            conn.execute(f'PRAGMA {schema}.journal_mode=WAL')
+            self._create_tables(conn, schema)
+        return schema
+
+    def _create_tables(self, conn, schema: str):
+        """Partition tables with the main tables' current definitions"""
+        for table in self.tables:
+            row = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                               (table,)).fetchone()
+            if row is None:
+                continue
+            sql = re.sub(r'^CREATE TABLE\s+(IF NOT EXISTS\s+)?["\w]+',
+                         f'CREATE TABLE IF NOT EXISTS {schema}.{table}', row[0])
+            conn.execute(sql)
+            # Months created before a column was added to the main table
+            present = {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+            for column in conn.execute(f"PRAGMA main.table_info({table})"):
+                if column[1] not in present:
+                    conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column[1]} {column[2]}")
+            for index, columns in EPOCH_INDEXES.get(table, []):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.{index} ON {table}({columns})")
+            if table in json_fields.JSON_SOURCES and sqlite3.sqlite_version_info >= (3, 35, 0):
+                json_fields.apply_fields(conn, table, schema)
+
+    def attach_for_write(self, conn, keys) -> Dict[str, str]:
+        """Attach (creating) the months being written; detaches other months"""
+        wanted = set(keys)
+        for schema in self._attached(conn):
+            if schema.startswith('p_') and schema not in {schema_name(k) for k in wanted}:
+                conn.execute(f'DETACH DATABASE {schema}')
+        schemas = {}
+        for key in wanted:
+            schemas[key] = self.attach(conn, key, create=True)
+            if 'site_samples' in self.tables:
+                rollups.create_rollup_triggers(conn, schemas[key])
+            if stats_catalog.exists(conn):
+                for table in self.tables:
+                    if table in stats_catalog.STATS_TABLES:
+                        stats_catalog.create_triggers(conn, table, schemas[key])
+        return schemas
+
+    def open_range(self, conn, since: Optional[float] = None,
+                   until: Optional[float] = None) -> List[str]:
+        """
+        Attach the months overlapping [since, until] (None: unbounded) and
+        point TEMP views over them; returns the attached months.
+        """
+        keys = self.keys_for_range(since, until)
+        if len(keys) > MAX_ATTACHED:
+            raise PartitionLimitError(
+                f"Range spans {len(keys)} monthly partitions; at most {MAX_ATTACHED} can be "
+                f"opened at once - use a shorter time range")
+        wanted = {schema_name(key) for key in keys}
+        for schema in self._attached(conn):
+            # Pooled connections come back with earlier requests' months
+            if schema.startswith('p_') and schema not in wanted:
+                conn.execute(f'DETACH DATABASE {schema}')
+        schemas = [self.attach(conn, key) for key in keys]
+        with temp_writes(conn):
+            for table in self.tables:
+                # table_xinfo: the promoted JSON (generated) columns too
+                columns = [row[1] for row in conn.execute(f"PRAGMA main.table_xinfo({table})")
+                           if row[6] != 1]
+                if not columns:
+                    continue
+                branches = [f"SELECT {', '.join(columns)} FROM main.{table}"]
+                for schema in schemas:
+                    present = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_xinfo({table})")}
+                    if not present:
+                        continue  # dropped by retention
+                    select = ', '.join(c if c in present else f"NULL AS {c}" for c in columns)
+                    branches.append(f"SELECT {select} FROM {schema}.{table}")
+                conn.execute(f"DROP VIEW IF EXISTS temp.{table}")
+                conn.execute(f"CREATE TEMP VIEW {table} AS " + ' UNION ALL '.join(branches))
+            # The main database's views only see the main tables
+            if 'site_samples' in self.tables:
+                site_samples.create_temp_legacy_views(conn)
+            if 'device_samples' in self.tables:
+                devices.create_temp_device_views(conn)
+        return keys
+
+    # ------------------------------------------------------------------
+    # Expiry
+    # ------------------------------------------------------------------
+    def expire(self, conn, cutoffs: Dict[str, int], before_drop=None) -> Dict:
+        """
+        Remove months whose tables are all past their cutoff epoch (unlink),
+        or DROP the expired tables of a month that still holds newer-lived
+        ones. ``before_drop(conn, schema, table)`` runs first, e.g. to
+        downsample. ``conn`` is a main-database connection outside a
+        transaction. Returns {'unlinked': [...], 'dropped': [...]}.
+        """
+        result = {'unlinked': [], 'dropped': []}
+        current = month_key()
+        for key in self.keys():
+            if key >= current:
+                break
+            _, end = month_bounds(key)
+            schema = self.attach(conn, key)
+            try:
+                present = [t for t in self.tables if conn.execute(
+                    f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                    (t,)).fetchone()]
+                expired = [t for t in present if t in cutoffs and end <= cutoffs[t]]
+                for table in expired:
+                    if before_drop is not None:
+                        before_drop(conn, schema, table)
+                if expired and len(expired) < len(present):
+                    for table in expired:
+                        conn.execute(f"DROP TABLE {schema}.{table}")
+                        result['dropped'].append(f"{key}:{table}")
+            finally:
+                conn.execute(f'DETACH DATABASE {schema}')
+            if present and len(expired) == len(present):
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(self.path(key) + suffix):
+                        os.remove(self.path(key) + suffix)
+                result['unlinked'].append(key)
+                print(f"🗑️  Partition {key} expired: {os.path.basename(self.path(key))} removed")
+        return result
+
@@ -13,119 +13,494 @@ PVS Client - FIXED to properly parse production meter subtype
 
 import requests
 import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field, replace
 from datetime import datetime
-from typing import Dict, List, Optional
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+from requests.adapters import HTTPAdapter
 from config import config
 
+DEVICE_LIST_PATH = "/cgi-bin/dl_cgi?Command=DeviceList"
+
+# DeviceList fields that describe the hardware rather than a measurement
+STATIC_FIELDS = {
+    'model': 'MODEL',
+    'sw_version': 'SWVER',
+    'hw_version': 'hw_version',
+    'panel': 'PANEL',
+    'module_type': 'TYPE',
+    'description': 'DESCR',
+}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of contacting a gateway that is known to be down"""
+
+    def __init__(self, base_url: str, retry_in: float):
+        super().__init__(f"PVS6 at {base_url} unavailable - circuit open, next probe in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    closed -> (failure_threshold consecutive failures) -> open
+    open -> (backoff elapsed) -> half-open: exactly one probe request
+    half-open -> success: closed / failure: open with doubled backoff
+
+    Backoff is exponential in the number of consecutive trips, capped at
+    max_backoff, with "equal jitter" (50-100% of the nominal delay) so
+    several clients don't all probe a rebooting gateway at once.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold: int = 3, base_backoff: float = 5.0,
+                 max_backoff: float = 300.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self.open_until:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        with self._lock:
+            return max(0.0, self.open_until - time.monotonic()) if self.state != self.CLOSED else 0.0
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print("✅ PVS6 reachable again - circuit closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trips = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.trips += 1
+                nominal = min(self.max_backoff, self.base_backoff * 2 ** (self.trips - 1))
+                delay = nominal / 2 + random.uniform(0, nominal / 2)
+                self.state = self.OPEN
+                self.open_until = time.monotonic() + delay
+                self._probe_in_flight = False
+                print(f"⚡ PVS6 circuit open after {self.failures} failure(s) - next probe in {delay:.0f}s")
+
+    def get_state(self) -> Dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'trips': self.trips,
+            'retry_in_s': round(self.retry_in(), 1),
+        }
+
+
+def _as_float(device: Mapping, keys: Tuple[str, ...], default: Optional[float]) -> Optional[float]:
+    """Return the first parseable float among ``keys`` (PVS6 firmwares disagree on names)"""
+    for key in keys:
+        value = device.get(key)
+        if value in (None, ''):
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            continue
+    return default
+
+
+@dataclass(frozen=True)
+class PVSSnapshot:
+    """
+    Immutable result of ONE DeviceList fetch.
+
+    Everything a collection cycle needs (system totals, per-inverter rows and
+    meter readings) is derived from this object, so the gateway is asked for
+    DeviceList exactly once per poll.
+    """
+    timestamp: str
+    devices: Tuple[Mapping, ...]
+    pvs_online: bool
+    timings: Mapping = field(default_factory=lambda: MappingProxyType({}))
+    # True when this is the last good snapshot served during an outage;
+    # age_seconds is then how old its data is
+    stale: bool = False
+    age_seconds: float = 0.0
+
+    @classmethod
+    def from_devices(cls, devices: Optional[List[Dict]], timestamp: Optional[str] = None,
+                     timings: Optional[Dict] = None) -> 'PVSSnapshot':
+        frozen = tuple(MappingProxyType(dict(d)) for d in (devices or []) if isinstance(d, dict))
+        return cls(
+            timestamp=timestamp or datetime.now().isoformat(),
+            devices=frozen,
+            pvs_online=devices is not None,
+            timings=MappingProxyType(dict(timings or {})),
+        )
+
+    @classmethod
+    def merge(cls, snapshots: List['PVSSnapshot'], timestamp: Optional[str] = None) -> 'PVSSnapshot':
+        """Combine snapshots from several gateways on one site into one"""
+        online = [s for s in snapshots if s is not None and s.pvs_online]
+        devices = [d for s in online for d in s.devices]
+        return cls(
+            timestamp=timestamp or datetime.now().isoformat(),
+            devices=tuple(devices),
+            pvs_online=bool(online),
+            timings=MappingProxyType({'gateways': len(snapshots), 'gateways_online': len(online)}),
+        )
+
+    @property
+    def device_count(self) -> int:
+        return len(self.devices)
+
+    def raw_devices(self) -> List[Dict]:
+        """Plain-dict copies of the devices (for JSON encoding and legacy callers)"""
+        return [dict(d) for d in self.devices]
+
+    def meters(self) -> List[Dict]:
+        """Power meters classified as 'production' or 'consumption'"""
+        meters = []
+        for device in self.devices:
+            if 'power meter' not in device.get('DEVICE_TYPE', '').lower():
+                continue
+            serial = device.get('SERIAL', '')
+            subtype = device.get('subtype', '')
+            production_subtype = device.get('production_subtype_enum', '')
+            consumption_subtype = device.get('consumption_subtype_enum', '')
+
+            # Check for production meter using multiple fields
+            if ('GROSS_PRODUCTION' in subtype or
+                'GROSS_PRODUCTION' in production_subtype or
+                serial.endswith('p')):
+                role = 'production'
+            # Check for consumption meter
+            elif ('GROSS_CONSUMPTION' in subtype or
+                  'GROSS_CONSUMPTION' in consumption_subtype or
+                  serial.endswith('c')):
+                role = 'consumption'
+            else:
+                role = 'other'
+
+            meters.append({
+                'serial': serial,
+                'role': role,
+                'power_kw': _as_float(device, ('p_3phsum_kw',), 0.0),
+                'state': device.get('STATE', '').lower(),
+            })
+        return meters
+
+    def inverters(self, by_serial: bool = False) -> List[Mapping]:
+        """
+        Devices that report as inverters. By default that is TYPE ==
+        'inverter' (data_collector's rule); ``by_serial`` uses the simple
+        collector's looser DEVICE_TYPE / serial match instead.
+        """
+        inverters = []
+        for device in self.devices:
+            if not by_serial:
+                if device.get('TYPE', '').lower() == 'inverter':
+                    inverters.append(device)
+                continue
+            device_type = device.get('DEVICE_TYPE', '').lower()
+            serial = device.get('SERIAL', '')
+            if ('inverter' in device_type or
+                'inv' in serial.lower() or
+                device_type == 'inverter'):
+                inverters.append(device)
+        return inverters
+
+    def inverter_rows(self, by_serial: bool = False) -> List[Dict]:
+        """
+        Raw per-inverter metrics in device_data column order, keyed by
+        DEVICE_ID (or by SERIAL with ``by_serial``, as the simple collector
+        has always stored them) so existing device histories continue
+        """
+        rows = []
+        for device in self.inverters(by_serial):
+            device_id = device.get('SERIAL' if by_serial else 'DEVICE_ID')
+            if not device_id:
+                continue
+            rows.append({
+                'device_id': device_id,
+                'device_type': 'inverter',
+                'state': device.get('STATE', 'unknown').lower(),
+                'power_kw': _as_float(device, ('p_3phsum_kw',), 0.0),
+                'voltage': _as_float(device, ('vln_3phavg_v', 'vln_3phavg'), 240.0),
+                'current_a': _as_float(device, ('i_3phsum_a',), 0.0),
+                'frequency': _as_float(device, ('freq_hz',), 60.0),
+                'temperature': _as_float(device, ('t_htsnk_degc', 'temperature'), 25.0),
+                # Static attributes for the device registry (devices.py)
+                'attributes': {name: device.get(field)
+                               for name, field in STATIC_FIELDS.items() if device.get(field)},
+            })
+        return rows
+
+    def summary(self) -> Dict:
+        """System totals in the shape returned by PVSClient.get_system_summary()"""
+        if not self.devices:
+            return {
+                'device_count': 0,
+                'total_production_kw': 0,
+                'total_consumption_kw': 0,
+                'net_export_kw': 0,
+                'system_online': False,
+                'pvs_online': False,
+                'stale': self.stale,
+                'age_seconds': self.age_seconds,
+            }
+
+        working_devices = sum(1 for d in self.devices if d.get('STATE', '').lower() == 'working')
+        total_production_kw = 0
+        total_consumption_kw = 0
+
+        for meter in self.meters():
+            if meter['role'] == 'production':
+                total_production_kw += meter['power_kw']
+            elif meter['role'] == 'consumption':
+                total_consumption_kw += meter['power_kw']
+
+        # If no consumption meter found, use reasonable default
+        if total_consumption_kw == 0:
+            total_consumption_kw = 1.5  # Reasonable default consumption
+
+        return {
+            'device_count': self.device_count,
+            'working_devices': working_devices,
+            'total_production_kw': total_production_kw,
+            'total_consumption_kw': total_consumption_kw,
+            'net_export_kw': total_production_kw - total_consumption_kw,
+            'system_online': working_devices > 0,
+            'pvs_online': True,
+            'stale': self.stale,
+            'age_seconds': self.age_seconds,
+        }
+
+
 class PVSClient:
-    def __init__(self, pvs_ip=None, pvs_port=80):
+    def __init__(self, pvs_ip=None, pvs_port=None, session=None):
         self.pvs_ip = pvs_ip or config.pvs6_ip
-        self.pvs_port = pvs_port
-        self.base_url = f"http://{self.pvs_ip}:{pvs_port}"
+        self.pvs_port = pvs_port or config.pvs6_port
+        self.base_url = f"http://{self.pvs_ip}:{self.pvs_port}"
         self.serial_number = config.pvs6_serial
+        # (connect, read) - fail fast when the PVS6 access point is gone,
+        # but give a slow DeviceList time to render
+        self.timeout = (config.pvs6_connect_timeout, config.pvs6_read_timeout)
+        
+        # Long-lived pooled session: keep-alive avoids a new TCP handshake
+        # over the PVS6 Wi-Fi link on every poll
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.pvs6_pool_size,
+                                    max_retries=0)
+        self.session = session or requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+        
+        # Fail fast while the gateway is down instead of waiting out the
+        # timeout on every call; callers that can live with old data get
+        # the last good snapshot instead
+        self.breaker = CircuitBreaker(config.pvs6_breaker_threshold,
+                                      config.pvs6_backoff_base, config.pvs6_backoff_max)
+        self.max_stale_age = config.pvs6_max_stale_seconds
+        self._last_good = None  # (PVSSnapshot, monotonic time)
+        
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'errors': 0,
+            'total_latency_ms': 0.0,
+            'max_latency_ms': 0.0,
+            'last_latency_ms': None,
+            'short_circuited': 0,
+            'stale_served': 0,
+        }
+    
+    def _request(self, path: str):
+        """GET ``path`` through the pooled session and record transport stats"""
+        if not self.breaker.allow():
+            with self._stats_lock:
+                self._stats['short_circuited'] += 1
+            raise CircuitOpenError(self.base_url, self.breaker.retry_in())
+        started = time.perf_counter()
+        try:
+            response = self.session.get(f"{self.base_url}{path}", timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            self._record_request((time.perf_counter() - started) * 1000, error=True)
+            self.breaker.record_failure()
+            raise
+        self._record_request((time.perf_counter() - started) * 1000, error=False)
+        # A 5xx means the gateway is up but not serving (e.g. still booting)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+    
+    def _record_request(self, latency_ms: float, error: bool):
+        with self._stats_lock:
+            self._stats['requests'] += 1
+            self._stats['errors'] += int(error)
+            self._stats['total_latency_ms'] += latency_ms
+            self._stats['max_latency_ms'] = max(self._stats['max_latency_ms'], latency_ms)
+            self._stats['last_latency_ms'] = latency_ms
+    
+    def get_transport_stats(self) -> Dict:
+        """Request/latency counters plus how often a pooled connection was reused"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        try:
+            pools = self._adapter.poolmanager.pools
+            connections_opened = sum(pools[key].num_connections for key in pools.keys())
+        except Exception:
+            connections_opened = None
+        
+        stats['base_url'] = self.base_url
+        stats['timeout'] = {'connect': self.timeout[0], 'read': self.timeout[1]}
+        stats['connections_opened'] = connections_opened
+        if connections_opened is not None:
+            stats['connections_reused'] = max(0, stats['requests'] - connections_opened)
+        stats['avg_latency_ms'] = (stats['total_latency_ms'] / stats['requests']
+                                   if stats['requests'] else None)
+        stats['health'] = self.get_health()
+        return stats
+    
+    def get_health(self) -> Dict:
+        """Circuit breaker state and the age of the last good snapshot"""
+        health = self.breaker.get_state()
+        last_good = self._last_good
+        health['last_good_age_s'] = (round(time.monotonic() - last_good[1], 1)
+                                     if last_good else None)
+        return health
+    
+    def close(self):
+        """Release pooled connections"""
+        self.session.close()
         
     def test_connection(self) -> bool:
-        """Test connection to PVS"""
+        """Test connection to PVS (instantly False while the circuit is open)"""
         try:
-            response = requests.get(f"{self.base_url}/cgi-bin/dl_cgi?Command=DeviceList", timeout=10)
+            response = self._request(DEVICE_LIST_PATH)
             return response.status_code == 200
         except:
             return False
     
-    def get_device_list(self) -> Optional[List[Dict]]:
-        """Get list of all devices from PVS - REAL DATA ONLY"""
+    def send_command(self, command: str):
+        """Raw dl_cgi command (used by /api/pvs6/proxy); returns the Response"""
+        return self._request(f"/cgi-bin/dl_cgi?Command={command}")
+    
+    def _fetch_device_list(self, timings: Optional[Dict] = None) -> Optional[List[Dict]]:
+        """Single DeviceList round trip; records 'fetch_ms'/'decode_ms' into ``timings``"""
+        timings = timings if timings is not None else {}
+        started = time.perf_counter()
         try:
-            response = requests.get(f"{self.base_url}/cgi-bin/dl_cgi?Command=DeviceList", timeout=10)
+            response = self._request(DEVICE_LIST_PATH)
             response.raise_for_status()
-            
+            timings['fetch_ms'] = (time.perf_counter() - started) * 1000
+
+            decode_started = time.perf_counter()
             data = response.json()
+            timings['decode_ms'] = (time.perf_counter() - decode_started) * 1000
             if 'devices' in data and data.get('result') == 'succeed':
                 print(f"✅ Got {len(data['devices'])} REAL devices from PVS")
                 return data['devices']
             return []
             
         except requests.exceptions.RequestException as e:
+            timings['fetch_ms'] = (time.perf_counter() - started) * 1000
             print(f"❌ Error fetching device list: {e}")
             return None
         except json.JSONDecodeError as e:
             print(f"❌ Error parsing JSON response: {e}")
             return None
-    
-    def get_system_summary(self) -> Dict:
-        """Get system summary using REAL PVS data - FIXED PRODUCTION PARSING"""
-        devices = self.get_device_list()
-        if not devices:
-            return {
-                'device_count': 0,
-                'total_production_kw': 0,
-                'total_consumption_kw': 0,
-                'net_export_kw': 0,
-                'system_online': False,
-                'pvs_online': False,
-            }
-        
-        total_production_kw = 0
-        total_consumption_kw = 0
-        working_devices = 0
-        total_devices = len(devices)
-        
-        print(f"📊 Parsing {total_devices} devices for REAL power data...")
-        
-        for device in devices:
-            if not isinstance(device, dict):
-                continue
-                
-            device_type = device.get('DEVICE_TYPE', '').lower()
-            state = device.get('STATE', '').lower()
-            serial = device.get('SERIAL', '')
-            
-            # Count working devices
-            if state == 'working':
-                working_devices += 1
-            
-            # Extract production data - FIXED LOGIC
-            if 'power meter' in device_type:
-                subtype = device.get('subtype', '')
-                production_subtype = device.get('production_subtype_enum', '')
-                consumption_subtype = device.get('consumption_subtype_enum', '')
-                
-                power_kw = device.get('p_3phsum_kw', 0)
-                if isinstance(power_kw, (int, float, str)):
-                    power_kw = float(power_kw)
-                
-                # Check for production meter using multiple fields
-                if ('GROSS_PRODUCTION' in subtype or 
-                    'GROSS_PRODUCTION' in production_subtype or
-                    serial.endswith('p')):
-                    total_production_kw += power_kw
-                    print(f"✅ Production Meter: {power_kw:.3f}kW from {serial}")
-                
-                # Check for consumption meter
-                elif ('GROSS_CONSUMPTION' in subtype or 
-                      'GROSS_CONSUMPTION' in consumption_subtype or
-                      serial.endswith('c')):
-                    total_consumption_kw += power_kw
-                    print(f"✅ Consumption Meter: {power_kw:.3f}kW from {serial}")
+
+    def get_device_list(self, allow_stale: bool = False) -> Optional[List[Dict]]:
+        """Get list of all devices from PVS - REAL DATA ONLY"""
+        snapshot = self.get_snapshot(allow_stale=allow_stale)
+        return snapshot.raw_devices() if snapshot.pvs_online else None
+
+    def get_snapshot(self, allow_stale: bool = False) -> PVSSnapshot:
+        """
+        Fetch DeviceList once and freeze it into a PVSSnapshot.
+
+        With ``allow_stale`` (dashboards, mobile API) a failed fetch returns
+        the last good snapshot, marked ``stale`` with its ``age_seconds``,
+        as long as it is younger than PVS6_MAX_STALE_SECONDS. Collectors
+        leave it off so old readings are never stored as new samples.
+        """
+        timings = {}
+        timestamp = datetime.now().isoformat()
+        devices = self._fetch_device_list(timings)
+        snapshot = PVSSnapshot.from_devices(devices, timestamp=timestamp, timings=timings)
+        if snapshot.pvs_online:
+            self._last_good = (snapshot, time.monotonic())
+            return snapshot
         
-        # If no consumption meter found, use reasonable default
-        if total_consumption_kw == 0:
-            total_consumption_kw = 1.5  # Reasonable default consumption
+        if allow_stale and self._last_good is not None:
+            last, fetched_at = self._last_good
+            age = time.monotonic() - fetched_at
+            if age <= self.max_stale_age:
+                with self._stats_lock:
+                    self._stats['stale_served'] += 1
+                return replace(last, stale=True, age_seconds=round(age, 1))
+        return snapshot
+    
+    def get_system_summary(self, snapshot: Optional[PVSSnapshot] = None,
+                           allow_stale: bool = False) -> Dict:
+        """Get system summary using REAL PVS data - FIXED PRODUCTION PARSING
+
+        Pass an existing ``snapshot`` to avoid another DeviceList round trip.
+        """
+        snapshot = snapshot or self.get_snapshot(allow_stale=allow_stale)
+        summary = snapshot.summary()
+        if not summary['pvs_online']:
+            return summary
         
-        net_export_kw = total_production_kw - total_consumption_kw
-        system_online = working_devices > 0
+        print(f"📊 Parsed {snapshot.device_count} devices for REAL power data")
+        for meter in snapshot.meters():
+            if meter['role'] == 'production':
+                print(f"✅ Production Meter: {meter['power_kw']:.3f}kW from {meter['serial']}")
+            elif meter['role'] == 'consumption':
+                print(f"✅ Consumption Meter: {meter['power_kw']:.3f}kW from {meter['serial']}")
         
         print(f"🔋 REAL PVS6 Summary:")
-        print(f"   Production: {total_production_kw:.3f}kW")
-        print(f"   Consumption: {total_consumption_kw:.3f}kW") 
-        print(f"   Net Export: {net_export_kw:.3f}kW")
-        print(f"   Devices: {working_devices}/{total_devices} working")
+        print(f"   Production: {summary['total_production_kw']:.3f}kW")
+        print(f"   Consumption: {summary['total_consumption_kw']:.3f}kW") 
+        print(f"   Net Export: {summary['net_export_kw']:.3f}kW")
+        print(f"   Devices: {summary['working_devices']}/{summary['device_count']} working")
         
-        return {
-            'device_count': total_devices,
-            'working_devices': working_devices,
-            'total_production_kw': total_production_kw,
-            'total_consumption_kw': total_consumption_kw,
-            'net_export_kw': net_export_kw,
-            'system_online': system_online,
-            'pvs_online': True,
-        }
+        return summary
+
+
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+def get_shared_client(pvs_ip=None, pvs_port=None) -> PVSClient:
+    """
+    Process-wide PVSClient (one per gateway address) so the collector,
+    /api/pvs6/proxy and the mobile API share one keep-alive connection pool.
+    """
+    key = (pvs_ip or config.pvs6_ip, pvs_port or config.pvs6_port)
+    with _shared_clients_lock:
+        client = _shared_clients.get(key)
+        if client is None:
+            client = PVSClient(*key)
+            _shared_clients[key] = client
+        return client
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor PVS6 Simulator
+Local stand-in for the SunPower PVS6 gateway, plus a traffic recorder.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Serves /cgi-bin/dl_cgi?Command=... over HTTP/1.1 keep-alive, either from a
+synthetic fleet of N inverters (production follows the sun for
+WEATHER_LATITUDE/LONGITUDE) or from responses recorded off a real gateway.
+Latency, errors, hung requests and dropped connections can be injected, and
+the simulated clock can run faster than real time so a whole day of
+production plays out in minutes.
+
+    # 200-inverter fleet, 1 day per minute, 300ms latency, 5% HTTP 500s
+    python pvs_simulator.py serve --port 8080 --inverters 200 --speed 1440 \\
+        --latency-ms 300 --error-rate 0.05
+
+    # capture a real gateway, then play it back 60x
+    python pvs_simulator.py record --out recordings/ --interval 60 --count 1440
+    python pvs_simulator.py serve --port 8080 --replay recordings/ --speed 60
+
+Point the collectors/dashboard at it with PVS6_IP_ADDRESS=127.0.0.1 and
+PVS6_PORT=8080. GET /sim/stats returns the simulator's request counters.
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from config import config
+from scheduler import AdaptiveScheduler, solar_events
+
+
+class SimClock:
+    """Simulated wall clock: ``start`` + elapsed monotonic time * ``speed``"""
+
+    def __init__(self, speed: float = 1.0, start: Optional[float] = None):
+        self.speed = speed
+        self.start = time.time() if start is None else start
+        self._origin = time.monotonic()
+
+    def now(self) -> float:
+        return self.start + (time.monotonic() - self._origin) * self.speed
+
+    def elapsed(self) -> float:
+        return self.now() - self.start
+
+
+# ----------------------------------------------------------------------
+# Response sources
+# ----------------------------------------------------------------------
+class SyntheticFleet:
+    """DeviceList for a supervisor, two meters and N inverters"""
+
+    def __init__(self, inverters: int = 24, clock: Optional[SimClock] = None,
+                 inverter_kw: float = 0.36, base_load_kw: float = 0.6, seed: int = 0):
+        self.clock = clock or SimClock()
+        self.inverter_kw = inverter_kw
+        self.base_load_kw = base_load_kw
+        self.latitude = float(config.weather_latitude)
+        self.longitude = float(config.weather_longitude)
+        rng = random.Random(seed)
+        # Per-panel mismatch: orientation/shading differences between inverters
+        self.serials = [f"E00122{1000000 + i:09d}" for i in range(inverters)]
+        self.derate = [rng.uniform(0.85, 1.0) for _ in range(inverters)]
+        self._rng = random.Random(seed + 1)
+        self._sun: Dict = {}
+
+    def _sun_fraction(self, when: float) -> float:
+        """0..1 clear-sky output for epoch ``when``"""
+        day = datetime.fromtimestamp(when).date()
+        if self._sun.get('day') != day:
+            self._sun = dict(solar_events(day, self.latitude, self.longitude), day=day)
+        sunrise, sunset = self._sun['sunrise'], self._sun['sunset']
+        if not sunrise < when < sunset:
+            return 0.0
+        return math.sin(math.pi * (when - sunrise) / (sunset - sunrise)) ** 1.3
+
+    def response(self, command: str) -> Tuple[int, Dict]:
+        if command != 'DeviceList':
+            return 400, {'result': f'error: unsupported command {command}'}
+        return 200, {'devices': self.devices(), 'result': 'succeed'}
+
+    def devices(self) -> List[Dict]:
+        when = self.clock.now()
+        stamp = datetime.fromtimestamp(when, tz=timezone.utc).strftime('%Y,%m,%d,%H,%M,%S')
+        sun = self._sun_fraction(when)
+        clouds = 1.0 - 0.3 * self._rng.random() if sun else 0.0
+
+        inverters = []
+        production_kw = 0.0
+        for serial, derate in zip(self.serials, self.derate):
+            power = round(self.inverter_kw * sun * clouds * derate, 4)
+            production_kw += power
+            awake = power > 0.001
+            inverters.append({
+                'DEVICE_TYPE': 'Inverter',
+                'SERIAL': serial,
+                'MODEL': 'AC_Module_Type_H',
+                'TYPE': 'SOLARBRIDGE',
+                'STATE': 'working' if awake else 'error',
+                'STATEDESCR': 'Working' if awake else 'Error',
+                'DATATIME': stamp,
+                'p_3phsum_kw': f"{power:.4f}" if awake else '0',
+                'vln_3phavg_v': f"{self._rng.uniform(238, 246):.2f}" if awake else '0',
+                'i_3phsum_a': f"{power * 1000 / 240:.2f}" if awake else '0',
+                'freq_hz': f"{self._rng.uniform(59.98, 60.02):.2f}" if awake else '0',
+                't_htsnk_degc': f"{20 + 30 * sun:.0f}" if awake else '0',
+            })
+
+        hour = datetime.fromtimestamp(when).hour
+        evening = 1.2 if 17 <= hour <= 22 else 0.0
+        consumption_kw = self.base_load_kw + evening + 0.4 * self._rng.random()
+
+        return [
+            {
+                'DEVICE_TYPE': 'PVS',
+                'SERIAL': 'ZT01234567890ABCDEF',
+                'MODEL': 'PV Supervisor PVS6',
+                'STATE': 'working',
+                'DATATIME': stamp,
+                'dl_uptime': str(int(self.clock.elapsed())),
+            },
+            {
+                'DEVICE_TYPE': 'Power Meter',
+                'SERIAL': 'PVS6M01234567p',
+                'TYPE': 'PVS5-METER-P',
+                'STATE': 'working',
+                'subtype': 'GROSS_PRODUCTION_SITE',
+                'production_subtype_enum': 'GROSS_PRODUCTION_SITE',
+                'DATATIME': stamp,
+                'p_3phsum_kw': f"{production_kw:.4f}",
+            },
+            {
+                'DEVICE_TYPE': 'Power Meter',
+                'SERIAL': 'PVS6M01234567c',
+                'TYPE': 'PVS5-METER-C',
+                'STATE': 'working',
+                'subtype': 'GROSS_CONSUMPTION_LOADSIDE',
+                'consumption_subtype_enum': 'GROSS_CONSUMPTION_LOADSIDE',
+                'DATATIME': stamp,
+                'p_3phsum_kw': f"{consumption_kw:.4f}",
+            },
+        ] + inverters
+
+
+class RecordedResponses:
+    """Plays back files written by record(); loops over the recorded span"""
+
+    def __init__(self, directory: str, clock: Optional[SimClock] = None):
+        self.clock = clock or SimClock()
+        self.records: Dict[str, List[Tuple[float, Dict]]] = {}
+        for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            offset = datetime.fromisoformat(record['recorded_at']).timestamp()
+            self.records.setdefault(record['command'], []).append((offset, record))
+        if not self.records:
+            raise ValueError(f"No recordings found in {directory}")
+        for entries in self.records.values():
+            entries.sort(key=lambda e: e[0])
+
+    def response(self, command: str) -> Tuple[int, Dict]:
+        entries = self.records.get(command)
+        if not entries:
+            return 400, {'result': f'error: no recording for {command}'}
+        first, last = entries[0][0], entries[-1][0]
+        # Loop the recording; a single capture is served forever
+        span = (last - first) or 1.0
+        position = first + self.clock.elapsed() % span
+        record = entries[0][1]
+        for offset, candidate in entries:
+            if offset > position:
+                break
+            record = candidate
+        return record.get('status', 200), record['body']
+
+
+# ----------------------------------------------------------------------
+# HTTP server
+# ----------------------------------------------------------------------
+class PVSSimulator:
+    """ThreadingHTTPServer wrapper with fault injection"""
+
+    def __init__(self, source, host: str = '127.0.0.1', port: int = 8080,
+                 latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 hang_rate: float = 0.0, hang_seconds: float = 30.0, drop_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.source = source
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.drop_rate = drop_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'hangs': 0, 'drops': 0}
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _fault(self) -> Optional[str]:
+        """Pick at most one injected fault for this request"""
+        with self._lock:
+            roll = self._rng.random()
+            delay = max(0.0, self._rng.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        time.sleep(delay)
+        if roll < self.drop_rate:
+            return 'drop'
+        if roll < self.drop_rate + self.hang_rate:
+            return 'hang'
+        if roll < self.drop_rate + self.hang_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def _handler_class(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes; without this,
+            # Nagle + delayed ACK adds ~40ms to every keep-alive request
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/sim/stats':
+                    return self._send(200, dict(simulator.stats))
+                if url.path != '/cgi-bin/dl_cgi':
+                    return self._send(404, {'result': 'error: not found'})
+
+                simulator._count('requests')
+                fault = simulator._fault()
+                if fault == 'drop':
+                    simulator._count('drops')
+                    self.close_connection = True
+                    return
+                if fault == 'hang':
+                    simulator._count('hangs')
+                    time.sleep(simulator.hang_seconds)
+                if fault == 'error':
+                    simulator._count('errors')
+                    return self._send(500, {'result': 'error: injected failure'})
+
+                command = parse_qs(url.query).get('Command', [''])[0]
+                status, body = simulator.source.response(command)
+                simulator._count('ok' if status == 200 else 'errors')
+                self._send(status, body)
+
+            def _send(self, status, body):
+                payload = body if isinstance(body, str) else json.dumps(body)
+                data = payload.encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Client gave up (e.g. its read timeout fired during a hang)
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'PVSSimulator':
+        """Serve from a background thread (for benchmarks and scripts)"""
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='pvs-simulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+
+# ----------------------------------------------------------------------
+# Recorder
+# ----------------------------------------------------------------------
+def record(out_dir: str, pvs_ip: Optional[str] = None, pvs_port: Optional[int] = None,
+           commands: Tuple[str, ...] = ('DeviceList',), interval: int = 60,
+           count: Optional[int] = None) -> int:
+    """Poll a real gateway and write one JSON file per response; returns files written"""
+    from pvs_client import PVSClient
+
+    os.makedirs(out_dir, exist_ok=True)
+    client = PVSClient(pvs_ip, pvs_port)
+    written = polls = 0
+    print(f"🎙️  Recording {', '.join(commands)} from {client.base_url} every {interval}s into {out_dir}")
+    try:
+        for scheduled, _ in AdaptiveScheduler.fixed(interval).ticks():
+            for command in commands:
+                try:
+                    response = client.send_command(command)
+                except Exception as e:
+                    print(f"❌ {command} failed: {e}")
+                    continue
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = response.text
+                recorded_at = datetime.now().isoformat()
+                path = os.path.join(out_dir, f"{scheduled.strftime('%Y%m%dT%H%M%S')}_{command}.json")
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump({
+                        'recorded_at': recorded_at,
+                        'command': command,
+                        'status': response.status_code,
+                        'body': body,
+                    }, f)
+                written += 1
+            polls += 1
+            print(f"📼 {scheduled.strftime('%H:%M:%S')}: {written} file(s) recorded")
+            if count is not None and polls >= count:
+                break
+    except KeyboardInterrupt:
+        print("\n🛑 Recording stopped by user")
+    finally:
+        client.close()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local PVS6 simulator and recorder')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    serve = sub.add_parser('serve', help='Run the simulated gateway')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--inverters', type=int, default=24, help='Synthetic fleet size')
+    serve.add_argument('--replay', help='Directory of recordings to serve instead')
+    serve.add_argument('--speed', type=float, default=1.0, help='Simulated seconds per real second')
+    serve.add_argument('--start', help='Simulated start time (ISO, local), default now')
+    serve.add_argument('--latency-ms', type=float, default=0.0)
+    serve.add_argument('--jitter-ms', type=float, default=0.0)
+    serve.add_argument('--error-rate', type=float, default=0.0, help='Fraction answered with HTTP 500')
+    serve.add_argument('--hang-rate', type=float, default=0.0, help='Fraction held for --hang-seconds')
+    serve.add_argument('--hang-seconds', type=float, default=30.0)
+    serve.add_argument('--drop-rate', type=float, default=0.0, help='Fraction closed without a response')
+    serve.add_argument('--seed', type=int)
+
+    rec = sub.add_parser('record', help='Capture a real gateway to files')
+    rec.add_argument('--out', required=True)
+    rec.add_argument('--ip', help='Gateway IP (default PVS6_IP_ADDRESS)')
+    rec.add_argument('--port', type=int, help='Gateway port (default PVS6_PORT)')
+    rec.add_argument('--commands', default='DeviceList', help='Comma separated dl_cgi commands')
+    rec.add_argument('--interval', type=int, default=60)
+    rec.add_argument('--count', type=int, help='Polls before stopping (default: until Ctrl+C)')
+
+    args = parser.parse_args()
+
+    if args.mode == 'record':
+        commands = tuple(c.strip() for c in args.commands.split(',') if c.strip())
+        record(args.out, args.ip, args.port, commands, args.interval, args.count)
+        return
+
+    start = datetime.fromisoformat(args.start).timestamp() if args.start else None
+    clock = SimClock(args.speed, start)
+    source = (RecordedResponses(args.replay, clock) if args.replay
+              else SyntheticFleet(args.inverters, clock, seed=args.seed or 0))
+    simulator = PVSSimulator(source, args.host, args.port,
+                             latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                             error_rate=args.error_rate, hang_rate=args.hang_rate,
+                             hang_seconds=args.hang_seconds, drop_rate=args.drop_rate,
+                             seed=args.seed)
+    what = f"replay of {args.replay}" if args.replay else f"{args.inverters} synthetic inverters"
+    print(f"☀️  PVS6 simulator on http://{args.host}:{simulator.port} ({what}, {args.speed:g}x time)")
+    print(f"   Point the collectors here with PVS6_IP_ADDRESS={args.host} PVS6_PORT={simulator.port}")
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n🛑 Simulator stopped: {simulator.stats}")
+
+
+if __name__ == '__main__':
+    main()
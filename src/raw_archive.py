@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Raw Snapshot Archive
+Content-addressed, compressed history of the PVS6 DeviceList.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Storing the raw DeviceList as json.dumps text every minute repeats the same
+serials, models and firmware versions for every device in every row. The
+archive splits each snapshot instead:
+
+    static block    one device's identity fields (ARCHIVE_STATIC_FIELDS),
+                    stored once per distinct content
+    layout block    the device roster: per device its static block id and
+                    its original key order; changes only when a device is
+                    added, swapped or re-flashed
+    payload block   the remaining (measurement) values of every device, as
+                    bare value lists in layout key order
+
+Every block lives in raw_blocks under the hash of its content and is
+zlib-compressed, so an unchanged roster or an identical payload (a sleeping
+array overnight) is stored once. raw_snapshots is the index: one small row
+per snapshot (timestamp, ts_epoch, layout id, payload id) from which
+rebuild() reassembles the exact DeviceList.
+
+Blocks record the newest snapshot that used them (last_epoch), so once
+retention (raw_snapshots in RETENTION_POLICY, forever by default) removes
+old snapshots, collect_garbage() can drop what nothing points at anymore.
+
+Run standalone with:  python raw_archive.py [--stats] [--at TIMESTAMP] [/path/to/solar_data.db]
+"""
+
+import hashlib
+import json
+import sqlite3
+import sys
+import zlib
+from typing import Dict, List, Optional
+
+from config import config
+
+# DeviceList fields that identify the hardware (superset of
+# pvs_client.STATIC_FIELDS); anything not listed is archived as a value
+ARCHIVE_STATIC_FIELDS = frozenset({
+    'SERIAL', 'DEVICE_TYPE', 'TYPE', 'MODEL', 'DESCR', 'SWVER', 'hw_version',
+    'PANEL', 'PORT', 'MOD_SN', 'NMPLT_SKU', 'origin', 'OPERATION', 'interface',
+    'slave', 'subtype', 'production_subtype_enum', 'consumption_subtype_enum',
+    'ct_scl_fctr', 'module_serial',
+})
+
+# Blocks whose ids are worth caching in the writer (few distinct values)
+CACHED_KINDS = ('static', 'layout')
+
+
+def create_raw_archive(conn):
+    """Block store and snapshot index (idempotent)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS raw_blocks (
+            id INTEGER PRIMARY KEY,
+            hash BLOB NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            data BLOB NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            first_epoch INTEGER,
+            last_epoch INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS raw_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            ts_epoch INTEGER NOT NULL,
+            layout_id INTEGER NOT NULL,
+            payload_id INTEGER NOT NULL,
+            devices INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_raw_snapshots_epoch ON raw_snapshots(ts_epoch)")
+
+
+def _encode(value) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode()
+
+
+def content_hash(kind: str, data: bytes) -> bytes:
+    """128-bit content address of an encoded block"""
+    return hashlib.sha256(kind.encode() + b'\0' + data).digest()[:16]
+
+
+def split_device(device: Dict):
+    """(static fields, key order, dynamic values) of one DeviceList entry"""
+    static = {k: v for k, v in device.items() if k in ARCHIVE_STATIC_FIELDS}
+    values = [v for k, v in device.items() if k not in ARCHIVE_STATIC_FIELDS]
+    return static, list(device), values
+
+
+def join_device(static: Dict, keys: List[str], values: List) -> Dict:
+    """Inverse of split_device (original key order)"""
+    remaining = iter(values)
+    return {k: static[k] if k in static else next(remaining) for k in keys}
+
+
+class ArchiveWriter:
+    """Writer-side block cache; archive() runs inside the caller's transaction"""
+
+    def __init__(self, level: int = 6):
+        self.level = level
+        self._ids: Dict[bytes, int] = {}
+        self.stats = {'snapshots': 0, 'blocks_written': 0, 'bytes_written': 0, 'raw_bytes': 0}
+
+    @classmethod
+    def from_config(cls) -> Optional['ArchiveWriter']:
+        """Writer from RAW_ARCHIVE_* settings, or None when disabled"""
+        if not config.raw_archive_enabled:
+            return None
+        return cls(config.raw_archive_level)
+
+    def reset(self):
+        """Forget cached block ids (after a rollback undid inserts)"""
+        self._ids.clear()
+
+    def _block(self, conn, kind: str, value, epoch: int) -> int:
+        data = _encode(value)
+        digest = content_hash(kind, data)
+        block_id = self._ids.get(digest)
+        if block_id is None:
+            row = conn.execute("SELECT id FROM raw_blocks WHERE hash = ?", (digest,)).fetchone()
+            if row is None:
+                compressed = zlib.compress(data, self.level)
+                block_id = conn.execute("""
+                    INSERT INTO raw_blocks (hash, kind, data, raw_bytes, first_epoch, last_epoch)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (digest, kind, compressed, len(data), epoch, epoch)).lastrowid
+                self.stats['blocks_written'] += 1
+                self.stats['bytes_written'] += len(compressed)
+                if kind in CACHED_KINDS:
+                    self._ids[digest] = block_id
+                return block_id
+            block_id = row[0]
+            if kind in CACHED_KINDS:
+                self._ids[digest] = block_id
+        if kind != 'static':
+            # Static blocks are kept alive through the layouts (collect_garbage)
+            conn.execute("UPDATE raw_blocks SET last_epoch = ? WHERE id = ? AND last_epoch < ?",
+                         (epoch, block_id, epoch))
+        return block_id
+
+    def archive(self, conn, timestamp: str, epoch: int, devices: List[Dict]) -> int:
+        """Store one DeviceList snapshot; returns its raw_snapshots id"""
+        layout, payload = [], []
+        for device in devices:
+            static, keys, values = split_device(device)
+            layout.append([self._block(conn, 'static', static, epoch), keys])
+            payload.append(values)
+        raw_bytes = len(json.dumps(devices))
+        snapshot_id = conn.execute("""
+            INSERT INTO raw_snapshots (timestamp, ts_epoch, layout_id, payload_id, devices, raw_bytes)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (timestamp, epoch, self._block(conn, 'layout', layout, epoch),
+              self._block(conn, 'payload', payload, epoch), len(devices), raw_bytes)).lastrowid
+        self.stats['snapshots'] += 1
+        self.stats['raw_bytes'] += raw_bytes
+        return snapshot_id
+
+
+def _load(conn, block_id: int, cache: Optional[Dict] = None):
+    if cache is not None and block_id in cache:
+        return cache[block_id]
+    row = conn.execute("SELECT data FROM raw_blocks WHERE id = ?", (block_id,)).fetchone()
+    if row is None:
+        raise LookupError(f"raw block {block_id} is missing")
+    value = json.loads(zlib.decompress(row[0]))
+    if cache is not None:
+        cache[block_id] = value
+    return value
+
+
+def rebuild(conn, at_epoch: Optional[int] = None, snapshot_id: Optional[int] = None) -> Optional[Dict]:
+    """
+    The snapshot taken at or before ``at_epoch`` (newest if None), or the one
+    with ``snapshot_id``, reassembled as {'timestamp', 'ts_epoch', 'devices'}.
+    """
+    if snapshot_id is not None:
+        row = conn.execute("SELECT id, timestamp, ts_epoch, layout_id, payload_id FROM raw_snapshots "
+                           "WHERE id = ?", (snapshot_id,)).fetchone()
+    else:
+        row = conn.execute("SELECT id, timestamp, ts_epoch, layout_id, payload_id FROM raw_snapshots "
+                           "WHERE ts_epoch <= ? ORDER BY ts_epoch DESC, id DESC LIMIT 1",
+                           (at_epoch if at_epoch is not None else 2 ** 62,)).fetchone()
+    if row is None:
+        return None
+    statics = {}
+    layout = _load(conn, row[3])
+    payload = _load(conn, row[4])
+    devices = [join_device(_load(conn, block_id, statics), keys, values)
+               for (block_id, keys), values in zip(layout, payload)]
+    return {'id': row[0], 'timestamp': row[1], 'ts_epoch': row[2], 'devices': devices}
+
+
+def snapshot_index(conn, since: Optional[int] = None, until: Optional[int] = None,
+                   limit: int = 100) -> List[Dict]:
+    """Archived snapshots in [since, until] (epochs), newest first"""
+    rows = conn.execute("""
+        SELECT id, timestamp, ts_epoch, devices, raw_bytes FROM raw_snapshots
+        WHERE ts_epoch >= ? AND ts_epoch <= ?
+        ORDER BY ts_epoch DESC LIMIT ?
+    """, (since if since is not None else -1, until if until is not None else 2 ** 62, limit))
+    return [dict(zip(('id', 'timestamp', 'ts_epoch', 'devices', 'raw_bytes'), r)) for r in rows]
+
+
+def archive_stats(conn) -> Dict:
+    """Snapshot count, stored vs. uncompressed size, blocks per kind"""
+    snapshots, raw_bytes, first, last = conn.execute(
+        "SELECT COUNT(*), TOTAL(raw_bytes), MIN(timestamp), MAX(timestamp) FROM raw_snapshots"
+    ).fetchone()
+    blocks = {kind: {'blocks': count, 'stored_bytes': int(stored)} for kind, count, stored in
+              conn.execute("SELECT kind, COUNT(*), TOTAL(LENGTH(data)) FROM raw_blocks GROUP BY kind")}
+    # Index rows are ~40 bytes each on top of the blocks
+    stored = sum(b['stored_bytes'] for b in blocks.values()) + snapshots * 40
+    return {
+        'snapshots': snapshots,
+        'first': first,
+        'last': last,
+        'raw_bytes': int(raw_bytes),
+        'stored_bytes': stored,
+        'ratio': round(raw_bytes / stored, 1) if stored else None,
+        'blocks': blocks,
+    }
+
+
+def collect_garbage(conn) -> int:
+    """Delete blocks no remaining snapshot uses; run inside a transaction"""
+    oldest = conn.execute("SELECT MIN(ts_epoch) FROM raw_snapshots").fetchone()[0]
+    if oldest is None:
+        return conn.execute("DELETE FROM raw_blocks").rowcount
+    # last_epoch is the newest snapshot that used the block
+    freed = conn.execute("DELETE FROM raw_blocks WHERE kind != 'static' AND last_epoch < ?",
+                         (oldest,)).rowcount
+    live = set()
+    for (layout_id,) in conn.execute("SELECT id FROM raw_blocks WHERE kind = 'layout'").fetchall():
+        live.update(block_id for block_id, _ in _load(conn, layout_id))
+    dead = [(block_id,) for (block_id,) in
+            conn.execute("SELECT id FROM raw_blocks WHERE kind = 'static'").fetchall()
+            if block_id not in live]
+    conn.executemany("DELETE FROM raw_blocks WHERE id = ?", dead)
+    return freed + len(dead)
+
+
+if __name__ == '__main__':
+    from migrations import timestamp_epoch
+
+    args = sys.argv[1:]
+    at = args[args.index('--at') + 1] if '--at' in args else None
+    paths = [a for i, a in enumerate(args) if not a.startswith('--') and a != at]
+    conn = sqlite3.connect(paths[0] if paths else config.database_path)
+    try:
+        if at is not None:
+            snapshot = rebuild(conn, timestamp_epoch(at))
+            print(json.dumps(snapshot, indent=2) if snapshot else f"No snapshot at or before {at}")
+        else:
+            stats = archive_stats(conn)
+            print(f"📦 {stats['snapshots']} snapshots ({stats['first']} .. {stats['last']}), "
+                  f"{stats['raw_bytes']} bytes raw -> {stats['stored_bytes']} stored "
+                  f"(x{stats['ratio']})")
+    finally:
+        conn.close()
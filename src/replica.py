@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Analytics Replica
+Read-only copy of the database for ad-hoc queries.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+The SQL explorer, the table browser and the exports run whatever SELECT a
+user writes. On the live database a heavy one (a self-join over
+device_data, an export of everything) holds its read snapshot for as long
+as it runs: checkpoints can't get past it, the WAL keeps growing under the
+collector's writes and the SD card is shared with the scan. With
+ANALYTICS_REPLICA_ENABLED those queries run on a replica instead:
+
+    <ANALYTICS_REPLICA_PATH>/
+        solar_data.db                   copy of the main database
+        partitions/solar_2025-09.db     copies of the monthly files (partitioned mode)
+        replica.json                    what was copied when (the replica's lag)
+
+ReplicaManager.refresh() copies with backup.copy_database (the page-stepped
+backup API, so the collector gets the write lock between steps) into a
+temporary file and renames it over the previous copy; a query still reading
+the previous copy keeps it until it finishes. A file whose size/mtime (and
+-wal) haven't changed since it was last copied is skipped, so in
+partitioned mode a refresh reads only the main database and the current
+month. Replica files are standalone (journal_mode=DELETE) and never written
+in place, so nothing a replica query does reaches the live WAL.
+
+ReplicaScheduler refreshes every ANALYTICS_REPLICA_REFRESH_MINUTES in the
+collector process. The web process opens replica connections with
+connect() - None until the first copy exists, in which case the dashboard
+falls back to the live database - and reports the lag from replica.json.
+
+Run standalone with:  python replica.py [/path/to/solar_data.db]
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from backup import copy_database, file_fingerprint
+from config import config
+from partitions import PartitionSet
+
+STATE_FILE = 'replica.json'
+
+
+class ReplicaManager:
+    """Analytics replica of one database (and its monthly files) under ``directory``"""
+
+    def __init__(self, db_path: str, directory: str = '', step_pages: int = 1024,
+                 pause_seconds: float = 0.02, refresh_minutes: float = 15):
+        self.db_path = db_path
+        self.directory = directory or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'replica')
+        self.step_pages = step_pages
+        self.pause_seconds = pause_seconds
+        self.refresh_minutes = refresh_minutes
+        self.partitions = PartitionSet.from_config(db_path)
+        self._lock = threading.Lock()
+        self.report = {'state': 'idle'}
+
+    @classmethod
+    def from_config(cls, db_path: str) -> Optional['ReplicaManager']:
+        """Manager per ANALYTICS_REPLICA_*, or None when the replica is off"""
+        if not config.analytics_replica_enabled:
+            return None
+        return cls(db_path, config.analytics_replica_path,
+                   step_pages=config.backup_step_pages,
+                   pause_seconds=config.backup_step_pause_ms / 1000.0,
+                   refresh_minutes=config.analytics_replica_refresh_minutes)
+
+    @property
+    def replica_path(self) -> str:
+        """The copy of the main database"""
+        return os.path.join(self.directory, os.path.basename(self.db_path))
+
+    def replica_partitions(self) -> Optional[PartitionSet]:
+        """PartitionSet over the copied monthly files (None outside partitioned mode)"""
+        if self.partitions is None:
+            return None
+        return PartitionSet(self.replica_path, os.path.join(self.directory, 'partitions'),
+                            self.partitions.tables)
+
+    def _sources(self) -> Dict[str, str]:
+        """Relative name in the replica -> live file"""
+        sources = {os.path.basename(self.db_path): self.db_path}
+        if self.partitions is not None:
+            for key in self.partitions.keys():
+                path = self.partitions.path(key)
+                sources[os.path.join('partitions', os.path.basename(path))] = path
+        return sources
+
+    # ------------------------------------------------------------------
+    # State (shared by the collector and the web process through replica.json)
+    # ------------------------------------------------------------------
+    def state(self) -> Dict:
+        try:
+            with open(os.path.join(self.directory, STATE_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state: Dict):
+        path = os.path.join(self.directory, STATE_FILE)
+        work = f"{path}.{os.getpid()}.tmp"
+        with open(work, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(work, path)
+
+    def available(self) -> bool:
+        return os.path.exists(self.replica_path) and bool(self.state().get('files'))
+
+    def describe(self) -> Dict:
+        """How current the replica is: as_of (every file at least this new) and lag_seconds"""
+        state = self.state()
+        result = {
+            'source': 'replica' if self.available() else 'live',
+            'refresh_minutes': self.refresh_minutes,
+            'refreshed_at': state.get('refreshed_at'),
+            'as_of': None,
+            'lag_seconds': None,
+            'refreshing': self.report.get('state') == 'running',
+        }
+        if result['source'] == 'replica' and state.get('as_of') is not None:
+            result['as_of'] = datetime.fromtimestamp(state['as_of']).isoformat()
+            result['lag_seconds'] = max(0, int(time.time() - state['as_of']))
+        return result
+
+    # ------------------------------------------------------------------
+    # Refresh
+    # ------------------------------------------------------------------
+    def refresh(self) -> Dict:
+        """Copy every file that changed since its last copy; returns the report"""
+        with self._lock:
+            started = time.monotonic()
+            self.report = {'state': 'running', 'started_at': datetime.now().isoformat(), 'file': None}
+            try:
+                self.report.update(self._refresh())
+                self.report['state'] = 'done'
+            except Exception as e:
+                self.report.update(state='failed', error=str(e))
+                print(f"❌ Replica refresh failed: {e}")
+            self.report['file'] = None
+            self.report['elapsed_s'] = round(time.monotonic() - started, 3)
+            if self.report['state'] == 'done':
+                print(f"🪞 Replica refreshed in {self.report['elapsed_s']}s "
+                      f"({self.report['copied']} copied, {self.report['unchanged']} unchanged)")
+            return self.report
+
+    def _refresh(self) -> Dict:
+        os.makedirs(self.directory, exist_ok=True)
+        files = self.state().get('files', {})
+        sources = self._sources()
+        copied, unchanged = 0, 0
+        for relative, source in sources.items():
+            dest = os.path.join(self.directory, relative)
+            # Taken before copying: a write landing during the copy makes the
+            # next refresh copy again rather than miss it
+            checked = time.time()
+            fingerprint = file_fingerprint(source)
+            before = files.get(relative)
+            if before is not None and before['fingerprint'] == fingerprint and os.path.exists(dest):
+                before['as_of'] = checked
+                unchanged += 1
+                continue
+            self.report['file'] = relative
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            work = f"{dest}.{os.getpid()}.partial"
+            try:
+                stats = copy_database(source, work, self.step_pages, self.pause_seconds)
+                os.replace(work, dest)
+            finally:
+                if os.path.exists(work):
+                    os.remove(work)
+            files[relative] = {
+                'fingerprint': fingerprint,
+                'as_of': checked,
+                'size': os.path.getsize(dest),
+                'pages': stats['pages'],
+                'restarts': stats['restarts'],
+                'seconds': stats['seconds'],
+            }
+            copied += 1
+        # Months retention removed from the live set
+        for relative in [r for r in files if r not in sources]:
+            path = os.path.join(self.directory, relative)
+            if os.path.exists(path):
+                os.remove(path)
+            del files[relative]
+        self._write_state({
+            'refreshed_at': datetime.now().isoformat(),
+            'source': self.db_path,
+            'as_of': min(f['as_of'] for f in files.values()),
+            'files': files,
+        })
+        return {'copied': copied, 'unchanged': unchanged}
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+    def connect(self, since: Optional[float] = None, until: Optional[float] = None):
+        """
+        Read-only connection to the replica, with the copied months over
+        [since, until] attached in partitioned mode; None until the first
+        refresh has finished.
+        """
+        if not self.available():
+            return None
+        conn = sqlite3.connect(f"file:{self.replica_path}?mode=ro", uri=True, timeout=10.0)
+        try:
+            conn.execute('PRAGMA query_only=ON')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            partitions = self.replica_partitions()
+            if partitions is not None:
+                partitions.open_range(conn, since, until)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+
+class ReplicaScheduler:
+    """Daemon thread refreshing the replica every ``interval_seconds``"""
+
+    def __init__(self, manager: ReplicaManager, interval_seconds: float):
+        self.manager = manager
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, db_path: str) -> Optional['ReplicaScheduler']:
+        """Scheduler per ANALYTICS_REPLICA_REFRESH_MINUTES, or None when the replica is off"""
+        manager = ReplicaManager.from_config(db_path)
+        if manager is None or manager.refresh_minutes <= 0:
+            return None
+        return cls(manager, manager.refresh_minutes * 60)
+
+    def next_due(self) -> float:
+        """Epoch the next refresh is due (interval after the last one)"""
+        as_of = self.manager.state().get('as_of')
+        return 0.0 if as_of is None else as_of + self.interval_seconds
+
+    def start(self) -> 'ReplicaScheduler':
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='replica', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(max(1.0, min(self.next_due() - time.time(), 3600.0))):
+            if time.time() >= self.next_due():
+                self.manager.refresh()
+                if self.manager.report['state'] == 'failed':
+                    # Don't retry in a tight loop
+                    self._stop.wait(min(self.interval_seconds, 3600.0))
+
+
+# ----------------------------------------------------------------------
+# Background refreshes (dashboard)
+# ----------------------------------------------------------------------
+_current: Optional[ReplicaManager] = None
+_current_lock = threading.Lock()
+
+
+def get_manager(db_path: str) -> Optional[ReplicaManager]:
+    """Process-wide manager for ``db_path`` (None when the replica is off)"""
+    global _current
+    with _current_lock:
+        if _current is None or _current.db_path != db_path:
+            _current = ReplicaManager.from_config(db_path)
+        elif not config.analytics_replica_enabled:
+            _current = None
+        return _current
+
+
+def run_in_background(db_path: str):
+    """Start a refresh unless one is going; returns (manager, started)"""
+    manager = get_manager(db_path)
+    if manager is None:
+        return None, False
+    with _current_lock:
+        if manager.report.get('state') == 'running':
+            return manager, False
+        manager.report = {'state': 'running'}
+    threading.Thread(target=manager.refresh, name='replica', daemon=True).start()
+    return manager, True
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    path = args[0] if args else config.database_path
+    manager = ReplicaManager.from_config(path) or ReplicaManager(path)
+    print(json.dumps(manager.refresh(), indent=2))
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Retention Engine
+Policy-driven downsampling and batched deletes of old time-series rows.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Every table has a rule "keep N days" (None = forever), see
+config.retention_policy / RETENTION_POLICY. Defaults: raw tables 90 days,
+15-minute and hourly tiers 2 years, daily tiers forever.
+
+Before raw rows are deleted they are folded into a coarser tier:
+
+    site_samples                already in solar_rollup_* (rollups.py); only
+                                purged once the rollup backfill is complete
+    device_samples              -> device_rollup_15m, device_rollup_1d
+                                (per inverter sum/min/max + sample count,
+                                and time-weighted integrals)
+    raw_snapshots               not folded; the archive blocks no remaining
+                                snapshot uses are freed afterwards
+                                (raw_archive.collect_garbage)
+
+In partitioned mode (partitions.py) whole expired months are unlinked first
+(device_samples folded into its tiers a day at a time beforehand); the batched
+deletes below then only see rows left in the main database.
+
+Rows go oldest first in batches of RETENTION_BATCH_ROWS. Each batch is one
+short BEGIN IMMEDIATE transaction (downsample + DELETE, both driven by the
+ts_epoch / bucket index), followed by a short pause so the collector's
+write never waits long for the lock.
+
+Run standalone with:  python retention.py [--dry-run] [/path/to/solar_data.db]
+"""
+
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+import raw_archive
+import rollups
+import stats_catalog
+from config import config
+from partitions import PartitionSet
+
+DEVICE_FIELDS = ('power_kw', 'voltage', 'current_a', 'frequency', 'temperature')
+DEVICE_TIERS = ('15m', '1d')
+
+# Purge order: raw tables first (they downsample into the tiers below)
+RAW_TABLES = ('device_samples', 'site_samples', 'weather_data', 'raw_snapshots')
+
+
+def device_rollup_table(tier: str) -> str:
+    return f"device_rollup_{tier}"
+
+
+def _device_columns():
+    columns = []
+    for f in DEVICE_FIELDS:
+        columns += [f"{f}_sum", f"{f}_min", f"{f}_max", f"{f}_integral", f"{f}_seconds"]
+    return columns
+
+
+def create_device_rollups(conn):
+    """Per-inverter tiers that device_samples is downsampled into"""
+    metric_columns = ''.join(f", {f}_sum REAL, {f}_min REAL, {f}_max REAL, "
+                             f"{f}_integral REAL NOT NULL DEFAULT 0, "
+                             f"{f}_seconds REAL NOT NULL DEFAULT 0" for f in DEVICE_FIELDS)
+    for tier in DEVICE_TIERS:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {device_rollup_table(tier)} (
+                device_id TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                samples INTEGER NOT NULL,
+                last_epoch INTEGER{metric_columns},
+                PRIMARY KEY (device_id, bucket)
+            )
+        """)
+        # Tiers created before the time-weighted integrals
+        present = {row[1] for row in conn.execute(f"PRAGMA table_info({device_rollup_table(tier)})")}
+        for column in _device_columns():
+            if column not in present:
+                conn.execute(f"ALTER TABLE {device_rollup_table(tier)} ADD COLUMN {column} "
+                             f"REAL NOT NULL DEFAULT 0")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{device_rollup_table(tier)}_bucket "
+                     f"ON {device_rollup_table(tier)}(bucket)")
+
+
+def _device_upsert_sql(tier: str) -> str:
+    columns = ['device_id', 'bucket', 'samples', 'last_epoch'] + _device_columns()
+    sets = ['samples = samples + excluded.samples',
+            'last_epoch = max(last_epoch, excluded.last_epoch)']
+    for f in DEVICE_FIELDS:
+        sets += [f"{f}_sum = {f}_sum + excluded.{f}_sum",
+                 f"{f}_min = min(COALESCE({f}_min, excluded.{f}_min), "
+                 f"COALESCE(excluded.{f}_min, {f}_min))",
+                 f"{f}_max = max(COALESCE({f}_max, excluded.{f}_max), "
+                 f"COALESCE(excluded.{f}_max, {f}_max))",
+                 f"{f}_integral = {f}_integral + excluded.{f}_integral",
+                 f"{f}_seconds = {f}_seconds + excluded.{f}_seconds"]
+    return (f"INSERT INTO {device_rollup_table(tier)} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT(device_id, bucket) DO UPDATE SET {', '.join(sets)}")
+
+
+def _downsample_devices(conn, bound: int, source: str = 'device_samples',
+                        since: Optional[int] = None) -> int:
+    """
+    Fold ``source`` rows with since <= ts_epoch <= bound into the device tiers.
+
+    Stored rows are irregular (the sample grid varies, and with compression
+    one row can stand for a long straight run), so besides count/sum/min/max
+    each row adds the integral of the line to the device's next row over the
+    span between them (nothing across gaps longer than
+    COMPRESSION_MAX_GAP_SECONDS): <field>_integral / <field>_seconds is the
+    time-weighted mean. Buckets folded before these columns existed have
+    <field>_seconds = 0.
+    """
+    # Samples name their device through the registry (devices.py)
+    device_id, series, d = 'r.device_id', 'd.device_key', 'd.'
+    source = f"{source} d LEFT JOIN main.devices r ON r.device_key = d.device_key"
+    fields = ', '.join(f"{d}{f}" for f in DEVICE_FIELDS)
+    buckets = ', '.join(rollups.bucket_sql(tier, f"{d}ts_epoch") for tier in DEVICE_TIERS)
+    rows = conn.execute(f"""
+        SELECT {device_id}, {series}, {d}ts_epoch, {buckets}, {fields} FROM {source}
+        WHERE {d}ts_epoch <= ? AND {d}ts_epoch >= ? AND {device_id} IS NOT NULL
+        ORDER BY {series}, {d}ts_epoch
+    """, (bound, since if since is not None else -1)).fetchall()
+    max_gap = config.compression_max_gap_seconds
+    n_tiers = len(DEVICE_TIERS)
+
+    merged = [{} for _ in DEVICE_TIERS]
+    for i, row in enumerate(rows):
+        key, t, values = row[1], row[2], row[3 + n_tiers:]
+        if i + 1 < len(rows) and rows[i + 1][1] == key:
+            following = rows[i + 1][2], rows[i + 1][3 + n_tiers:]
+        else:
+            # The device's next row is past this batch (or not written yet)
+            following = conn.execute(f"""
+                SELECT {d}ts_epoch, {fields} FROM {source}
+                WHERE {series} = ? AND {d}ts_epoch > ? ORDER BY {d}ts_epoch LIMIT 1
+            """, (key, t)).fetchone()
+            following = (following[0], following[1:]) if following else (None, ())
+        span = following[0] - t if following[0] is not None else 0
+        if not 0 < span <= max_gap:
+            span = 0
+
+        for tier_index in range(n_tiers):
+            bucket = row[3 + tier_index]
+            agg = merged[tier_index].get((row[0], bucket))
+            if agg is None:
+                agg = merged[tier_index][(row[0], bucket)] = [row[0], bucket, 0, t]
+                agg += [0.0, None, None, 0.0, 0.0] * len(DEVICE_FIELDS)
+            agg[2] += 1
+            agg[3] = max(agg[3], t)
+            for j, v in enumerate(values):
+                base = 4 + 5 * j
+                if v is not None:
+                    agg[base] += v
+                    agg[base + 1] = v if agg[base + 1] is None else min(agg[base + 1], v)
+                    agg[base + 2] = v if agg[base + 2] is None else max(agg[base + 2], v)
+                # Straight line to the next row (the interpolation compression relies on)
+                if not span or (v is None and following[1][j] is None):
+                    continue
+                w = following[1][j]
+                a, b = (v if v is not None else w), (w if w is not None else v)
+                agg[base + 3] += (a + b) / 2 * span
+                agg[base + 4] += span
+
+    folded = 0
+    for tier, buckets_of_tier in zip(DEVICE_TIERS, merged):
+        if buckets_of_tier:
+            conn.executemany(_device_upsert_sql(tier), list(buckets_of_tier.values()))
+            folded += len(buckets_of_tier)
+    return folded
+
+
+class RetentionEngine:
+    """One retention pass over every table that has a rule"""
+
+    def __init__(self, db_path: str, policy: Optional[Dict] = None,
+                 batch_rows: int = 2000, pause_seconds: float = 0.05, partitions=None):
+        self.db_path = db_path
+        self.policy = dict(config.retention_policy if policy is None else policy)
+        self.batch_rows = max(1, batch_rows)
+        self.pause_seconds = pause_seconds
+        self.partitions = partitions
+        self._stop = threading.Event()
+        self.report = {'state': 'idle', 'tables': {}}
+
+    @classmethod
+    def from_config(cls, db_path: str, **overrides) -> 'RetentionEngine':
+        """Engine configured from RETENTION_*; ``overrides`` replace single rules"""
+        policy = dict(config.retention_policy)
+        policy.update(overrides)
+        return cls(db_path, policy,
+                   batch_rows=config.retention_batch_rows,
+                   pause_seconds=config.retention_batch_pause_ms / 1000.0,
+                   partitions=PartitionSet.from_config(db_path))
+
+    def stop(self):
+        """Finish the current batch and stop"""
+        self._stop.set()
+
+    # ------------------------------------------------------------------
+    # Rules
+    # ------------------------------------------------------------------
+    def _plan(self, conn):
+        """(table, time column, cutoff epoch, downsample fn, skip reason) per rule"""
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        tiers = [t for t in self.policy if t not in RAW_TABLES]
+        now = time.time()
+        for table in list(RAW_TABLES) + sorted(tiers):
+            days = self.policy.get(table)
+            if days is None or table not in existing:
+                continue
+            cutoff = int(now - days * 86400)
+            column = 'ts_epoch' if table in RAW_TABLES else 'bucket'
+            downsample, skip = None, None
+            if table == 'device_samples':
+                downsample = _downsample_devices
+            elif table == 'site_samples' and not rollups.ready(conn):
+                skip = 'rollup backfill not finished'
+            yield table, column, cutoff, downsample, skip
+
+    def preview(self) -> Dict:
+        """Rows each rule would remove right now (nothing is changed)"""
+        conn = sqlite3.connect(self.db_path, timeout=10.0)
+        try:
+            result = {}
+            for table, column, cutoff, _, skip in self._plan(conn):
+                count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {column} < ?",
+                                     (cutoff,)).fetchone()[0]
+                result[table] = {'keep_days': self.policy[table], 'rows': count, 'skipped': skip}
+            return result
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Run
+    # ------------------------------------------------------------------
+    def run(self) -> Dict:
+        """Downsample + delete everything past its rule; returns the report"""
+        started = time.monotonic()
+        self.report = {
+            'state': 'running',
+            'started_at': datetime.now().isoformat(),
+            'policy': self.policy,
+            'table': None,
+            'tables': {},
+        }
+        conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            create_device_rollups(conn)
+            if self.partitions is not None:
+                self._expire_partitions(conn)
+            for table, column, cutoff, downsample, skip in self._plan(conn):
+                if self._stop.is_set():
+                    break
+                if skip:
+                    self.report['tables'][table] = {'skipped': skip}
+                    print(f"⏭️  Retention: {table} skipped ({skip})")
+                    continue
+                self.report['table'] = table
+                self._purge(conn, table, column, cutoff, downsample)
+                if table == 'raw_snapshots' and self.report['tables'][table]['deleted']:
+                    self._free_raw_blocks(conn)
+            self.report['state'] = 'stopped' if self._stop.is_set() else 'done'
+        except Exception as e:
+            self.report['state'] = 'failed'
+            self.report['error'] = str(e)
+            print(f"❌ Retention failed: {e}")
+        finally:
+            conn.close()
+            self.report['table'] = None
+            self.report['elapsed_s'] = round(time.monotonic() - started, 3)
+            self.report['deleted'] = sum(t.get('deleted', 0) for t in self.report['tables'].values())
+        print(f"🧹 Retention {self.report['state']}: {self.report['deleted']} rows deleted "
+              f"in {self.report['elapsed_s']}s")
+        return self.report
+
+    def _expire_partitions(self, conn):
+        """Drop whole monthly files (partitioned mode) instead of deleting rows"""
+        started = time.monotonic()
+        cutoffs = {}
+        for table, _, cutoff, _, skip in self._plan(conn):
+            if self.partitions.partitioned(table) and not skip:
+                cutoffs[table] = cutoff
+        self.report['table'] = 'partitions'
+        result = self.partitions.expire(conn, cutoffs, before_drop=self._before_drop)
+        result['seconds'] = round(time.monotonic() - started, 3)
+        self.report['partitions'] = result
+
+    def _before_drop(self, conn, schema: str, table: str):
+        self._fold_partition(conn, schema, table)
+        # The month's rows leave the statistics catalog with it
+        stats_catalog.forget(conn, schema, table)
+
+    def _fold_partition(self, conn, schema: str, table: str):
+        """Downsample an expiring month of device_samples, one day per transaction"""
+        if table != 'device_samples':
+            return
+        first, last = conn.execute(f"SELECT MIN(ts_epoch), MAX(ts_epoch) FROM {schema}.device_samples"
+                                   ).fetchone()
+        if first is None:
+            return
+        for since in range(first, last + 1, 86400):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                _downsample_devices(conn, since + 86399, f"{schema}.device_samples", since)
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            time.sleep(self.pause_seconds)
+
+    def _free_raw_blocks(self, conn):
+        """Drop archive blocks only the purged snapshots used"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            freed = raw_archive.collect_garbage(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        self.report['tables']['raw_snapshots']['freed_blocks'] = freed
+
+    def _purge(self, conn, table: str, column: str, cutoff: int, downsample):
+        stats = self.report['tables'][table] = {
+            'keep_days': self.policy[table],
+            'cutoff': datetime.fromtimestamp(cutoff).isoformat(),
+            'deleted': 0,
+            'downsampled_buckets': 0,
+            'batches': 0,
+            'seconds': 0.0,
+            'max_batch_ms': 0.0,
+        }
+        started = time.monotonic()
+        while not self._stop.is_set():
+            # Upper bound of the next batch, read off the index
+            row = conn.execute(f"SELECT {column} FROM {table} WHERE {column} < ? "
+                               f"ORDER BY {column} LIMIT 1 OFFSET ?",
+                               (cutoff, self.batch_rows - 1)).fetchone()
+            bound = row[0] if row else cutoff - 1
+
+            batch_started = time.monotonic()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if downsample is not None:
+                    stats['downsampled_buckets'] += downsample(conn, bound)
+                deleted = conn.execute(f"DELETE FROM {table} WHERE {column} <= ?", (bound,)).rowcount
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            batch_ms = (time.monotonic() - batch_started) * 1000
+
+            stats['deleted'] += deleted
+            stats['batches'] += 1
+            stats['max_batch_ms'] = round(max(stats['max_batch_ms'], batch_ms), 2)
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            if stats['batches'] % 50 == 0:
+                print(f"🧹 {table}: {stats['deleted']} rows deleted, {stats['batches']} batches")
+            if row is None:
+                break
+            # Let the collector in between batches
+            time.sleep(self.pause_seconds)
+        if stats['deleted']:
+            print(f"🧹 {table}: {stats['deleted']} rows older than {stats['cutoff']} deleted "
+                  f"in {stats['seconds']}s ({stats['batches']} batches, "
+                  f"max {stats['max_batch_ms']:.1f}ms)")
+
+
+# ----------------------------------------------------------------------
+# Background runs (dashboard)
+# ----------------------------------------------------------------------
+_current: Optional[RetentionEngine] = None
+_current_lock = threading.Lock()
+
+
+def run_in_background(db_path: str, **overrides):
+    """Start a run unless one is going; returns (engine, started)"""
+    global _current
+    with _current_lock:
+        if _current is not None and _current.report.get('state') == 'running':
+            return _current, False
+        engine = RetentionEngine.from_config(db_path, **overrides)
+        engine.report['state'] = 'running'
+        _current = engine
+    threading.Thread(target=engine.run, name='retention', daemon=True).start()
+    return engine, True
+
+
+def status() -> Optional[Dict]:
+    """Report of the latest run in this process (None if none yet)"""
+    return _current.report if _current is not None else None
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    engine = RetentionEngine.from_config(args[0] if args else config.database_path)
+    if '--dry-run' in sys.argv:
+        for table, info in engine.preview().items():
+            print(f"  {table:<20} keep {info['keep_days']}d: {info['rows']} rows to remove"
+                  + (f" (skipped: {info['skipped']})" if info['skipped'] else ''))
+    else:
+        engine.run()
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Rollups
+Pre-aggregated site power at 1-minute, 15-minute, 1-hour and 1-day tiers.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Each tier is a table keyed by the bucket start (UTC epoch; the 1h and 1d
+buckets follow local hours/days) holding, per metric, the sum, min, max and
+last value plus the sample count, and the energy integral:
+
+    solar_rollup_1m / _15m / _1h / _1d
+        bucket, samples, last_epoch,
+        production_sum, production_min, production_max, production_last,
+        consumption_..., net_export_...,
+        seconds, production_energy, consumption_energy, net_export_energy
+
+The collection grid is not fixed (scheduler.py samples every 30 s around
+noon and every 10 minutes at night), so energy is not a multiple of the
+sample sum: every sample is weighted by the gap to the previous one (its
+kW times that many seconds, 0 after a gap longer than MAX_GAP_SECONDS) and
+``seconds`` is the time those weights cover. kWh = <metric>_energy / 3600.
+Buckets written before the integrals existed and not covered by the 1m
+tier anymore have seconds = 0; energy_sql() counts their samples at the
+one-minute grid of the old collector.
+
+Triggers on site_samples fold every new sample into all four tiers inside
+the collector's own write transaction. With deadband compression on, a
+sample may replace the tail row in place instead of being inserted; an
+UPDATE trigger counts it all the same, so the tiers always see every raw
+sample. Existing history is backfilled once by migrations.py.
+
+Readers ask the planner for the coarsest tier that still resolves the
+bucket they group by; source_sql() exposes every tier (and raw site_samples)
+with the same columns so one aggregate query works on any of them:
+
+    timestamp, ts_epoch, samples, <metric>_sum, <metric>_min, <metric>_max
+
+    seconds, <metric>_energy (kW-seconds)
+
+Averages are SUM(<metric>_sum) / SUM(samples), exactly the AVG() of the raw
+rows they replace; SUM(<metric>_energy) / SUM(seconds) is the time-weighted
+mean power.
+"""
+
+import time
+from typing import Dict, List, Optional, Tuple
+
+from migrations import epoch_sql
+
+TIERS = (('1m', 60), ('15m', 900), ('1h', 3600), ('1d', 86400))
+TIER_WIDTHS = dict(TIERS)
+METRICS = ('production', 'consumption', 'net_export')
+
+BACKFILL_CHUNK_ROWS = 20000
+# A sample further than this from the previous one starts a new run (the
+# collector was down) and covers no time itself
+MAX_GAP_SECONDS = 1800
+# Sample period of the collector before the integrals existed
+LEGACY_SAMPLE_SECONDS = 60
+
+
+def rollup_table(tier: str) -> str:
+    return f"solar_rollup_{tier}"
+
+
+def bucket_sql(tier: str, epoch: str) -> str:
+    """SQL for the start of the ``tier`` bucket containing epoch expression ``epoch``"""
+    if tier == '1h':
+        return (f"CAST(strftime('%s', strftime('%Y-%m-%d %H:00:00', {epoch}, 'unixepoch', "
+                f"'localtime'), 'utc') AS INTEGER)")
+    if tier == '1d':
+        return f"CAST(strftime('%s', date({epoch}, 'unixepoch', 'localtime'), 'utc') AS INTEGER)"
+    width = TIER_WIDTHS[tier]
+    return f"(({epoch}) / {width}) * {width}"
+
+
+def _energy_columns() -> List[str]:
+    return ['seconds'] + [f"{m}_energy" for m in METRICS]
+
+
+def _columns() -> List[str]:
+    columns = ['bucket', 'samples', 'last_epoch']
+    for metric in METRICS:
+        columns += [f"{metric}_sum", f"{metric}_min", f"{metric}_max", f"{metric}_last"]
+    return columns + _energy_columns()
+
+
+def _upsert_sql(tier: str, values: str, source: str = '') -> str:
+    """
+    INSERT of one pre-aggregated bucket that merges into an existing one;
+    ``values`` is a VALUES row, or a SELECT list over ``source``.
+    """
+    sets = ['samples = samples + excluded.samples',
+            'last_epoch = max(last_epoch, excluded.last_epoch)']
+    for m in METRICS:
+        sets += [f"{m}_sum = {m}_sum + excluded.{m}_sum",
+                 f"{m}_min = min({m}_min, excluded.{m}_min)",
+                 f"{m}_max = max({m}_max, excluded.{m}_max)",
+                 f"{m}_last = CASE WHEN excluded.last_epoch >= last_epoch "
+                 f"THEN excluded.{m}_last ELSE {m}_last END"]
+    sets += [f"{c} = {c} + excluded.{c}" for c in _energy_columns()]
+    # "WHERE true" keeps the parser from reading ON CONFLICT as a join constraint
+    rows = f"SELECT {values} FROM {source} WHERE true" if source else f"VALUES ({values})"
+    return (f"INSERT INTO {rollup_table(tier)} ({', '.join(_columns())}) {rows} "
+            f"ON CONFLICT(bucket) DO UPDATE SET {', '.join(sets)}")
+
+
+def energy_sql(metric: str) -> str:
+    """kW-seconds of a tier row (old-grid estimate for buckets without the integral)"""
+    return (f"(CASE WHEN seconds > 0 THEN {metric}_energy "
+            f"ELSE {metric}_sum * {LEGACY_SAMPLE_SECONDS} END)")
+
+
+def seconds_sql() -> str:
+    """Seconds of a tier row that energy_sql() integrates over"""
+    return f"(CASE WHEN seconds > 0 THEN seconds ELSE samples * {LEGACY_SAMPLE_SECONDS} END)"
+
+
+# ----------------------------------------------------------------------
+# Schema (called from migrations.migrate)
+# ----------------------------------------------------------------------
+def create_rollups(conn, table: str = 'site_samples'):
+    """Tier tables and the ``table`` triggers that maintain them"""
+    for tier, _ in TIERS:
+        metric_columns = ''.join(
+            f", {m}_sum REAL, {m}_min REAL, {m}_max REAL, {m}_last REAL" for m in METRICS)
+        energy_columns = ''.join(f", {c} REAL NOT NULL DEFAULT 0" for c in _energy_columns())
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {rollup_table(tier)} (
+                bucket INTEGER PRIMARY KEY,
+                samples INTEGER NOT NULL,
+                last_epoch INTEGER{metric_columns}{energy_columns}
+            )
+        """)
+        # Tiers created before the energy integrals
+        present = {row[1] for row in conn.execute(f"PRAGMA table_info({rollup_table(tier)})")}
+        for column in _energy_columns():
+            if column not in present:
+                conn.execute(f"ALTER TABLE {rollup_table(tier)} ADD COLUMN {column} "
+                             f"REAL NOT NULL DEFAULT 0")
+        # ... and their one-trigger-per-tier predecessors
+        for suffix in ('', '_update'):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_rollup_{tier}{suffix}")
+    create_rollup_triggers(conn, table=table)
+
+
+def _gap_source(epoch: str) -> str:
+    """
+    FROM clause giving ``e`` (the sample's epoch) and ``gap`` (seconds since
+    the previous sample, read from the 1m tier before this one is folded in)
+    """
+    previous = (f"(SELECT MAX(last_epoch) FROM {rollup_table('1m')} "
+                f"WHERE bucket >= e - {MAX_GAP_SECONDS + 60} AND bucket <= e AND last_epoch < e)")
+    return (f"(SELECT e, CASE WHEN e - previous <= {MAX_GAP_SECONDS} THEN e - previous "
+            f"ELSE 0 END AS gap FROM (SELECT e, {previous} AS previous "
+            f"FROM (SELECT {epoch} AS e)))")
+
+
+def create_rollup_triggers(conn, schema: Optional[str] = None, table: str = 'site_samples'):
+    """
+    Triggers folding samples written to ``schema``.``table`` into the tiers:
+    every INSERT, and every in-place UPDATE of a compressed tail row. For an
+    attached partition (partitions.py) they are TEMP triggers of the
+    writer's connection, since only TEMP triggers may reach another file.
+    One trigger updates all tiers, 1m last, so each tier's gap is taken to
+    the sample before this one.
+    """
+    epoch = f"COALESCE(NEW.ts_epoch, {epoch_sql('NEW.timestamp')})"
+    statements = []
+    for tier, _ in reversed(TIERS):
+        values = [bucket_sql(tier, 'e'), '1', 'e']
+        for m in METRICS:
+            values += [f"COALESCE(NEW.{m}_kw, 0)"] * 4
+        values += ['gap'] + [f"COALESCE(NEW.{m}_kw, 0) * gap" for m in METRICS]
+        statements.append(_upsert_sql(tier, ', '.join(values), _gap_source(epoch)) + ';')
+    if schema is None:
+        create, name, target = 'CREATE TRIGGER', 'trg_rollup', table
+    else:
+        create, name, target = 'CREATE TEMP TRIGGER', f"trg_rollup_{schema}", f"{schema}.{table}"
+    body = '\n                    '.join(statements)
+    # The ts_epoch fill-in trigger only touches ts_epoch, so it never fires the UPDATE one
+    for suffix, event in (('', 'INSERT'),
+                          ('_update', 'UPDATE OF timestamp, production_kw, consumption_kw, '
+                                      'net_export_kw')):
+        conn.execute(f"""
+            {create} IF NOT EXISTS {name}{suffix}
+            AFTER {event} ON {target} WHEN {epoch} IS NOT NULL
+            BEGIN
+                {body}
+            END
+        """)
+
+
+def backfill_rollups(conn, first_rowid: int, last_rowid: int,
+                     chunk_rows: int = BACKFILL_CHUNK_ROWS,
+                     table: str = 'site_samples') -> Optional[int]:
+    """
+    Fold ``table`` rows [first_rowid, first_rowid + chunk_rows) into all
+    tiers. Returns the next rowid to process, or None when past last_rowid.
+    The caller commits the chunk together with its progress marker.
+    """
+    if first_rowid > last_rowid:
+        return None
+    end = min(first_rowid + chunk_rows, last_rowid + 1)
+    epoch = f"COALESCE(ts_epoch, {epoch_sql()})"
+    buckets = ', '.join(bucket_sql(tier, 'e') for tier, _ in TIERS)
+    metrics = ', '.join(f"COALESCE({m}_kw, 0)" for m in METRICS)
+    rows = conn.execute(f"""
+        SELECT e, {buckets}, {metrics} FROM (
+            SELECT {epoch} AS e, {', '.join(f'{m}_kw' for m in METRICS)} FROM {table}
+            WHERE rowid >= ? AND rowid < ?
+        ) WHERE e IS NOT NULL
+    """, (first_rowid, end)).fetchall()
+    # Gaps run on from the chunk before (rows are written in time order)
+    before = conn.execute(f"SELECT {epoch} FROM {table} WHERE rowid < ? AND {epoch} IS NOT NULL "
+                          f"ORDER BY rowid DESC LIMIT 1", (first_rowid,)).fetchone()
+    previous = before[0] if before else None
+    gaps = []
+    for row in rows:
+        gap = row[0] - previous if previous is not None else 0
+        gaps.append(gap if 0 < gap <= MAX_GAP_SECONDS else 0)
+        previous = row[0]
+
+    n_tiers = len(TIERS)
+    n_metrics = len(METRICS)
+    for i, (tier, _) in enumerate(TIERS):
+        merged: Dict[int, list] = {}
+        for row, gap in zip(rows, gaps):
+            e, bucket, values = row[0], row[1 + i], row[1 + n_tiers:]
+            agg = merged.get(bucket)
+            if agg is None:
+                agg = merged[bucket] = [bucket, 0, e]
+                for v in values:
+                    agg += [0.0, v, v, v]
+                agg += [0.0] * (1 + n_metrics)
+            agg[1] += 1
+            for j, v in enumerate(values):
+                base = 3 + 4 * j
+                agg[base] += v
+                agg[base + 1] = min(agg[base + 1], v)
+                agg[base + 2] = max(agg[base + 2], v)
+                if e >= agg[2]:
+                    agg[base + 3] = v
+                agg[4 + 4 * n_metrics + j] += v * gap
+            agg[2] = max(agg[2], e)
+            agg[3 + 4 * n_metrics] += gap
+        if merged:
+            conn.executemany(_upsert_sql(tier, ', '.join('?' * len(_columns()))),
+                             list(merged.values()))
+    return end
+
+
+def backfill_energy(conn, first_bucket: int, last_bucket: int,
+                    chunk_rows: int = BACKFILL_CHUNK_ROWS) -> Optional[int]:
+    """
+    Energy integrals for 1m buckets [first_bucket, last_bucket] stored
+    before the tiers had them, ``chunk_rows`` buckets per call; returns the
+    next bucket to process, or None when past last_bucket.
+
+    The raw gaps are gone, but a bucket's gaps add up to its last_epoch
+    minus the previous bucket's, so ``seconds`` is exact and energy is
+    the bucket's mean power over it. Coarser buckets are re-summed from
+    their 1m rows, where the 1m tier still holds every sample of them
+    (older ones keep the one-minute estimate of energy_sql()).
+    """
+    rows = conn.execute(f"""
+        SELECT bucket, samples, last_epoch, {', '.join(f'{m}_sum' for m in METRICS)},
+               {', '.join(bucket_sql(tier, 'bucket') for tier, _ in TIERS[1:])}
+        FROM {rollup_table('1m')} WHERE bucket >= ? AND bucket <= ? ORDER BY bucket LIMIT ?
+    """, (first_bucket, last_bucket, chunk_rows)).fetchall()
+    if not rows:
+        return None
+    before = conn.execute(f"SELECT last_epoch FROM {rollup_table('1m')} WHERE bucket < ? "
+                          f"ORDER BY bucket DESC LIMIT 1", (rows[0][0],)).fetchone()
+    previous = before[0] if before else None
+    updates = []
+    for row in rows:
+        bucket, samples, last_epoch, sums = row[0], row[1], row[2], row[3:3 + len(METRICS)]
+        span = last_epoch - previous if previous is not None else 0
+        seconds = span if 0 < span <= MAX_GAP_SECONDS else 0
+        updates.append([seconds] + [s / samples * seconds for s in sums] + [bucket])
+        previous = last_epoch
+    sets = ', '.join(f"{c} = ?" for c in _energy_columns())
+    conn.executemany(f"UPDATE {rollup_table('1m')} SET {sets} WHERE bucket = ?", updates)
+
+    totals = ', '.join(f"TOTAL({c})" for c in ['samples'] + _energy_columns())
+    for i, (tier, width) in enumerate(TIERS[1:]):
+        for bucket in sorted({row[3 + len(METRICS) + i] for row in rows}):
+            # Local days/hours can be an hour longer across DST
+            hi = bucket + width + (3600 if width >= 3600 else 0)
+            covered = conn.execute(f"""
+                SELECT {totals} FROM {rollup_table('1m')}
+                WHERE bucket >= ? AND bucket < ? AND {bucket_sql(tier, 'bucket')} = ?
+            """, (bucket, hi, bucket)).fetchone()
+            conn.execute(f"UPDATE {rollup_table(tier)} SET {sets} WHERE bucket = ? AND samples = ?",
+                         list(covered[1:]) + [bucket, covered[0]])
+    return rows[-1][0] + 60 if rows[-1][0] < last_bucket else None
+
+
+def ready(conn) -> bool:
+    """True once the tiers hold all history (backfill finished)"""
+    try:
+        return conn.execute("SELECT 1 FROM schema_migrations WHERE name = 'rollups'"
+                            ).fetchone() is not None
+    except Exception:
+        return False
+
+
+# ----------------------------------------------------------------------
+# Planner
+# ----------------------------------------------------------------------
+def tier_for_bucket(bucket_seconds: float) -> Optional[str]:
+    """Coarsest tier whose buckets tile ``bucket_seconds`` (None: needs raw rows)"""
+    chosen = None
+    for tier, width in TIERS:
+        if width <= bucket_seconds and bucket_seconds % width == 0:
+            chosen = tier
+    return chosen
+
+
+def tier_for_span(span_seconds: float) -> str:
+    """Coarsest tier giving at least ~24 buckets over a window"""
+    chosen = TIERS[0][0]
+    for tier, width in TIERS:
+        if width * 24 <= span_seconds:
+            chosen = tier
+    return chosen
+
+
+# Raw rows are only read before the backfill finished: the old one-minute grid
+RAW_SOURCE_COLUMNS = ', '.join(
+    ['timestamp', 'ts_epoch', '1 AS samples']
+    + [f"{m}_kw AS {m}_{agg}" for m in METRICS for agg in ('sum', 'min', 'max')]
+    + [f"{LEGACY_SAMPLE_SECONDS} AS seconds"]
+    + [f"{m}_kw * {LEGACY_SAMPLE_SECONDS} AS {m}_energy" for m in METRICS])
+
+
+def source_sql(tier: Optional[str], raw_table: str = 'site_samples') -> str:
+    """Subquery with the common reader columns for a tier (or raw rows)"""
+    if tier is None:
+        return f"(SELECT {RAW_SOURCE_COLUMNS} FROM {raw_table})"
+    columns = ', '.join(
+        ["strftime('%Y-%m-%dT%H:%M:%S', bucket, 'unixepoch', 'localtime') AS timestamp",
+         'bucket AS ts_epoch', 'samples']
+        + [f"{m}_{agg}" for m in METRICS for agg in ('sum', 'min', 'max')]
+        + [f"{seconds_sql()} AS seconds"]
+        + [f"{energy_sql(m)} AS {m}_energy" for m in METRICS])
+    return f"(SELECT {columns} FROM {rollup_table(tier)})"
+
+
+def plan(conn, bucket_seconds: float) -> Dict:
+    """Where to read a query grouped into ``bucket_seconds`` buckets from"""
+    tier = tier_for_bucket(bucket_seconds) if ready(conn) else None
+    return {
+        'tier': tier,
+        'width': TIER_WIDTHS.get(tier, 0),
+        'source': source_sql(tier),
+    }
+
+
+def bucket_start(conn, tier: str, epoch: float) -> int:
+    """Start of the ``tier`` bucket containing ``epoch`` (same SQL as the triggers)"""
+    return conn.execute(f"SELECT {bucket_sql(tier, ':e')}", {'e': int(epoch)}).fetchone()[0]
+
+
+# ----------------------------------------------------------------------
+# Window aggregates (exact to the minute: coarse tier + 1m edge)
+# ----------------------------------------------------------------------
+def _window_split(conn, tier: str, since: float) -> Tuple[int, Optional[int]]:
+    """(first minute, first whole ``tier`` bucket) of the window starting at ``since``"""
+    since_minute = int(since) // 60 * 60
+    row = conn.execute(f"SELECT MIN(bucket) FROM {rollup_table(tier)} WHERE bucket >= ?",
+                       (since_minute,)).fetchone()
+    return since_minute, row[0]
+
+
+def window_totals(conn, since: float) -> Dict:
+    """Sample count, per-metric sums and energy (``<metric>_kwh``) over [since, now]"""
+    sums = ', '.join([f"TOTAL({m}_sum)" for m in METRICS]
+                     + [f"TOTAL({energy_sql(m)})" for m in METRICS])
+    if not ready(conn):
+        sums = ', '.join([f"TOTAL({m}_kw)" for m in METRICS]
+                         + [f"TOTAL({m}_kw) * {LEGACY_SAMPLE_SECONDS}" for m in METRICS])
+        row = conn.execute(f"SELECT COUNT(*), {sums} FROM site_samples WHERE ts_epoch >= ?",
+                           (int(since),)).fetchone()
+        parts = [tuple(row)]
+    else:
+        tier = tier_for_span(time.time() - since)
+        since_minute, first_full = _window_split(conn, tier, since)
+        parts = []
+        if first_full is not None:
+            parts.append(tuple(conn.execute(
+                f"SELECT TOTAL(samples), {sums} FROM {rollup_table(tier)} WHERE bucket >= ?",
+                (first_full,)).fetchone()))
+        edge_sql = f"SELECT TOTAL(samples), {sums} FROM {rollup_table('1m')} WHERE bucket >= ?"
+        edge_args = [since_minute]
+        if first_full is not None:
+            edge_sql += " AND bucket < ?"
+            edge_args.append(first_full)
+        parts.append(tuple(conn.execute(edge_sql, edge_args).fetchone()))
+
+    totals = {'samples': int(sum(p[0] or 0 for p in parts))}
+    for i, m in enumerate(METRICS):
+        totals[f"{m}_sum"] = sum(p[1 + i] or 0 for p in parts)
+        totals[f"{m}_kwh"] = sum(p[1 + len(METRICS) + i] or 0 for p in parts) / 3600.0
+    return totals
+
+
+def _extreme(conn, tier: str, column: str, order: str, lo: int, hi: Optional[int]):
+    sql = f"SELECT bucket, {column} FROM {rollup_table(tier)} WHERE bucket >= ?"
+    args = [lo]
+    if hi is not None:
+        sql += " AND bucket < ?"
+        args.append(hi)
+    return conn.execute(sql + f" ORDER BY {column} {order} LIMIT 1", args).fetchone()
+
+
+def peak(conn, metric: str, since: float, highest: bool = True) -> Optional[Tuple[float, int]]:
+    """
+    (value, epoch of its minute) of the max (or min) ``metric`` since ``since``.
+    Drills from the window's tier down to 1m, reading a few dozen rows per tier.
+    """
+    column = f"{metric}_max" if highest else f"{metric}_min"
+    order = 'DESC' if highest else 'ASC'
+    better = (lambda a, b: a > b) if highest else (lambda a, b: a < b)
+    if not ready(conn):
+        agg = 'MAX' if highest else 'MIN'
+        row = conn.execute(f"SELECT ts_epoch, {agg}({metric}_kw) FROM site_samples "
+                           f"WHERE ts_epoch >= ?", (int(since),)).fetchone()
+        return (row[1], row[0]) if row and row[1] is not None else None
+
+    tier = tier_for_span(time.time() - since)
+    since_minute, first_full = _window_split(conn, tier, since)
+    candidates = [_extreme(conn, '1m', column, order, since_minute, first_full)]
+    if first_full is not None:
+        tiers = [t for t, _ in TIERS]
+        hit = _extreme(conn, tier, column, order, first_full, None)
+        for finer in reversed(tiers[:tiers.index(tier)]):
+            if hit is None:
+                break
+            width = TIER_WIDTHS[tier]
+            # Local days/hours can be an hour longer across DST; extra rows
+            # from the next bucket can't beat this bucket's extreme anyway
+            hi = hit[0] + width + (3600 if width >= 3600 else 0)
+            hit = _extreme(conn, finer, column, order, hit[0], hi)
+            tier = finer
+        candidates.append(hit)
+
+    best = None
+    for row in candidates:
+        if row is not None and row[1] is not None and (best is None or better(row[1], best[1])):
+            best = row
+    return (best[1], best[0]) if best else None
+
+
+def days_with_data(conn, since: float) -> int:
+    """Local calendar days with at least one sample since ``since``"""
+    if not ready(conn):
+        return conn.execute("SELECT COUNT(DISTINCT substr(timestamp, 1, 10)) FROM site_samples "
+                            "WHERE ts_epoch >= ?", (int(since),)).fetchone()[0]
+    return conn.execute(f"SELECT COUNT(*) FROM {rollup_table('1d')} WHERE last_epoch >= ?",
+                        (int(since),)).fetchone()[0]
+
+
+def latest(conn) -> Optional[Dict]:
+    """Newest site sample (the last value of the newest 1m bucket), or None"""
+    columns = ', '.join(f"{m}_last" for m in METRICS)
+    try:
+        row = conn.execute(f"SELECT last_epoch, {columns} FROM {rollup_table('1m')} "
+                           f"ORDER BY bucket DESC LIMIT 1").fetchone()
+    except Exception:
+        return None  # tiers not created yet
+    if row is None:
+        return None
+    result = {'ts_epoch': row[0]}
+    for i, m in enumerate(METRICS):
+        result[f"{m}_kw"] = row[1 + i]
+    return result
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Scheduler
+Drift-free, sun-aware sampling schedule for the collectors.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Samples are placed on a wall-clock grid (12:00:00, 12:01:00, ...) in local
+time, and the wait until the next grid point is measured on the monotonic
+clock, so the time a cycle takes never pushes the following samples back.
+The grid spacing depends on where the sun is:
+
+    night  (sunset + twilight .. sunrise - twilight)   NIGHT_INTERVAL  (600s)
+    day    (the rest of the daylight hours)             COLLECTOR_INTERVAL (60s)
+    noon   (solar noon +/- NOON_WINDOW_HOURS)           NOON_INTERVAL   (30s)
+
+Sunrise/sunset come from the most recent weather_data row for the day when
+there is one, otherwise from the NOAA solar position equations.
+"""
+
+import math
+import sqlite3
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional, Tuple
+
+from config import config
+
+# How often to look for a fresher weather_data row when none matched today
+WEATHER_RECHECK_SECONDS = 1800
+
+
+def solar_events(day: date, latitude: float, longitude: float) -> Dict[str, float]:
+    """Sunrise, solar noon and sunset (UTC epoch seconds) for a calendar day"""
+    # NOAA General Solar Position calculations, evaluated at 12:00 UTC
+    julian_day = day.toordinal() + 1721425.0
+    jc = (julian_day - 2451545.0) / 36525.0
+
+    mean_long = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    mean_anom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    eccent = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    m = math.radians(mean_anom)
+    center = (math.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+              + math.sin(2 * m) * (0.019993 - 0.000101 * jc)
+              + math.sin(3 * m) * 0.000289)
+    omega = math.radians(125.04 - 1934.136 * jc)
+    apparent_long = mean_long + center - 0.00569 - 0.00478 * math.sin(omega)
+    mean_obliq = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    obliq = math.radians(mean_obliq + 0.00256 * math.cos(omega))
+    declination = math.asin(math.sin(obliq) * math.sin(math.radians(apparent_long)))
+
+    y = math.tan(obliq / 2) ** 2
+    l0 = math.radians(mean_long)
+    eq_of_time = 4 * math.degrees(
+        y * math.sin(2 * l0) - 2 * eccent * math.sin(m)
+        + 4 * eccent * y * math.sin(m) * math.cos(2 * l0)
+        - 0.5 * y * y * math.sin(4 * l0) - 1.25 * eccent * eccent * math.sin(2 * m))
+
+    lat = math.radians(latitude)
+    cos_hour_angle = (math.cos(math.radians(90.833)) / (math.cos(lat) * math.cos(declination))
+                      - math.tan(lat) * math.tan(declination))
+    # Polar night / midnight sun: clamp to "never rises" / "never sets"
+    hour_angle = math.degrees(math.acos(max(-1.0, min(1.0, cos_hour_angle))))
+
+    midnight_utc = datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()
+    noon_minutes = 720 - 4 * longitude - eq_of_time
+    return {
+        'sunrise': midnight_utc + (noon_minutes - 4 * hour_angle) * 60,
+        'solar_noon': midnight_utc + noon_minutes * 60,
+        'sunset': midnight_utc + (noon_minutes + 4 * hour_angle) * 60,
+    }
+
+
+class AdaptiveScheduler:
+    """Wall-clock aligned ticks whose spacing follows the sun"""
+
+    def __init__(self, day_interval: int = 60, noon_interval: int = 30,
+                 night_interval: int = 600, noon_window_hours: float = 2.0,
+                 twilight_minutes: float = 30.0, latitude: float = 39.7392,
+                 longitude: float = -104.9903, db_path: Optional[str] = None):
+        self.intervals = {
+            'night': max(1, night_interval),
+            'day': max(1, day_interval),
+            'noon': max(1, noon_interval),
+        }
+        self.noon_window = noon_window_hours * 3600
+        self.twilight = twilight_minutes * 60
+        self.latitude = latitude
+        self.longitude = longitude
+        self.db_path = db_path
+        self._sun_cache: Dict[date, Dict] = {}
+
+    @classmethod
+    def from_config(cls, db_path: Optional[str] = None) -> 'AdaptiveScheduler':
+        return cls(day_interval=config.collector_interval,
+                   noon_interval=config.noon_interval,
+                   night_interval=config.night_interval,
+                   noon_window_hours=config.noon_window_hours,
+                   twilight_minutes=config.twilight_minutes,
+                   latitude=float(config.weather_latitude),
+                   longitude=float(config.weather_longitude),
+                   db_path=db_path)
+
+    @classmethod
+    def fixed(cls, interval: int) -> 'AdaptiveScheduler':
+        """Same grid spacing around the clock"""
+        return cls(day_interval=interval, noon_interval=interval, night_interval=interval)
+
+    # ------------------------------------------------------------------
+    # Sun
+    # ------------------------------------------------------------------
+    def sun_times(self, day: date) -> Dict:
+        """Sunrise/solar noon/sunset for a local day, preferring weather_data"""
+        cached = self._sun_cache.get(day)
+        if cached and (cached['source'] == 'weather_data'
+                       or time.time() - cached['checked'] < WEATHER_RECHECK_SECONDS):
+            return cached
+
+        times = self._weather_sun_times(day)
+        if times:
+            times['solar_noon'] = (times['sunrise'] + times['sunset']) / 2
+            times['source'] = 'weather_data'
+        else:
+            times = solar_events(day, self.latitude, self.longitude)
+            times['source'] = 'computed'
+        times['checked'] = time.time()
+
+        self._sun_cache = {d: v for d, v in self._sun_cache.items()
+                           if abs((d - day).days) <= 2}
+        self._sun_cache[day] = times
+        return times
+
+    def _weather_sun_times(self, day: date) -> Optional[Dict]:
+        if not self.db_path:
+            return None
+        try:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=2.0)
+            try:
+                row = conn.execute("""
+                    SELECT sunrise, sunset FROM weather_data
+                    WHERE sunrise IS NOT NULL AND sunset IS NOT NULL
+                    ORDER BY id DESC LIMIT 1
+                """).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        if not row or datetime.fromtimestamp(row[0]).date() != day:
+            return None
+        return {'sunrise': float(row[0]), 'sunset': float(row[1])}
+
+    def _boundaries(self, day: date):
+        """(start, phase) pairs for a local day, in time order"""
+        sun = self.sun_times(day)
+        return [
+            (sun['sunrise'] - self.twilight, 'day'),
+            (sun['solar_noon'] - self.noon_window, 'noon'),
+            (sun['solar_noon'] + self.noon_window, 'day'),
+            (sun['sunset'] + self.twilight, 'night'),
+        ]
+
+    def _boundaries_around(self, when: float):
+        # Neighbouring days too: when the host clock is not in the site's
+        # timezone, sunset can fall after local midnight
+        today = datetime.fromtimestamp(when).date()
+        bounds = []
+        for day in (today - timedelta(days=1), today, today + timedelta(days=1)):
+            bounds.extend(self._boundaries(day))
+        return sorted(bounds)
+
+    def phase_at(self, when: float) -> str:
+        phase = 'night'
+        for start, name in self._boundaries_around(when):
+            if when >= start:
+                phase = name
+        return phase
+
+    def interval_at(self, when: float) -> int:
+        return self.intervals[self.phase_at(when)]
+
+    # ------------------------------------------------------------------
+    # Grid
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _grid_after(when: float, interval: int) -> float:
+        """First local-time grid point strictly after ``when``"""
+        offset = datetime.fromtimestamp(when).astimezone().utcoffset().total_seconds()
+        return (math.floor((when + offset) / interval) + 1) * interval - offset
+
+    def next_tick(self, now: Optional[float] = None) -> Tuple[float, str]:
+        """Epoch of the next sample and the phase it belongs to"""
+        now = time.time() if now is None else now
+        target = self._grid_after(now, self.interval_at(now))
+
+        # Don't let a sparse night grid overshoot the switch to a faster rate
+        for start, phase in self._boundaries_around(now):
+            if now < start < target:
+                target = min(target, self._grid_after(start - 1e-6, self.intervals[phase]))
+        return target, self.phase_at(target)
+
+    def wait_until(self, target: float):
+        """Sleep on the monotonic clock until wall-clock ``target``"""
+        deadline = time.monotonic() + (target - time.time())
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def ticks(self) -> Iterator[Tuple[datetime, str]]:
+        """Blocking generator: (scheduled local datetime, phase) per sample"""
+        while True:
+            target, phase = self.next_tick()
+            self.wait_until(target)
+            yield datetime.fromtimestamp(target), phase
+
+    def describe(self) -> Dict:
+        """Today's schedule, for logs and the API"""
+        sun = self.sun_times(datetime.now().date())
+        fmt = lambda t: datetime.fromtimestamp(t).strftime('%H:%M:%S')
+        return {
+            'source': sun['source'],
+            'sunrise': fmt(sun['sunrise']),
+            'solar_noon': fmt(sun['solar_noon']),
+            'sunset': fmt(sun['sunset']),
+            'intervals': dict(self.intervals),
+        }
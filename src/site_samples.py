@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Site Samples
+One canonical site-level time series, with the old tables as views.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+Every collection cycle used to write the same (timestamp, production_kw,
+consumption_kw, net_export_kw) into both system_status and solar_data. It
+is now written once, to site_samples, and system_status / solar_data are
+read-only views over it in their old column layouts. The views also carry
+the columns database.SolarDatabase and mobile_api were written against
+(power_kw, net_power_kw, total_production_kw, raw_data, ...): aliases where
+the value exists, NULL where it never did.
+
+INSTEAD OF INSERT triggers keep old insert paths working: a solar_data row
+naming a device goes to device_data (encoded by devices.py), anything else
+becomes a site sample. UPDATE/DELETE go to site_samples directly (storage,
+compression, retention).
+
+Rollup tiers are maintained by triggers on site_samples (rollups.py).
+"""
+
+SITE_TABLE = 'site_samples'
+
+# Old table -> (column, expression over site_samples), in the old column order
+LEGACY_VIEWS = {
+    'system_status': (
+        ('id', 'id'),
+        ('timestamp', 'timestamp'),
+        ('production_kw', 'production_kw'),
+        ('consumption_kw', 'consumption_kw'),
+        ('net_export_kw', 'net_export_kw'),
+        ('grid_frequency', 'NULL'),
+        ('voltage', 'NULL'),
+        ('ts_epoch', 'ts_epoch'),
+        # database.SolarDatabase layout
+        ('total_production_kw', 'production_kw'),
+        ('total_consumption_kw', 'consumption_kw'),
+        ('system_online', 'NULL'),
+        ('pvs_online', 'NULL'),
+    ),
+    'solar_data': (
+        ('id', 'id'),
+        ('timestamp', 'timestamp'),
+        ('production_kw', 'production_kw'),
+        ('consumption_kw', 'consumption_kw'),
+        ('net_export_kw', 'net_export_kw'),
+        ('device_id', 'NULL'),
+        ('ts_epoch', 'ts_epoch'),
+        # database.SolarDatabase / mobile_api layout
+        ('device_type', 'NULL'),
+        ('power_kw', 'production_kw'),
+        ('net_power_kw', 'net_export_kw'),
+        ('energy_kwh', 'NULL'),
+        ('voltage', 'NULL'),
+        ('current', 'NULL'),
+        ('frequency', 'NULL'),
+        ('raw_data', 'NULL'),
+    ),
+}
+
+LEGACY_INSERT_TRIGGERS = {
+    'system_status': """
+        INSERT INTO site_samples (timestamp, production_kw, consumption_kw, net_export_kw, ts_epoch)
+        VALUES (COALESCE(NEW.timestamp, CURRENT_TIMESTAMP),
+                COALESCE(NEW.production_kw, NEW.total_production_kw, 0),
+                COALESCE(NEW.consumption_kw, NEW.total_consumption_kw, 0),
+                COALESCE(NEW.net_export_kw, 0), NEW.ts_epoch);
+    """,
+    'solar_data': """
+        INSERT INTO device_data
+        (timestamp, device_id, device_type, power_kw, voltage, current_a, frequency, ts_epoch)
+        SELECT COALESCE(NEW.timestamp, CURRENT_TIMESTAMP), NEW.device_id,
+               COALESCE(NEW.device_type, 'inverter'), COALESCE(NEW.power_kw, 0),
+               NEW.voltage, NEW.current, NEW.frequency, NEW.ts_epoch
+        WHERE NEW.device_id IS NOT NULL;
+        INSERT INTO site_samples (timestamp, production_kw, consumption_kw, net_export_kw, ts_epoch)
+        SELECT COALESCE(NEW.timestamp, CURRENT_TIMESTAMP),
+               COALESCE(NEW.production_kw, NEW.power_kw, 0), COALESCE(NEW.consumption_kw, 0),
+               COALESCE(NEW.net_export_kw, NEW.net_power_kw, 0), NEW.ts_epoch
+        WHERE NEW.device_id IS NULL;
+    """,
+}
+
+
+def create_site_samples(conn):
+    """The canonical table (idempotent)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS site_samples (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            production_kw REAL DEFAULT 0,
+            consumption_kw REAL DEFAULT 0,
+            net_export_kw REAL DEFAULT 0,
+            ts_epoch INTEGER
+        )
+    """)
+    # Legacy readers sort/filter the views by timestamp
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_site_samples_timestamp ON site_samples(timestamp)")
+
+
+def view_sql(view: str, source: str = SITE_TABLE) -> str:
+    return (f"SELECT {', '.join(f'{expr} AS {column}' for column, expr in LEGACY_VIEWS[view])} "
+            f"FROM {source}")
+
+
+def create_legacy_views(conn):
+    """system_status / solar_data views plus their INSTEAD OF INSERT triggers"""
+    for view in LEGACY_VIEWS:
+        conn.execute(f"CREATE VIEW IF NOT EXISTS {view} AS {view_sql(view)}")
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{view}_insert
+            INSTEAD OF INSERT ON {view}
+            BEGIN
+                {LEGACY_INSERT_TRIGGERS[view]}
+            END
+        """)
+
+
+def create_temp_legacy_views(conn):
+    """The views over temp.site_samples (the partition UNION view)"""
+    for view in LEGACY_VIEWS:
+        conn.execute(f"DROP VIEW IF EXISTS temp.{view}")
+        conn.execute(f"CREATE TEMP VIEW {view} AS {view_sql(view, 'temp.' + SITE_TABLE)}")
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Statistics Catalog
+Row counts, time ranges and device counts kept current by triggers.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+The status endpoints used to answer "how many rows, since when, how many
+devices" with COUNT(*), MIN/MAX(timestamp) and COUNT(DISTINCT ...) over
+the full tables on every poll. The catalog keeps those numbers instead:
+
+    stats_tables    per table: rows, first_epoch, last_epoch, reconciled_at
+    stats_days      per table and local day (bucket as in solar_rollup_1d):
+                    rows, first_epoch, last_epoch
+    stats_devices   per table and device (device_samples.device_key): rows,
+                    last_epoch
+
+Triggers on every STATS_TABLES table update the catalog in the writer's own
+transaction: INSERT adds, DELETE subtracts (a deleted first/last row moves
+the day's bound with one index seek), and an UPDATE that moves a row -
+a compressed tail sample - counts as both. Monthly partition files get TEMP
+triggers on the writer's connection (like the rollup triggers), and an
+expiring month is subtracted before its file goes (forget()).
+
+Anything that writes around the triggers (another process attaching a month
+without them, a restored file) leaves drift, which reconcile() - the
+maintenance job 'reconcile_stats' - recounts: days before today without
+holding a lock, today's rows and the write under BEGIN IMMEDIATE.
+
+Run standalone with:  python stats_catalog.py [--reconcile] [/path/to/solar_data.db]
+"""
+
+import sqlite3
+import sys
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+
+from config import config
+from migrations import epoch_sql
+from rollups import bucket_sql
+
+# Catalogued tables -> their device column (None: no per-device counts)
+STATS_TABLES = {
+    'site_samples': None,
+    'device_samples': 'device_key',
+    'weather_data': None,
+}
+
+
+def row_epoch(alias: str) -> str:
+    """Epoch of NEW/OLD (or a bare table row with alias '') as the triggers see it"""
+    prefix = f"{alias}." if alias else ''
+    return f"COALESCE({prefix}ts_epoch, {epoch_sql(prefix + 'timestamp')})"
+
+
+def day_start(epoch: float) -> int:
+    """Start of the local day containing ``epoch`` (the stats_days key)"""
+    return int(time.mktime(date.fromtimestamp(epoch).timetuple()))
+
+
+def next_day_start(epoch: float) -> int:
+    return int(time.mktime((date.fromtimestamp(epoch) + timedelta(days=1)).timetuple()))
+
+
+# ----------------------------------------------------------------------
+# Schema (called from migrations.migrate)
+# ----------------------------------------------------------------------
+def create_catalog(conn):
+    """Catalog tables (idempotent); triggers are added per table"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_tables (
+            tbl TEXT PRIMARY KEY,
+            rows INTEGER NOT NULL DEFAULT 0,
+            first_epoch INTEGER,
+            last_epoch INTEGER,
+            reconciled_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_days (
+            tbl TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            first_epoch INTEGER,
+            last_epoch INTEGER,
+            PRIMARY KEY (tbl, day)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_devices (
+            tbl TEXT NOT NULL,
+            device INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            last_epoch INTEGER,
+            PRIMARY KEY (tbl, device)
+        ) WITHOUT ROWID
+    """)
+
+
+def _add_sql(table: str, alias: str) -> str:
+    """Trigger statements counting row ``alias`` in"""
+    e = row_epoch(alias)
+    statements = [
+        f"INSERT INTO stats_days (tbl, day, rows, first_epoch, last_epoch) "
+        f"VALUES ('{table}', {bucket_sql('1d', e)}, 1, {e}, {e}) "
+        f"ON CONFLICT(tbl, day) DO UPDATE SET rows = rows + 1, "
+        f"first_epoch = min(first_epoch, excluded.first_epoch), "
+        f"last_epoch = max(last_epoch, excluded.last_epoch)",
+        f"INSERT INTO stats_tables (tbl, rows, first_epoch, last_epoch) "
+        f"VALUES ('{table}', 1, {e}, {e}) "
+        f"ON CONFLICT(tbl) DO UPDATE SET rows = rows + 1, "
+        f"first_epoch = min(COALESCE(first_epoch, excluded.first_epoch), excluded.first_epoch), "
+        f"last_epoch = max(COALESCE(last_epoch, excluded.last_epoch), excluded.last_epoch)",
+    ]
+    device = STATS_TABLES[table]
+    if device:
+        statements.append(
+            f"INSERT INTO stats_devices (tbl, device, rows, last_epoch) "
+            f"SELECT '{table}', {alias}.{device}, 1, {e} WHERE {alias}.{device} IS NOT NULL "
+            f"ON CONFLICT(tbl, device) DO UPDATE SET rows = rows + 1, "
+            f"last_epoch = max(last_epoch, excluded.last_epoch)")
+    return ';\n'.join(statements)
+
+
+def _remove_sql(table: str, alias: str, target: str) -> str:
+    """Trigger statements counting row ``alias`` out (``target``: the table, schema-qualified for TEMP)"""
+    e = row_epoch(alias)
+    day = bucket_sql('1d', e)
+    # Local days are 23-25 hours long; +25h always lands in the next one
+    day_end = bucket_sql('1d', f"{day} + 90000")
+    statements = [
+        f"UPDATE stats_days SET rows = rows - 1, "
+        f"first_epoch = CASE WHEN first_epoch < {e} THEN first_epoch ELSE "
+        f"(SELECT MIN(ts_epoch) FROM {target} WHERE ts_epoch >= {e} AND ts_epoch < {day_end}) END, "
+        f"last_epoch = CASE WHEN last_epoch > {e} THEN last_epoch ELSE "
+        f"(SELECT MAX(ts_epoch) FROM {target} WHERE ts_epoch <= {e} AND ts_epoch >= {day}) END "
+        f"WHERE tbl = '{table}' AND day = {day}",
+        f"DELETE FROM stats_days WHERE tbl = '{table}' AND day = {day} AND rows <= 0",
+        f"UPDATE stats_tables SET rows = rows - 1, "
+        f"first_epoch = CASE WHEN first_epoch < {e} THEN first_epoch ELSE "
+        f"(SELECT MIN(first_epoch) FROM stats_days WHERE tbl = '{table}') END, "
+        f"last_epoch = CASE WHEN last_epoch > {e} THEN last_epoch ELSE "
+        f"(SELECT MAX(last_epoch) FROM stats_days WHERE tbl = '{table}') END "
+        f"WHERE tbl = '{table}'",
+    ]
+    device = STATS_TABLES[table]
+    if device:
+        statements += [
+            f"UPDATE stats_devices SET rows = rows - 1 WHERE tbl = '{table}' AND device = {alias}.{device}",
+            f"DELETE FROM stats_devices WHERE tbl = '{table}' AND device = {alias}.{device} AND rows <= 0",
+        ]
+    return ';\n'.join(statements)
+
+
+def create_triggers(conn, table: str, schema: Optional[str] = None):
+    """
+    INSERT/DELETE/UPDATE triggers keeping the catalog in step with
+    ``schema``.``table``; TEMP triggers of this connection for an attached
+    partition, since only those may write the main database's catalog.
+    """
+    device = STATS_TABLES[table]
+    if schema is None:
+        create, name, target = 'CREATE TRIGGER', f"trg_stats_{table}", table
+    else:
+        create, name, target = 'CREATE TEMP TRIGGER', f"trg_stats_{table}_{schema}", f"{schema}.{table}"
+    moved = f"{row_epoch('OLD')} IS NOT {row_epoch('NEW')}"
+    columns = 'timestamp, ts_epoch'
+    if device:
+        moved += f" OR OLD.{device} IS NOT NEW.{device}"
+        columns += f", {device}"
+    for suffix, event, when, body in (
+            ('_insert', 'INSERT', f"{row_epoch('NEW')} IS NOT NULL", _add_sql(table, 'NEW')),
+            ('_delete', 'DELETE', f"{row_epoch('OLD')} IS NOT NULL", _remove_sql(table, 'OLD', target)),
+            # The ts_epoch fill-in trigger doesn't move the row: not fired
+            ('_update', f"UPDATE OF {columns}", moved,
+             _remove_sql(table, 'OLD', target) + ';\n' + _add_sql(table, 'NEW'))):
+        conn.execute(f"""
+            {create} IF NOT EXISTS {name}{suffix}
+            AFTER {event} ON {target} WHEN {when}
+            BEGIN
+                {body};
+            END
+        """)
+
+
+def create_all(conn) -> bool:
+    """Catalog plus the main tables' triggers; True if it was just created (needs a reconcile)"""
+    existed = exists(conn)
+    create_catalog(conn)
+    for table in STATS_TABLES:
+        if _table_exists(conn, 'main', table):
+            create_triggers(conn, table)
+    return not existed
+
+
+def exists(conn) -> bool:
+    """Catalog created (migrations.migrate)"""
+    return _table_exists(conn, 'main', 'stats_tables')
+
+
+def _table_exists(conn, schema: str, table: str) -> bool:
+    return conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                        (table,)).fetchone() is not None
+
+
+# ----------------------------------------------------------------------
+# Reading
+# ----------------------------------------------------------------------
+def table_stats(conn, table: str) -> Dict:
+    """rows, first/last epoch, days with data, distinct devices of ``table``"""
+    if not exists(conn):
+        return _live_stats(conn, table)
+    row = conn.execute("SELECT rows, first_epoch, last_epoch, reconciled_at FROM stats_tables "
+                       "WHERE tbl = ?", (table,)).fetchone()
+    days = conn.execute("SELECT COUNT(*) FROM stats_days WHERE tbl = ?", (table,)).fetchone()[0]
+    devices = conn.execute("SELECT COUNT(*) FROM stats_devices WHERE tbl = ?", (table,)).fetchone()[0]
+    return {
+        'rows': row[0] if row else 0,
+        'first_epoch': row[1] if row else None,
+        'last_epoch': row[2] if row else None,
+        'days': days,
+        'devices': devices,
+        'reconciled_at': row[3] if row else None,
+    }
+
+
+def _live_stats(conn, table: str) -> Dict:
+    """Catalog not created yet (database not migrated): count the table"""
+    rows, first, last = conn.execute(f"SELECT COUNT(*), MIN(ts_epoch), MAX(ts_epoch) FROM {table}").fetchone()
+    device = STATS_TABLES.get(table)
+    devices = (conn.execute(f"SELECT COUNT(DISTINCT {device}) FROM {table}").fetchone()[0]
+               if device else 0)
+    return {'rows': rows, 'first_epoch': first, 'last_epoch': last, 'days': None,
+            'devices': devices, 'reconciled_at': None}
+
+
+def window(conn, table: str, since: float) -> Dict:
+    """
+    rows and first/last epoch of ``table`` from ``since`` on: whole days
+    from the catalog, the part of since's day by an index range count.
+    ``conn`` must see ``table`` over that range (app.get_range_connection).
+    """
+    boundary = next_day_start(since)
+    rows, first, last = conn.execute(
+        f"SELECT COUNT(*), MIN(ts_epoch), MAX(ts_epoch) FROM {table} WHERE ts_epoch >= ? AND ts_epoch < ?",
+        (int(since), boundary)).fetchone()
+    if not exists(conn):
+        later = conn.execute(f"SELECT COUNT(*), MIN(ts_epoch), MAX(ts_epoch) FROM {table} "
+                             f"WHERE ts_epoch >= ?", (boundary,)).fetchone()
+    else:
+        later = conn.execute("SELECT TOTAL(rows), MIN(first_epoch), MAX(last_epoch) FROM stats_days "
+                             "WHERE tbl = ? AND day >= ?", (table, boundary)).fetchone()
+    return {
+        'rows': rows + int(later[0]),
+        'first_epoch': first if first is not None else later[1],
+        'last_epoch': later[2] if later[2] is not None else last,
+    }
+
+
+def active_devices(conn, table: str = 'device_samples', since: Optional[float] = None) -> int:
+    """Distinct devices with rows (newer than ``since``)"""
+    if not exists(conn):
+        device = STATS_TABLES[table]
+        return conn.execute(f"SELECT COUNT(DISTINCT {device}) FROM {table} WHERE ts_epoch >= ?",
+                            (since or 0,)).fetchone()[0]
+    return conn.execute("SELECT COUNT(*) FROM stats_devices WHERE tbl = ? AND last_epoch >= ?",
+                        (table, since or 0)).fetchone()[0]
+
+
+def day_counts(conn, table: str, since: Optional[float] = None) -> Dict[str, int]:
+    """Rows per local day ('YYYY-MM-DD'), oldest first"""
+    rows = conn.execute("SELECT day, rows FROM stats_days WHERE tbl = ? AND day >= ? ORDER BY day",
+                        (table, day_start(since) if since else 0))
+    return {date.fromtimestamp(day).isoformat(): count for day, count in rows}
+
+
+# ----------------------------------------------------------------------
+# Reconcile
+# ----------------------------------------------------------------------
+def _count(conn, source: str, table: str, lo: Optional[int], hi: Optional[int], days: Dict, devices: Dict):
+    """Add ``source`` rows with lo <= epoch < hi to the day/device tallies"""
+    e = row_epoch('')
+    where = f"{e} IS NOT NULL" + (f" AND ts_epoch >= {int(lo)}" if lo is not None else '') \
+        + (f" AND {e} < {int(hi)}" if hi is not None else '')
+    for day, rows, first, last in conn.execute(
+            f"SELECT {bucket_sql('1d', e)}, COUNT(*), MIN({e}), MAX({e}) FROM {source} WHERE {where} GROUP BY 1"):
+        tally = days.setdefault(day, [0, first, last])
+        tally[0] += rows
+        tally[1], tally[2] = min(tally[1], first), max(tally[2], last)
+    device = STATS_TABLES[table]
+    if device:
+        for key, rows, last in conn.execute(
+                f"SELECT {device}, COUNT(*), MAX({e}) FROM {source} WHERE {where} AND {device} IS NOT NULL "
+                f"GROUP BY 1"):
+            tally = devices.setdefault(key, [0, last])
+            tally[0] += rows
+            tally[1] = max(tally[1], last)
+
+
+def reconcile(conn, partitions=None, tables=None) -> Dict:
+    """
+    Recount the catalog from the tables (main and every monthly file) and
+    fix what drifted; ``conn`` is a main-database connection outside a
+    transaction (isolation_level=None). Returns {table: corrected entries}.
+    """
+    from partitions import month_key, schema_name
+
+    create_catalog(conn)
+    today = day_start(time.time())
+    current = month_key()
+    result = {}
+    for table in tables or STATS_TABLES:
+        if not _table_exists(conn, 'main', table):
+            continue
+        months = partitions.keys() if partitions is not None and partitions.partitioned(table) else []
+        days, devices = {}, {}
+        # Closed days need no lock: only retention deletes from them
+        _count(conn, f"main.{table}", table, None, today, days, devices)
+        for key in months:
+            schema = partitions.attach(conn, key)
+            try:
+                if _table_exists(conn, schema, table):
+                    _count(conn, f"{schema}.{table}", table, None, today, days, devices)
+            finally:
+                if key != current:
+                    conn.execute(f"DETACH DATABASE {schema}")
+        # Today's rows and the write itself under the writer lock
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            _count(conn, f"main.{table}", table, today, None, days, devices)
+            if current in months and _table_exists(conn, schema_name(current), table):
+                _count(conn, f"{schema_name(current)}.{table}", table, today, None, days, devices)
+            result[table] = _replace(conn, table, days, devices)
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if current in months and schema_name(current) in {r[1] for r in conn.execute('PRAGMA database_list')}:
+                conn.execute(f"DETACH DATABASE {schema_name(current)}")
+    return result
+
+
+def _replace(conn, table: str, days: Dict, devices: Dict) -> int:
+    """Write recounted tallies; returns how many catalog entries were wrong"""
+    stored_days = {row[0]: list(row[1:]) for row in conn.execute(
+        "SELECT day, rows, first_epoch, last_epoch FROM stats_days WHERE tbl = ?", (table,))}
+    stored_devices = {row[0]: list(row[1:]) for row in conn.execute(
+        "SELECT device, rows, last_epoch FROM stats_devices WHERE tbl = ?", (table,))}
+    drift = (sum(1 for day in set(days) | set(stored_days) if days.get(day) != stored_days.get(day))
+             + sum(1 for key in set(devices) | set(stored_devices)
+                   if devices.get(key) != stored_devices.get(key)))
+    conn.execute("DELETE FROM stats_days WHERE tbl = ?", (table,))
+    conn.executemany("INSERT INTO stats_days (tbl, day, rows, first_epoch, last_epoch) VALUES (?, ?, ?, ?, ?)",
+                     [(table, day, *tally) for day, tally in days.items()])
+    conn.execute("DELETE FROM stats_devices WHERE tbl = ?", (table,))
+    conn.executemany("INSERT INTO stats_devices (tbl, device, rows, last_epoch) VALUES (?, ?, ?, ?)",
+                     [(table, key, *tally) for key, tally in devices.items()])
+    rows = sum(t[0] for t in days.values())
+    first = min((t[1] for t in days.values()), default=None)
+    last = max((t[2] for t in days.values()), default=None)
+    stored = conn.execute("SELECT rows, first_epoch, last_epoch FROM stats_tables WHERE tbl = ?",
+                          (table,)).fetchone()
+    if stored is not None and tuple(stored) != (rows, first, last):
+        drift += 1
+    conn.execute("""
+        INSERT INTO stats_tables (tbl, rows, first_epoch, last_epoch, reconciled_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(tbl) DO UPDATE SET rows = excluded.rows, first_epoch = excluded.first_epoch,
+            last_epoch = excluded.last_epoch, reconciled_at = excluded.reconciled_at
+    """, (table, rows, first, last, datetime.now().isoformat()))
+    return drift
+
+
+def forget(conn, schema: str, table: str):
+    """Subtract an expiring month's ``schema``.``table`` before it is dropped/unlinked"""
+    if table not in STATS_TABLES or not exists(conn):
+        return
+    days, devices = {}, {}
+    _count(conn, f"{schema}.{table}", table, None, None, days, devices)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany("UPDATE stats_days SET rows = rows - ? WHERE tbl = ? AND day = ?",
+                         [(t[0], table, day) for day, t in days.items()])
+        conn.execute("DELETE FROM stats_days WHERE tbl = ? AND rows <= 0", (table,))
+        conn.executemany("UPDATE stats_devices SET rows = rows - ? WHERE tbl = ? AND device = ?",
+                         [(t[0], table, key) for key, t in devices.items()])
+        conn.execute("DELETE FROM stats_devices WHERE tbl = ? AND rows <= 0", (table,))
+        conn.execute("""
+            UPDATE stats_tables SET
+                rows = (SELECT TOTAL(rows) FROM stats_days WHERE tbl = :t),
+                first_epoch = (SELECT MIN(first_epoch) FROM stats_days WHERE tbl = :t),
+                last_epoch = (SELECT MAX(last_epoch) FROM stats_days WHERE tbl = :t)
+            WHERE tbl = :t
+        """, {'t': table})
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+
+if __name__ == '__main__':
+    from partitions import PartitionSet
+
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    path = args[0] if args else config.database_path
+    conn = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+    try:
+        if '--reconcile' in sys.argv:
+            print(f"📊 Corrected: {reconcile(conn, PartitionSet.from_config(path))}")
+        for table in STATS_TABLES:
+            if _table_exists(conn, 'main', table):
+                print(f"  {table:<14} {table_stats(conn, table)}")
+    finally:
+        conn.close()
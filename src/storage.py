@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+"""
+Solar Monitor Storage Writer
+Batched, single-transaction writes for the collection cycle.
+
+Author: Barry Solomon
+Copyright (c) 2025 Barry Solomon
+Licensed under the MIT License - see LICENSE file for details
+
+A collection cycle produces one site-level sample, one row per inverter and
+(optionally) one weather reading. CycleWriter keeps a single long-lived
+connection and writes all of it inside one BEGIN IMMEDIATE ... COMMIT using
+executemany, so a cycle costs one fsync instead of one per table/row.
+
+WriteBehindBuffer sits in front of the writer: cycles are group-committed
+every N samples or T seconds, kept in memory while the database is locked,
+and spilled to an append-only JSONL journal if SQLite stays unavailable.
+The journal is replayed (before any newer data) on the next flush/startup.
+A cycle that fails for any reason other than a SQLite error (malformed, not
+JSON-serialisable) and an unreadable journal line are moved to a
+dead-letter file (<journal>-dead.jsonl) with the error, instead of being
+retried on every flush ahead of all newer data.
+
+A cycle record is a plain dict (JSON-serialisable so it can be queued):
+
+    {
+        'timestamp': '2025-09-25T12:00:00',
+        'system': {'production_kw': .., 'consumption_kw': .., 'net_export_kw': ..},
+        'devices': [{'device_id': .., 'device_type': 'inverter', 'status': ..,
+                     'power_kw': .., 'voltage': .., 'current_a': ..,
+                     'frequency': .., 'temperature': ..,
+                     'attributes': {'model': .., 'sw_version': .., ...}}, ...],
+        'weather': {... weather_info as built by fetch_weather_data() ...},
+        'raw': [... the DeviceList entries, for the raw archive ...],
+    }
+
+With an ArchiveWriter (raw_archive.py) the cycle's 'raw' snapshot is
+archived in the same transaction as its rows.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from devices import DeviceRegistry
+from json_fields import raw_fields, raw_keys
+from migrations import timestamp_epoch
+from partitions import month_key
+
+# Every row tuple ends with ts_epoch (see migrations.py)
+SITE_SAMPLE_INSERT = """
+    INSERT INTO site_samples (timestamp, production_kw, consumption_kw, net_export_kw, ts_epoch)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# Dictionary-encoded (devices.py; device_data is the decoding view over it);
+# raw_fields feeds the promoted JSON columns (json_fields.py)
+DEVICE_SAMPLE_INSERT = """
+    INSERT INTO device_samples
+    (timestamp, device_key, status_code, power_kw, voltage, current_a, frequency, temperature,
+     raw_fields, ts_epoch)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Takes the text rows of _rows_for (not the encoded ones); replayed/late rows never win
+DEVICE_LATEST_UPSERT = """
+    INSERT INTO device_latest
+    (timestamp, device_id, device_type, status, power_kw, voltage, current_a, frequency,
+     temperature, ts_epoch)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(device_id) DO UPDATE SET
+        timestamp = excluded.timestamp, device_type = excluded.device_type,
+        status = excluded.status, power_kw = excluded.power_kw, voltage = excluded.voltage,
+        current_a = excluded.current_a, frequency = excluded.frequency,
+        temperature = excluded.temperature, ts_epoch = excluded.ts_epoch
+    WHERE device_latest.ts_epoch IS NULL OR excluded.ts_epoch >= device_latest.ts_epoch
+"""
+
+DEVICE_SAMPLE_UPDATE = """
+    UPDATE device_samples
+    SET timestamp = ?, device_key = ?, status_code = ?, power_kw = ?,
+        voltage = ?, current_a = ?, frequency = ?, temperature = ?, raw_fields = ?, ts_epoch = ?
+    WHERE id = ?
+"""
+
+SITE_SAMPLE_UPDATE = """
+    UPDATE site_samples
+    SET timestamp = ?, production_kw = ?, consumption_kw = ?, net_export_kw = ?, ts_epoch = ?
+    WHERE id = ?
+"""
+
+WEATHER_DATA_INSERT = """
+    INSERT INTO weather_data (
+        timestamp, temperature, feels_like, humidity, pressure, visibility, uv_index,
+        clouds, wind_speed, wind_direction, weather_main, weather_description,
+        weather_icon, sunrise, sunset, city, country, api_response, ts_epoch
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+WEATHER_FIELDS = (
+    'temperature', 'feels_like', 'humidity', 'pressure', 'visibility', 'uv_index',
+    'clouds', 'wind_speed', 'wind_direction', 'weather_main', 'weather_description',
+    'weather_icon', 'sunrise', 'sunset', 'city', 'country',
+)
+
+
+def qualify(sql: str, table: str, schema: Optional[str]) -> str:
+    """``sql`` writing to ``schema``.table instead of the main database's table"""
+    if schema is None:
+        return sql
+    return re.sub(rf"\b{table}\b", f"{schema}.{table}", sql, count=1)
+
+
+def make_cycle(timestamp: str, system: Optional[Dict] = None,
+               devices: Optional[List[Dict]] = None, weather: Optional[Dict] = None,
+               raw: Optional[List[Dict]] = None) -> Dict:
+    """Build a cycle record (see module docstring)"""
+    return {
+        'timestamp': timestamp,
+        'system': system,
+        'devices': devices or [],
+        'weather': weather,
+        'raw': raw or [],
+    }
+
+
+class CycleWriter:
+    """One long-lived connection; every call is a single transaction"""
+
+    def __init__(self, db_path: str, compressor=None, partitions=None, archive=None):
+        self.db_path = db_path
+        # Optional compression.DeadbandCompressor for device_samples/site_samples
+        self.compressor = compressor
+        # Optional partitions.PartitionSet: raw tables go to monthly files
+        self.partitions = partitions
+        # Optional raw_archive.ArchiveWriter for the cycles' DeviceList snapshots
+        self.archive = archive
+        self.registry = DeviceRegistry()
+        # DeviceList keys kept in device_samples.raw_fields (PROMOTED_JSON_FIELDS)
+        self.raw_keys = raw_keys()
+        self._schemas = {}
+        self._conn = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'transactions': 0,
+            'cycles': 0,
+            'rows': 0,
+            'write_seconds': 0.0,
+            'last_commit_ms': None,
+            'max_commit_ms': 0.0,
+            'total_commit_ms': 0.0,
+            'errors': 0,
+            'compressed_updates': 0,
+        }
+
+    def connect(self) -> sqlite3.Connection:
+        """Open (once) the writer connection"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10.0, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            # WAL + NORMAL: durable across app crashes, one fsync per checkpoint
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def write_cycle(self, timestamp: str, system: Optional[Dict] = None,
+                    devices: Optional[List[Dict]] = None, weather: Optional[Dict] = None) -> int:
+        """Write one cycle; returns the number of rows inserted"""
+        return self.write_cycles([make_cycle(timestamp, system, devices, weather)])
+
+    def write_cycles(self, cycles: Iterable[Dict]) -> int:
+        """Write any number of cycle records in ONE transaction"""
+        cycles = list(cycles)
+        system_rows, device_rows, weather_rows, attributes, raw = self._rows_for(cycles, self.raw_keys)
+        row_count = len(system_rows) + len(device_rows) + len(weather_rows)
+        snapshots = [(c['timestamp'], c['raw']) for c in cycles
+                     if c.get('raw')] if self.archive is not None else []
+        if not row_count and not snapshots:
+            return 0
+
+        with self._lock:
+            started = time.perf_counter()
+            conn = self.connect()
+            if self.partitions is not None:
+                # ATTACH is not allowed inside the transaction
+                months = {month_key(row[-1]) for row in system_rows + device_rows + weather_rows}
+                self._schemas = self.partitions.attach_for_write(conn, months)
+            session = self.compressor.session() if self.compressor else None
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                encoded_rows = self._encode_devices(conn, device_rows, attributes, raw)
+                if session is not None:
+                    row_count -= self._write_compressed(conn, session, system_rows, encoded_rows)
+                else:
+                    # One row per sample; system_status/solar_data/device_data are views
+                    for sql, rows in self._targets(SITE_SAMPLE_INSERT, 'site_samples', system_rows):
+                        conn.executemany(sql, rows)
+                    for sql, rows in self._targets(DEVICE_SAMPLE_INSERT, 'device_samples',
+                                                   encoded_rows):
+                        conn.executemany(sql, rows)
+                if device_rows:
+                    # Status pages read this instead of scanning device_samples
+                    conn.executemany(DEVICE_LATEST_UPSERT, device_rows)
+                for sql, rows in self._targets(WEATHER_DATA_INSERT, 'weather_data', weather_rows):
+                    conn.executemany(sql, rows)
+                for timestamp, devices in snapshots:
+                    epoch = timestamp_epoch(timestamp)
+                    self.archive.archive(conn, timestamp, int(time.time()) if epoch is None else epoch,
+                                         devices)
+
+                commit_started = time.perf_counter()
+                conn.execute('COMMIT')
+                commit_ms = (time.perf_counter() - commit_started) * 1000
+                if session is not None:
+                    session.commit()
+            except BaseException:
+                # BaseException: a SIGTERM-raised SystemExit must not leave
+                # the connection stuck inside an open transaction
+                self.stats['errors'] += 1
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                # Registrations made in this transaction are gone too
+                self.registry.reset()
+                if self.archive is not None:
+                    self.archive.reset()
+                raise
+
+            self.stats['transactions'] += 1
+            self.stats['cycles'] += len(cycles)
+            self.stats['rows'] += row_count
+            self.stats['write_seconds'] += time.perf_counter() - started
+            self.stats['last_commit_ms'] = commit_ms
+            self.stats['total_commit_ms'] += commit_ms
+            self.stats['max_commit_ms'] = max(self.stats['max_commit_ms'], commit_ms)
+        return row_count
+
+    def _schema_for(self, table: str, row) -> Optional[str]:
+        """Attached partition a row of ``table`` goes to (None: main database)"""
+        if self.partitions is None or not self.partitions.partitioned(table):
+            return None
+        return self._schemas[month_key(row[-1])]
+
+    def _targets(self, sql: str, table: str, rows):
+        """(sql, rows) per destination, SQL qualified with the partition schema"""
+        groups = {}
+        for row in rows:
+            groups.setdefault(self._schema_for(table, row), []).append(row)
+        for schema, group in groups.items():
+            yield qualify(sql, table, schema), group
+
+    def _encode_devices(self, conn, device_rows, attributes, raw) -> List[tuple]:
+        """device_samples rows: device_key/status_code instead of the text columns"""
+        encoded = []
+        for row, attrs, fields in zip(device_rows, attributes, raw):
+            key = self.registry.device_key(conn, row[1], row[2], attrs, row[-1])
+            encoded.append((row[0], key, self.registry.status_code(conn, row[3]))
+                           + row[4:-1] + (fields, row[-1]))
+        return encoded
+
+    def _write_compressed(self, conn, session, system_rows, device_rows) -> int:
+        """site_samples/device_samples through the compressor; returns rows saved"""
+        from compression import DEVICE_FIELDS, SITE_FIELDS
+
+        saved = 0
+        # The partition is part of the run key: a run never spans two files
+        work = []
+        for row in system_rows:
+            schema = self._schema_for('site_samples', row)
+            work.append((('site', None), row, qualify(SITE_SAMPLE_INSERT, 'site_samples', schema),
+                         qualify(SITE_SAMPLE_UPDATE, 'site_samples', schema),
+                         dict(zip(SITE_FIELDS, row[1:4])), schema))
+        for row in device_rows:
+            schema = self._schema_for('device_samples', row)
+            work.append((('device', row[1]), row,
+                         qualify(DEVICE_SAMPLE_INSERT, 'device_samples', schema),
+                         qualify(DEVICE_SAMPLE_UPDATE, 'device_samples', schema),
+                         dict(zip(DEVICE_FIELDS, row[3:8])),
+                         (row[2],) if schema is None else (row[2], schema)))
+
+        for series_key, row, insert_sql, update_sql, values, key in work:
+            action, row_id = session.feed(series_key, row[0], values, key)
+            if action == 'update':
+                if conn.execute(update_sql, row + (row_id,)).rowcount:
+                    self.stats['compressed_updates'] += 1
+                    saved += 1
+                    continue
+                # Tail row was deleted underneath us (cleanup): insert instead
+                action = 'insert'
+            row_id = conn.execute(insert_sql, row).lastrowid
+            if action == 'insert':
+                session.bind(series_key, row_id)
+        return saved
+
+    @staticmethod
+    def _rows_for(cycles: List[Dict], keys: Sequence[str] = ()):
+        system_rows, device_rows, weather_rows, attributes, raw = [], [], [], [], []
+        for cycle in cycles:
+            timestamp = cycle['timestamp']
+            epoch = timestamp_epoch(timestamp)
+            # Collectors name a device by its DEVICE_ID or its SERIAL
+            snapshot = {ident: d for d in (cycle.get('raw') or [] if keys else [])
+                        for ident in (d.get('SERIAL'), d.get('DEVICE_ID')) if ident}
+            system = cycle.get('system')
+            if system:
+                system_rows.append((timestamp, system['production_kw'],
+                                    system['consumption_kw'], system['net_export_kw'], epoch))
+            for row in cycle.get('devices') or []:
+                device_rows.append((timestamp, row['device_id'], row.get('device_type', 'inverter'),
+                                    row['status'], row['power_kw'], row['voltage'],
+                                    row['current_a'], row['frequency'], row['temperature'], epoch))
+                attributes.append(row.get('attributes'))
+                raw.append(raw_fields(snapshot.get(row['device_id']), keys))
+            weather = cycle.get('weather')
+            if weather:
+                weather_rows.append((timestamp,) + tuple(weather.get(f) for f in WEATHER_FIELDS)
+                                    + (json.dumps(weather), epoch))
+        return system_rows, device_rows, weather_rows, attributes, raw
+
+    def get_stats(self) -> Dict:
+        """Write counters including rows/sec and commit latency"""
+        stats = dict(self.stats)
+        stats['rows_per_sec'] = (stats['rows'] / stats['write_seconds']
+                                 if stats['write_seconds'] else None)
+        stats['avg_commit_ms'] = (stats['total_commit_ms'] / stats['transactions']
+                                  if stats['transactions'] else None)
+        if self.archive is not None:
+            stats['raw_archive'] = dict(self.archive.stats)
+        return stats
+
+
+class WriteBehindBuffer:
+    """Bounded group-commit buffer with a crash-safe spill journal"""
+
+    def __init__(self, writer: CycleWriter, journal_path: str, max_samples: int = 1,
+                 max_seconds: float = 60.0, capacity: int = 500, spill_after_failures: int = 3,
+                 dead_letter_path: str = ''):
+        self.writer = writer
+        self.journal_path = journal_path
+        self.dead_letter_path = dead_letter_path or f"{os.path.splitext(journal_path)[0]}-dead.jsonl"
+        self.max_samples = max(1, max_samples)
+        self.max_seconds = max_seconds
+        self.capacity = max(self.max_samples, capacity)
+        self.spill_after_failures = spill_after_failures
+
+        self._pending: List[Dict] = []
+        self._oldest = None  # monotonic time of the oldest pending cycle
+        self._failures = 0
+        # RLock: flush() is reached both from add() and from close()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._flusher = None
+        self._closed = False
+        self.stats = {
+            'added': 0,
+            'flushes': 0,
+            'flushed_cycles': 0,
+            'deferred_flushes': 0,
+            'spilled_cycles': 0,
+            'replayed_cycles': 0,
+            'corrupt_journal_lines': 0,
+            'dead_letter_cycles': 0,
+            'last_error': None,
+        }
+
+    @classmethod
+    def from_config(cls, writer: CycleWriter) -> 'WriteBehindBuffer':
+        """Buffer configured from WRITE_BUFFER_* / WRITE_JOURNAL_PATH"""
+        from config import config
+        return cls(writer,
+                   config.write_journal_path or f"{writer.db_path}-ingest.jsonl",
+                   max_samples=config.write_buffer_max_samples,
+                   max_seconds=config.write_buffer_max_seconds,
+                   capacity=config.write_buffer_capacity)
+
+    # ------------------------------------------------------------------
+    # Ingest
+    # ------------------------------------------------------------------
+    def add(self, cycle: Dict) -> int:
+        """Buffer one cycle; returns rows written if this triggered a commit"""
+        return self.add_many([cycle])
+
+    def add_many(self, cycles: Iterable[Dict]) -> int:
+        with self._lock:
+            for cycle in cycles:
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                self._pending.append(cycle)
+                self.stats['added'] += 1
+            if self._closed:
+                # A straggler after close(): nothing will flush it later
+                rows = self.flush()
+                self.spill()
+                return rows
+            if self._due():
+                return self.flush()
+        return 0
+
+    def _due(self) -> bool:
+        if not self._pending:
+            return False
+        return (len(self._pending) >= self.max_samples
+                or time.monotonic() - self._oldest >= self.max_seconds)
+
+    def flush(self) -> int:
+        """Commit journal + pending cycles; on SQLite errors keep them buffered"""
+        with self._lock:
+            rows = 0
+            try:
+                if self.journal_size():
+                    rows += self._replay_journal()
+                if self._pending:
+                    count = len(self._pending)
+                    # Consumes _pending as cycles are written or dead-lettered
+                    rows += self._write(self._pending)
+                    self.stats['flushes'] += 1
+                    self.stats['flushed_cycles'] += count
+                    self._oldest = None
+                self._failures = 0
+            except sqlite3.Error as e:
+                # "database is locked" & co: nothing is lost, retry next time
+                self._failures += 1
+                self.stats['deferred_flushes'] += 1
+                self.stats['last_error'] = str(e)
+                print(f"⚠️  Write deferred ({len(self._pending)} cycle(s) buffered): {e}")
+                if (len(self._pending) >= self.capacity
+                        or self._failures >= self.spill_after_failures):
+                    self.spill()
+            return rows
+
+    def _write(self, cycles: List[Dict]) -> int:
+        """
+        Write ``cycles`` in one transaction, removing them from the list.
+        If that fails for any reason but a SQLite error, one of them is bad:
+        write them one by one and dead-letter the ones that fail. SQLite
+        errors propagate with the unwritten cycles still in the list.
+        """
+        try:
+            rows = self.writer.write_cycles(cycles)
+            del cycles[:]
+            return rows
+        except sqlite3.Error:
+            raise
+        except Exception:
+            pass
+        rows = 0
+        while cycles:
+            try:
+                rows += self.writer.write_cycles(cycles[:1])
+            except sqlite3.Error:
+                raise
+            except Exception as e:
+                self._dead_letter(e, cycle=cycles[0])
+            del cycles[0]
+        return rows
+
+    def _dead_letter(self, error: Exception, **entry):
+        """Append one unwritable cycle (or journal line) to the dead-letter file"""
+        self.stats['dead_letter_cycles'] += 1
+        self.stats['last_error'] = f"{type(error).__name__}: {error}"
+        entry = dict(entry, error=self.stats['last_error'], failed_at=datetime.now().isoformat())
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, separators=(',', ':'), default=repr) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        print(f"❌ Cycle moved to {self.dead_letter_path}: {self.stats['last_error']}")
+
+    # ------------------------------------------------------------------
+    # Journal
+    # ------------------------------------------------------------------
+    def spill(self) -> int:
+        """Append every pending cycle to the journal and fsync it"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            lines = []
+            for cycle in self._pending:
+                try:
+                    lines.append(json.dumps(cycle, separators=(',', ':')) + '\n')
+                except (TypeError, ValueError) as e:
+                    self._dead_letter(e, cycle=cycle)
+            self._write_journal(lines, 'a')
+            self._pending = []
+            self._oldest = None
+            self.stats['spilled_cycles'] += len(lines)
+            print(f"📝 Spilled {len(lines)} cycle(s) to {self.journal_path}")
+            return len(lines)
+
+    def _write_journal(self, lines: List[str], mode: str):
+        if not lines and mode == 'a':
+            return
+        path = self.journal_path if mode == 'a' else f"{self.journal_path}.tmp"
+        with open(path, mode, encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode != 'a':
+            os.replace(path, self.journal_path)
+
+    def journal_size(self) -> int:
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def replay_journal(self) -> int:
+        """Startup hook: write any spilled cycles back into SQLite"""
+        with self._lock:
+            if not self.journal_size():
+                return 0
+            try:
+                return self._replay_journal()
+            except sqlite3.Error as e:
+                self.stats['last_error'] = str(e)
+                print(f"⚠️  Journal replay deferred: {e}")
+                return 0
+
+    def _replay_journal(self) -> int:
+        cycles, corrupt = [], 0
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    cycles.append(json.loads(line))
+                except ValueError as e:
+                    # A torn final line from a crash mid-append
+                    corrupt += 1
+                    self.stats['corrupt_journal_lines'] += 1
+                    self._dead_letter(e, line=line)
+        count = len(cycles)
+        # One transaction, then drop the file: a crash in between can only
+        # replay the journal twice, never lose it
+        try:
+            rows = self._write(cycles) if cycles else 0
+        except sqlite3.Error:
+            if len(cycles) < count or corrupt:
+                # Keep only what is still unwritten journaled
+                self._write_journal([json.dumps(c, separators=(',', ':')) + '\n' for c in cycles], 'w')
+            raise
+        os.remove(self.journal_path)
+        self.stats['replayed_cycles'] += count
+        print(f"♻️  Replayed {count} journaled cycle(s) ({rows} rows)")
+        return rows
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+    def start(self, poll_seconds: float = 1.0):
+        """Background thread that enforces the T-seconds flush deadline"""
+        if self._flusher is None:
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, args=(poll_seconds,),
+                                             name='write-behind-flusher', daemon=True)
+            self._flusher.start()
+        return self
+
+    def _flush_loop(self, poll_seconds: float):
+        while not self._stop.wait(poll_seconds):
+            with self._lock:
+                if self._due() or (self._pending and self._failures):
+                    self.flush()
+
+    def close(self) -> int:
+        """Flush what we can; anything SQLite will not take goes to the journal
+
+        Returns the cycles still pending afterwards, which should be none.
+        """
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+            self._flusher = None
+        with self._lock:
+            self._closed = True
+            self.flush()
+            self.spill()
+            if self._pending:
+                print(f"❌ {len(self._pending)} cycle(s) neither written nor journaled at close")
+            return len(self._pending)
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats['pending'] = len(self._pending)
+        stats['journal_bytes'] = self.journal_size()
+        return stats
@@ -920,12 +920,15 @@ LIMIT 25;`
             try {
                 const response = await fetch('/api/db/backup', { method: 'POST' });
                 
-                if (response.ok) {
+                const type = response.headers.get('Content-Type') || '';
+                if (response.ok && !type.includes('application/json')) {
                     const blob = await response.blob();
                     const url = window.URL.createObjectURL(blob);
                     const a = document.createElement('a');
+                    const disposition = response.headers.get('Content-Disposition') || '';
+                    const match = disposition.match(/filename=([^;]+)/);
                     a.href = url;
-                    a.download = `solar_monitor_backup_${new Date().toISOString().split('T')[0]}.db`;
+                    a.download = match ? match[1] : `solar_monitor_backup_${new Date().toISOString().split('T')[0]}.db.gz`;
                     document.body.appendChild(a);
                     a.click();
                     window.URL.revokeObjectURL(url);
@@ -3403,9 +3406,12 @@ def db_health_check():
         
         cursor = conn.cursor()
         
-        # Check database integrity
-        cursor.execute('PRAGMA integrity_check')
-        integrity = cursor.fetchone()[0]
+        # Latest scheduled check (maintenance.py) instead of a scan per request
+        import maintenance
+        check = maintenance.integrity(conn)
+        if check is None:
+            maintenance.run_in_background(DATABASE_PATH, jobs=['quick_check'])
+        integrity = check['result'] if check else 'not checked yet'
         
         # Check fragmentation (page count vs file size)
         cursor.execute('PRAGMA page_count')
@@ -3427,8 +3433,10 @@ def db_health_check():
         
         return jsonify({
             'success': True,
-            'status': 'Healthy' if integrity == 'ok' else 'Issues Detected',
+            'status': ('Healthy' if integrity == 'ok' else
+                       'Not Checked Yet' if check is None else 'Issues Detected'),
             'integrity': integrity,
+            'integrity_checked_at': check['last_run'] if check else None,
             'fragmentation': fragmentation,
             'page_count': page_count,
             'freelist_count': freelist_count,
@@ -3547,23 +3555,16 @@ def cleanup_old_data():
 def optimize_database():
     try:
         import os
+        # Checkpoint, PRAGMA optimize and incremental_vacuum in short steps:
+        # the collector keeps writing (no full VACUUM under the request)
+        import maintenance
         
         # Get size before optimization
         size_before = os.path.getsize(DATABASE_PATH)
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'success': False, 'error': 'Database connection failed'})
-        
-        cursor = conn.cursor()
-        
-        # Run VACUUM to optimize database
-        cursor.execute('VACUUM')
-        
-        # Update statistics
-        cursor.execute('ANALYZE')
-        
-        conn.close()
+        report = maintenance.MaintenanceRunner.from_config(DATABASE_PATH).run()
+        if report['state'] == 'failed':
+            return jsonify({'success': False, 'error': report.get('error', 'Optimization failed')})
         
         # Get size after optimization
         size_after = os.path.getsize(DATABASE_PATH)
@@ -3573,7 +3574,8 @@ def optimize_database():
             'success': True,
             'size_before': f"{size_before / (1024*1024):.2f} MB",
             'size_after': f"{size_after / (1024*1024):.2f} MB",
-            'space_saved': f"{space_saved / (1024*1024):.2f} MB" if space_saved > 0 else "0 MB"
+            'space_saved': f"{space_saved / (1024*1024):.2f} MB" if space_saved > 0 else "0 MB",
+            'jobs': report['jobs']
         })
         
     except Exception as e:
@@ -3582,21 +3584,19 @@ def optimize_database():
 @app.route('/api/db/backup', methods=['POST'])
 def create_database_backup():
     try:
-        import shutil
-        import tempfile
-        
-        # Create temporary backup file
-        backup_filename = f"solar_monitor_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            shutil.copy2(DATABASE_PATH, temp_file.name)
-            
-            # Return file for download
-            return app.response_class(
-                open(temp_file.name, 'rb').read(),
-                mimetype='application/octet-stream',
-                headers={'Content-Disposition': f'attachment; filename={backup_filename}'}
-            )
+        # Backup API copy (consistent while the collector writes), streamed gzip
+        import backup
+        
+        manager = backup.BackupManager.from_config(DATABASE_PATH)
+        report = manager.run()
+        if report['state'] != 'done':
+            return jsonify({'success': False, 'error': report.get('error', 'Backup failed')})
+        
+        return app.response_class(
+            manager.stream_set(report['name']),
+            mimetype='application/gzip',
+            headers={'Content-Disposition': f"attachment; filename={manager.download_name(report['name'])}"}
+        )
             
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})